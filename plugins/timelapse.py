@@ -47,7 +47,7 @@ from odemis.gui.plugin import Plugin, AcquisitionDialog
 
 class TimelapsePlugin(Plugin):
     name = "Timelapse"
-    __version__ = "1.0"
+    __version__ = "1.1"
     __author__ = "Éric Piel"
     __license__ = "Public domain"
 
@@ -126,7 +126,8 @@ class TimelapsePlugin(Plugin):
 
         dlg = AcquisitionDialog(self, "Timelapse acquisition",
                                 "The same stream will be acquired multiple times, defined by the 'number of acquisitions'.\n"
-                                "The time separating each acquisition is defined by the 'period'.\n")
+                                "The time separating each acquisition is defined by the 'period'.\n"
+                                "Each acquisition is saved in a separate file, numbered after the filename.\n")
         dlg.addSettings(self, self.vaconf)
         dlg.addStream(st)
         dlg.addButton("Cancel")
@@ -151,34 +152,63 @@ class TimelapsePlugin(Plugin):
                 sacqt, p
             )
 
+        # Each acquisition is saved in a separate file, in the background, so
+        # that the disk (and compression) speed doesn't delay the next acquisition.
         exporter = dataio.find_fittest_converter(self.filename.value)
+        fn_pattern = self._get_filename_pattern(self.filename.value, exporter)
+        export_queue = dataio.ExportQueue()
 
         f = model.ProgressiveFuture()
         f.task_canceller = lambda l: True  # To allow cancelling while it's running
         f.set_running_or_notify_cancel()  # Indicate the work is starting now
         dlg.showProgress(f)
 
-        das = []
-        for i in range(nb):
-            left = nb - i
-            dur = sacqt * left + intp * (left - 1)
-            startt = time.time()
-            f.set_progress(end=startt + dur)
-            d, e = acq.acquire([self._stream]).result()
-            das.extend(d)
-            if f.cancelled():
-                return
-
-            # Wait the period requested, excepted the last time
-            if left > 1:
-                sleept = (startt + p) - time.time()
-                if sleept > 0:
-                    time.sleep(sleept)
-                else:
-                    logging.info("Immediately starting next acquisition, %g s late", -sleept)
-
-        exporter.export(self.filename.value, das)
+        export_fs = []
+        try:
+            for i in range(nb):
+                left = nb - i
+                dur = sacqt * left + intp * (left - 1)
+                startt = time.time()
+                f.set_progress(end=startt + dur)
+                d, e = acq.acquire([self._stream]).result()
+                if d:
+                    ef = export_queue.export(fn_pattern % (i + 1,), d, exporter=exporter)
+                    export_fs.append(ef)
+                if f.cancelled():
+                    return
+
+                # Wait the period requested, excepted the last time
+                if left > 1:
+                    sleept = (startt + p) - time.time()
+                    if sleept > 0:
+                        time.sleep(sleept)
+                    else:
+                        logging.info("Immediately starting next acquisition, %g s late", -sleept)
+        finally:
+            # Wait for all the data to be saved
+            export_queue.shutdown(wait=True)
+
+        for ef in export_fs:
+            if ef.exception() is not None:
+                logging.error("Failed to save an acquisition: %s", ef.exception())
+
         f.set_result(None)  # Indicate it's over
 
         # self.showAcquisition(self.filename.value)
         dlg.Destroy()
+
+    def _get_filename_pattern(self, filename, exporter):
+        """
+        filename (unicode): the filename given by the user
+        exporter (module): the dataio converter
+        return (unicode): filename with a "%05d" to be replaced by the
+          acquisition number
+        """
+        # Don't use os.path.splitext(), to handle extensions like ".ome.tiff"
+        for ext in exporter.EXTENSIONS:
+            if filename.endswith(ext):
+                basename = filename[:-len(ext)]
+                break
+        else:
+            basename, ext = os.path.splitext(filename)
+        return basename + u"-%05d" + ext
@@ -19,19 +19,18 @@ select spot mode, and pick the point you're interested.
 from __future__ import division
 
 from collections import OrderedDict
-from concurrent.futures._base import CancelledError, CANCELLED, FINISHED, RUNNING
+from concurrent.futures._base import CancelledError
 import logging
 import math
-import numpy
 from odemis import dataio, model, acq
 from odemis.acq import stream
+from odemis.acq.stream import MonochromatorScanStream
 import odemis.gui
 from odemis.gui.conf import get_acqui_conf
 from odemis.gui.model import TOOL_SPOT
 from odemis.util import units
 import os
 import sys
-import threading
 import time
 import wx
 
@@ -41,194 +40,6 @@ from odemis.gui.plugin import Plugin, AcquisitionDialog
 logging.getLogger().setLevel(logging.INFO)  # put "DEBUG" level for more messages
 
 
-class MonochromatorScanStream(stream.Stream):
-    """
-    Stream that allows to acquire a spectrum by scanning the wavelength of a
-    spectrograph and acquiring with a monochromator
-    """
-
-    def __init__(self, name, detector, emitter, spectrograph):
-        """
-        name (string): user-friendly name of this stream
-        detector (Detector): the monochromator
-        emitter (Emitter): the emitter (eg: ebeam scanner)
-        spectrograph (Actuator): the spectrograph
-        """
-        self.name = model.StringVA(name)
-
-        # Hardware Components
-        self._detector = detector
-        self._emitter = emitter
-        self._sgr = spectrograph
-
-        wlr = spectrograph.axes["wavelength"].range
-        self.startWavelength = model.FloatContinuous(400e-9, wlr, unit="m")
-        self.endWavelength = model.FloatContinuous(500e-9, wlr, unit="m")
-        self.numberOfPixels = model.IntContinuous(51, (2, 1000), unit="px")
-        # TODO: could be a local attribute?
-        self.dwellTime = model.FloatContinuous(1e-3, range=self._emitter.dwellTime.range,
-                                               unit="s")
-        self.emtTranslation = model.TupleContinuous((0, 0),
-                                                    range=self._emitter.translation.range,
-                                                    cls=(int, long, float),
-                                                    unit="px")
-
-        # For acquisition
-        self._pt_acq = threading.Event()
-        self._acq_thread = None
-        self._data = []
-        self._md = {}
-
-    def estimateAcquisitionTime(self):
-        """
-        Estimate the time it will take to put through the overlay procedure
-
-        returns (float): approximate time in seconds that overlay will take
-        """
-        nbp = self.numberOfPixels.value
-        dt = self.dwellTime.value
-        return nbp * (dt + 0.05)  # 50 ms to change wavelength
-
-    def acquire(self):
-        """
-        Runs the acquisition
-        returns Future that will have as a result a DataArray with the spectrum
-        """
-        est_start = time.time() + 0.1
-        f = model.ProgressiveFuture(start=est_start,
-                                    end=est_start + self.estimateAcquisitionTime())
-        f.task_canceller = self._cancelAcquisition
-        f._acq_state = RUNNING
-        f._acq_lock = threading.Lock()
-        f._acq_done = threading.Event()
-
-        # run task in separate thread
-        self._acq_thread = threading.Thread(target=acq._futures.executeTask,
-                                            name="Monochromator scan acquisition",
-                                            args=(f, self._runAcquisition, f))
-        self._acq_thread.start()
-        return f
-
-    def _on_mchr_data(self, df, data):
-        if not self._md:
-            self._md = data.metadata.copy()
-        if data.shape != (1, 1):
-            logging.error("Monochromator scan got %s values for just one point", data.shape)
-        self._data.append(data[0, 0])
-        self._pt_acq.set()
-
-    def _runAcquisition(self, future):
-        self._data = []
-        self._md = {}
-
-        wls = self.startWavelength.value
-        wle = self.endWavelength.value
-        res = self.numberOfPixels.value
-        dt = self.dwellTime.value
-        trig = self._detector.softwareTrigger
-        df = self._detector.data
-
-        # Prepare the hardware
-        self._emitter.resolution.value = (1, 1)  # Force one pixel only
-        self._emitter.translation.value = self.emtTranslation.value
-        self._emitter.dwellTime.value = dt
-
-        df.synchronizedOn(trig)
-        df.subscribe(self._on_mchr_data)
-
-        wllist = []
-        if wle == wls:
-            res = 1
-
-        if res <= 1:
-            res = 1
-            wli = 0
-        else:
-            wli = (wle - wls) / (res - 1)
-
-        try:
-            for i in range(res):
-                left = (res - i) * (dt + 0.05)
-                future.set_progress(end=time.time() + left)
-
-                cwl = wls + i * wli  # requested value
-                self._sgr.moveAbs({"wavelength": cwl}).result()
-                if future._acq_state == CANCELLED:
-                    raise CancelledError()
-                cwl = self._sgr.position.value["wavelength"]  # actual value
-                logging.info("Acquiring point %d/%d @ %s", i + 1, res,
-                             units.readable_str(cwl, unit="m", sig=3))
-
-                self._pt_acq.clear()
-                trig.notify()
-                if not self._pt_acq.wait(dt * 5 + 1):
-                    raise IOError("Timeout waiting for the data")
-                if future._acq_state == CANCELLED:
-                    raise CancelledError()
-                wllist.append(cwl)
-
-            # Done
-            df.unsubscribe(self._on_mchr_data)
-            df.synchronizedOn(None)
-
-            # Convert the sequence of data into one spectrum in a DataArray
-
-            if wls > wle:  # went backward? => sort back the spectrum
-                logging.debug("Inversing spectrum as acquisition went from %g to %g m", wls, wls)
-                self._data.reverse()
-                wllist.reverse()
-
-            na = numpy.array(self._data)  # keeps the dtype
-            na.shape += (1, 1, 1, 1)  # make it 5th dim to indicate a channel
-            md = self._md
-            md[model.MD_WL_LIST] = wllist
-            if model.MD_OUT_WL in md:
-                # The MD_OUT_WL on the monochromator contains the current cw, which we don't want
-                del md[model.MD_OUT_WL]
-
-            # MD_POS should already be at the correct position (from the e-beam metadata)
-
-            # MD_PIXEL_SIZE is not meaningful but handy for the display in Odemis
-            # (it's the size of the square on top of the SEM survey => BIG!)
-            sempxs = self._emitter.pixelSize.value
-            md[model.MD_PIXEL_SIZE] = (sempxs[0] * 50, sempxs[1] * 50)
-
-            spec = model.DataArray(na, md)
-
-            with future._acq_lock:
-                if future._acq_state == CANCELLED:
-                    raise CancelledError()
-                future._acq_state = FINISHED
-
-            return [spec]
-
-        except CancelledError:
-            raise  # Just don't log the exception
-        except Exception:
-            logging.exception("Failure during monochromator scan")
-        finally:
-            # In case it was stopped before the end
-            df.unsubscribe(self._on_mchr_data)
-            df.synchronizedOn(None)
-
-            future._acq_done.set()
-
-    def _cancelAcquisition(self, future):
-        with future._acq_lock:
-            if future._acq_state == FINISHED:
-                return False  # too late
-            future._acq_state = CANCELLED
-
-        logging.debug("Cancelling acquisition of components %s and %s",
-                      self._emitter.name, self._detector.name)
-
-        self._pt_acq.set()  # To help end quickly
-
-        # Wait for the thread to be complete (and hardware state restored)
-        future._acq_done.wait(5)
-        return True
-
-
 def acquire_spec(wls, wle, res, dt, filename):
     """
     wls (float): start wavelength in m
@@ -353,7 +164,7 @@ def main(args):
 # Plugin version for the GUI
 class MonoScanPlugin(Plugin):
     name = "Monochromator Scan"
-    __version__ = "1.1"
+    __version__ = "1.2"
     __author__ = "Éric Piel"
     __license__ = "GNU General Public License 2"
 
@@ -374,6 +185,10 @@ class MonoScanPlugin(Plugin):
             "range": (1e-9, 10),
             "scale": "log",
         }),
+        ("sweep", {
+            "tooltip": "Move the wavelength continuously during the acquisition, "
+                       "if the spectrograph allows it",
+        }),
         ("filename", {
             "control_type": odemis.gui.CONTROL_SAVE_FILE,
         }),
@@ -409,6 +224,7 @@ class MonoScanPlugin(Plugin):
         self.endWavelength = self._mchr_s.endWavelength
         self.numberOfPixels = self._mchr_s.numberOfPixels
         self.dwellTime = self._mchr_s.dwellTime
+        self.sweep = self._mchr_s.sweep
 
         self.filename = model.StringVA("a.h5")
         self.expectedDuration = model.VigilantAttribute(1, unit="s", readonly=True)
@@ -416,6 +232,9 @@ class MonoScanPlugin(Plugin):
         # Update the expected duration when values change
         self.dwellTime.subscribe(self._update_exp_dur)
         self.numberOfPixels.subscribe(self._update_exp_dur)
+        self.startWavelength.subscribe(self._update_exp_dur)
+        self.endWavelength.subscribe(self._update_exp_dur)
+        self.sweep.subscribe(self._update_exp_dur)
 
     def _update_exp_dur(self, _=None):
         """
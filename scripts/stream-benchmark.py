@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Created on 19 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent, Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
+
+This is a script to measure the performance of the acquisition pipeline, from
+the driver up to the RGB image of the stream, typically on a simulated
+microscope. For each scenario, it reports the frame rate, the duration and
+latency of each stage, and the memory usage. The output is in JSON, so that it's
+easy to compare the performance between releases.
+
+run as:
+./scripts/stream-benchmark.py --config install/linux/usr/share/odemis/sim/secom-sim.odm.yaml --output secom.json
+
+--config indicates the microscope file to start the back-end with. If not
+         provided, the back-end must be already running.
+--scenario selects the scenarios to run (by default, all the ones which are
+         possible with the microscope)
+--duration defines how long each live scenario runs
+--output indicates the name of the JSON file. If not provided, it's printed.
+
+The scenarios are:
+ * sem-live: SEMStream playing
+ * ccd-live: BrightfieldStream playing
+ * sem-spectrum: acquisition of a SEMSpectrumMDStream
+ * sem-ar: acquisition of a SEMARMDStream
+
+The stages measured for the live scenarios are:
+ * receive: time between the acquisition (MD_ACQ_DATE) and the reception of the
+   data by the stream. It includes the driver notification and the transport.
+ * on_new_data: duration of Stream._onNewData()
+ * histogram: duration of Stream._updateHistogram()
+ * projection: duration of Stream._updateImage(), which computes the RGB image
+ * display: time between the acquisition and the RGB image available
+'''
+
+from __future__ import division
+
+import argparse
+import json
+import logging
+import numpy
+from odemis import model, acq
+import odemis
+from odemis.acq import stream
+from odemis.util import driver, test
+import resource
+import sys
+import time
+
+
+logging.getLogger().setLevel(logging.INFO) # put "DEBUG" level for more messages
+
+SCENARIOS = ("sem-live", "ccd-live", "sem-spectrum", "sem-ar")
+
+# Roles of the components needed by each scenario
+SCENARIO_ROLES = {
+    "sem-live": ("e-beam", "se-detector"),
+    "ccd-live": ("ccd", "light"),
+    "sem-spectrum": ("e-beam", "se-detector", "spectrometer"),
+    "sem-ar": ("e-beam", "se-detector", "ccd"),
+}
+
+
+class StageTimer(object):
+    """
+    Records the durations of one stage of the pipeline
+    """
+
+    def __init__(self):
+        self.durations = []
+
+    def add(self, d):
+        self.durations.append(d)
+
+    def summary(self):
+        """
+        return (dict str -> value): statistics of the durations, in s
+        """
+        if not self.durations:
+            return {"count": 0}
+
+        d = numpy.array(self.durations)
+        return {"count": len(d),
+                "mean": float(d.mean()),
+                "median": float(numpy.median(d)),
+                "p95": float(numpy.percentile(d, 95)),
+                "max": float(d.max()),
+                }
+
+
+def get_memory_usage():
+    """
+    return (dict str -> int): current and maximum memory used by this process, in bytes
+    """
+    mem = {}
+    try:
+        with open("/proc/self/status") as f:
+            for l in f:
+                if l.startswith("VmRSS:"):
+                    mem["rss"] = int(l.split()[1]) * 1024
+                elif l.startswith("VmHWM:"):
+                    mem["rss_max"] = int(l.split()[1]) * 1024
+    except IOError:
+        # Not on Linux => only the maximum is available
+        mem["rss_max"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return mem
+
+
+def instrument_stream(s):
+    """
+    Wraps the methods of the stream corresponding to each stage of the pipeline,
+    in order to measure them.
+    Must be called before the stream is activated.
+    s (Stream): the stream to instrument
+    return (dict str -> StageTimer): the timers for each stage
+    """
+    timers = {"receive": StageTimer(),
+              "on_new_data": StageTimer(),
+              "histogram": StageTimer(),
+              "projection": StageTimer(),
+              "display": StageTimer()}
+
+    orig_onNewData = s._onNewData
+    orig_updateHistogram = s._updateHistogram
+    orig_updateImage = s._updateImage
+
+    # The wrappers are stored on the instance, so they are used instead of the
+    # methods of the class by the dataflow and the threads of the stream.
+    def _onNewData(df, data):
+        tstart = time.time()
+        try:
+            timers["receive"].add(tstart - data.metadata[model.MD_ACQ_DATE])
+        except (AttributeError, KeyError):
+            pass
+        orig_onNewData(df, data)
+        timers["on_new_data"].add(time.time() - tstart)
+
+    def _updateHistogram(*args, **kwargs):
+        tstart = time.time()
+        orig_updateHistogram(*args, **kwargs)
+        timers["histogram"].add(time.time() - tstart)
+
+    def _updateImage(*args, **kwargs):
+        tstart = time.time()
+        orig_updateImage(*args, **kwargs)
+        tend = time.time()
+        timers["projection"].add(tend - tstart)
+        im = s.image.value
+        try:
+            timers["display"].add(tend - im.metadata[model.MD_ACQ_DATE])
+        except (AttributeError, KeyError):
+            pass
+
+    s._onNewData = _onNewData
+    s._updateHistogram = _updateHistogram
+    s._updateImage = _updateImage
+
+    return timers
+
+
+def run_live(s, duration):
+    """
+    Plays a stream for a given time, and measures its performance
+    s (LiveStream): the stream to run
+    duration (0 < float): time to play the stream, in s
+    return (dict): the results
+    """
+    timers = instrument_stream(s)
+
+    s.should_update.value = True
+    tstart = time.time()
+    s.is_active.value = True
+    time.sleep(duration)
+    s.is_active.value = False
+    dur = time.time() - tstart
+    s.should_update.value = False
+    time.sleep(0.5)  # Let the last image be projected
+
+    nreceived = timers["on_new_data"].summary()["count"]
+    nprojected = timers["projection"].summary()["count"]
+    return {"duration": dur,
+            "frames_received": nreceived,
+            "frames_displayed": nprojected,
+            # The image is updated at most at 10 Hz, so the extra frames are dropped
+            "frames_dropped": max(0, nreceived - nprojected),
+            "fps": nreceived / dur,
+            "shape": list(s.raw[0].shape) if s.raw else None,
+            "stages": {n: t.summary() for n, t in timers.items()},
+            }
+
+
+def run_acquisition(s):
+    """
+    Acquires a stream, and measures its performance
+    s (Stream): the stream to acquire
+    return (dict): the results
+    """
+    est_dur = acq.estimateTime([s])
+    tstart = time.time()
+    f = acq.acquire([s])
+    data, exp = f.result()
+    dur = time.time() - tstart
+    if exp:
+        raise exp
+
+    return {"duration": dur,
+            "estimated_duration": est_dur,
+            "overhead": dur - est_dur,
+            "data_size": sum(d.nbytes for d in data),
+            "shapes": [list(d.shape) for d in data],
+            }
+
+
+def run_scenario(name, duration, repetition):
+    """
+    Runs one scenario
+    name (str): one of the SCENARIOS
+    duration (0 < float): duration of the live scenarios
+    repetition (int, int): repetition of the acquisition scenarios
+    return (dict): the results
+    """
+    comps = {r: model.getComponent(role=r) for r in SCENARIO_ROLES[name]}
+
+    if name == "sem-live":
+        s = stream.SEMStream("SEM live", comps["se-detector"],
+                             comps["se-detector"].data, comps["e-beam"])
+        return run_live(s, duration)
+    elif name == "ccd-live":
+        s = stream.BrightfieldStream("CCD live", comps["ccd"], comps["ccd"].data,
+                                     comps["light"])
+        return run_live(s, duration)
+    elif name in ("sem-spectrum", "sem-ar"):
+        sems = stream.SEMStream("SEM", comps["se-detector"],
+                                comps["se-detector"].data, comps["e-beam"])
+        if name == "sem-spectrum":
+            det = comps["spectrometer"]
+            reps = stream.SpectrumSettingsStream("Spectrum", det, det.data, comps["e-beam"])
+            s = stream.SEMSpectrumMDStream("SEM Spectrum", sems, reps)
+        else:
+            det = comps["ccd"]
+            reps = stream.ARSettingsStream("AR", det, det.data, comps["e-beam"])
+            s = stream.SEMARMDStream("SEM AR", sems, reps)
+        reps.repetition.value = repetition
+        return run_acquisition(s)
+    else:
+        raise ValueError("Unknown scenario %s" % (name,))
+
+
+def run_benchmark(scenarios, duration, repetition):
+    """
+    Runs all the given scenarios
+    return (dict): the results
+    """
+    results = {"version": odemis.__version__,
+               "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "microscope": model.getMicroscope().name,
+               "scenarios": {},
+               }
+
+    for sn in scenarios:
+        try:
+            for r in SCENARIO_ROLES[sn]:
+                model.getComponent(role=r)
+        except LookupError:
+            logging.info("Skipping scenario %s, as component %s is not available", sn, r)
+            results["scenarios"][sn] = {"skipped": "no %s component" % (r,)}
+            continue
+
+        logging.info("Running scenario %s", sn)
+        try:
+            res = run_scenario(sn, duration, repetition)
+        except Exception as ex:
+            logging.exception("Failed to run scenario %s", sn)
+            res = {"error": str(ex)}
+        res["memory"] = get_memory_usage()
+        results["scenarios"][sn] = res
+
+    return results
+
+
+def main(args):
+    """
+    Handles the command line arguments
+    args is the list of arguments passed
+    return (int): value to return to the OS as program exit code
+    """
+
+    # arguments handling
+    parser = argparse.ArgumentParser(description=
+                     "Benchmark of the acquisition pipeline")
+
+    parser.add_argument("--config", "-c", dest="config",
+                        help="microscope file to start the back-end with. "
+                             "If not provided, the back-end must be running.")
+    parser.add_argument("--scenario", "-s", dest="scenarios", action="append",
+                        choices=SCENARIOS,
+                        help="scenario to run (can be used multiple times). "
+                             "Default is to run all of them.")
+    parser.add_argument("--duration", "-d", dest="duration", type=float, default=10,
+                        help="time to run each live scenario (in s)")
+    parser.add_argument("--repetition", "-r", dest="repetition", type=int, nargs=2,
+                        default=(10, 10), metavar=("X", "Y"),
+                        help="repetition for the acquisition scenarios")
+    parser.add_argument("--output", "-o", dest="filename",
+                        help="name of the JSON file output")
+
+    options = parser.parse_args(args[1:])
+
+    backend_started = False
+    try:
+        if options.config:
+            test.start_backend(options.config)
+            backend_started = True
+        elif driver.get_backend_status() != driver.BACKEND_RUNNING:
+            raise IOError("Back-end is not running, and no config given")
+
+        results = run_benchmark(options.scenarios or SCENARIOS, options.duration,
+                                tuple(options.repetition))
+        results["config"] = options.config
+
+        out = json.dumps(results, indent=2, sort_keys=True)
+        if options.filename:
+            with open(options.filename, "w") as f:
+                f.write(out)
+        else:
+            print out
+    except KeyboardInterrupt:
+        logging.info("Interrupted before the end of the execution")
+        return 1
+    except LookupError as ex:
+        logging.error("%s", ex)
+        return 128
+    except Exception:
+        logging.exception("Unexpected error while performing action.")
+        return 127
+    finally:
+        if backend_started:
+            test.stop_backend()
+
+    return 0
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    logging.shutdown()
+    exit(ret)
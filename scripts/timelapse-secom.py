@@ -71,8 +71,9 @@ def acquire_timelapse(num, period, filename):
 
     acq_streams = [stem, stfm, stovl]
     
-    # Prepare to save each acquisition in a separate file
+    # Prepare to save each acquisition in a separate file, in the background
     exporter = dataio.find_fittest_converter(filename)
+    export_queue = dataio.ExportQueue()
     basename, ext = os.path.splitext(filename)
     fn_pattern = basename + "%04d" + ext
 
@@ -102,7 +103,7 @@ def acquire_timelapse(num, period, filename):
 
             # Save the file
             if data:
-                exporter.export(fn_pattern % (i,), data)
+                export_queue.export(fn_pattern % (i,), data, exporter=exporter)
 
             # TODO: run autofocus from time to time?
 
@@ -122,6 +123,9 @@ def acquire_timelapse(num, period, filename):
     except Exception:
         logging.exception("Failed to acquire all the images.")
         raise
+    finally:
+        # Wait for all the data to be saved
+        export_queue.shutdown(wait=True)
 
     fpos.close()
 
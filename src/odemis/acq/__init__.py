@@ -37,6 +37,7 @@ from odemis.acq import _futures
 from odemis.acq.stream import FluoStream, SEMCCDMDStream, \
     OverlayStream, OpticalStream, EMStream, SEMMDStream
 from odemis.util import img, fluo
+import Queue
 import sys
 import threading
 import time
@@ -53,6 +54,7 @@ import time
 # returns a special "ProgressiveFuture" which is a Future object that can be
 # stopped while already running, and reports from time to time progress on its
 # execution.
+# The streams which use independent hardware are acquired simultaneously.
 def acquire(streams):
     """ Start an acquisition task for the given streams.
 
@@ -91,13 +93,16 @@ def estimateTime(streams):
     streams (list of Stream): the streams to acquire
     return (0 <= float): estimated time in s.
     """
-    tot_time = 0
     # We don't use mergeStreams() as it creates new streams at every call, and
     # anyway sum of each stream should give already a good estimation.
-    for s in streams:
-        tot_time += s.estimateAcquisitionTime()
+    streams = sorted(streams, key=_weight_stream, reverse=True)
+    stream_times = {s: s.estimateAcquisitionTime() for s in streams}
+    if len(streams) <= 1:
+        return sum(stream_times.values())
 
-    return tot_time
+    # Some streams might be acquired simultaneously
+    conflicts = _getConflicts(streams)
+    return _estimateScheduleTime(streams, stream_times, conflicts)
 
 def computeThumbnail(streamTree, acqTask):
     """
@@ -126,7 +131,7 @@ def computeThumbnail(streamTree, acqTask):
         logging.warning("No stream found in the stream tree")
         return None
 
-    iim = streams[0].image.value
+    iim = streams[0].getFullImage()
     # add some basic info to the image
     iim.metadata[model.MD_DESCRIPTION] = "Composited image preview"
     return iim
@@ -169,6 +174,155 @@ def _weight_stream(stream):
         return 0
 
 
+# microscope name, affected_by graph: cache of _getAffectedByGraph()
+_affected_by_cache = (None, None)
+
+
+def _getAffectedByGraph():
+    """
+    Computes which components affect each component, according to the .affects
+    of the components of the microscope.
+    return (dict str -> set of str): for each component name, the names of all
+      the components which affect it, directly or indirectly. If the back-end
+      is not available, it is empty.
+    """
+    global _affected_by_cache
+    try:
+        mic_name = model.getMicroscope().name
+        if _affected_by_cache[0] == mic_name:
+            return _affected_by_cache[1]
+
+        affects = {}
+        for c in model.getComponents():
+            try:
+                affects[c.name] = set(c.affects.value)
+            except AttributeError:  # Not a HwComponent
+                affects[c.name] = set()
+    except Exception:
+        logging.debug("Failed to read the affects of the components, will not use them", exc_info=True)
+        return {}
+
+    affected_by = {}
+    for n, direct in affects.items():
+        # Look for every component reached (via the affects) from n
+        reached = set()
+        todo = list(direct)
+        while todo:
+            a = todo.pop()
+            if a in reached:
+                continue
+            reached.add(a)
+            todo.extend(affects.get(a, ()))
+        for a in reached:
+            affected_by.setdefault(a, set()).add(n)
+
+    _affected_by_cache = (mic_name, affected_by)
+    return affected_by
+
+
+def _getStreamComponents(stream):
+    """
+    Lists the hardware components used by a stream (and its sub-streams)
+    stream (Stream)
+    return (None or set of str): the names of the components, or None if it
+      cannot be found out.
+    """
+    if not hasattr(stream, "acquire"):
+        return None  # Old style stream, don't know what it does
+
+    comps = set()
+    for s in [stream] + list(getattr(stream, "_streams", [])):
+        for v in vars(s).values():
+            if isinstance(v, model.ComponentBase):
+                comps.add(v.name)
+
+    if not comps:
+        return None
+    return comps
+
+
+def _getConflicts(streams):
+    """
+    Finds which streams cannot be acquired at the same time.
+    Two streams are in conflict if they use the same component, if one uses a
+    component which affects a component of the other (ex: the e-beam affects the
+    CCD, in case of cathodoluminescence), or if both need the optical path manager.
+    Streams for which the components cannot be found are in conflict with all
+    the other streams.
+    streams (list of Streams)
+    return (dict Stream -> set of Streams): for each stream, the streams it is
+      in conflict with
+    """
+    affected_by = _getAffectedByGraph()
+
+    # For each stream: the components it uses, and all the components which
+    # would affect its acquisition
+    used = {}
+    sensitive = {}
+    for s in streams:
+        comps = _getStreamComponents(s)
+        used[s] = comps
+        if comps is not None:
+            sensitive[s] = comps.union(*(affected_by.get(c, set()) for c in comps))
+
+    conflicts = {s: set() for s in streams}
+    for i, s1 in enumerate(streams):
+        for s2 in streams[i + 1:]:
+            if (used[s1] is None or used[s2] is None or
+                (getattr(s1, "_opm", None) is not None and
+                 getattr(s2, "_opm", None) is not None) or
+                used[s1] & sensitive[s2] or used[s2] & sensitive[s1]):
+                conflicts[s1].add(s2)
+                conflicts[s2].add(s1)
+
+    return conflicts
+
+
+def _getStartableStreams(pending, running, conflicts):
+    """
+    Selects the streams which can be started now. To respect the priority of
+    the streams, a stream cannot be started before a stream in conflict which
+    is earlier in the list.
+    pending (list of Streams): the streams not yet started, in order of priority
+    running (set of Streams): the streams currently being acquired
+    conflicts (dict Stream -> set of Streams): see _getConflicts()
+    return (list of Streams): the streams which can be started
+    """
+    startable = []
+    for i, s in enumerate(pending):
+        if conflicts[s] & running:
+            continue
+        if any(o in conflicts[s] for o in pending[:i]):
+            continue
+        startable.append(s)
+        running = running | {s}
+    return startable
+
+
+def _estimateScheduleTime(streams, stream_times, conflicts):
+    """
+    Simulates the acquisition of the streams, running simultaneously the
+    streams not in conflict.
+    streams (list of Streams): the streams, in order of priority
+    stream_times (dict Stream -> float): the estimated time of each stream
+    conflicts (dict Stream -> set of Streams): see _getConflicts()
+    return (0 <= float): total estimated time in s
+    """
+    t = 0
+    pending = list(streams)
+    running = {}  # Stream -> end time
+    while pending or running:
+        for s in _getStartableStreams(pending, set(running.keys()), conflicts):
+            running[s] = t + stream_times[s]
+            pending.remove(s)
+
+        # Skip to the end of the first stream finished
+        s = min(running, key=running.get)
+        t = running.pop(s)
+
+    return t
+
+
 class AcquisitionTask(object):
 
     def __init__(self, streams, future, opm=None):
@@ -183,9 +337,14 @@ class AcquisitionTask(object):
         for s in streams:
             self._streamTimes[s] = s.estimateAcquisitionTime()
 
-        self._streams_left = set(self._streams) # just for progress update
-        self._current_stream = None
-        self._current_future = None
+        # Which streams must not be acquired simultaneously
+        self._conflicts = _getConflicts(self._streams)
+
+        self._streams_left = list(self._streams) # not yet started, in order
+        self._current_futures = {}  # Future -> Stream: acquisitions running
+        self._future_ends = {}  # Future -> float: expected end of the running acquisitions
+        self._done_futures = Queue.Queue()  # Futures finished
+        self._lock = threading.Lock()  # to protect the current futures
         self._cancelled = False
 
     def run(self):
@@ -198,48 +357,56 @@ class AcquisitionTask(object):
             Exception: if it failed before any result were acquired
         """
         exp = None
-        assert(self._current_stream is None) # Task should be used only once
-        expected_time = sum(self._streamTimes.values())
+        assert(not self._current_futures) # Task should be used only once
+        expected_time = _estimateScheduleTime(self._streams, self._streamTimes,
+                                              self._conflicts)
         # no need to set the start time of the future: it's automatically done
         # when setting its state to running.
         self._future.set_progress(end=time.time() + expected_time)
 
         raw_images = {} # stream -> list of raw images
         try:
-            for s in self._streams:
-
-                # Get the future of the acquisition, depending on the Stream type
-                if hasattr(s, "acquire"):
-                    f = s.acquire()
-                else: # fall-back to old style stream
-                    f = _futures.wrapSimpleStreamIntoFuture(s)
-                self._current_future = f
-                self._current_stream = s
-                self._streams_left.discard(s)
-
-                # in case acquisition was cancelled, before the future was set
-                if self._cancelled:
-                    f.cancel()
-                    raise CancelledError()
-
-                # If it's a ProgressiveFuture, listen to the time update
-                try:
-                    f.add_update_callback(self._on_progress_update)
-                except AttributeError:
-                    pass # not a ProgressiveFuture, fine
-
-                # Wait for the acquisition to be finished.
+            while self._streams_left or self._current_futures:
+                # Start all the acquisitions which can run now (unless an
+                # acquisition already failed)
+                if exp is None:
+                    running = set(self._current_futures.values())
+                    for s in _getStartableStreams(self._streams_left, running,
+                                                  self._conflicts):
+                        self._start_stream(s)
+
+                # Wait for (at least) one acquisition to be finished.
                 # Will pass down exceptions, included in case it's cancelled
-                raw_images[s] = f.result()
+                f = self._done_futures.get()
+                with self._lock:
+                    s = self._current_futures.pop(f)
+                    self._future_ends.pop(f, None)
+                try:
+                    raw_images[s] = f.result()
+                except CancelledError:
+                    raise
+                except Exception as e:
+                    # Don't start new acquisitions, but let the ones running
+                    # finish, as their results are still useful
+                    logging.warning("Acquisition of stream %s failed: %s", s.name.value, e)
+                    if exp is None:
+                        exp = e
+                    self._streams_left = []
+                    continue
 
                 # update the time left
-                expected_time -= self._streamTimes[s]
-                self._future.set_progress(end=time.time() + expected_time)
+                self._update_progress()
+
+            if exp is not None:
+                raise exp
 
             # Update metadata using OverlayStream (if there was one)
             self._adjust_metadata(raw_images)
 
         except CancelledError:
+            # Stop the other acquisitions still running
+            for f in self._current_futures.keys():
+                f.cancel()
             raise
         except Exception as e:
             # If no acquisition yet => just raise the exception,
@@ -251,9 +418,10 @@ class AcquisitionTask(object):
             # Don't hold references to the streams once it's over
             self._streams = []
             self._streamTimes = {}
-            self._streams_left.clear()
-            self._current_stream = None
-            self._current_future = None
+            self._streams_left = []
+            with self._lock:
+                self._current_futures = {}
+                self._future_ends = {}
 
         # merge all the raw data (= list of DataArrays) into one long list
         ret = sum(raw_images.values(), [])
@@ -295,18 +463,62 @@ class AcquisitionTask(object):
                 if model.MD_DESCRIPTION not in d.metadata:
                     d.metadata[model.MD_DESCRIPTION] = s.name.value
 
+    def _start_stream(self, s):
+        """
+        Starts the acquisition of a stream
+        s (Stream): the stream to acquire, in ._streams_left
+        """
+        # Get the future of the acquisition, depending on the Stream type
+        if hasattr(s, "acquire"):
+            f = s.acquire()
+        else: # fall-back to old style stream
+            f = _futures.wrapSimpleStreamIntoFuture(s)
+        with self._lock:
+            self._current_futures[f] = s
+            self._future_ends[f] = time.time() + self._streamTimes[s]
+        self._streams_left.remove(s)
+
+        # in case acquisition was cancelled, before the future was set
+        if self._cancelled:
+            f.cancel()
+            raise CancelledError()
+
+        # If it's a ProgressiveFuture, listen to the time update
+        try:
+            f.add_update_callback(self._on_progress_update)
+        except AttributeError:
+            pass # not a ProgressiveFuture, fine
+
+        f.add_done_callback(self._done_futures.put)
+
+    def _update_progress(self):
+        """
+        Updates the expected end of the whole acquisition, based on the expected
+        end of the acquisitions running, and the streams left.
+        """
+        with self._lock:
+            ends = self._future_ends.values()
+        left = list(self._streams_left)
+        # Approximation: the streams left start after all the running ones
+        end_running = max(ends + [time.time()])
+        if left:
+            left_time = _estimateScheduleTime(left, self._streamTimes, self._conflicts)
+        else:
+            left_time = 0
+        self._future.set_progress(end=end_running + left_time)
+
     def _on_progress_update(self, f, start, end):
         """
-        Called when the current future has made a progress (and so it should
-        provide a better time estimation).
+        Called when one of the current futures has made a progress (and so it
+        should provide a better time estimation).
         """
-        if self._current_future != f:
-            logging.warning("Progress update not from the current future: %s instead of %s",
-                            f, self._current_future)
-            return
+        with self._lock:
+            if f not in self._current_futures:
+                logging.debug("Progress update not from a current future: %s", f)
+                return
+            self._future_ends[f] = end
 
-        total_end = end + sum(self._streamTimes[s] for s in self._streams_left)
-        self._future.set_progress(end=total_end)
+        self._update_progress()
 
     def cancel(self, future):
         """
@@ -315,10 +527,12 @@ class AcquisitionTask(object):
         # put the cancel flag
         self._cancelled = True
 
-        if self._current_future is not None:
-            cancelled = self._current_future.cancel()
-        else:
-            cancelled = False
+        with self._lock:
+            current_futures = self._current_futures.keys()
+        cancelled = False
+        for f in current_futures:
+            if f.cancel():
+                cancelled = True
 
         # Report it's too late for cancellation (and so result will come)
         if not cancelled and not self._streams_left:
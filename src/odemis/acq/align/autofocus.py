@@ -23,6 +23,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import collections
+from concurrent import futures
 from concurrent.futures._base import CancelledError, CANCELLED, FINISHED, \
     RUNNING
 import logging
@@ -107,6 +108,40 @@ def MeasureOpticalFocus(image):
     return cv2.Laplacian(image, cv2.CV_64F).var()
 
 
+def _EstimatePeakPosition(positions, levels):
+    """
+    Estimates the position of the best focus, by fitting a curve on the focus
+    levels around the maximum. If all the levels are positive, a Gaussian is
+    fitted (ie, a parabola on the logarithm of the levels), otherwise a parabola.
+    positions (list of floats): focus positions, in increasing order
+    levels (list of floats): focus level measured at each position
+    returns (float or None): estimated position of the peak, or None if the peak
+      cannot be estimated (eg, the maximum is on the border of the range)
+    """
+    if len(positions) != len(levels):
+        raise ValueError("Got %d positions but %d levels" % (len(positions), len(levels)))
+    i_max = int(numpy.argmax(levels))
+    if not 0 < i_max < len(levels) - 1:
+        return None
+
+    # Only use the maximum and its direct neighbours, as away from the peak
+    # the focus level quickly drops to the noise level.
+    pos = numpy.asarray(positions[i_max - 1:i_max + 2], dtype=numpy.float64)
+    lvl = numpy.asarray(levels[i_max - 1:i_max + 2], dtype=numpy.float64)
+    if (lvl > 0).all():
+        lvl = numpy.log(lvl)
+
+    # Fit in a coordinate system centred on the maximum, to keep the values
+    # (in m) far from the float precision.
+    a, b, c = numpy.polyfit(pos - pos[1], lvl, 2)
+    if a >= 0:  # Not a peak
+        return None
+    peak = pos[1] - b / (2 * a)
+    if not pos[0] <= peak <= pos[2]:
+        return None
+    return peak
+
+
 def AcquireNoBackground(ccd, dfbkg=None):
     """
     Performs optical acquisition with background subtraction if possible.
@@ -173,6 +208,9 @@ def _DoBinaryFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
     #   even go back to the same focus position when wanted
     logging.debug("Starting Binary Autofocus...")
 
+    # The focus level of an image is measured in a separate thread, while the
+    # focus moves to the next position and acquires the next image.
+    executor = futures.ThreadPoolExecutor(max_workers=1)
     try:
         # use the .depthOfField on detector or emitter as maximum stepsize
         avail_depths = (detector, emt)
@@ -269,9 +307,7 @@ def _DoBinaryFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
                 fm_center = focus_levels[center]
             else:
                 image = AcquireNoBackground(detector, dfbkg)
-                fm_center = Measure(image)
-                logging.debug("Focus level (center) at %f is %f", center, fm_center)
-                focus_levels[center] = fm_center
+                fm_center = executor.submit(Measure, image)
 
             # Move to right position
             right = center + step_factor * min_step
@@ -282,9 +318,7 @@ def _DoBinaryFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
                 focus.moveAbsSync({"z": right})
                 right = focus.position.value["z"]
                 image = AcquireNoBackground(detector, dfbkg)
-                fm_right = Measure(image)
-                logging.debug("Focus level (right) at %f is %f", right, fm_right)
-                focus_levels[right] = fm_right
+                fm_right = executor.submit(Measure, image)
 
             # Move to left position
             left = center - step_factor * min_step
@@ -295,12 +329,21 @@ def _DoBinaryFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
                 focus.moveAbsSync({"z": left})
                 left = focus.position.value["z"]
                 image = AcquireNoBackground(detector, dfbkg)
-                fm_left = Measure(image)
-                logging.debug("Focus level (left) at %f is %f", left, fm_left)
-                focus_levels[left] = fm_left
+                fm_left = executor.submit(Measure, image)
                 last_pos = left
 
-            fm_range = (fm_left, fm_center, fm_right)
+            # Wait for all the measurements
+            fms = []
+            for name, pos, fm in (("left", left, fm_left),
+                                  ("center", center, fm_center),
+                                  ("right", right, fm_right)):
+                if isinstance(fm, futures.Future):
+                    fm = fm.result()
+                    logging.debug("Focus level (%s) at %f is %f", name, pos, fm)
+                    focus_levels[pos] = fm
+                fms.append(fm)
+
+            fm_range = tuple(fms)
             pos_range = (left, center, right)
             best_fm = max(fm_range)
             i_max = fm_range.index(best_fm)
@@ -337,6 +380,7 @@ def _DoBinaryFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
         # Go to the best position known so far
         focus.moveAbsSync({"z": best_pos})
     finally:
+        executor.shutdown(wait=False)
         with future._autofocus_lock:
             if future._autofocus_state == CANCELLED:
                 raise CancelledError()
@@ -349,6 +393,8 @@ def _DoExhaustiveFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focu
     level on each position and ends up where the best focus level was found. In
     case a significant deviation was found while going through the range, it
     stops and limits the search within a smaller range around this position.
+    If the focus levels around the best position allow it, the position of the
+    peak is estimated by curve fitting, to limit even more the final search.
     future (model.ProgressiveFuture): Progressive future provided by the wrapper
     detector: model.DigitalCamera or model.Detector
     emt (None or model.Emitter): In case of a SED this is the scanner used
@@ -367,6 +413,10 @@ def _DoExhaustiveFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focu
     """
     logging.debug("Starting Exhaustive Autofocus...")
 
+    # To compute the focus level while the next image is acquired
+    executor = futures.ThreadPoolExecutor(max_workers=1)
+    focus_levels = {}  # focus pos (float) -> focus level (float), measured so far
+    assessed_levels = []  # list with focus levels measured so far
     try:
         # use the .depthOfField on detector or emitter as maximum stepsize
         avail_depths = (detector, emt)
@@ -404,10 +454,8 @@ def _DoExhaustiveFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focu
         if good_focus:
             focus.moveAbsSync({"z": good_focus})
 
-        focus_levels = []  # list with focus levels measured so far
         best_pos = orig_pos = focus.position.value['z']
-        best_fm = 0
-        logging.debug("Focus level at %f is %f", best_pos, best_fm)
+        logging.debug("Starting exhaustive search at %f", orig_pos)
 
         if future._autofocus_state == CANCELLED:
             raise CancelledError()
@@ -419,55 +467,43 @@ def _DoExhaustiveFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focu
         step = 8 * dof
         lower_bound, upper_bound = rng
         # start moving upwards until we reach the upper bound or we find some
-        # significant deviation in focus level
+        # significant deviation in focus level. If nothing is found, start again
+        # from the original position, going downwards.
         # we know that upper_bound is excluded but: 1. realistically the best focus
         # position would not be there 2. the upper_bound - orig_pos range is not
         # expected to be precisely a multiple of the step anyway
-        for next_pos in numpy.arange(orig_pos, upper_bound, step):
-            focus.moveAbsSync({"z": next_pos})
-            image = AcquireNoBackground(detector, dfbkg)
-            new_fm = Measure(image)
-            focus_levels.append(new_fm)
-            logging.debug("Focus level at %f is %f", next_pos, new_fm)
-            if new_fm >= best_fm:
-                best_fm = new_fm
-                best_pos = next_pos
-            if len(focus_levels) >= 10 and AssessFocus(focus_levels):
-                # trigger binary search on if significant deviation was
-                # found in current position
-                return _DoBinaryFocus(future, detector, emt, focus, dfbkg, best_pos, (best_pos - 2 * step, best_pos + 2 * step))
-
-        if future._autofocus_state == CANCELLED:
-            raise CancelledError()
-
-        # if nothing was found return to original position and start going
-        # downwards
-        focus.moveAbsSync({"z": orig_pos})
-        for next_pos in numpy.arange(orig_pos - step, lower_bound, -step):
-            focus.moveAbsSync({"z": next_pos})
-            image = AcquireNoBackground(detector, dfbkg)
-            new_fm = Measure(image)
-            focus_levels.append(new_fm)
-            logging.debug("Focus level at %f is %f", next_pos, new_fm)
-            if new_fm >= best_fm:
-                best_fm = new_fm
-                best_pos = next_pos
-            if len(focus_levels) >= 10 and AssessFocus(focus_levels):
+        for positions in (numpy.arange(orig_pos, upper_bound, step),
+                          numpy.arange(orig_pos - step, lower_bound, -step)):
+            if _SweepFocus(future, executor, detector, focus, dfbkg, Measure,
+                           positions, focus_levels, assessed_levels):
                 # trigger binary search on if significant deviation was
                 # found in current position
-                return _DoBinaryFocus(future, detector, emt, focus, dfbkg, best_pos, (best_pos - 2 * step, best_pos + 2 * step))
+                break
+        else:
+            logging.debug("No significant focus level was found so far, thus we just use the best position found")
 
         if future._autofocus_state == CANCELLED:
             raise CancelledError()
 
-        logging.debug("No significant focus level was found so far, thus we just move to the best position found %f", best_pos)
-        focus.moveAbsSync({"z": best_pos})
-        return _DoBinaryFocus(future, detector, emt, focus, dfbkg, best_pos, (best_pos - 2 * step, best_pos + 2 * step))
+        if focus_levels:
+            best_pos = max(focus_levels, key=focus_levels.get)
+        # Fit a curve on the focus levels, to start the binary search closer
+        # to the peak, and within a smaller range.
+        all_pos = sorted(focus_levels.keys())
+        peak = _EstimatePeakPosition(all_pos, [focus_levels[p] for p in all_pos])
+        if peak is not None:
+            logging.debug("Focus peak estimated at %f (best measured at %f)", peak, best_pos)
+            return _DoBinaryFocus(future, detector, emt, focus, dfbkg, peak, (peak - step, peak + step))
+        else:
+            return _DoBinaryFocus(future, detector, emt, focus, dfbkg, best_pos, (best_pos - 2 * step, best_pos + 2 * step))
 
     except CancelledError:
         # Go to the best position known so far
+        if focus_levels:
+            best_pos = max(focus_levels, key=focus_levels.get)
         focus.moveAbsSync({"z": best_pos})
     finally:
+        executor.shutdown(wait=False)
         # Only used if for some reason the binary focus is not called (e.g. cancellation)
         with future._autofocus_lock:
             if future._autofocus_state == CANCELLED:
@@ -475,6 +511,61 @@ def _DoExhaustiveFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focu
             future._autofocus_state = FINISHED
 
 
+def _SweepFocus(future, executor, detector, focus, dfbkg, Measure, positions,
+                focus_levels, assessed_levels):
+    """
+    Acquires an image at each focus position, and measures its focus level,
+    until a significant deviation in the focus levels is found. The focus level
+    of each image is computed in the executor, while the focus moves to the
+    next position and the next image is acquired.
+    future (model.ProgressiveFuture): Progressive future provided by the wrapper
+    executor (concurrent.futures.Executor): executor to run the measurements
+    detector: model.DigitalCamera or model.Detector
+    focus (model.Actuator): The optical focus
+    dfbkg (model.DataFlow): dataflow of se- or bs- detector
+    Measure (callable: DataArray -> float): function to compute the focus level
+    positions (iterable of floats): the focus positions, in order
+    focus_levels (dict float -> float): focus position -> focus level. It is
+      updated with all the levels measured.
+    assessed_levels (list of floats): focus levels passed to AssessFocus(). It
+      is updated with all the levels measured.
+    returns (bool): True if a significant deviation was found
+    raises:
+            CancelledError if cancelled
+    """
+    pending = collections.deque()  # (focus position, Future returning the focus level)
+
+    def record_levels(keep):
+        """
+        Wait for the pending measurements until only "keep" are left
+        returns (bool): True if a significant deviation was found
+        """
+        found = False
+        while len(pending) > keep:
+            pos, f = pending.popleft()
+            fm = f.result()
+            logging.debug("Focus level at %f is %f", pos, fm)
+            focus_levels[pos] = fm
+            assessed_levels.append(fm)
+            if len(assessed_levels) >= 10 and AssessFocus(assessed_levels):
+                found = True
+        return found
+
+    for next_pos in positions:
+        if future._autofocus_state == CANCELLED:
+            raise CancelledError()
+        focus.moveAbsSync({"z": next_pos})
+        image = AcquireNoBackground(detector, dfbkg)
+        pending.append((next_pos, executor.submit(Measure, image)))
+        # Check the previous measurement, while the latest one is computed
+        if record_levels(1):
+            # Also get the last level, which is the neighbour of the peak
+            record_levels(0)
+            return True
+
+    return record_levels(0)
+
+
 def _CancelAutoFocus(future):
     """
     Canceller of AutoFocus task.
@@ -27,10 +27,8 @@ import logging
 import math
 from numpy import fft
 from numpy import histogram
-from numpy import unravel_index
 import numpy
 from odemis import model
-import operator
 
 from scipy.spatial import cKDTree
 
@@ -78,72 +76,43 @@ def DivideInNeighborhoods(data, number_of_spots, scale, sensitivity_limit=100):
     # filter window size
     filter_window_size = 8
 
-    # Increase sensitivity until expected number of spots is detected
-    while sensitivity <= sensitivity_limit:
-        subimage_coordinates = []
-        subimages = []
+    # The filter responses do not depend on the sensitivity, so they are only
+    # computed once. Each sensitivity just selects the local maxima which have
+    # a contrast above the threshold.
+    max_diff = image.max() - image.min()
+    data_max = filters.maximum_filter(image, filter_window_size)
+    data_min = filters.minimum_filter(image, filter_window_size)
+    maxima = (image == data_max)
+    contrast = data_max - data_min
+    sorted_contrast = numpy.sort(contrast[maxima])
+    prev_num_maxima = None
+
+    # Number of bright pixels, as an integral image, to check each candidate
+    # subimage without cropping it
+    bright_sum = _IntegralImage(image > spot_factor * avg_intensity)
 
-        i_max, j_max = unravel_index(image.argmax(), image.shape)
-        i_min, j_min = unravel_index(image.argmin(), image.shape)
-        max_diff = image[i_max, j_max] - image[i_min, j_min]
-        data_max = filters.maximum_filter(image, filter_window_size)
-        data_min = filters.minimum_filter(image, filter_window_size)
+    expected_spots = numpy.prod(number_of_spots)
+    clean_subimages, clean_subimage_coordinates = [], []
 
+    # Increase sensitivity until expected number of spots is detected
+    while sensitivity <= sensitivity_limit:
         # Determine threshold
-        i = sensitivity
-        threshold = max_diff / i
-
-        # Filter the parts of the image with variance in intensity greater
-        # than the threshold
-        maxima = (image == data_max)
-        diff = ((data_max - data_min) > threshold)
-        maxima[diff == 0] = 0
-
-        labeled, num_objects = ndimage.label(maxima)
-
-        slices = ndimage.find_objects(labeled)
-
-        (x_center_last, y_center_last) = (-10, -10)
-
-        # Go through these parts and crop the subimages based on the neighborhood_size
-        # value
-        for dy, dx in slices:
-            x_center = (dx.start + dx.stop - 1) / 2
-            y_center = (dy.start + dy.stop - 1) / 2
-
-            # Make sure we don't detect spots on the top of each other
-            tab = tuple(map(operator.sub, (x_center_last, y_center_last),
-                            (x_center, y_center)))
-
-            subimage = image[int(dy.start - 2.5):int(dy.stop + 2.5),
-                             int(dx.start - 2.5):int(dx.stop + 2.5)]
-
-            if subimage.shape[0] == 0 or subimage.shape[1] == 0:
-                continue
-
-            if (subimage > spot_factor * avg_intensity).sum() < 6:
-                continue
-
-            # if spots detected too close keep the brightest one
-            if (len(subimages) > 0) and (math.hypot(tab[0], tab[1]) < (scale / 2)):
-                if numpy.sum(subimage) > numpy.sum(subimages[len(subimages) - 1]):
-                    subimages.pop()
-                    subimage_coordinates.pop()
-                    subimage_coordinates.append((x_center, y_center))
-                    subimages.append(subimage)
-            else:
-                subimage_coordinates.append((x_center, y_center))
-                subimages.append(subimage)
-
-            (x_center_last, y_center_last) = (x_center, y_center)
-
-        # Take care of outliers
-        expected_spots = numpy.prod(number_of_spots)
-        clean_subimages, clean_subimage_coordinates = FilterOutliers(image, subimages,
-                                                                     subimage_coordinates,
-                                                                     expected_spots)
-        if len(clean_subimages) >= numpy.prod(number_of_spots):
-            break
+        threshold = max_diff / sensitivity
+
+        # The thresholds are decreasing, so the maxima selected only grow. If
+        # their number hasn't changed, the result is the same as previously.
+        num_maxima = sorted_contrast.size - numpy.searchsorted(sorted_contrast, threshold, side="right")
+        if num_maxima != prev_num_maxima:
+            prev_num_maxima = num_maxima
+            subimages, subimage_coordinates = _CropNeighborhoods(image, maxima & (contrast > threshold),
+                                                                 bright_sum, scale)
+
+            # Take care of outliers
+            clean_subimages, clean_subimage_coordinates = FilterOutliers(image, subimages,
+                                                                         subimage_coordinates,
+                                                                         expected_spots)
+            if len(clean_subimages) >= expected_spots:
+                break
 
         if sensitivity > 4:
             step = 4
@@ -152,6 +121,79 @@ def DivideInNeighborhoods(data, number_of_spots, scale, sensitivity_limit=100):
     return clean_subimages, clean_subimage_coordinates
 
 
+def _CropNeighborhoods(image, maxima, bright_sum, scale):
+    """
+    Crops the subimages around each group of local maxima
+    image (model.DataArray): 2D array containing the intensity of each pixel
+    maxima (2D ndarray of bool): the local maxima to consider
+    bright_sum (2D ndarray): integral image of the bright pixels (as returned
+      by _IntegralImage())
+    scale (float): Distance between spots in optical grid (in pixels)
+    returns subimages (List of DataArrays): One subimage per spot
+            subimage_coordinates (List of tuples): The coordinates of the center of each
+                                                subimage with respect to the overall image
+    """
+    subimage_coordinates = []
+    subimages = []
+
+    labeled, num_objects = ndimage.label(maxima)
+    slices = ndimage.find_objects(labeled)
+
+    (x_center_last, y_center_last) = (-10, -10)
+
+    # Go through these parts and crop the subimages based on the neighborhood_size
+    # value
+    for dy, dx in slices:
+        x_center = (dx.start + dx.stop - 1) / 2
+        y_center = (dy.start + dy.stop - 1) / 2
+
+        # Make sure we don't detect spots on the top of each other
+        tab = (x_center_last - x_center, y_center_last - y_center)
+
+        # Same boundaries as if the image was sliced
+        t, b, _ = slice(int(dy.start - 2.5), int(dy.stop + 2.5)).indices(image.shape[0])
+        l, r, _ = slice(int(dx.start - 2.5), int(dx.stop + 2.5)).indices(image.shape[1])
+        if b <= t or r <= l:
+            continue
+
+        n_bright = (bright_sum[b, r] - bright_sum[t, r] -
+                    bright_sum[b, l] + bright_sum[t, l])
+        if n_bright < 6:
+            continue
+
+        subimage = image[t:b, l:r]
+
+        # if spots detected too close keep the brightest one
+        if subimages and (math.hypot(tab[0], tab[1]) < (scale / 2)):
+            if numpy.sum(subimage) > numpy.sum(subimages[-1]):
+                subimages[-1] = subimage
+                subimage_coordinates[-1] = (x_center, y_center)
+        else:
+            subimage_coordinates.append((x_center, y_center))
+            subimages.append(subimage)
+
+        (x_center_last, y_center_last) = (x_center, y_center)
+
+    return subimages, subimage_coordinates
+
+
+def _IntegralImage(image):
+    """
+    Computes the integral image (aka summed-area table), which allows to get the
+      sum of any rectangle in constant time.
+    image (2D ndarray): the image
+    returns (2D ndarray of shape+1): the integral image. The sum of the region
+      image[t:b, l:r] is ii[b, r] - ii[t, r] - ii[b, l] + ii[t, l].
+    """
+    if image.dtype.kind in "biu":
+        dtype = numpy.int64
+    else:
+        dtype = numpy.float64
+    ii = numpy.zeros((image.shape[0] + 1, image.shape[1] + 1), dtype=dtype)
+    numpy.cumsum(numpy.cumsum(image, axis=0, dtype=dtype), axis=1, out=ii[1:, 1:])
+    return ii
+
+
 def ReconstructCoordinates(subimage_coordinates, spot_coordinates):
     """
     Given the coordinates of each subimage as also the coordinates of the spot into it,
@@ -184,14 +226,11 @@ def FilterOutliers(image, subimages, subimage_coordinates, expected_spots):
     number_of_subimages = len(subimages)
     clean_subimages = []
     clean_subimage_coordinates = []
-    filtered_subimages = []
-    filtered_subimage_coordinates = []
 
     for i in xrange(number_of_subimages):
         hist, bin_edges = histogram(subimages[i], bins=10)
         # Remove subimage if its histogram implies a cosmic ray
-        hist_list = hist.tolist()
-        if hist_list.count(0) < 6:
+        if numpy.count_nonzero(hist == 0) < 6:
             clean_subimages.append(subimages[i])
             clean_subimage_coordinates.append(subimage_coordinates[i])
 
@@ -208,31 +247,15 @@ def FilterOutliers(image, subimages, subimage_coordinates, expected_spots):
     if (expected_spots >= 4) and (len(clean_subimage_coordinates) > expected_spots):
         points = numpy.array(clean_subimage_coordinates)
         tree = cKDTree(points, 5)
-        distance, index = tree.query(clean_subimage_coordinates, 5)
-        list_distance = numpy.array(distance)
-        avg_1 = numpy.average(list_distance[:, 1])
-        avg_2 = numpy.average(list_distance[:, 2])
-        avg_3 = numpy.average(list_distance[:, 3])
-        avg_4 = numpy.average(list_distance[:, 4])
-        diff_avg_list = numpy.array(list_distance[:, 1:5])
-        for i in xrange(0, len(list_distance), 1):
-            diff_avg = [abs(list_distance[i, 1] - avg_1),
-                        abs(list_distance[i, 2] - avg_2),
-                        abs(list_distance[i, 3] - avg_3),
-                        abs(list_distance[i, 4] - avg_4)]
-            diff_avg_list[i] = diff_avg
-        var_1 = numpy.average(diff_avg_list[:, 0])
-        var_2 = numpy.average(diff_avg_list[:, 1])
-        var_3 = numpy.average(diff_avg_list[:, 2])
-        var_4 = numpy.average(diff_avg_list[:, 3])
-
-        for i in xrange(len(clean_subimage_coordinates)):
-            if (diff_avg_list[i, 0] <= var_1
-                or diff_avg_list[i, 1] <= var_2
-                or diff_avg_list[i, 2] <= var_3
-                or diff_avg_list[i, 3] <= var_4):
-                filtered_subimages.append(clean_subimages[i])
-                filtered_subimage_coordinates.append(clean_subimage_coordinates[i])
+        distance, index = tree.query(points, 5)
+        # Distance to the 4 closest neighbours (the first one is the point itself)
+        diff_avg_list = numpy.abs(distance[:, 1:5] - numpy.average(distance[:, 1:5], axis=0))
+        var = numpy.average(diff_avg_list, axis=0)
+
+        # Keep the points which have at least one "normal" distance
+        keep = numpy.any(diff_avg_list <= var, axis=1)
+        filtered_subimages = list(compress(clean_subimages, keep))
+        filtered_subimage_coordinates = list(compress(clean_subimage_coordinates, keep))
         return filtered_subimages, filtered_subimage_coordinates
 
     return clean_subimages, clean_subimage_coordinates
@@ -261,12 +284,19 @@ def MatchCoordinates(input_coordinates, electron_coordinates, guess_scale, max_a
                         len(input_coordinates))
         return [], []
 
+    # All the computations are done on arrays, and the original lists are
+    # only used to build the result.
+    optical_array = numpy.array(optical_coordinates, dtype=numpy.float64)
+    electron_array = numpy.array(electron_coordinates, dtype=numpy.float64)
+    # The electron coordinates never change, so the same tree can be used at every step
+    electron_tree = cKDTree(electron_array)
+
     # Informed guess
-    guess_coordinates = _TransformCoordinates(optical_coordinates, (0, 0), 0, (guess_scale, guess_scale))
+    guess_coordinates = _TransformArray(optical_array, (0, 0), 0, (guess_scale, guess_scale))
 
     # Overlay center
-    guess_center = numpy.mean(guess_coordinates, 0) - numpy.mean(electron_coordinates, 0)
-    transformed_coordinates = [(c[0] - guess_center[0], c[1] - guess_center[1]) for c in guess_coordinates]
+    guess_center = numpy.mean(guess_coordinates, 0) - numpy.mean(electron_array, 0)
+    transformed_coordinates = guess_coordinates - guess_center
 
     max_wrong_points = math.ceil(0.5 * math.sqrt(len(electron_coordinates)))
     for step in xrange(MAX_STEPS_NUMBER):
@@ -274,30 +304,30 @@ def MatchCoordinates(input_coordinates, electron_coordinates, guess_scale, max_a
         try:
             (estimated_coordinates, index1, e_wrong_points,
              o_wrong_points, total_shift) = _MatchAndCalculate(transformed_coordinates,
-                                                               optical_coordinates,
-                                                               electron_coordinates)
+                                                               optical_array,
+                                                               electron_array,
+                                                               electron_tree)
         except LookupError as ex:
             logging.warning("Failed to get any coordinate match (%s)", ex)
             return [], []
 
         # Calculate successful
-        e_match_points = [not i for i in e_wrong_points]
-        o_match_points = [not i for i in o_wrong_points]
-        e_coord_exp = [estimated_coordinates[i] for i in compress(index1, e_match_points)]
-        e_coord_actual = list(compress(electron_coordinates, e_match_points))
+        e_match_points = ~e_wrong_points
+        o_match_points = ~o_wrong_points
+        e_coord_exp = estimated_coordinates[index1[e_match_points]]
+        e_coord_actual = electron_array[e_match_points]
 
         # Calculate distance between the expected and found electron coordinates
-        coord_diff = []
-        for ta, tb in zip(e_coord_exp, e_coord_actual):
-            coord_diff.append(math.hypot(ta[0] - tb[0], ta[1] - tb[1]))
+        coord_diff = e_coord_exp - e_coord_actual
+        coord_diff = numpy.hypot(coord_diff[:, 0], coord_diff[:, 1])
 
         # Look at the worse distance, not including 5% outliers
-        sort_diff = sorted(coord_diff)
+        sort_diff = numpy.sort(coord_diff)
         outlier_i = max(0, math.trunc(DIFF_NUMBER * len(sort_diff)) - 1)
         max_diff = sort_diff[outlier_i]
 
         if (max_diff < max_allowed_diff
-            and sum(e_wrong_points) <= max_wrong_points
+            and numpy.count_nonzero(e_wrong_points) <= max_wrong_points
             and total_shift <= max_allowed_diff
            ):
             break
@@ -306,16 +336,14 @@ def MatchCoordinates(input_coordinates, electron_coordinates, guess_scale, max_a
     else:
         logging.warning("Cannot find overlay: distance = %f px (> %f px), after %d steps.",
                         max_diff, max_allowed_diff, step + 1)
-        logging.warning("Optical coordinates found: %s", estimated_coordinates)
-        logging.warning("SEM coordinates distances: %s", sort_diff)
+        logging.warning("Optical coordinates found: %s", estimated_coordinates.tolist())
+        logging.warning("SEM coordinates distances: %s", sort_diff.tolist())
         return [], []
 
-    # The ordered list gives for each electron coordinate the corresponding optical coordinates
-    ordered_coordinates_index = zip(index1, electron_coordinates)
-    ordered_coordinates_index.sort()
-    ordered_coordinates = []
-    for i in xrange(len(ordered_coordinates_index)):
-        ordered_coordinates.append(ordered_coordinates_index[i][1])
+    # The ordered list gives for each electron coordinate the corresponding
+    # optical coordinates (sorted by index, and then by coordinates)
+    order = numpy.lexsort((electron_array[:, 1], electron_array[:, 0], index1))
+    ordered_coordinates = [electron_coordinates[i] for i in order]
 
     # Remove unknown coordinates
     known_ordered_coordinates = list(compress(ordered_coordinates, e_match_points))
@@ -326,178 +354,152 @@ def MatchCoordinates(input_coordinates, electron_coordinates, guess_scale, max_a
     return known_ordered_coordinates, known_optical_coordinates
 
 
-def _KNNsearch(x_coordinates, y_coordinates):
+def _TransformCoordinates(x_coordinates, translation, rotation, scale):
     """
-    Applies K-nearest neighbors search to the lists x_coordinates and y_coordinates.
+    Transforms the x_coordinates according to the parameters.
     x_coordinates (List of tuples): List of coordinates
-    y_coordinates (List of tuples): List of coordinates
-    returns (List of integers): Contains the index of nearest neighbor in x_coordinates
-                                for the corresponding element in y_coordinates
+    translation (Tuple of floats): Translation
+    rotation (float): Rotation in rad
+    scale (Tuple of floats): Scaling
+    returns (List of tuples): Transformed coordinates
     """
-    points = numpy.array(x_coordinates)
-    tree = cKDTree(points)
-    distance, index = tree.query(y_coordinates)
-    list_index = numpy.array(index).tolist()
-
-    return list_index
+    coords = numpy.array(x_coordinates, dtype=numpy.float64).reshape(-1, 2)
+    transformed = _TransformArray(coords, translation, rotation, scale)
+    return [tuple(c) for c in transformed.tolist()]
 
 
-def _TransformCoordinates(x_coordinates, translation, rotation, scale):
+def _TransformArray(coordinates, translation, rotation, scale):
     """
-    Transforms the x_coordinates according to the parameters.
-    x_coordinates (List of tuples): List of coordinates
+    Transforms the coordinates according to the parameters.
+    coordinates (ndarray of shape Nx2): coordinates
     translation (Tuple of floats): Translation
     rotation (float): Rotation in rad
     scale (Tuple of floats): Scaling
-    returns (List of tuples): Transformed coordinates
+    returns (ndarray of shape Nx2): Transformed coordinates
     """
-    transformed_coordinates = []
-    for ta in x_coordinates:
-        # translation-scaling-rotation
-        translated = [a + t for a, t in zip(ta, translation)]
-        scaled = [t * s for t, s in zip(translated, scale)]
-        x, y = scaled
-        x_rotated = x * math.cos(-rotation) - y * math.sin(-rotation)
-        y_rotated = x * math.sin(-rotation) + y * math.cos(-rotation)
-        rotated = (x_rotated, y_rotated)
-        transformed_coordinates.append(rotated)
+    # translation-scaling-rotation
+    scaled = (coordinates + translation) * scale
+    x, y = scaled[:, 0], scaled[:, 1]
+    cos_r, sin_r = math.cos(-rotation), math.sin(-rotation)
+    return numpy.column_stack((x * cos_r - y * sin_r,
+                               x * sin_r + y * cos_r))
+
 
-    return transformed_coordinates
+def _WrapAngle(a):
+    """
+    a (ndarray of floats): angles in rad
+    returns (ndarray of floats): same angles, between -Pi and Pi
+    """
+    a = numpy.mod(a, 2 * math.pi)
+    a[a > math.pi] -= 2 * math.pi
+    return a
 
 
-def _MatchAndCalculate(transformed_coordinates, optical_coordinates, electron_coordinates):
+def _MatchAndCalculate(transformed_coordinates, optical_coordinates, electron_coordinates,
+                       electron_tree=None):
     """
     Applies transformation to the optical coordinates in order to match electron coordinates and returns
     the transformed coordinates. This function must be used recursively until the transformed coordinates
     reach the required accuracy.
-    transformed_coordinates (List of tuples): List of transformed coordinates
-    optical_coordinates (List of tuples): List of optical coordinates
-    electron_coordinates (List of tuples): List of electron coordinates
-    returns estimated_coordinates (List of tuples): Estimated optical coordinates
-            index1 (List of integers): Indexes of nearest points in optical with respect to electron
-            e_wrong_points (List of booleans): Electron coordinates that have no proper match
-            o_wrong_points (List of booleans): Optical coordinates that have no proper match
+    transformed_coordinates (ndarray of shape Nx2): transformed coordinates
+    optical_coordinates (ndarray of shape Nx2): optical coordinates
+    electron_coordinates (ndarray of shape Mx2): electron coordinates
+    electron_tree (None or cKDTree): KD-tree of the electron coordinates, to
+      avoid recomputing it at every call
+    returns estimated_coordinates (ndarray of shape Nx2): Estimated optical coordinates
+            index1 (ndarray of M ints): Indexes of nearest points in optical with respect to electron
+            e_wrong_points (ndarray of M bools): Electron coordinates that have no proper match
+            o_wrong_points (ndarray of N bools): Optical coordinates that have no proper match
             total_shift (float): Calculated total shift
     raises LookupError: if no match can be found
     """
-    index1 = _KNNsearch(transformed_coordinates, electron_coordinates)
-    # Sort optical coordinates based on the _KNNsearch output index
-    knn_points1 = [optical_coordinates[i] for i in index1]
+    if electron_tree is None:
+        electron_tree = cKDTree(electron_coordinates)
 
-    index2 = _KNNsearch(electron_coordinates, transformed_coordinates)
-    # Sort electron coordinates based on the _KNNsearch output index
-    knn_points2 = [electron_coordinates[i] for i in index2]
+    # Indexes of the nearest optical point for each electron point, and the opposite
+    index1 = cKDTree(transformed_coordinates).query(electron_coordinates)[1]
+    index2 = electron_tree.query(transformed_coordinates)[1]
+    # Sort optical and electron coordinates based on the nearest neighbour indexes
+    knn_points1 = optical_coordinates[index1]
+    knn_points2 = electron_coordinates[index2]
 
     # Sort index1 based on index2 and the opposite
-    o_index = [index1[i] for i in index2]
-    e_index = [index2[i] for i in index1]
-
-    transformed_range = range(len(transformed_coordinates))
-    electron_range = range(len(electron_coordinates))
+    o_index = index1[index2]
+    e_index = index2[index1]
 
     # Coordinates that have no proper match (optical and electron)
-    o_wrong_points = [i != r for i, r in zip(o_index, transformed_range)]
-    o_match_points = [not i for i in o_wrong_points]
-    e_wrong_points = [i != r for i, r in zip(e_index, electron_range)]
-    e_match_points = [not i for i in e_wrong_points]
+    o_wrong_points = (o_index != numpy.arange(len(transformed_coordinates)))
+    o_match_points = ~o_wrong_points
+    e_wrong_points = (e_index != numpy.arange(len(electron_coordinates)))
+    e_match_points = ~e_wrong_points
 
-    if all(o_wrong_points) or all(e_wrong_points):
+    if o_wrong_points.all() or e_wrong_points.all():
         raise LookupError("Cannot perform matching.")
 
     # Calculate the transform parameters for the correct electron_coordinates
     move1, scale1, rotation1 = transform.CalculateTransform(
-                                           list(compress(electron_coordinates, e_match_points)),
-                                           list(compress(knn_points1, e_match_points)))
+                                           electron_coordinates[e_match_points],
+                                           knn_points1[e_match_points])
 
     # Calculate the transform parameters for the correct optical_coordinates
     move2, scale2, rotation2 = transform.CalculateTransform(
-                                           list(compress(knn_points2, o_match_points)),
-                                           list(compress(optical_coordinates, o_match_points)))
+                                           knn_points2[o_match_points],
+                                           optical_coordinates[o_match_points])
 
     # Average between the two parameters
-    # TODO: use numpy.mean()
-    avg_move = ((move1[0] + move2[0]) / 2, (move1[1] + move2[1]) / 2)
-    avg_scale = ((scale1[0] + scale2[0]) / 2, (scale1[1] + scale2[1]) / 2)
+    avg_move = numpy.mean([move1, move2], axis=0)
+    avg_scale = numpy.mean([scale1, scale2], axis=0)
     avg_rotation = (rotation1 + rotation2) / 2
 
     total_shift = 0
     # Correct for shift if 'too many' points are wrong, with 'too many' defined by:
     threshold = math.ceil(0.5 * math.sqrt(len(electron_coordinates)))
     # If the number of wrong points is above threshold perform corrections
-    if sum(o_wrong_points) > threshold and sum(e_wrong_points) > threshold:
+    if (numpy.count_nonzero(o_wrong_points) > threshold and
+        numpy.count_nonzero(e_wrong_points) > threshold):
         # Shift
-        electron_o_index2 = [electron_coordinates[i] for i in compress(index2, o_wrong_points)]
-        transformed_o_points = list(compress(transformed_coordinates, o_wrong_points))
-        o_wrong_diff = []
-        for ta, tb in zip(electron_o_index2, transformed_o_points):
-            o_wrong_diff.append((ta[0] - tb[0], ta[1] - tb[1]))
-
-        transformed_e_index1 = [transformed_coordinates[i] for i in compress(index1, e_wrong_points)]
-        electron_e_points = list(compress(electron_coordinates, e_wrong_points))
-        e_wrong_diff = []
-        for ta, tb in zip(transformed_e_index1, electron_e_points):
-            e_wrong_diff.append((ta[0] - tb[0], ta[1] - tb[1]))
+        o_wrong_diff = (electron_coordinates[index2[o_wrong_points]] -
+                        transformed_coordinates[o_wrong_points])
+        e_wrong_diff = (transformed_coordinates[index1[e_wrong_points]] -
+                        electron_coordinates[e_wrong_points])
 
         mean_wrong_diff = numpy.mean(e_wrong_diff, 0) - numpy.mean(o_wrong_diff, 0)
-        avg_move = (avg_move[0] - (0.65 * mean_wrong_diff[0]) / avg_scale[0],
-                    avg_move[1] - (0.65 * mean_wrong_diff[1]) / avg_scale[1])
-        total_shift = math.hypot((0.65 * mean_wrong_diff[0]) / avg_scale[0],
-                                 (0.65 * mean_wrong_diff[1]) / avg_scale[1])
+        shift = (0.65 * mean_wrong_diff) / avg_scale
+        avg_move = avg_move - shift
+        total_shift = math.hypot(shift[0], shift[1])
 
         # Angle
         # Calculate angle with respect to its center, therefore move points towards center
-        electron_coordinates_vs_center = []
         mean_electron_coordinates = numpy.mean(electron_coordinates, 0)
-        for ta in electron_coordinates:
-            # translation
-            translated = tuple(map(operator.sub, ta, mean_electron_coordinates))
-            electron_coordinates_vs_center.append(translated)
-
-        transformed_coordinates_vs_center = []
-        for tb in transformed_coordinates:
-            # translation
-            translated = tuple(map(operator.sub, tb, mean_electron_coordinates))
-            transformed_coordinates_vs_center.append(translated)
+        electron_coordinates_vs_center = electron_coordinates - mean_electron_coordinates
+        transformed_coordinates_vs_center = transformed_coordinates - mean_electron_coordinates
 
         # Calculate the angle with its center for every point
-        angle_vect_electron = numpy.arctan2([float(i[0]) for i in electron_coordinates_vs_center], [float(i[1]) for i in electron_coordinates_vs_center])
-        angle_vect_transformed = numpy.arctan2([float(i[0]) for i in transformed_coordinates_vs_center], [float(i[1]) for i in transformed_coordinates_vs_center])
+        angle_vect_electron = numpy.arctan2(electron_coordinates_vs_center[:, 0],
+                                            electron_coordinates_vs_center[:, 1])
+        angle_vect_transformed = numpy.arctan2(transformed_coordinates_vs_center[:, 0],
+                                               transformed_coordinates_vs_center[:, 1])
 
         # Calculate the angle difference for the wrong electron_coordinates
-        angle_vect_transformed_e_index1 = [angle_vect_transformed[i] for i in compress(index1, e_wrong_points)]
-        angle_diff_electron_wrong = []
-        for x, y in zip(compress(angle_vect_electron, e_wrong_points), angle_vect_transformed_e_index1):
-            a = (x - y)
-            # Ensure the angle is between -Pi and Pi
-            a %= (2 * math.pi)
-            if a > math.pi:
-                a -= 2 * math.pi
-            angle_diff_electron_wrong.append(a)
+        angle_diff_electron_wrong = _WrapAngle(angle_vect_electron[e_wrong_points] -
+                                               angle_vect_transformed[index1[e_wrong_points]])
 
         # Calculate the angle difference for the wrong transformed_coordinates
-        angle_vect_electron_o_index2 = [angle_vect_electron[i] for i in compress(index2, o_wrong_points)]
-        angle_diff_transformed_wrong = []
-        for x, y in zip(compress(angle_vect_transformed, o_wrong_points), angle_vect_electron_o_index2):
-            a = (x - y)
-            # Ensure the angle is between -Pi and Pi
-            a %= (2 * math.pi)
-            if a > math.pi:
-                a -= 2 * math.pi
-            angle_diff_transformed_wrong.append(a)
+        angle_diff_transformed_wrong = _WrapAngle(angle_vect_transformed[o_wrong_points] -
+                                                  angle_vect_electron[index2[o_wrong_points]])
 
         # Apply correction
         angle_correction = 0.5 * (numpy.mean(angle_diff_electron_wrong) - numpy.mean(angle_diff_transformed_wrong))
         avg_rotation += angle_correction
 
     # Perform transformation
-    estimated_coordinates = _TransformCoordinates(optical_coordinates, avg_move,
-                                                  avg_rotation,
-                                                  avg_scale)
-    index1 = _KNNsearch(estimated_coordinates, electron_coordinates)
-    index2 = _KNNsearch(electron_coordinates, estimated_coordinates)
-    e_index = [index2[i] for i in index1]
-    e_wrong_points = [i != r for i, r in zip(e_index, electron_range)]
-    if all(e_wrong_points) or index1.count(index1[0]) == len(index1):
+    estimated_coordinates = _TransformArray(optical_coordinates, avg_move,
+                                            avg_rotation, avg_scale)
+    index1 = cKDTree(estimated_coordinates).query(electron_coordinates)[1]
+    index2 = electron_tree.query(estimated_coordinates)[1]
+    e_index = index2[index1]
+    e_wrong_points = (e_index != numpy.arange(len(electron_coordinates)))
+    if e_wrong_points.all() or (index1 == index1[0]).all():
         raise LookupError("Cannot perform matching.")
 
     return estimated_coordinates, index1, e_wrong_points, o_wrong_points, total_shift
@@ -272,7 +272,7 @@ def FindSpot(image, sensitivity_limit=100):
     if subimages == []:
         raise ValueError("No spot detected")
 
-    spot_coordinates = [uspot.FindCenterCoordinates(i) for i in subimages]
+    spot_coordinates = uspot.FindSubCenterCoordinates(subimages)
     optical_coordinates = coordinates.ReconstructCoordinates(subimage_coordinates, spot_coordinates)
 
     # Too many spots detected
@@ -21,6 +21,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 '''
 from concurrent.futures._base import CancelledError
 import logging
+import numpy
 from odemis import model
 import odemis
 from odemis.acq import align
@@ -118,6 +119,45 @@ class TestAutofocus(unittest.TestCase):
         self.assertAlmostEqual(foc_pos, self._opt_good_focus, 3)
         self.assertGreater(foc_lev, 0)
 
+    @timeout(1000)
+    def test_autofocus_overlap(self):
+        """
+        Test AutoFocus on CCD measures the focus level of an image while the
+        focus moves to the next position
+        """
+        measures = []  # (start, end) of each focus level measurement
+        orig_measure = autofocus.MeasureOpticalFocus
+        def slow_measure(image):
+            tstart = time.time()
+            time.sleep(0.2)  # Long enough to always overlap with the move
+            fm = orig_measure(image)
+            measures.append((tstart, time.time()))
+            return fm
+
+        moves = []  # time of each update of the focus position
+        def on_position(pos):
+            moves.append(time.time())
+
+        focus = self.focus
+        ccd = self.ccd
+        focus.moveAbs({"z": self._opt_good_focus - 400e-6}).result()
+        ccd.exposureTime.value = ccd.exposureTime.range[0]
+        autofocus.MeasureOpticalFocus = slow_measure
+        focus.position.subscribe(on_position)
+        try:
+            future_focus = align.AutoFocus(ccd, self.ebeam, focus)
+            foc_pos, foc_lev = future_focus.result(timeout=900)
+        finally:
+            focus.position.unsubscribe(on_position)
+            autofocus.MeasureOpticalFocus = orig_measure
+
+        self.assertAlmostEqual(foc_pos, self._opt_good_focus, 3)
+        self.assertGreater(foc_lev, 0)
+        self.assertGreater(len(measures), 0)
+        # The focus moved while some images were being measured
+        overlapped = [t for t in moves if any(s < t < e for s, e in measures)]
+        self.assertGreater(len(overlapped), 0)
+
     @timeout(1000)
     def test_autofocus_sem(self):
         """
@@ -145,6 +185,36 @@ class TestAutofocus(unittest.TestCase):
         self.assertGreater(foc_lev, 0)
 
 
+class TestEstimatePeak(unittest.TestCase):
+    """
+    Test the estimation of the focus peak by curve fitting
+    """
+
+    def test_gaussian(self):
+        pos = numpy.arange(-50e-6, 50e-6, 8e-6) + 1.3e-3
+        for peak in (1.3e-3, 1.3031e-3, 1.2987e-3):
+            levels = 1000 * numpy.exp(-(pos - peak) ** 2 / (2 * 10e-6 ** 2))
+            epeak = autofocus._EstimatePeakPosition(list(pos), list(levels))
+            self.assertAlmostEqual(epeak, peak, 9)
+
+    def test_noisy(self):
+        numpy.random.seed(0)
+        pos = numpy.arange(-50e-6, 50e-6, 8e-6)
+        peak = 3e-6
+        levels = 1000 * numpy.exp(-(pos - peak) ** 2 / (2 * 10e-6 ** 2))
+        levels += numpy.random.uniform(0, 10, levels.shape)
+        epeak = autofocus._EstimatePeakPosition(list(pos), list(levels))
+        # At least better than just taking the best position
+        best_pos = pos[numpy.argmax(levels)]
+        self.assertLessEqual(abs(epeak - peak), abs(best_pos - peak))
+
+    def test_no_peak(self):
+        # Maximum on the border
+        self.assertIsNone(autofocus._EstimatePeakPosition([0, 1, 2], [3, 2, 1]))
+        # Flat
+        self.assertIsNone(autofocus._EstimatePeakPosition([0, 1, 2], [1, 1, 1]))
+
+
 class TestAutofocusSpectrometer(unittest.TestCase):
     """
     Test autofocus spectrometer function
@@ -25,11 +25,13 @@ from numpy import random
 import numpy
 from numpy.random import shuffle
 from numpy.random import uniform
+from odemis import model
 from odemis.acq.align import coordinates
 from odemis.acq.align import transform
 from odemis.dataio import hdf5
 from odemis.util import spot
 import operator
+import time
 import unittest
 
 
@@ -374,5 +376,62 @@ class TestMatchCoordinates(unittest.TestCase):
         if known_estimated_coordinates != []:
             numpy.testing.assert_equal(known_estimated_coordinates.__len__(), electron_coordinates.__len__() - 1)
             
+
+def _generate_grid(shape, dist, sigma=2.5, intensity=1000, noise=20):
+    """
+    Generates a synthetic optical image of a grid of Gaussian spots
+    shape (int, int): number of spots in X and Y
+    dist (int): distance between spots (in px)
+    returns (model.DataArray of uint16): the image, with a border of 1.5 dist
+      around the grid
+    """
+    size = (shape[1] * dist + 2 * dist, shape[0] * dist + 2 * dist)
+    img = numpy.zeros(size, dtype=numpy.float64)
+    yy, xx = numpy.mgrid[-10:10, -10:10]
+    for i in xrange(shape[1]):
+        for j in xrange(shape[0]):
+            cy = int(dist * 1.5 + i * dist)
+            cx = int(dist * 1.5 + j * dist)
+            dy, dx = uniform(-1, 1), uniform(-1, 1)
+            spot = intensity * numpy.exp(-((yy - dy) ** 2 + (xx - dx) ** 2) / (2 * sigma ** 2))
+            img[cy - 10:cy + 10, cx - 10:cx + 10] += spot
+    img += random.normal(100, noise, size)
+    return model.DataArray(img.astype(numpy.uint16))
+
+
+class TestSyntheticGrid(unittest.TestCase):
+    """
+    Test the whole spot detection and matching on big synthetic grids
+    """
+    def setUp(self):
+        random.seed(0)
+
+    def test_divide_and_match_speed(self):
+        """
+        Check that big grids are correctly detected and matched in a reasonable time
+        """
+        for n in (10, 20):
+            optical_image = _generate_grid((n, n), 40)
+
+            tstart = time.time()
+            subimages, subimage_coordinates = coordinates.DivideInNeighborhoods(optical_image, (n, n), 40)
+            dur_divide = time.time() - tstart
+            self.assertEqual(len(subimages), n * n)
+
+            spot_coordinates = [spot.FindCenterCoordinates(i) for i in subimages]
+            optical_coordinates = coordinates.ReconstructCoordinates(subimage_coordinates, spot_coordinates)
+
+            electron_coordinates = [(i + 1, j + 1) for i in xrange(n) for j in xrange(n)]
+            tstart = time.time()
+            known_ec, known_oc = coordinates.MatchCoordinates(optical_coordinates, electron_coordinates,
+                                                              1 / 40.0, 0.25)
+            dur_match = time.time() - tstart
+            self.assertEqual(len(known_ec), n * n)
+
+            logging.info("Grid %dx%d: divided in %g s, matched in %g s",
+                         n, n, dur_divide, dur_match)
+            self.assertLess(dur_divide + dur_match, 10)
+
+
 if __name__ == '__main__':
     unittest.main()
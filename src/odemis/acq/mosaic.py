@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 19 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent, Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License version 2 as published by the Free
+Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+
+"""
+
+# Acquisition of an area larger than the field of view, by moving the stage
+# between each tile, and assembling the tiles into one large image (mosaic).
+# The stage move to the next tile takes place while the tile just acquired is
+# registered and saved. The mosaic can be directly written to a file, so that
+# it's never entirely in memory.
+
+from __future__ import division
+
+from concurrent.futures._base import CancelledError
+import logging
+import math
+import numpy
+from odemis import model, acq
+from odemis.acq import _futures
+from odemis.acq.drift import CalculateDrift
+from odemis.dataio import hdf5
+import threading
+import time
+
+
+# Maximum shift accepted from the registration, as a ratio of the overlap
+MAX_SHIFT_RATIO = 0.25
+# Minimum size (in px) of the overlap to attempt a registration
+MIN_REGISTRATION_SIZE = 16
+# Time (in s) for a stage move, if it cannot be estimated from its speed
+DEFAULT_MOVE_TIME = 1
+# Time (in s) to register and store a tile (rough estimate)
+TILE_PROCESSING_TIME = 0.1
+
+
+def getFov(stream):
+    """
+    Finds the area covered by an acquisition of the stream
+    stream (Stream): the stream
+    return (float, float): width and height (in m)
+    raise ValueError: if the field of view cannot be found
+    """
+    # The last image acquired is the most reliable information
+    for da in stream.raw:
+        if da.ndim == 2 and model.MD_PIXEL_SIZE in da.metadata:
+            pxs = da.metadata[model.MD_PIXEL_SIZE]
+            return da.shape[1] * pxs[0], da.shape[0] * pxs[1]
+
+    # For a scanner, the whole area which can be scanned
+    emt = stream.emitter
+    if model.hasVA(emt, "pixelSize") and hasattr(emt, "shape"):
+        pxs = emt.pixelSize.value
+        return emt.shape[0] * pxs[0], emt.shape[1] * pxs[1]
+
+    raise ValueError("Field of view of stream %s unknown, it should be acquired once first"
+                     % (stream.name.value,))
+
+
+def computeTiles(area, fov, overlap):
+    """
+    Computes the positions of the tiles to cover an area
+    area (4 floats): xmin, ymin, xmax, ymax of the area to acquire (in m, in the
+      stage coordinates)
+    fov (float, float): width and height of a tile (in m)
+    overlap (0 <= float < 1): ratio of the tile size which overlaps with the
+      neighbouring tile
+    return (list of ((int, int), (float, float))): for each tile, its index
+      (column, row) and the position of its center (in m). The tiles are ordered
+      so that the stage moves as little as possible: row by row, from the top,
+      going alternatively left to right and right to left.
+    """
+    if not 0 <= overlap < 1:
+        raise ValueError("Overlap must be between 0 and 1, got %s" % (overlap,))
+    xmin, ymin, xmax, ymax = area
+    if xmax < xmin or ymax < ymin:
+        raise ValueError("Area %s is not valid" % (area,))
+
+    size = (xmax - xmin, ymax - ymin)
+    center = ((xmin + xmax) / 2, (ymin + ymax) / 2)
+    steps = []
+    ntiles = []
+    for s, f in zip(size, fov):
+        step = f * (1 - overlap)
+        # The epsilon avoids an extra tile due to floating point errors
+        n = max(1, int(math.ceil((s - f) / step - 1e-6)) + 1)
+        steps.append(step)
+        ntiles.append(n)
+
+    # The grid is centred on the area
+    x0 = center[0] - (ntiles[0] - 1) * steps[0] / 2
+    y0 = center[1] + (ntiles[1] - 1) * steps[1] / 2  # Y goes up
+    tiles = []
+    for r in range(ntiles[1]):
+        cols = range(ntiles[0])
+        if r % 2:
+            cols = cols[::-1]
+        for c in cols:
+            tiles.append(((c, r), (x0 + c * steps[0], y0 - r * steps[1])))
+
+    return tiles
+
+
+def _estimateMoveTime(stage, dist):
+    """
+    stage (Actuator): the stage with axes x and y
+    dist (float, float): distance of the move on x and y (in m)
+    return (0 <= float): estimated time of the move (in s)
+    """
+    try:
+        speed = stage.speed.value
+        # Axes move simultaneously
+        return max(abs(dist[0]) / speed["x"], abs(dist[1]) / speed["y"])
+    except (AttributeError, KeyError, ZeroDivisionError):
+        return DEFAULT_MOVE_TIME
+
+
+def estimateMosaicTime(streams, stage, area, overlap=0.2, fov=None):
+    """
+    Estimates the time to acquire a mosaic (same arguments as acquireMosaic())
+    return (0 <= float): estimated time in s
+    """
+    if fov is None:
+        fov = _getMinFov(streams)
+    tiles = computeTiles(area, fov, overlap)
+    return len(tiles) * _estimateTileTime(streams, stage, fov, overlap)
+
+
+def _estimateTileTime(streams, stage, fov, overlap):
+    """
+    return (0 <= float): estimated time to acquire one tile, and get to the
+      next one (in s)
+    """
+    acq_time = sum(acq.estimateTime([s]) for s in streams)
+    step = (fov[0] * (1 - overlap), fov[1] * (1 - overlap))
+    # The move is done in parallel of the processing of the tile, so only the
+    # longest of both counts
+    return acq_time + max(_estimateMoveTime(stage, step), TILE_PROCESSING_TIME)
+
+
+def _getMinFov(streams):
+    """
+    return (float, float): the field of view covered by all the streams
+    """
+    fovs = [getFov(s) for s in streams]
+    return min(f[0] for f in fovs), min(f[1] for f in fovs)
+
+
+def acquireMosaic(streams, stage, area, overlap=0.2, register=True,
+                  filename=None, fov=None):
+    """
+    Acquires an area larger than the field of view by acquiring the streams at
+    each tile of a grid, and assembling all the tiles into one image per data.
+    Each DataArray acquired must be 2D.
+    streams (list of Streams): the streams to acquire at each tile
+    stage (Actuator): the stage with axes x and y, to move between the tiles
+    area (4 floats): xmin, ymin, xmax, ymax of the area to acquire (in m, in the
+      stage coordinates)
+    overlap (0 <= float < 1): ratio of the tile size which overlaps with the
+      neighbouring tile
+    register (bool): if True, the position of each tile is adjusted by
+      comparing its overlap with the neighbouring tile, on the first data of the
+      first stream. Otherwise, the tiles are placed according to the stage
+      position.
+    filename (None or unicode): if provided, the mosaic is written progressively
+      to this HDF5 file, instead of being kept in memory.
+    fov (None or (float, float)): size of a tile (in m). If None, it is
+      the smallest field of view of the streams.
+    return (ProgressiveFuture): the acquisition task. Its result is
+      a list of DataArray (one per data acquired at each tile), or None if
+      filename is provided.
+    raise ValueError: if the field of view of the streams is unknown
+    """
+    if fov is None:
+        fov = _getMinFov(streams)
+    tiles = computeTiles(area, fov, overlap)
+
+    est_start = time.time() + 0.1
+    est_dur = estimateMosaicTime(streams, stage, area, overlap, fov)
+    future = model.ProgressiveFuture(start=est_start, end=est_start + est_dur)
+
+    task = MosaicAcquisitionTask(future, streams, stage, tiles, fov, overlap,
+                                 register, filename)
+    future.task_canceller = task.cancel # let the future cancel the task
+
+    thread = threading.Thread(target=_futures.executeTask, name="Mosaic acquisition",
+                              args=(future, task.run))
+    thread.start()
+
+    return future
+
+
+class _MemoryMosaic(object):
+    """
+    Assembles the tiles into images in memory. Same interface as
+    hdf5.MosaicWriter.
+    """
+
+    def __init__(self):
+        self._images = [] # list of DataArrays
+
+    def add_image(self, shape, dtype, md):
+        self._images.append(model.DataArray(numpy.zeros(shape, dtype), md))
+        return len(self._images) - 1
+
+    def write_tile(self, index, tile, pos):
+        im = self._images[index]
+        t, l = pos
+        tt, tl = max(0, -t), max(0, -l)
+        tb, tr = min(tile.shape[0], im.shape[0] - t), min(tile.shape[1], im.shape[1] - l)
+        if tb <= tt or tr <= tl:
+            logging.debug("Tile at %s is outside of the image", pos)
+            return
+        im[t + tt:t + tb, l + tl:l + tr] = tile[tt:tb, tl:tr]
+
+    def close(self):
+        ims = self._images
+        self._images = []
+        return ims
+
+
+class MosaicAcquisitionTask(object):
+
+    def __init__(self, future, streams, stage, tiles, fov, overlap, register,
+                 filename):
+        """
+        future (ProgressiveFuture): the future representing the task
+        tiles (list of ((int, int), (float, float))): as returned by computeTiles()
+        Other arguments: see acquireMosaic()
+        """
+        self._future = future
+        self._streams = streams
+        self._stage = stage
+        self._tiles = tiles
+        self._fov = fov
+        self._overlap = overlap
+        self._register = register
+        if filename:
+            self._mosaic = hdf5.MosaicWriter(filename)
+        else:
+            self._mosaic = _MemoryMosaic()
+
+        # Position of the top-left corner of the mosaic (in m)
+        cols = [p[0] for i, p in tiles]
+        rows = [p[1] for i, p in tiles]
+        self._tl = min(cols) - fov[0] / 2, max(rows) + fov[1] / 2
+        self._size = max(cols) - min(cols) + fov[0], max(rows) - min(rows) + fov[1]
+
+        self._images = {} # (stream index, data index) -> image index in the mosaic
+        # tile index -> DataArray, position in the mosaic (px): the data used
+        # for registering the next tiles
+        self._reg_tiles = {}
+        self._md_offset = None # difference between MD_POS and stage position (in m)
+
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._current_future = None
+
+    def run(self):
+        """
+        Runs the acquisition
+        returns: see acquireMosaic()
+        raise:
+          CancelledError() if cancelled
+          Exceptions if error
+        """
+        try:
+            tile_time = _estimateTileTime(self._streams, self._stage,
+                                          self._fov, self._overlap)
+            move_f = self._move(self._tiles[0][1])
+            for i, (idx, pos) in enumerate(self._tiles):
+                move_f.result()
+                das = self._acquire_tile()
+
+                # Move to the next tile while processing the current one
+                if i + 1 < len(self._tiles):
+                    move_f = self._move(self._tiles[i + 1][1])
+
+                self._process_tile(idx, pos, das)
+
+                left = len(self._tiles) - i - 1
+                self._future.set_progress(end=time.time() + left * tile_time)
+                logging.debug("Tile %s acquired, %d left", idx, left)
+
+            return self._mosaic.close()
+        except Exception:
+            try:
+                self._mosaic.close()
+            except Exception:
+                logging.exception("Failed to close the mosaic")
+            raise
+        finally:
+            self._current_future = None
+
+    def _move(self, pos):
+        """
+        Starts moving the stage to the given position
+        pos (float, float): position on x and y (in m)
+        return (Future): the move
+        """
+        with self._lock:
+            if self._cancelled:
+                raise CancelledError()
+            f = self._stage.moveAbs({"x": pos[0], "y": pos[1]})
+            self._current_future = f
+        return f
+
+    def _acquire_tile(self):
+        """
+        Acquires all the streams at the current position
+        return (list of list of DataArray): for each stream, the data acquired
+        """
+        das = []
+        for s in self._streams:
+            with self._lock:
+                if self._cancelled:
+                    raise CancelledError()
+                f = acq.acquire([s])
+                self._current_future = f
+            data, exp = f.result()
+            if exp:
+                raise exp
+            das.append(data)
+        return das
+
+    def _process_tile(self, idx, pos, das):
+        """
+        Places the data of a tile in the mosaic
+        idx (int, int): index of the tile
+        pos (float, float): stage position of the center of the tile (in m)
+        das (list of list of DataArray): data of the tile for each stream
+        """
+        if self._md_offset is None:
+            # The data position might not be exactly the stage position (eg, due
+            # to calibration), so keep the same shift for the whole mosaic.
+            md_pos = das[0][0].metadata.get(model.MD_POS, pos)
+            self._md_offset = md_pos[0] - pos[0], md_pos[1] - pos[1]
+
+        if self._register:
+            reg_da = das[0][0]
+            pos = self._register_tile(idx, pos, reg_da)
+            # Only the tiles of the current and previous row can be neighbours
+            # of the next tiles
+            for i in self._reg_tiles.keys():
+                if i[1] < idx[1] - 1:
+                    del self._reg_tiles[i]
+            if reg_da.ndim == 2 and model.MD_PIXEL_SIZE in reg_da.metadata:
+                self._reg_tiles[idx] = reg_da, self._get_tile_px(reg_da, pos)
+
+        for si, sdas in enumerate(das):
+            for di, da in enumerate(sdas):
+                if da.ndim != 2:
+                    raise ValueError("Cannot acquire mosaic of %dD data" % (da.ndim,))
+                mi = self._get_image(si, di, da)
+                self._mosaic.write_tile(mi, da, self._get_tile_px(da, pos))
+
+    def _get_image(self, si, di, da):
+        """
+        Finds (or creates) the image of the mosaic corresponding to the data
+        si (int): index of the stream
+        di (int): index of the data in the stream
+        da (DataArray): the data of the tile
+        return (int): index of the image in the mosaic
+        """
+        try:
+            return self._images[(si, di)]
+        except KeyError:
+            pass
+
+        pxs = da.metadata.get(model.MD_PIXEL_SIZE)
+        if pxs is None:
+            raise ValueError("Data from stream %s has no pixel size" %
+                             (self._streams[si].name.value,))
+        shape = (int(math.ceil(self._size[1] / pxs[1])),
+                 int(math.ceil(self._size[0] / pxs[0])))
+        md = da.metadata.copy()
+        md[model.MD_POS] = (self._tl[0] + self._size[0] / 2 + self._md_offset[0],
+                            self._tl[1] - self._size[1] / 2 + self._md_offset[1])
+        logging.debug("Creating mosaic image of shape %s", shape)
+        mi = self._mosaic.add_image(shape, da.dtype, md)
+        self._images[(si, di)] = mi
+        return mi
+
+    def _get_tile_px(self, da, pos):
+        """
+        Computes the position of the tile in the mosaic image
+        da (DataArray): the data of the tile
+        pos (float, float): position of the center of the tile (in m)
+        return (int, int): position of the top-left pixel of the tile (Y, X)
+        """
+        pxs = da.metadata[model.MD_PIXEL_SIZE]
+        left = pos[0] - da.shape[1] * pxs[0] / 2 - self._tl[0]
+        top = self._tl[1] - (pos[1] + da.shape[0] * pxs[1] / 2)
+        return int(round(top / pxs[1])), int(round(left / pxs[0]))
+
+    def _register_tile(self, idx, pos, da):
+        """
+        Adjusts the position of the tile by comparing it with a neighbouring
+        tile already acquired, on the region they overlap.
+        idx (int, int): index of the tile
+        pos (float, float): stage position of the center of the tile (in m)
+        da (DataArray): the data of the tile used for registration
+        return (float, float): the adjusted position of the center (in m)
+        """
+        c, r = idx
+        pxs = da.metadata.get(model.MD_PIXEL_SIZE)
+        if pxs is None or da.ndim != 2:
+            return pos
+
+        # Prefer the neighbour on the same row, as it was acquired just before
+        for nidx in ((c - 1, r), (c + 1, r), (c, r - 1)):
+            if nidx in self._reg_tiles:
+                nda, (nt, nl) = self._reg_tiles[nidx]
+                break
+        else:
+            return pos
+
+        # Overlapping region, in the mosaic coordinates
+        t, l = self._get_tile_px(da, pos)
+        h, w = da.shape
+        top, bottom = max(t, nt), min(t + h, nt + nda.shape[0])
+        left, right = max(l, nl), min(l + w, nl + nda.shape[1])
+        if min(bottom - top, right - left) < MIN_REGISTRATION_SIZE:
+            return pos
+
+        ref = nda[top - nt:bottom - nt, left - nl:right - nl]
+        tile = da[top - t:bottom - t, left - l:right - l]
+        # The tiles are placed with a precision of 1 px, so no need for subpixel
+        shift = CalculateDrift(ref, tile)
+        max_shift = MAX_SHIFT_RATIO * min(ref.shape)
+        if max(abs(shift[0]), abs(shift[1])) > max_shift:
+            logging.info("Registration of tile %s gave a too large shift %s px, ignoring it",
+                         idx, shift)
+            return pos
+
+        logging.debug("Tile %s shifted by %s px", idx, shift)
+        # Y is inverted between image and physical coordinates
+        return pos[0] + shift[0] * pxs[0], pos[1] - shift[1] * pxs[1]
+
+    def cancel(self, future):
+        """
+        Cancels the acquisition
+        """
+        with self._lock:
+            self._cancelled = True
+            if self._current_future is not None:
+                self._current_future.cancel()
+        return True
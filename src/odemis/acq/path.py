@@ -22,13 +22,17 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+from collections import OrderedDict
 from concurrent.futures.thread import ThreadPoolExecutor
 import copy
 import logging
 import math
+import numbers
 from odemis import model
 from odemis.acq import stream
 from odemis.model import isasync
+from odemis.util import almost_equal
+import time
 
 GRATING_NOT_MIRROR = ("NOTMIRROR",)  # A tuple, so that no grating position can be like this
 
@@ -239,7 +243,6 @@ class OpticalPathManager(object):
                 del self._modes[m]
 
         # Create the guess information out of the mode
-        # TODO: just make it a dict comprole -> mode
         self.guessed = self._modes.copy()
         # No stream should ever imply alignment mode
         for m in ALIGN_MODES:
@@ -247,6 +250,8 @@ class OpticalPathManager(object):
                 del self.guessed[m]
             except KeyError:
                 pass  # Mode to delete is just not there
+        # detector role -> mode
+        self._role_to_mode = {det: m for m, (det, conf) in self.guessed.items()}
 
         try:
             spec = self._getComponent("spectrometer")
@@ -272,6 +277,17 @@ class OpticalPathManager(object):
                                           act_role, det_role, mode)
                             del modeconf[act_role]
 
+        # The selectors to move to reach a target only depend on the hardware,
+        # so compute them once for all the detectors of the modes.
+        self._selector_routes = {}  # str (target name) -> list of (Actuator, dict, str)
+        for det_role, conf in self._modes.values():
+            self._getSelectorRoute(self._getComponent(det_role).name)
+
+        # Duration of each mode change, with the mode as stage name. The
+        # number of axes not moved, because already in position, is counted
+        # as "dropped".
+        self.statistics = model.PipelineStatistics()
+
         # will take care of executing setPath asynchronously
         self._executor = ThreadPoolExecutor(max_workers=1)
 
@@ -312,6 +328,7 @@ class OpticalPathManager(object):
                 ValueError if the given mode does not exist
                 IOError if a detector is missing
         """
+        tstart = time.time()
         if isinstance(path, stream.Stream):
             mode = self.guessMode(path)
             if mode not in self._modes:
@@ -328,7 +345,8 @@ class OpticalPathManager(object):
         logging.debug("Going to optical path '%s', with target detector %s.", mode, target)
 
         modeconf = self._modes[mode][1]
-        fmoves = []  # moves in progress
+        # All the moves are first gathered, so that each component is moved only once
+        moves = OrderedDict()  # str (component name) -> (Component, dict str -> value)
         for comp_role, conf in modeconf.items():
             # Try to access the component needed
             try:
@@ -427,32 +445,42 @@ class OpticalPathManager(object):
                 else:
                     logging.debug("Not moving axis %s.%s as it is not present", comp_role, axis)
 
-            try:
-                fmoves.append(comp.moveAbs(mv))
-            except AttributeError:
-                logging.debug("%s not an actuator", comp_role)
+            if mv:
+                self._addMove(moves, comp, mv)
 
         # Now take care of the selectors based on the target detector
-        fmoves.extend(self.selectorsToPath(target))
+        for comp, mv in self._getSelectorMoves(target):
+            self._addMove(moves, comp, mv)
 
         # If we are about to leave alignment modes, restore values
         if self._last_mode in ALIGN_MODES and mode not in ALIGN_MODES:
             if 'band' in self._stored:
                 try:
                     flter = self._getComponent("filter")
-                    fmoves.append(flter.moveAbs({"band": self._stored['band']}))
+                    self._addMove(moves, flter, {"band": self._stored['band']})
                 except LookupError:
                     logging.debug("No filter component available")
             if 'slit-in' in self._stored:
                 try:
                     spectrograph = self._getComponent("spectrograph")
-                    fmoves.append(spectrograph.moveAbs({"slit-in": self._stored['slit-in']}))
+                    self._addMove(moves, spectrograph, {"slit-in": self._stored['slit-in']})
                 except LookupError:
                     logging.debug("No spectrograph component available")
 
         # Save last mode
         self._last_mode = mode
 
+        # Start all the moves simultaneously
+        fmoves = []  # moves in progress
+        for comp, mv in moves.values():
+            try:
+                f = self._moveIfNeeded(comp, mv)
+            except AttributeError:
+                logging.debug("%s not an actuator", comp.name)
+                continue
+            if f is not None:
+                fmoves.append(f)
+
         # wait for all the moves to be completed
         for f in fmoves:
             try:
@@ -460,6 +488,57 @@ class OpticalPathManager(object):
             except IOError as e:
                 logging.debug("Actuator move failed giving the error %s", e)
 
+        tend = time.time()
+        self.statistics.record(None, tstart, tend, mode)
+        logging.info("Optical path changed to '%s' in %g s, with %d components moved",
+                     mode, tend - tstart, len(fmoves))
+
+    def _addMove(self, moves, comp, mv):
+        """
+        Adds a move to the moves to be done. If the component is already moved,
+        the positions are merged (and the new ones have precedence).
+        moves (OrderedDict str -> (Component, dict)): the moves, updated
+        comp (Component): the component to move
+        mv (dict str -> value): axis -> position
+        """
+        try:
+            moves[comp.name][1].update(mv)
+        except KeyError:
+            moves[comp.name] = (comp, dict(mv))
+
+    def _moveIfNeeded(self, comp, mv):
+        """
+        Moves only the axes of the component which are not yet at the requested
+        position.
+        comp (Actuator): the component to move
+        mv (dict str -> value): axis -> position
+        return (Future or None): the move, or None if all the axes are already
+          at the requested position.
+        raises AttributeError: if the component is not an actuator
+        """
+        pos = comp.position.value
+        needed = {}
+        for axis, p in mv.items():
+            if axis in pos and self._isSamePosition(pos[axis], p):
+                continue
+            needed[axis] = p
+
+        self.statistics.dropped += len(mv) - len(needed)
+        if not needed:
+            logging.debug("Not moving %s, as it's already at %s", comp.name, mv)
+            return None
+        return comp.moveAbs(needed)
+
+    def _isSamePosition(self, a, b):
+        """
+        return (bool): True if the position a and b are the same (within
+          rounding errors for numbers)
+        """
+        if (isinstance(a, numbers.Real) and isinstance(b, numbers.Real) and
+            not isinstance(a, bool) and not isinstance(b, bool)):
+            return almost_equal(a, b)
+        return a == b
+
     def selectorsToPath(self, target):
         """
         Sets the selectors so the optical path leads to the target component
@@ -468,8 +547,51 @@ class OpticalPathManager(object):
         return (list of futures)
         """
         fmoves = []
+        for comp, mv in self._getSelectorMoves(target):
+            f = self._moveIfNeeded(comp, mv)
+            if f is not None:
+                fmoves.append(f)
+
+        return fmoves
+
+    def _getSelectorMoves(self, target):
+        """
+        Computes the moves of the selectors so the optical path leads to the
+        target component.
+        target (str): component name
+        return (list of (Actuator, dict str -> value)): each component to move,
+          with the position of the axes.
+        """
+        moves = []
+        for comp, mv, md_name in self._getSelectorRoute(target):
+            mv = dict(mv)
+            if md_name is not None:
+                # Favourite positions can be calibrated, so always read them
+                mv.update(comp.getMetadata().get(md_name, {}))
+            if mv:
+                logging.debug("Move %s added so %s targets to %s", mv, comp.name, target)
+                moves.append((comp, mv))
+
+        return moves
+
+    def _getSelectorRoute(self, target):
+        """
+        Finds the selectors to set so that the optical path leads to the target
+        component, including the selectors leading to these selectors. As it
+        only depends on the hardware, the result is cached.
+        target (str): component name
+        return (list of (Actuator, dict str -> value, str or None)): for each
+          selector, the positions of the axes with choices, and the name of the
+          favourite position metadata to use (if any).
+        """
+        try:
+            return self._selector_routes[target]
+        except KeyError:
+            pass
+
+        route = []
+        self._selector_routes[target] = route
         for comp in self._actuators:
-            # TODO: pre-cache this as comp/target -> axis/pos
             mv = {}
             for an, ad in comp.axes.items():
                 if hasattr(ad, "choices") and isinstance(ad.choices, dict):
@@ -480,17 +602,18 @@ class OpticalPathManager(object):
 
             comp_md = comp.getMetadata()
             if target in comp_md.get(model.MD_FAV_POS_ACTIVE_DEST, {}):
-                mv.update(comp_md[model.MD_FAV_POS_ACTIVE])
+                md_name = model.MD_FAV_POS_ACTIVE
             elif target in comp_md.get(model.MD_FAV_POS_DEACTIVE_DEST, {}):
-                mv.update(comp_md[model.MD_FAV_POS_DEACTIVE])
+                md_name = model.MD_FAV_POS_DEACTIVE
+            else:
+                md_name = None
 
-            if mv:
-                logging.debug("Move %s added so %s targets to %s", mv, comp.name, target)
-                fmoves.append(comp.moveAbs(mv))
+            if mv or md_name:
+                route.append((comp, mv, md_name))
                 # make sure this component is also on the optical path
-                fmoves.extend(self.selectorsToPath(comp.name))
+                route.extend(self._getSelectorRoute(comp.name))
 
-        return fmoves
+        return route
 
     def guessMode(self, guess_stream):
         """
@@ -513,9 +636,10 @@ class OpticalPathManager(object):
                 except LookupError:
                     pass
         else:
-            for mode, conf in self.guessed.items():
-                if conf[0] == guess_stream.detector.role:
-                    return mode
+            try:
+                return self._role_to_mode[guess_stream.detector.role]
+            except KeyError:
+                pass
         # In case no mode was found yet
         raise LookupError("No mode can be inferred for the given stream")
 
@@ -541,9 +665,8 @@ class OpticalPathManager(object):
                     # TODO: handle setting multiple optical paths? => return all the detectors
                     role = st.detector.role
                     name = st.detector.name
-                    for conf in self.guessed.values():
-                        if conf[0] == role:
-                            return name
+                    if role in self._role_to_mode:
+                        return name
                     dets.append(name)
                 except AttributeError:
                     pass
@@ -92,6 +92,13 @@ class Stream(object):
         # has a separate attribute.
         self._dataflow = dataflow
 
+        # Statistics of the data received and displayed. Only summarized when
+        # the .statistics VA is read, so it costs nearly nothing otherwise.
+        self._stats = model.PipelineStatistics()
+        # dict str -> value: see _getStatistics()
+        self.statistics = model.VigilantAttribute({}, readonly=True,
+                                                  getter=self._getStatistics)
+
         # TODO: We need to reorganise everything so that the
         # image display is done via a dataflow (in a separate thread), instead
         # of a VA.
@@ -116,6 +123,13 @@ class Stream(object):
         # DataArray or None: RGB projection of the raw data
         self.image = model.VigilantAttribute(None)
 
+        # Areas displayed, as requested by the views (see setDisplayRequest())
+        # hashable -> (4 floats or None, float or None): key -> rect, mpp
+        self._display_reqs = {}
+        # None or (DataArray, tint): the input of the latest projection, if it
+        # was reduced for the display (see getFullImage())
+        self._reduced_proj = None
+
         # indicating if stream has already been prepared
         self._prepared = False
         # TODO: should_update is a GUI stuff => move away from stream
@@ -708,13 +722,142 @@ class Stream(object):
 
         return md
 
-    def _projectXY2RGB(self, data, tint=(255, 255, 255)):
+    def setDisplayRequest(self, key, rect, mpp):
+        """
+        Indicates which part of the data is displayed, and at which resolution.
+        While the stream is active, the image is only computed for the union of
+        all the areas requested, and reduced to the finest resolution
+        requested. When the stream is not active, the image is always computed
+        with the whole data at full resolution. To export the image while the
+        stream is active, use getFullImage().
+        key (hashable): identifies the requester (eg, the canvas). A new request
+          with the same key replaces the previous one.
+        rect (None or 4 floats): xmin, ymin, xmax, ymax, in physical coordinates
+          (m), of the area displayed. None means the whole data.
+        mpp (None or 0<float): size of a pixel of the display (m). None means
+          full resolution.
+        """
+        if self._display_reqs.get(key) == (rect, mpp):
+            return
+        self._display_reqs[key] = (rect, mpp)
+        if self.is_active.value:
+            self._shouldUpdateImage()
+
+    def getFullImage(self):
+        """
+        return (None or DataArray): the RGB projection of the whole data, at
+          full resolution. It's the same as .image, unless the stream is active,
+          in which case .image might only contain the displayed area (see
+          setDisplayRequest()).
+        """
+        reduced = self._reduced_proj
+        if reduced is None:
+            return self.image.value
+        data, tint = reduced
+        return self._projectXY2RGB(data, tint, reduce=False)
+
+    def removeDisplayRequest(self, key):
+        """
+        Removes a request added with setDisplayRequest()
+        key (hashable): identifies the requester
+        """
+        if self._display_reqs.pop(key, None) is not None and self.is_active.value:
+            self._shouldUpdateImage()
+
+    def _getDisplayRequest(self):
+        """
+        return (None or 4 floats, None or float): the union of the areas
+          requested, and the finest resolution requested (see setDisplayRequest())
+        """
+        reqs = self._display_reqs.values()
+        if not reqs:
+            return None, None
+
+        rects = [r for r, m in reqs]
+        if None in rects:
+            rect = None
+        else:
+            rect = (min(r[0] for r in rects), min(r[1] for r in rects),
+                    max(r[2] for r in rects), max(r[3] for r in rects))
+
+        mpps = [m for r, m in reqs]
+        mpp = None if None in mpps else min(mpps)
+
+        return rect, mpp
+
+    def _reduceToDisplay(self, data, md):
+        """
+        Crops and decimates the data to what is needed for the display
+        data (DataArray): 2D data
+        md (dict MD_* -> value): metadata of the projection, as returned by
+          _find_metadata(). It is updated to match the reduced data.
+        return (numpy.ndarray): the reduced data (or data itself if no reduction)
+        """
+        rect, mpp = self._getDisplayRequest()
+        if (rect is None and mpp is None) or data.ndim != 2:
+            return data
+        # Not worthy supporting the complex cases
+        if md.get(MD_ROTATION, 0) or md.get(MD_SHEAR, 0):
+            return data
+
+        pxs = md[MD_PIXEL_SIZE]
+        pos = md[MD_POS]
+        h, w = data.shape
+
+        # Only decimate by an integer factor, which is cheap
+        if mpp is None:
+            k = 1
+        else:
+            k = max(1, int(mpp / max(pxs) + 1e-6))  # margin for float errors
+
+        # Find the visible part, in pixels
+        left = pos[0] - w * pxs[0] / 2
+        top = pos[1] + h * pxs[1] / 2
+        if rect is None:
+            c0, r0, c1, r1 = 0, 0, w, h
+        else:
+            c0 = max(0, int(math.floor((rect[0] - left) / pxs[0])))
+            c1 = min(w, int(math.ceil((rect[2] - left) / pxs[0])))
+            r0 = max(0, int(math.floor((top - rect[3]) / pxs[1])))
+            r1 = min(h, int(math.ceil((top - rect[1]) / pxs[1])))
+            if c0 >= c1 or r0 >= r1:
+                # Nothing visible => keep everything, but still decimated
+                c0, r0, c1, r1 = 0, 0, w, h
+
+        if k == 1 and (c0, r0, c1, r1) == (0, 0, w, h):
+            return data
+
+        # Start on a multiple of k, so that the same pixels are always picked,
+        # which avoids flickering when the view moves.
+        c0 -= c0 % k
+        r0 -= r0 % k
+        # Copy, as the optimised RGB conversion needs a C-contiguous array
+        rdata = numpy.ascontiguousarray(data[r0:r1:k, c0:c1:k])
+        rh, rw = rdata.shape
+        md[MD_PIXEL_SIZE] = (pxs[0] * k, pxs[1] * k)
+        md[MD_POS] = (left + (c0 + rw * k / 2) * pxs[0],
+                      top - (r0 + rh * k / 2) * pxs[1])
+        return rdata
+
+    def _projectXY2RGB(self, data, tint=(255, 255, 255), reduce=True):
         """
         Project a 2D spatial DataArray into a RGB representation
+        When the stream is active, only the part needed for the display is
+        projected (cf setDisplayRequest()).
         data (DataArray): 2D DataArray
         tint ((int, int, int)): colouration of the image, in RGB.
+        reduce (bool): if False, the whole data is always projected, and the
+          projection is not considered for .image.
         return (DataArray): 3D DataArray
         """
+        md = self._find_metadata(data.metadata)
+        if reduce:
+            rdata = data
+            if self._display_reqs and self.is_active.value:
+                rdata = self._reduceToDisplay(data, md)
+            self._reduced_proj = None if rdata is data else (data, tint)
+            data = rdata
+
         irange = self._getDisplayIRange()
         rgbim = img.DataArray2RGB(data, irange, tint)
         rgbim.flags.writeable = False
@@ -722,10 +865,25 @@ class Stream(object):
         # if model.MD_ACQ_DATE in data.metadata:
         #     logging.debug("Computed RGB projection %g s after acquisition",
         #                    time.time() - data.metadata[model.MD_ACQ_DATE])
-        md = self._find_metadata(data.metadata)
         md[model.MD_DIMS] = "YXC" # RGB format
         return model.DataArray(rgbim, md)
 
+    def _getStatistics(self):
+        """
+        return (dict str -> value): the statistics of the stream (see
+          PipelineStatistics.to_dict()). It contains the number of data
+          received and the number dropped before being displayed, and the
+          latencies of the stages "processing" (_onNewData()), "histogram",
+          "projection", "age" (at reception), "display_age" (at display).
+          If the dataflow records statistics (see
+          DataFlow.enableStatistics()), they are in "dataflow".
+        """
+        stats = self._stats.to_dict()
+        dfstats = getattr(self._dataflow, "stats", None)
+        if dfstats is not None:
+            stats["dataflow"] = dfstats.to_dict()
+        return stats
+
     def _shouldUpdateImage(self):
         """
         Ensures that the image VA will be updated in the "near future".
@@ -753,6 +911,8 @@ class Stream(object):
             wstream = weakref.ref(stream, lambda o: im_needs_recompute.set())
 
             tnext = 0
+            ndisplayed = 0
+            prev_raw_id = None
             while True:
                 del stream
                 im_needs_recompute.wait()  # wait until a new image is available
@@ -771,7 +931,21 @@ class Stream(object):
 
                 tnext = time.time() + 0.1  # max 10 Hz
                 im_needs_recompute.clear()
+                raw = stream.raw[0] if stream.raw else None
+                tstart = time.time()
                 stream._updateImage()
+                tend = time.time()
+
+                stats = stream._stats
+                stats.add("projection", tend - tstart)
+                # The image might be recomputed just because the display
+                # settings changed, so only count the new data.
+                if raw is not None and id(raw) != prev_raw_id:
+                    prev_raw_id = id(raw)
+                    ndisplayed += 1
+                    stats.add_age("display_age", raw, tend)
+                    stats.dropped = max(0, stats.received - ndisplayed)
+                del raw, stats
         except Exception:
             logging.exception("image update thread failed")
 
@@ -95,7 +95,10 @@ class LiveStream(Stream):
             self._prepared = False
             msg = "Unsubscribing from dataflow of component %s"
             logging.debug(msg, self._detector.name)
-            self._dataflow.unsubscribe(self._onNewData)
+            self._dataflow.unsubscribe(self._onNewDataMeasured)
+            if self._display_reqs:
+                # Recompute the image from the whole data, at full resolution
+                self._shouldUpdateImage()
 
     def _startAcquisition(self, future=None):
         msg = "Subscribing to dataflow of component %s"
@@ -103,7 +106,7 @@ class LiveStream(Stream):
         if not self.should_update.value:
             logging.info("Trying to activate stream while it's not "
                          "supposed to update")
-        self._dataflow.subscribe(self._onNewData)
+        self._dataflow.subscribe(self._onNewDataMeasured)
 
     def _updateAcquisitionTime(self):
         """
@@ -134,8 +137,8 @@ class LiveStream(Stream):
         # TODO: do this on a rate-limited fashion (now, or ~1s)
         # unsubscribe, and re-subscribe immediately
         logging.debug("Restarting acquisition because it lasts %f s", prev_dur)
-        self._dataflow.unsubscribe(self._onNewData)
-        self._dataflow.subscribe(self._onNewData)
+        self._dataflow.unsubscribe(self._onNewDataMeasured)
+        self._dataflow.subscribe(self._onNewDataMeasured)
 
     def _shouldUpdateHistogram(self):
         """
@@ -172,6 +175,7 @@ class LiveStream(Stream):
                 ht_needs_recompute.clear()
                 stream._updateHistogram()
                 tend = time.time()
+                stream._stats.add("histogram", tend - tstart)
 
                 # sleep as much, to ensure we are not using too much CPU
                 tsleep = max(0.2, tend - tstart)  # max 5 Hz
@@ -187,6 +191,15 @@ class LiveStream(Stream):
 
         gc.collect()
 
+    def _onNewDataMeasured(self, dataflow, data):
+        """
+        Called by the dataflow: passes the data to _onNewData() and updates the
+        statistics.
+        """
+        tstart = time.time()
+        self._onNewData(dataflow, data)
+        self._stats.record(data, tstart, time.time())
+
     def _onNewData(self, dataflow, data):
         old_drange = self._drange
 
@@ -249,6 +262,17 @@ class SEMStream(LiveStream):
         # in seconds, default to "fairly frequent" to work hopefully in most cases
         self.dcPeriod = model.FloatContinuous(10, range=(0.1, 1e6), unit="s")
 
+        # If the detector can send the frame while it's being scanned, it's
+        # used to update the image progressively (useful for slow scans).
+        self._partialDataflow = None
+        if dataflow is getattr(detector, "data", None):
+            pdf = getattr(detector, "partialData", None)
+            if isinstance(pdf, model.DataFlowBase):
+                self._partialDataflow = pdf
+        # (float, DataArray): date and frame being scanned, only used for the
+        # projection (.raw only contains complete frames)
+        self._partial = None
+
     def _computeROISettings(self, roi):
         """
         roi (4 0<=floats<=1)
@@ -363,6 +387,73 @@ class SEMStream(LiveStream):
                                       "acquisition not yet implemented")
 
         super(SEMStream, self)._startAcquisition()
+        if self._partialDataflow:
+            self._partialDataflow.subscribe(self._onPartialData)
+
+    def _onActive(self, active):
+        if not active and self._partialDataflow:
+            self._partialDataflow.unsubscribe(self._onPartialData)
+            self._partial = None
+        super(SEMStream, self)._onActive(active)
+
+    def _onPartialData(self, dataflow, block):
+        """
+        Called when a block of rows of the frame being scanned is received.
+        Updates the image with these rows, while keeping the rest of the
+        previous frame. The .raw is not changed: it only gets the complete
+        frame, once it's received.
+        block (DataArray): the rows, with MD_FRAME_ROWS
+        """
+        try:
+            r0, r1, h = block.metadata[model.MD_FRAME_ROWS]
+            date = block.metadata.get(model.MD_ACQ_DATE)
+            shape = (h,) + block.shape[1:]
+            if (self.raw and date is not None and
+                self.raw[0].metadata.get(model.MD_ACQ_DATE, 0) >= date):
+                # The complete frame has already been received
+                return
+
+            partial = self._partial
+            if (partial is not None and partial[0] == date and
+                partial[1].shape == shape):
+                prev = partial[1]
+            else:
+                prev = self.raw[0] if self.raw else None
+            md = block.metadata.copy()
+            del md[model.MD_FRAME_ROWS]
+            if (prev is not None and prev.shape == shape and
+                prev.dtype == block.dtype):
+                frame = model.DataArray(prev.copy(), md)
+            else:
+                frame = model.DataArray(numpy.zeros(shape, dtype=block.dtype), md)
+
+            # A new array each time, as the previous one might still be used
+            # by the projection
+            frame[r0:r1] = block
+            self._partial = (date, frame)
+            self._shouldUpdateImage()
+        except Exception:
+            logging.exception("Failed to update the image with rows of the frame")
+
+    def _onNewData(self, dataflow, data):
+        # The complete frame replaces the partial one
+        self._partial = None
+        super(SEMStream, self)._onNewData(dataflow, data)
+
+    def _updateImage(self):
+        partial = self._partial
+        if partial is None:
+            super(SEMStream, self)._updateImage()
+            return
+
+        try:
+            if not self.raw:
+                # First frame => no histogram yet to compute the display range
+                self._updateDRange(partial[1])
+                self._updateHistogram(partial[1])
+            self.image.value = self._projectXY2RGB(partial[1], self.tint.value)
+        except Exception:
+            logging.exception("Updating %s %s image", self.__class__.__name__, self.name.value)
 
     def _onDwellTime(self, value):
         self._updateAcquisitionTime()
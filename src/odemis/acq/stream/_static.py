@@ -34,6 +34,8 @@ from odemis.acq import calibration
 from odemis.model import MD_POS, MD_PIXEL_SIZE, VigilantAttribute
 from odemis.util import img, conversion, polar, spectrum
 from scipy import ndimage
+import threading
+import weakref
 
 from ._base import Stream
 
@@ -228,9 +230,17 @@ class StaticARStream(StaticStream):
             except KeyError:
                 logging.info("Skipping DataArray without known position")
 
-        # Cached conversion of the CCD image to polar representation
-        # TODO: automatically fill it in a background thread
-        self._polar = {} # dict tuple 2 floats -> DataArray
+        # Cached conversion of the CCD image to polar representation, ordered
+        # from the least recently used to the most recently used.
+        self._polar = collections.OrderedDict() # tuple 2 floats -> DataArray
+        self._polar_size = 0 # total number of bytes used by ._polar
+        # Positions being converted: tuple 2 floats -> threading.Event
+        self._polar_computing = {}
+        self._polar_failed = set() # positions which cannot be converted
+        # Incremented each time the cache is emptied
+        self._polar_generation = 0
+        # Must be taken to access any of the attributes above
+        self._polar_lock = threading.Lock()
 
         # SEM position displayed, (None, None) == no point selected
         self.point = model.VAEnumerated((None, None),
@@ -258,68 +268,151 @@ class StaticARStream(StaticStream):
         # no need for init=True, as Stream.__init__ will update the image
         self.point.subscribe(self._onPoint)
 
+        # Set whenever the prefetch thread should look for projections to compute
+        self._prefetch_needed = threading.Event()
+        self._prefetch_needed.set()
+
         super(StaticARStream, self).__init__(name, list(self._sempos.values()))
 
+        # Compute in advance the projections of the points around the selected
+        # one, so that they are immediately available when selected. It also
+        # computes the full projection of the selected point.
+        self._pfthread = threading.Thread(target=self._prefetch_thread,
+                                          args=(weakref.ref(self),),
+                                          name="AR projection prefetch")
+        self._pfthread.daemon = True
+        self._pfthread.start()
+
+    # Maximum amount of memory used for caching the polar projections
+    MAX_POLAR_CACHE_SIZE = 256 * 2 ** 20 # B
+    # Size of the smallest dimension of the image used to compute the preview
+    # projection (which takes typically less than 0.1 s)
+    PREVIEW_SIZE = 128 # px
+
     def _project2Polar(self, pos):
         """
         Return the polar projection of the image at the given position.
+        If it's already being computed by another thread, it waits for it.
         pos (tuple of 2 floats): position (must be part of the ._sempos
         returns DataArray: the polar projection
         """
-        if pos in self._polar:
-            polard = self._polar[pos]
-        else:
-            # Compute the polar representation
-            data = self._sempos[pos]
-            try:
-                if numpy.prod(data.shape) > (1280 * 1080):
-                    # AR conversion fails with very large images due to too much
-                    # memory consumed (> 2Gb). So, rescale + use a "degraded" type that
-                    # uses less memory. As the display size is small (compared
-                    # to the size of the input image, it shouldn't actually
-                    # affect much the output.
-                    logging.info("AR image is very large %s, will convert to "
-                                 "azimuthal projection in reduced precision.",
-                                 data.shape)
-                    y, x = data.shape
-                    if y > x:
-                        small_shape = 1024, int(round(1024 * x / y))
+        while True:
+            with self._polar_lock:
+                if pos in self._polar:
+                    # Mark it as most recently used
+                    polard = self._polar.pop(pos)
+                    self._polar[pos] = polard
+                    return polard
+
+                computing = self._polar_computing.get(pos)
+                if computing is None:
+                    computing = threading.Event()
+                    self._polar_computing[pos] = computing
+                    generation = self._polar_generation
+                    break
+            # Another thread is already computing it => wait for the result
+            computing.wait()
+
+        polard = None
+        try:
+            polard = self._computePolar(self._sempos[pos])
+        except Exception:
+            logging.exception("Failed to convert to azimuthal projection")
+            return self._sempos[pos] # display it raw as fallback
+        finally:
+            with self._polar_lock:
+                del self._polar_computing[pos]
+                # Only cache it if the cache hasn't been emptied meanwhile
+                if generation == self._polar_generation:
+                    if polard is None:
+                        self._polar_failed.add(pos)
                     else:
-                        small_shape = int(round(1024 * y / x)), 1024
-                    # resize
-                    data = img.rescale_hq(data, small_shape)
-                    dtype = numpy.float16
-                else:
-                    dtype = None # just let the function use the best one
-
-                # 2 x size of original image (on smallest axis) and at most
-                # the size of a full-screen canvas
-                size = min(min(data.shape) * 2, 1134)
-
-                # TODO: First compute quickly a low resolution and then
-                # compute a high resolution version.
-                # TODO: could use the size of the canvas that will display
-                # the image to save some computation time.
-
-                bg_data = self.background.value
-                if bg_data is None:
-                    # Simple version: remove the background value
-                    data0 = polar.ARBackgroundSubtract(data)
-                else:
-                    data0 = img.Subtract(data, bg_data) # metadata from data
-
-                # Warning: allocates lot of memory, which will not be free'd until
-                # the current thread is terminated.
-                polard = polar.AngleResolved2Polar(data0, size, hole=False, dtype=dtype)
-
-                # TODO: don't hold too many of them in cache (eg, max 3 * 1134**2)
-                self._polar[pos] = polard
-            except Exception:
-                logging.exception("Failed to convert to azimuthal projection")
-                return data # display it raw as fallback
+                        self._addPolarToCache(pos, polard)
+            computing.set()
 
         return polard
 
+    def _addPolarToCache(self, pos, polard):
+        """
+        Store a polar projection in the cache, and remove the least recently
+        used projections if the cache is too big.
+        Must be called with ._polar_lock taken.
+        pos (tuple of 2 floats): position of the projection
+        polard (DataArray): the polar projection
+        """
+        self._polar[pos] = polard
+        self._polar_size += polard.nbytes
+        # Always keep the latest one, even if it's bigger than the cache
+        while self._polar_size > self.MAX_POLAR_CACHE_SIZE and len(self._polar) > 1:
+            _, oldd = self._polar.popitem(last=False)
+            self._polar_size -= oldd.nbytes
+
+    def _getCachedPolar(self, pos):
+        """
+        pos (tuple of 2 floats): position (must be part of the ._sempos)
+        returns (DataArray or None): the polar projection, if it's in the cache
+        """
+        with self._polar_lock:
+            polard = self._polar.pop(pos, None)
+            if polard is not None:
+                self._polar[pos] = polard # Mark it as most recently used
+            return polard
+
+    def _computePolar(self, data, preview=False):
+        """
+        Compute the polar representation of an AR image
+        data (DataArray): the raw AR image
+        preview (bool): if True, the image is first reduced to PREVIEW_SIZE, so
+          that the (low resolution) projection is quick to compute.
+        returns DataArray: the polar projection
+        raises: any exception if the conversion failed
+        """
+        bg_data = self.background.value
+        if bg_data is None:
+            # Simple version: remove the background value
+            data = polar.ARBackgroundSubtract(data)
+        else:
+            data = img.Subtract(data, bg_data) # metadata from data
+
+        if preview and min(data.shape) > self.PREVIEW_SIZE:
+            y, x = data.shape
+            if y > x:
+                small_shape = int(round(self.PREVIEW_SIZE * y / x)), self.PREVIEW_SIZE
+            else:
+                small_shape = self.PREVIEW_SIZE, int(round(self.PREVIEW_SIZE * x / y))
+            data = img.rescale_hq(data, small_shape)
+            dtype = None
+        elif numpy.prod(data.shape) > (1280 * 1080):
+            # AR conversion fails with very large images due to too much
+            # memory consumed (> 2Gb). So, rescale + use a "degraded" type that
+            # uses less memory. As the display size is small (compared
+            # to the size of the input image, it shouldn't actually
+            # affect much the output.
+            logging.info("AR image is very large %s, will convert to "
+                         "azimuthal projection in reduced precision.",
+                         data.shape)
+            y, x = data.shape
+            if y > x:
+                small_shape = 1024, int(round(1024 * x / y))
+            else:
+                small_shape = int(round(1024 * y / x)), 1024
+            # resize
+            data = img.rescale_hq(data, small_shape)
+            dtype = numpy.float16
+        else:
+            dtype = None # just let the function use the best one
+
+        # 2 x size of original image (on smallest axis) and at most
+        # the size of a full-screen canvas
+        size = min(min(data.shape) * 2, 1134)
+
+        # TODO: could use the size of the canvas that will display
+        # the image to save some computation time.
+
+        # Warning: allocates lot of memory, which will not be free'd until
+        # the current thread is terminated.
+        return polar.AngleResolved2Polar(data, size, hole=False, dtype=dtype)
+
     def _find_metadata(self, md):
         # For polar view, no PIXEL_SIZE nor POS
         return {}
@@ -336,7 +429,23 @@ class StaticARStream(StaticStream):
             if pos == (None, None):
                 self.image.value = None
             else:
-                polard = self._project2Polar(pos)
+                polard = self._getCachedPolar(pos)
+                if polard is None:
+                    data = self._sempos[pos]
+                    if pos in self._polar_failed:
+                        polard = data # display it raw as fallback
+                    elif min(data.shape) > 2 * self.PREVIEW_SIZE:
+                        # The full projection is long to compute => it's done
+                        # by the prefetch thread (which will ask for an update
+                        # when it's ready). Meanwhile, display a low resolution one.
+                        self._prefetch_needed.set()
+                        polard = self._computePolar(data, preview=True)
+                        if self._im_needs_recompute.is_set():
+                            # Already outdated (eg, another point was selected)
+                            return
+                    else:
+                        polard = self._project2Polar(pos)
+
                 # update the histogram
                 # TODO: cache the histogram per image
                 # FIXME: histogram should not include the black pixels outside
@@ -351,6 +460,90 @@ class StaticARStream(StaticStream):
 
     def _onPoint(self, pos):
         self._shouldUpdateImage()
+        # The closest points have changed
+        self._prefetch_needed.set()
+
+    def _getNextPrefetchPosition(self):
+        """
+        Select the next position for which the polar projection should be
+        computed in advance. The closest positions to the current point are
+        picked first, as they are the most likely to be selected next.
+        Only as many positions as fit in the cache are picked.
+        returns (tuple of 2 floats or None): the position, or None if there is
+          nothing (more) to compute.
+        """
+        cpos = self.point.value
+        if cpos == (None, None):
+            # Just pick the points in any order
+            dist = lambda p: 0
+        else:
+            dist = lambda p: math.hypot(p[0] - cpos[0], p[1] - cpos[1])
+        positions = sorted(self._sempos.keys(), key=dist)
+
+        with self._polar_lock:
+            if self._polar:
+                avg_size = self._polar_size / len(self._polar)
+                nmax = max(1, int(self.MAX_POLAR_CACHE_SIZE // avg_size))
+                targets = positions[:nmax]
+            else:
+                # Size of a projection not yet known => only one at a time
+                targets = positions
+
+            for p in targets:
+                if (p not in self._polar and p not in self._polar_computing and
+                    p not in self._polar_failed):
+                    break
+            else:
+                return None
+
+            # If the cache is full, make space by dropping projections which
+            # are not among the closest ones (instead of the least recently used
+            # ones, which could be among the closest ones).
+            if self._polar:
+                stargets = set(targets)
+                for op in list(self._polar.keys()):
+                    if self._polar_size + avg_size <= self.MAX_POLAR_CACHE_SIZE:
+                        break
+                    if op not in stargets:
+                        self._polar_size -= self._polar.pop(op).nbytes
+
+            return p
+
+    @staticmethod
+    def _prefetch_thread(wstream):
+        """
+        Called as a separate thread, and computes the polar projections of the
+        points likely to be displayed soon, whenever it receives an event
+        asking for it.
+        wstream (Weakref to a StaticARStream): the stream to follow
+        """
+        try:
+            stream = wstream()
+            name = stream.name.value
+            prefetch_needed = stream._prefetch_needed
+            # Only hold a weakref to allow the stream to be garbage collected
+            # On GC, trigger prefetch_needed so that the thread can end too
+            wstream = weakref.ref(stream, lambda o: prefetch_needed.set())
+
+            while True:
+                del stream
+                prefetch_needed.wait()
+                stream = wstream()
+                if stream is None:
+                    logging.debug("Stream %s disappeared so ending prefetch thread", name)
+                    break
+
+                prefetch_needed.clear()
+                pos = stream._getNextPrefetchPosition()
+                if pos is not None:
+                    logging.debug("Precomputing polar projection at %s", pos)
+                    stream._project2Polar(pos)
+                    if pos == stream.point.value:
+                        # Replace the preview by the full projection
+                        stream._shouldUpdateImage()
+                    prefetch_needed.set() # Look for the next one
+        except Exception:
+            logging.exception("AR projection prefetch thread failed")
 
     def _setBackground(self, data):
         """Called when the background is about to be changed"""
@@ -396,8 +589,13 @@ class StaticARStream(StaticStream):
     def _onBackground(self, data):
         """Called when the background is changed"""
         # uncache all the polar images, and update the current image
-        self._polar = {}
+        with self._polar_lock:
+            self._polar.clear()
+            self._polar_size = 0
+            self._polar_failed.clear()
+            self._polar_generation += 1
         self._shouldUpdateImage()
+        self._prefetch_needed.set()
 
 
 class StaticSpectrumStream(StaticStream):
@@ -567,7 +765,7 @@ class StaticSpectrumStream(StaticStream):
         assert low_px <= high_px
         return low_px, high_px
 
-    def get_spatial_spectrum(self, data=None, raw=False):
+    def get_spatial_spectrum(self, data=None, raw=False, step=1):
         """
         Project a spectrum cube (CYX) to XY space in RGB, by averaging the
           intensity over all the wavelengths (selected by the user)
@@ -575,6 +773,8 @@ class StaticSpectrumStream(StaticStream):
           will use the whole data from the stream.
         raw (bool): if True, will return the "raw" values (ie, same data type as
           the original data). Otherwise, it will return a RGB image.
+        step (int > 0): only use one wavelength every step. Values > 1 give a
+          quicker approximation of the average.
         return (DataArray YXC of uint8 or YX of same data type as data): average
           intensity over the selected wavelengths
         """
@@ -587,7 +787,7 @@ class StaticSpectrumStream(StaticStream):
         logging.debug("Spectrum range picked: %s px", spec_range)
 
         if raw:
-            av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1], axis=0)
+            av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1:step], axis=0)
             av_data = img.ensure2DImage(av_data).astype(data.dtype)
             return model.DataArray(av_data, md)
         else:
@@ -595,7 +795,7 @@ class StaticSpectrumStream(StaticStream):
 
             if not self.fitToRGB.value:
                 # TODO: use better intermediary type if possible?, cf semcomedi
-                av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1], axis=0)
+                av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1:step], axis=0)
                 av_data = img.ensure2DImage(av_data)
                 rgbim = img.DataArray2RGB(av_data, irange)
             else:
@@ -616,14 +816,14 @@ class StaticSpectrumStream(StaticStream):
                 rrange[1] = max(rrange)
 
                 # FIXME: unoptimized, as each channel is duplicated 3 times, and discarded
-                av_data = numpy.mean(data[rrange[0]:rrange[1] + 1], axis=0)
+                av_data = numpy.mean(data[rrange[0]:rrange[1] + 1:step], axis=0)
                 av_data = img.ensure2DImage(av_data)
                 rgbim = img.DataArray2RGB(av_data, irange)
-                av_data = numpy.mean(data[grange[0]:grange[1] + 1], axis=0)
+                av_data = numpy.mean(data[grange[0]:grange[1] + 1:step], axis=0)
                 av_data = img.ensure2DImage(av_data)
                 gim = img.DataArray2RGB(av_data, irange)
                 rgbim[:, :, 1] = gim[:, :, 0]
-                av_data = numpy.mean(data[brange[0]:brange[1] + 1], axis=0)
+                av_data = numpy.mean(data[brange[0]:brange[1] + 1:step], axis=0)
                 av_data = img.ensure2DImage(av_data)
                 bim = img.DataArray2RGB(av_data, irange)
                 rgbim[:, :, 2] = bim[:, :, 0]
@@ -797,6 +997,11 @@ class StaticSpectrumStream(StaticStream):
 
         return av_data
 
+    # Above this number of values to average, a preview image is first computed
+    PREVIEW_MIN_SIZE = 2 ** 20
+    # Number of wavelengths averaged to compute the preview image
+    PREVIEW_WAVELENGTHS = 8
+
     def _updateImage(self):
         """ Recomputes the image with all the raw data available
           Note: for spectrum-based data, it mostly computes a projection of the
@@ -806,6 +1011,19 @@ class StaticSpectrumStream(StaticStream):
             data = self._calibrated
             if data is None: # can happen during __init__
                 return
+
+            # If it's long to compute, first display quickly an image using
+            # just a few of the wavelengths
+            spec_range = self._get_bandwidth_in_pixel()
+            nwl = spec_range[1] - spec_range[0] + 1
+            if (nwl > 2 * self.PREVIEW_WAVELENGTHS and
+                nwl * numpy.prod(data.shape[1:]) > self.PREVIEW_MIN_SIZE):
+                step = int(math.ceil(nwl / self.PREVIEW_WAVELENGTHS))
+                self.image.value = self.get_spatial_spectrum(data, step=step)
+                if self._im_needs_recompute.is_set():
+                    # Already outdated (eg, the bandwidth has changed)
+                    return
+
             self.image.value = self.get_spatial_spectrum(data)
         except Exception:
             logging.exception("Updating %s image", self.__class__.__name__)
@@ -1669,3 +1669,343 @@ class MomentOfInertiaMDStream(SEMCCDMDStream):
             # in case of exception, so drop it immediately on the log too
             logging.exception("Failure to compute moment of inertia")
             raise
+
+
+class MonochromatorScanStream(Stream):
+    """
+    Stream that acquires a spectrum by scanning the centre wavelength of a
+    spectrograph, while acquiring with a monochromator (ie, a counting detector
+    behind the exit slit) at one point of the e-beam.
+
+    If the speed of the spectrograph is known, and it's slow enough to
+    acquire every point during the move, the wavelength is swept continuously
+    while the detector keeps acquiring. The wavelength of each acquisition
+    is then computed from its time. Otherwise (or if .sweep is False), the
+    spectrograph is moved to each wavelength, one at a time, and the detector
+    acquires once the move is over.
+    """
+
+    # Time needed to change the wavelength, in step mode
+    STEP_MOVE_TIME = 0.05  # s
+    # Extra time between two acquisitions of the detector, in sweep mode
+    SWEEP_SAMPLE_OVERHEAD = 0.01  # s
+
+    def __init__(self, name, detector, emitter, spectrograph):
+        """
+        name (string): user-friendly name of this stream
+        detector (Detector): the monochromator
+        emitter (Emitter): the emitter (eg: ebeam scanner)
+        spectrograph (Actuator): the spectrograph, with a "wavelength" axis
+        """
+        super(MonochromatorScanStream, self).__init__(name, detector, detector.data, emitter)
+        self._sgr = spectrograph
+
+        wlr = spectrograph.axes["wavelength"].range
+        self.startWavelength = model.FloatContinuous(400e-9, wlr, unit="m")
+        self.endWavelength = model.FloatContinuous(500e-9, wlr, unit="m")
+        self.numberOfPixels = model.IntContinuous(51, (2, 1000), unit="px")
+        self.dwellTime = model.FloatContinuous(1e-3, range=emitter.dwellTime.range,
+                                               unit="s")
+        self.emtTranslation = model.TupleContinuous((0, 0),
+                                                    range=emitter.translation.range,
+                                                    cls=(int, long, float),
+                                                    unit="px")
+        # If True, sweep the wavelength during the acquisition, when the
+        # hardware allows it
+        self.sweep = model.BooleanVA(True)
+
+        # For acquisition
+        self._pt_acq = threading.Event()
+        self._acq_thread = None
+        self._points = []  # (float, number): time and value of each acquisition
+        self._md = {}
+
+    def _getSweepDuration(self):
+        """
+        Computes how long the sweep over the wavelength range will last
+        return (None or 0<float): duration in s, or None if the wavelength
+          cannot be swept (and so the acquisition must be done step by step)
+        """
+        if not self.sweep.value:
+            return None
+
+        wls = self.startWavelength.value
+        wle = self.endWavelength.value
+        res = self.numberOfPixels.value
+        if wls == wle or res <= 1:
+            return None
+
+        # Not all the axes report their speed
+        speed = getattr(self._sgr.axes["wavelength"], "speed", None)
+        if not speed or not speed[1] > 0:
+            logging.debug("Spectrograph speed unknown, cannot sweep the wavelength")
+            return None
+
+        dur = abs(wle - wls) / speed[1]
+        # Every wavelength needs (at least) one acquisition
+        if dur / res < self.dwellTime.value + self.SWEEP_SAMPLE_OVERHEAD:
+            logging.debug("Spectrograph too fast to sweep the wavelength with "
+                          "dwell time %g s", self.dwellTime.value)
+            return None
+        return dur
+
+    def estimateAcquisitionTime(self):
+        dur = self._getSweepDuration()
+        if dur is None:
+            nbp = self.numberOfPixels.value
+            return nbp * (self.dwellTime.value + self.STEP_MOVE_TIME)
+        else:
+            return dur + self.SETUP_OVERHEAD
+
+    def acquire(self):
+        """
+        Runs the acquisition
+        returns Future that will have as a result a DataArray with the spectrum
+        """
+        est_start = time.time() + 0.1
+        f = model.ProgressiveFuture(start=est_start,
+                                    end=est_start + self.estimateAcquisitionTime())
+        f.task_canceller = self._cancelAcquisition
+        f._acq_state = RUNNING
+        f._acq_lock = threading.Lock()
+        f._acq_done = threading.Event()
+
+        # run task in separate thread
+        self._acq_thread = threading.Thread(target=_futures.executeTask,
+                                            name="Monochromator scan acquisition",
+                                            args=(f, self._runAcquisition, f))
+        self._acq_thread.start()
+        return f
+
+    def _on_mchr_data(self, df, data):
+        if not self._md:
+            self._md = data.metadata.copy()
+        if data.shape != (1, 1):
+            logging.error("Monochromator scan got %s values for just one point", data.shape)
+        # Store the time at the middle of the acquisition
+        md = data.metadata
+        t = md.get(MD_ACQ_DATE, time.time()) + md.get(model.MD_DWELL_TIME, 0) / 2
+        self._points.append((t, data[0, 0]))
+        self._pt_acq.set()
+
+    def _runAcquisition(self, future):
+        self._points = []
+        self._md = {}
+
+        wls = self.startWavelength.value
+        wle = self.endWavelength.value
+        res = self.numberOfPixels.value
+        dt = self.dwellTime.value
+        if wle == wls:
+            res = 1
+
+        # Prepare the hardware
+        self._emitter.resolution.value = (1, 1)  # Force one pixel only
+        self._emitter.translation.value = self.emtTranslation.value
+        self._emitter.dwellTime.value = dt
+
+        try:
+            spec = None
+            sweep_dur = self._getSweepDuration()
+            if sweep_dur is not None:
+                spec, wllist = self._runSweepAcquisition(future, wls, wle, res, dt, sweep_dur)
+                if spec is None:
+                    logging.warning("Failed to sweep the wavelength, will acquire step by step")
+            if spec is None:
+                spec, wllist = self._runStepAcquisition(future, wls, wle, res, dt)
+
+            # Convert the sequence of data into one spectrum in a DataArray
+            if wls > wle:  # went backward? => sort back the spectrum
+                logging.debug("Inversing spectrum as acquisition went from %g to %g m", wls, wle)
+                spec = spec[::-1]
+                wllist.reverse()
+
+            na = numpy.array(spec)  # keeps the dtype
+            na.shape += (1, 1, 1, 1)  # make it 5th dim to indicate a channel
+            md = self._md
+            md[model.MD_WL_LIST] = wllist
+            if model.MD_OUT_WL in md:
+                # The MD_OUT_WL on the monochromator contains the current cw, which we don't want
+                del md[model.MD_OUT_WL]
+
+            # MD_POS should already be at the correct position (from the e-beam metadata)
+
+            # MD_PIXEL_SIZE is not meaningful but handy for the display in Odemis
+            # (it's the size of the square on top of the SEM survey => BIG!)
+            sempxs = self._emitter.pixelSize.value
+            md[MD_PIXEL_SIZE] = (sempxs[0] * 50, sempxs[1] * 50)
+
+            da = model.DataArray(na, md)
+
+            with future._acq_lock:
+                if future._acq_state == CANCELLED:
+                    raise CancelledError()
+                future._acq_state = FINISHED
+
+            self.raw = [da]
+            return [da]
+
+        except CancelledError:
+            raise  # Just don't log the exception
+        except Exception:
+            logging.exception("Failure during monochromator scan")
+            raise
+        finally:
+            future._acq_done.set()
+
+    def _runStepAcquisition(self, future, wls, wle, res, dt):
+        """
+        Acquires the spectrum by moving to each wavelength, and acquiring one
+        point once the move is over.
+        return:
+            spec (list of numbers): the value for each wavelength
+            wllist (list of floats): the wavelengths (in m)
+        """
+        # Discard the data acquired by a previous (failed) sweep
+        self._points = []
+        self._md = {}
+        trig = self._detector.softwareTrigger
+        df = self._detector.data
+
+        if res <= 1:
+            res = 1
+            wli = 0
+        else:
+            wli = (wle - wls) / (res - 1)
+
+        wllist = []
+        df.synchronizedOn(trig)
+        df.subscribe(self._on_mchr_data)
+        try:
+            for i in range(res):
+                left = (res - i) * (dt + self.STEP_MOVE_TIME)
+                future.set_progress(end=time.time() + left)
+
+                cwl = wls + i * wli  # requested value
+                self._sgr.moveAbs({"wavelength": cwl}).result()
+                if future._acq_state == CANCELLED:
+                    raise CancelledError()
+                cwl = self._sgr.position.value["wavelength"]  # actual value
+                logging.info("Acquiring point %d/%d @ %s", i + 1, res,
+                             units.readable_str(cwl, unit="m", sig=3))
+
+                self._pt_acq.clear()
+                trig.notify()
+                if not self._pt_acq.wait(dt * 5 + 1):
+                    raise IOError("Timeout waiting for the data")
+                if future._acq_state == CANCELLED:
+                    raise CancelledError()
+                wllist.append(cwl)
+        finally:
+            # In case it was stopped before the end
+            df.unsubscribe(self._on_mchr_data)
+            df.synchronizedOn(None)
+
+        return [v for t, v in self._points], wllist
+
+    def _runSweepAcquisition(self, future, wls, wle, res, dt, sweep_dur):
+        """
+        Acquires the spectrum by moving the wavelength continuously, while the
+        detector keeps acquiring.
+        return:
+            spec (None or numpy.array of floats): the mean value at each
+              wavelength, or None if no data could be acquired during the sweep
+            wllist (list of floats): the wavelengths (in m)
+        """
+        df = self._detector.data
+
+        future.set_progress(end=time.time() + sweep_dur + self.SETUP_OVERHEAD)
+        self._sgr.moveAbs({"wavelength": wls}).result()
+        if future._acq_state == CANCELLED:
+            raise CancelledError()
+        wl0 = self._sgr.position.value["wavelength"]
+
+        self._pt_acq.clear()
+        df.subscribe(self._on_mchr_data)
+        try:
+            # Wait for the detector to be acquiring, so that the whole move is covered
+            if not self._pt_acq.wait(dt * 5 + 1):
+                raise IOError("Timeout waiting for the data")
+            if future._acq_state == CANCELLED:
+                raise CancelledError()
+
+            logging.info("Sweeping from %s to %s",
+                         units.readable_str(wls, unit="m", sig=3),
+                         units.readable_str(wle, unit="m", sig=3))
+            future.set_progress(end=time.time() + sweep_dur + self.SETUP_OVERHEAD)
+            t0 = time.time()
+            self._sgr.moveAbs({"wavelength": wle}).result()
+            t1 = time.time()
+            if future._acq_state == CANCELLED:
+                raise CancelledError()
+
+            # Wait for the acquisition happening at the end of the move
+            self._pt_acq.clear()
+            if not self._pt_acq.wait(dt * 5 + 1):
+                raise IOError("Timeout waiting for the data")
+        finally:
+            df.unsubscribe(self._on_mchr_data)
+        wl1 = self._sgr.position.value["wavelength"]
+
+        wllist = [wls + i * (wle - wls) / (res - 1) for i in range(res)]
+        spec = self._assignWavelengths(self._points, t0, t1, wl0, wl1, wllist)
+        return spec, wllist
+
+    @staticmethod
+    def _assignWavelengths(points, t0, t1, wl0, wl1, wllist):
+        """
+        Computes the spectrum from the acquisitions done during a sweep. The
+        move is assumed to be at constant speed.
+        points (list of (float, number)): time and value of each acquisition
+        t0 (float): time the move started
+        t1 (float): time the move ended
+        wl0 (float): wavelength at the beginning of the move
+        wl1 (float): wavelength at the end of the move
+        wllist (list of float): the wavelengths of the spectrum, in order and
+          evenly spaced
+        return (None or numpy.array of floats): mean value of the acquisitions
+          closest to each wavelength of wllist, or None if no acquisition
+          happened during the move.
+        """
+        times = numpy.array([t for t, v in points], dtype=numpy.float64)
+        vals = numpy.array([v for t, v in points], dtype=numpy.float64)
+        during = (t0 <= times) & (times <= t1)
+        if t1 <= t0 or not during.any():
+            return None
+
+        # Interpolate the wavelength of each acquisition from its time
+        wl = wl0 + (times[during] - t0) * ((wl1 - wl0) / (t1 - t0))
+        res = len(wllist)
+        step = (wllist[-1] - wllist[0]) / (res - 1)
+        idx = numpy.round((wl - wllist[0]) / step).astype(numpy.int)
+        inside = (0 <= idx) & (idx < res)
+        idx = idx[inside]
+        counts = numpy.bincount(idx, minlength=res)
+        sums = numpy.bincount(idx, weights=vals[during][inside], minlength=res)
+        if not counts.any():
+            return None
+        spec = sums / numpy.maximum(counts, 1)
+
+        # Wavelengths without acquisition get the value of their neighbours
+        empty = (counts == 0)
+        if empty.any():
+            logging.warning("No acquisition for %d wavelengths, will interpolate them",
+                            numpy.count_nonzero(empty))
+            spec[empty] = numpy.interp(numpy.flatnonzero(empty),
+                                       numpy.flatnonzero(~empty), spec[~empty])
+        return spec
+
+    def _cancelAcquisition(self, future):
+        with future._acq_lock:
+            if future._acq_state == FINISHED:
+                return False  # too late
+            future._acq_state = CANCELLED
+
+        logging.debug("Cancelling acquisition of components %s and %s",
+                      self._emitter.name, self._detector.name)
+
+        self._pt_acq.set()  # To help end quickly
+
+        # Wait for the thread to be complete (and hardware state restored)
+        future._acq_done.wait(5)
+        return True
@@ -43,8 +43,38 @@ SECOM_CONFIG = CONFIG_PATH + "sim/secom-sim.odm.yaml"
 class TestNoBackend(unittest.TestCase):
     # No backend, and only fake streams that don't generate anything
 
-    # TODO
-    pass
+    def test_schedule_time(self):
+        """
+        Check the estimation of the time when some streams run simultaneously
+        """
+        s1, s2, s3 = "s1", "s2", "s3"  # Only need to be hashable
+        times = {s1: 2, s2: 3, s3: 5}
+
+        # All in conflict => one after another
+        conflicts = {s1: {s2, s3}, s2: {s1, s3}, s3: {s1, s2}}
+        t = acq._estimateScheduleTime([s1, s2, s3], times, conflicts)
+        self.assertEqual(t, 10)
+
+        # None in conflict => all at the same time
+        conflicts = {s1: set(), s2: set(), s3: set()}
+        t = acq._estimateScheduleTime([s1, s2, s3], times, conflicts)
+        self.assertEqual(t, 5)
+
+        # s1 and s2 in conflict => s3 runs in parallel of both
+        conflicts = {s1: {s2}, s2: {s1}, s3: set()}
+        t = acq._estimateScheduleTime([s1, s2, s3], times, conflicts)
+        self.assertEqual(t, 5)
+
+        # s1 in conflict with both => s2 and s3 together, after s1
+        conflicts = {s1: {s2, s3}, s2: {s1}, s3: {s1}}
+        t = acq._estimateScheduleTime([s1, s2, s3], times, conflicts)
+        self.assertEqual(t, 7)
+
+        # s2 and s3 cannot start before s1, even if they don't conflict with each other
+        self.assertEqual(acq._getStartableStreams([s1, s2, s3], set(), conflicts),
+                         [s1])
+        self.assertEqual(acq._getStartableStreams([s2, s3], {s1}, conflicts),
+                         [])
 
 # @skip("simple")
 class SECOMTestCase(unittest.TestCase):
@@ -161,6 +191,31 @@ class SECOMTestCase(unittest.TestCase):
         self.assertTrue(self.done)
         self.assertTrue(f.cancelled())
 
+    def test_conflicts(self):
+        """
+        Check the streams sharing hardware are not acquired simultaneously
+        """
+        sems = stream.SEMStream("sem", self.sed, self.sed.data, self.ebeam)
+        streams = self.streams + [sems]
+        conflicts = acq._getConflicts(streams)
+
+        # The optical streams all use the same camera
+        for s in self.streams:
+            self.assertEqual(conflicts[s], set(streams) - {s})
+
+        # The e-beam affects the camera (cathodoluminescence)
+        self.assertEqual(conflicts[sems], set(self.streams))
+
+        # => no time gained
+        est = acq.estimateTime(streams)
+        tot = sum(s.estimateAcquisitionTime() for s in streams)
+        self.assertAlmostEqual(est, tot)
+
+        f = acq.acquire(streams)
+        data, e = f.result()
+        self.assertIsNone(e)
+        self.assertEqual(len(data), len(streams))
+
     def on_done(self, future):
         self.done = True
 
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 19 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent, Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+from __future__ import division
+
+from concurrent.futures._base import CancelledError
+import logging
+from odemis import model, acq
+import odemis
+from odemis.acq import mosaic, stream
+from odemis.dataio import hdf5
+from odemis.util import test
+import os
+import time
+import unittest
+
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+CONFIG_PATH = os.path.dirname(odemis.__file__) + "/../../install/linux/usr/share/odemis/"
+SECOM_CONFIG = CONFIG_PATH + "sim/secom-sim.odm.yaml"
+
+FILENAME = u"test-mosaic" + hdf5.EXTENSIONS[0]
+
+
+class TestTiles(unittest.TestCase):
+    """
+    Test the computation of the tiles, without backend
+    """
+
+    def test_one_tile(self):
+        tiles = mosaic.computeTiles((-1e-6, -2e-6, 1e-6, 2e-6), (10e-6, 10e-6), 0.2)
+        self.assertEqual(len(tiles), 1)
+        self.assertEqual(tiles[0][0], (0, 0))
+        self.assertAlmostEqual(tiles[0][1][0], 0)
+        self.assertAlmostEqual(tiles[0][1][1], 0)
+
+    def test_grid(self):
+        fov = (10e-6, 5e-6)
+        overlap = 0.2
+        area = (0, 0, 26e-6, 13e-6)
+        tiles = mosaic.computeTiles(area, fov, overlap)
+
+        # 10 + 8 + 8 + 8 >= 26 / 5 + 4 + 4 + 4 >= 13
+        self.assertEqual(len(tiles), 3 * 3)
+        idxs = [i for i, p in tiles]
+        self.assertEqual(set(idxs), {(c, r) for c in range(3) for r in range(3)})
+
+        # Snake order: each tile is next to the previous one
+        for (i1, p1), (i2, p2) in zip(tiles[:-1], tiles[1:]):
+            self.assertEqual(abs(i1[0] - i2[0]) + abs(i1[1] - i2[1]), 1)
+
+        # The whole area is covered, and it starts from the top
+        xs = [p[0] for i, p in tiles]
+        ys = [p[1] for i, p in tiles]
+        self.assertLessEqual(min(xs) - fov[0] / 2, area[0])
+        self.assertGreaterEqual(max(xs) + fov[0] / 2, area[2])
+        self.assertLessEqual(min(ys) - fov[1] / 2, area[1])
+        self.assertGreaterEqual(max(ys) + fov[1] / 2, area[3])
+        self.assertAlmostEqual(tiles[0][1][1], max(ys))
+
+        # The tiles overlap
+        self.assertAlmostEqual(tiles[1][1][0] - tiles[0][1][0], fov[0] * (1 - overlap))
+
+    def test_exact_fit(self):
+        # If the area is exactly a number of tiles, there should be no extra tile
+        tiles = mosaic.computeTiles((0, 0, 28e-6, 10e-6), (10e-6, 10e-6), 0.1)
+        self.assertEqual(len(tiles), 3)
+
+    def test_bad_args(self):
+        with self.assertRaises(ValueError):
+            mosaic.computeTiles((0, 0, 1e-3, 1e-3), (10e-6, 10e-6), 1)
+        with self.assertRaises(ValueError):
+            mosaic.computeTiles((0, 0, -1e-3, 1e-3), (10e-6, 10e-6), 0.1)
+
+
+class SECOMTestCase(unittest.TestCase):
+
+    backend_was_running = False
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            test.start_backend(SECOM_CONFIG)
+        except LookupError:
+            logging.info("A running backend is already found, skipping tests")
+            cls.backend_was_running = True
+            return
+        except IOError as exp:
+            logging.error(str(exp))
+            raise
+
+        cls.ebeam = model.getComponent(role="e-beam")
+        cls.sed = model.getComponent(role="se-detector")
+        cls.stage = model.getComponent(role="stage")
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.backend_was_running:
+            return
+        test.stop_backend()
+
+    def setUp(self):
+        if self.backend_was_running:
+            self.skipTest("Running backend found")
+
+        self.ebeam.scale.value = (4, 4)
+        self.ebeam.dwellTime.value = self.ebeam.dwellTime.range[0]
+        self.sems = stream.SEMStream("sem", self.sed, self.sed.data, self.ebeam)
+        self.fov = mosaic.getFov(self.sems)
+        pos = self.stage.position.value
+        # 2 x 2 tiles
+        self.area = (pos["x"], pos["y"],
+                     pos["x"] + self.fov[0] * 1.5, pos["y"] + self.fov[1] * 1.5)
+
+    def tearDown(self):
+        try:
+            os.remove(FILENAME)
+        except Exception:
+            pass
+
+    def test_memory(self):
+        est = mosaic.estimateMosaicTime([self.sems], self.stage, self.area, 0.2)
+        self.assertGreater(est, 0)
+        # 4 tiles, and the moves overlap with the processing of the tiles
+        tile_acq = acq.estimateTime([self.sems])
+        move = mosaic._estimateMoveTime(self.stage, (self.fov[0] * 0.8, self.fov[1] * 0.8))
+        self.assertAlmostEqual(est, 4 * (tile_acq + max(move, mosaic.TILE_PROCESSING_TIME)))
+
+        f = mosaic.acquireMosaic([self.sems], self.stage, self.area, 0.2)
+        data = f.result()
+        self.assertEqual(len(data), 1)
+        da = data[0]
+        pxs = da.metadata[model.MD_PIXEL_SIZE]
+        res = self.ebeam.resolution.value
+        # 2 tiles overlapping in each dimension
+        self.assertEqual(da.shape, (int(round(res[1] * 1.8)), int(round(res[0] * 1.8))))
+        self.assertAlmostEqual(da.shape[1] * pxs[0], self.fov[0] * 1.8)
+
+    def test_file(self):
+        f = mosaic.acquireMosaic([self.sems], self.stage, self.area, 0.2,
+                                 register=False, filename=FILENAME)
+        self.assertIsNone(f.result())
+
+        data = hdf5.read_data(FILENAME)
+        self.assertEqual(len(data), 1)
+        res = self.ebeam.resolution.value
+        self.assertEqual(data[0].shape[-2:],
+                         (int(round(res[1] * 1.8)), int(round(res[0] * 1.8))))
+
+    def test_cancel(self):
+        f = mosaic.acquireMosaic([self.sems], self.stage, self.area, 0.2)
+        time.sleep(0.5)
+        f.cancel()
+        self.assertRaises(CancelledError, f.result, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -546,6 +546,35 @@ class Sparc2PathTestCase(unittest.TestCase):
         self.assertEqual(self.cl_det_sel.position.value,
                          {'x': 0.01})
 
+    # @skip("simple")
+    def test_set_path_twice(self):
+        """
+        Test that setting the same mode again doesn't move anything, and that
+        the duration of the mode changes is recorded
+        """
+        stats = self.optmngr.statistics
+        self.optmngr.setPath("cli").result()
+        self.optmngr.setPath("spectral").result()
+        pos_lenswitch = self.lenswitch.position.value
+        pos_spec_det_sel = self.spec_det_sel.position.value
+        pos_cl_det_sel = self.cl_det_sel.position.value
+        nspec = stats.latencies["spectral"].count
+        dropped = stats.dropped
+
+        self.optmngr.setPath("spectral").result()
+        self.assertEqual(stats.latencies["spectral"].count, nspec + 1)
+        # At least the lens-switch, the slit and the selectors were already in position
+        self.assertGreaterEqual(stats.dropped, dropped + 3)
+        self.assertEqual(self.lenswitch.position.value, pos_lenswitch)
+        self.assertEqual(self.spec_det_sel.position.value, pos_spec_det_sel)
+        self.assertEqual(self.cl_det_sel.position.value, pos_cl_det_sel)
+        logging.info("Mode change durations: %s", stats.to_dict())
+
+        # Going back to another mode still moves the selectors
+        self.optmngr.setPath("cli").result()
+        self.assertEqual(self.cl_det_sel.position.value,
+                         {'x': 0.003})
+
     # @skip("simple")
     def test_guess_mode(self):
         # test guess mode for ar
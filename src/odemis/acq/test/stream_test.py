@@ -29,7 +29,7 @@ from odemis import model
 import odemis
 from odemis.acq import stream, calibration
 from odemis.driver import simcam
-from odemis.util import test, conversion, img
+from odemis.util import test, conversion, img, driver
 import os
 import threading
 import time
@@ -314,6 +314,121 @@ class StreamTestCase(unittest.TestCase):
         self.assertLessEqual(len(h), 1024)
         self.assertEqual((ir[0][0], ir[1][1]), (0, (2 ** 12) - 1))
 
+    def test_display_request(self):
+        """
+        Check that only the displayed part of the data is projected while
+        playing, and that the whole data is projected once paused.
+        """
+        ebeam = FakeEBeam("ebeam")
+        se = FakeDetector("se")
+        ss = stream.SEMStream("test", se, se.data, ebeam)
+
+        ss.should_update.value = True
+        ss.is_active.value = True
+
+        # Display the top-left quarter, at half the resolution
+        ss.setDisplayRequest("test", (1e-3 - 512e-6, 1e-3, 1e-3, 1e-3 + 512e-6), 2e-6)
+
+        d = numpy.zeros((1024, 1024), "uint16")
+        md = {model.MD_BPP: 12,
+              model.MD_PIXEL_SIZE: (1e-6, 1e-6), # m/px
+              model.MD_POS: (1e-3, 1e-3), # m
+              }
+        se.data.notify(model.DataArray(d, md))
+
+        time.sleep(0.5) # make sure all the delayed code is executed
+        im = ss.image.value
+        self.assertEqual(im.shape[:2], (256, 256))
+        self.assertEqual(im.metadata[model.MD_PIXEL_SIZE], (2e-6, 2e-6))
+        self.assertTupleAlmostEqual(im.metadata[model.MD_POS], (1e-3 - 256e-6, 1e-3 + 256e-6))
+
+        # For exporting, the whole image is available
+        fim = ss.getFullImage()
+        self.assertEqual(fim.shape[:2], (1024, 1024))
+        self.assertEqual(fim.metadata[model.MD_PIXEL_SIZE], (1e-6, 1e-6))
+        self.assertTupleAlmostEqual(fim.metadata[model.MD_POS], (1e-3, 1e-3))
+        self.assertIs(ss.image.value, im)
+
+        # Paused => full image
+        ss.is_active.value = False
+        time.sleep(0.5)
+        im = ss.image.value
+        self.assertEqual(im.shape[:2], (1024, 1024))
+        self.assertEqual(im.metadata[model.MD_PIXEL_SIZE], (1e-6, 1e-6))
+        self.assertTupleAlmostEqual(im.metadata[model.MD_POS], (1e-3, 1e-3))
+        self.assertIs(ss.getFullImage(), im)
+
+        ss.removeDisplayRequest("test")
+
+    def test_partial_data(self):
+        """
+        Check the image is updated with the blocks of rows of the frame being
+        scanned, without modifying the .raw, which only gets complete frames.
+        """
+        ebeam = FakeEBeam("ebeam")
+        se = FakeDetector("se")
+        se.partialData = driver.PartialDataFlow()
+        ss = stream.SEMStream("test", se, se.data, ebeam)
+
+        ss.should_update.value = True
+        ss.is_active.value = True
+
+        md = {model.MD_BPP: 8,
+              model.MD_PIXEL_SIZE: (1e-6, 1e-6),  # m/px
+              model.MD_POS: (1e-3, 1e-3),  # m
+              model.MD_ACQ_DATE: time.time(),
+              }
+        se.data.notify(model.DataArray(numpy.zeros((256, 256), "uint8"), md))
+        time.sleep(0.5)  # make sure all the delayed code is executed
+        self.assertTrue(se.partialData.active)
+        raw0 = ss.raw[0]
+        ss.auto_bc.value = False
+        ss.intensityRange.value = (0, 255)
+
+        # First rows of the next frame
+        bmd = md.copy()
+        bmd[model.MD_ACQ_DATE] += 1
+        bmd[model.MD_FRAME_ROWS] = (0, 64, 256)
+        se.partialData.notify(model.DataArray(numpy.zeros((64, 256), "uint8") + 255, bmd))
+        time.sleep(0.5)
+        self.assertIs(ss.raw[0], raw0)
+        self.assertEqual(raw0.max(), 0)
+        im = ss.image.value
+        self.assertEqual(im.shape[:2], (256, 256))
+        self.assertEqual(im[0, 0].tolist(), [255, 255, 255])
+        self.assertEqual(im[100, 0].tolist(), [0, 0, 0])
+
+        # The next rows are added to the image
+        bmd[model.MD_FRAME_ROWS] = (64, 128, 256)
+        se.partialData.notify(model.DataArray(numpy.zeros((64, 256), "uint8") + 255, bmd))
+        time.sleep(0.5)
+        self.assertIs(ss.raw[0], raw0)
+        im = ss.image.value
+        self.assertEqual(im[0, 0].tolist(), [255, 255, 255])
+        self.assertEqual(im[100, 0].tolist(), [255, 255, 255])
+        self.assertEqual(im[200, 0].tolist(), [0, 0, 0])
+
+        # The complete frame replaces the partial one
+        fmd = md.copy()
+        fmd[model.MD_ACQ_DATE] = bmd[model.MD_ACQ_DATE]
+        se.data.notify(model.DataArray(numpy.zeros((256, 256), "uint8") + 128, fmd))
+        time.sleep(0.5)
+        raw1 = ss.raw[0]
+        self.assertEqual(raw1[200, 0], 128)
+        im = ss.image.value
+        self.assertEqual(im[0, 0].tolist(), im[200, 0].tolist())
+
+        # A late block of the same frame is ignored
+        bmd[model.MD_FRAME_ROWS] = (128, 192, 256)
+        se.partialData.notify(model.DataArray(numpy.zeros((64, 256), "uint8"), bmd))
+        time.sleep(0.5)
+        self.assertIs(ss.raw[0], raw1)
+        im = ss.image.value
+        self.assertEqual(im[0, 0].tolist(), im[150, 0].tolist())
+
+        ss.is_active.value = False
+        self.assertFalse(se.partialData.active)
+
     def test_hwvas(self):
         ebeam = FakeEBeam("ebeam")
         se = FakeDetector("se")
@@ -1135,6 +1250,75 @@ class SPARCTestCase(unittest.TestCase):
         md = mcsd.metadata
         self.assertIn(model.MD_POS, md)
 
+#     @skip("simple")
+    def test_acq_mn_scan(self):
+        """
+        Test acquisition of a spectrum by scanning the wavelength with the
+        monochromator, both by sweeping and step by step
+        """
+        mss = stream.MonochromatorScanStream("test mn scan", self.mnchr, self.ebeam, self.spgp)
+        mss.numberOfPixels.value = 30
+        mss.dwellTime.value = 1e-3  # s
+
+        for sweep in (True, False):
+            mss.sweep.value = sweep
+            # Also check going backward gives a spectrum in the right order
+            for wls, wle in ((400e-9, 700e-9), (700e-9, 400e-9)):
+                mss.startWavelength.value = wls
+                mss.endWavelength.value = wle
+                exp_dur = mss.estimateAcquisitionTime()
+                if sweep:
+                    # Simulated spectrograph is slow enough to sweep
+                    self.assertLess(exp_dur, 30 * (1e-3 + mss.STEP_MOVE_TIME))
+
+                f = mss.acquire()
+                data = f.result(exp_dur * 3 + 10)
+                self.assertEqual(len(data), 1)
+                spec = data[0]
+                self.assertEqual(spec.shape, (30, 1, 1, 1, 1))
+                wll = spec.metadata[model.MD_WL_LIST]
+                self.assertEqual(len(wll), 30)
+                self.assertEqual(wll, sorted(wll))
+                self.assertAlmostEqual(wll[0], 400e-9, delta=1e-9)
+                self.assertAlmostEqual(wll[-1], 700e-9, delta=1e-9)
+                self.assertIs(mss.raw[0], spec)
+
+        # Cancelling
+        mss.sweep.value = True
+        f = mss.acquire()
+        time.sleep(0.1)
+        f.cancel()
+        self.assertTrue(f.cancelled())
+
+#     @skip("simple")
+    def test_acq_mn_scan_sweep_fallback(self):
+        """
+        Test that when the sweep fails, the spectrum acquired step by step
+        doesn't contain the data of the sweep
+        """
+        class FailingSweepStream(stream.MonochromatorScanStream):
+            def _runSweepAcquisition(self, future, wls, wle, res, dt, sweep_dur):
+                # Acquire during the sweep, but pretend it failed
+                spec, wllist = super(FailingSweepStream, self)._runSweepAcquisition(
+                                                future, wls, wle, res, dt, sweep_dur)
+                self.sweep_points = len(self._points)
+                return None, wllist
+
+        mss = FailingSweepStream("test mn scan", self.mnchr, self.ebeam, self.spgp)
+        mss.numberOfPixels.value = 30
+        mss.dwellTime.value = 1e-3  # s
+        mss.startWavelength.value = 400e-9
+        mss.endWavelength.value = 700e-9
+        mss.sweep.value = True
+        exp_dur = 30 * (1e-3 + mss.STEP_MOVE_TIME)
+
+        f = mss.acquire()
+        data = f.result(exp_dur * 3 + 10)
+        self.assertGreater(mss.sweep_points, 0)
+        spec = data[0]
+        self.assertEqual(spec.shape, (30, 1, 1, 1, 1))
+        self.assertEqual(len(spec.metadata[model.MD_WL_LIST]), 30)
+
 #     @skip("simple")
     def test_count(self):
         cs = stream.CameraCountStream("test count", self.spec, self.spec.data, self.ebeam)
@@ -1916,6 +2100,110 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         self.assertFalse(im2d1 is im2dc)
 
+    def test_ar_progressive(self):
+        """Test StaticARStream displays first a low resolution projection"""
+        md = {model.MD_SW_VERSION: "1.0-test",
+             model.MD_HW_NAME: "fake ccd",
+             model.MD_DESCRIPTION: "AR",
+             model.MD_ACQ_DATE: time.time(),
+             model.MD_BPP: 12,
+             model.MD_BINNING: (1, 1), # px, px
+             model.MD_SENSOR_PIXEL_SIZE: (13e-6, 13e-6), # m/px
+             model.MD_PIXEL_SIZE: (2e-5, 2e-5), # m/px
+             model.MD_POS: (1.2e-3, -30e-3), # m
+             model.MD_EXP_TIME: 1.2, # s
+             model.MD_AR_POLE: (253.1, 65.1),
+             model.MD_LENS_MAG: 0.4, # ratio
+            }
+        data0 = model.DataArray(1500 + numpy.zeros((512, 1024), dtype=numpy.uint16), md)
+
+        images = []
+        e = threading.Event()
+        def on_im(im):
+            if im is not None:
+                images.append(im)
+                if im.shape[0] == 1024:  # 2 x smallest dimension of the data
+                    e.set()
+
+        ars = stream.StaticARStream("test", [data0])
+        ars.image.subscribe(on_im, init=True)
+        e.wait(30)
+        self.assertTrue(e.is_set(), "Full projection not received")
+
+        # The preview should have been received before (unless it came before
+        # the subscription)
+        if len(images) > 1:
+            self.assertLess(images[0].shape[0], 1024)
+
+        # Now it's cached => directly the full projection
+        del images[:]
+        ars.point.value = (None, None)
+        ars.point.value = md[model.MD_POS]
+        time.sleep(0.5)
+        self.assertEqual([im.shape[0] for im in images], [1024])
+
+    def test_ar_cache(self):
+        """Test the cache and prefetch of the StaticARStream projections"""
+        md = {model.MD_SW_VERSION: "1.0-test",
+             model.MD_HW_NAME: "fake ccd",
+             model.MD_DESCRIPTION: "AR",
+             model.MD_ACQ_DATE: time.time(),
+             model.MD_BPP: 12,
+             model.MD_BINNING: (1, 1), # px, px
+             model.MD_SENSOR_PIXEL_SIZE: (13e-6, 13e-6), # m/px
+             model.MD_PIXEL_SIZE: (2e-5, 2e-5), # m/px
+             model.MD_EXP_TIME: 1.2, # s
+             model.MD_AR_POLE: (253.1, 65.1),
+             model.MD_LENS_MAG: 0.4, # ratio
+            }
+
+        # 4 points on a line
+        data = []
+        for i in range(4):
+            mdi = dict(md)
+            mdi[model.MD_POS] = (1.2e-3 + i * 1e-5, -30e-3)
+            data.append(model.DataArray(1500 + 100 * i + numpy.zeros((512, 1024), dtype=numpy.uint16), mdi))
+        pos = [d.metadata[model.MD_POS] for d in data]
+
+        ars = stream.StaticARStream("test", data)
+        self.assertEqual(ars.point.value, pos[0])
+
+        # All the projections should be computed in background
+        for i in range(60):
+            if len(ars._polar) == 4:
+                break
+            time.sleep(0.5)
+        self.assertEqual(set(ars._polar.keys()), set(pos))
+
+        # Projection of another point should come directly from the cache
+        polard3 = ars._polar[pos[3]]
+        e = threading.Event()
+        def on_im(im):
+            if im is not None:
+                e.set()
+        ars.image.subscribe(on_im)
+        ars.point.value = pos[3]
+        e.wait(5)
+        self.assertIs(ars._project2Polar(pos[3]), polard3)
+
+        # With a smaller cache, only the closest points should be kept
+        ars.MAX_POLAR_CACHE_SIZE = polard3.nbytes * 2
+        dcalib = numpy.ones((1, 1, 1, 512, 1024), dtype=numpy.uint16)
+        ars.background.value = model.DataArray(dcalib, md)
+        for i in range(60):
+            time.sleep(0.5)
+            if len(ars._polar) >= 2 and not ars._polar_computing:
+                break
+        time.sleep(1)  # Check it doesn't compute more
+        self.assertEqual(set(ars._polar.keys()), {pos[3], pos[2]})
+        self.assertLessEqual(ars._polar_size, ars.MAX_POLAR_CACHE_SIZE)
+
+        # Going back to the first point still works, and drops the least
+        # recently used one
+        ars._project2Polar(pos[0])
+        self.assertIn(pos[0], ars._polar)
+        self.assertEqual(len(ars._polar), 2)
+
     def _create_spec_data(self):
         # Spectrum
         data = numpy.ones((251, 1, 1, 200, 300), dtype="uint16")
@@ -1964,6 +2252,36 @@ class StaticStreamsTestCase(unittest.TestCase):
         im2d = specs.image.value
         self.assertEqual(im2d.shape, spec.shape[-2:] + (3,))
 
+    def test_spec_progressive(self):
+        """Test StaticSpectrumStream displays first a preview"""
+        spec = self._create_spec_data()
+        specs = stream.StaticSpectrumStream("test", spec)
+        time.sleep(0.5)  # wait a bit for the image to update
+
+        images = []
+        specs.image.subscribe(images.append)
+        # Large bandwidth => long to compute => preview
+        specs.spectrumBandwidth.value = (specs.spectrumBandwidth.range[0][0],
+                                         specs.spectrumBandwidth.range[1][1])
+        final = specs.get_spatial_spectrum()
+
+        # Wait for the final image, which is the full projection
+        tend = time.time() + 30  # s, generous, in case the computer is slow
+        i_final = None
+        while i_final is None:
+            for i, im in enumerate(list(images)):
+                if numpy.array_equal(im, final):
+                    i_final = i
+                    break
+            else:
+                self.assertLess(time.time(), tend, "Final image not received")
+                time.sleep(0.1)
+
+        # At least one preview image before the final one
+        self.assertGreaterEqual(i_final, 1)
+        for im in images:
+            self.assertEqual(im.shape, spec.shape[-2:] + (3,))
+
     def test_spec_0d(self):
         """Test StaticSpectrumStream 0D"""
         spec = self._create_spec_data()
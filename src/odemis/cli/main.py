@@ -34,12 +34,15 @@ import logging
 import numbers
 from odemis import model, dataio, util
 import odemis
+from odemis.dataio import hdf5
 from odemis.util import units
 from odemis.util.conversion import convert_to_object
 from odemis.util.driver import BACKEND_RUNNING, \
     BACKEND_DEAD, BACKEND_STOPPED, get_backend_status, BACKEND_STARTING
+import Queue
 import sys
 import threading
+import time
 
 
 status_to_xtcode = {BACKEND_RUNNING: 0,
@@ -48,6 +51,12 @@ status_to_xtcode = {BACKEND_RUNNING: 0,
                     BACKEND_STARTING: 3,
                     }
 
+# Maximum amount of data waiting to be written during a recording. When it's
+# full, the new frames are dropped.
+RECORD_BUFFER_SIZE = 512 * 2 ** 20  # B
+# Duration during which the statistics of a dataflow are recorded (in s)
+STATS_DURATION = 5
+
 # small object that can be remotely executed for scanning
 class Scanner(model.Component):
     def __init__(self, cls, **kwargs):
@@ -738,6 +747,268 @@ def live_display(comp_name, df_name):
     finally:
         df.unsubscribe(new_image_wrapper)
 
+class FrameRecorder(object):
+    """
+    Receives the frames of a DataFlow, and writes them to a file from a separate
+    thread. The frames go through a bounded buffer: if the frames cannot be
+    written as fast as they arrive, the buffer fills up and the new frames are
+    dropped (and counted), instead of using up all the memory.
+    """
+
+    def __init__(self, writer, max_frames=None, buffer_size=RECORD_BUFFER_SIZE):
+        """
+        writer (hdf5.FrameWriter): where to write the frames. It is closed by
+          close().
+        max_frames (None or 0 < int): number of frames to receive, after which
+          .finished is set and the next frames are ignored. None for no limit.
+        buffer_size (0 < int): maximum amount of data waiting to be written (in
+          bytes). One frame can always be buffered, even if it's bigger.
+        """
+        self._writer = writer
+        self._max_frames = max_frames
+        self._buffer_size = buffer_size
+        self._queue = Queue.Queue()
+        self._queued_size = 0  # B
+        self._lock = threading.Lock()  # to protect _queued_size
+
+        self.received = 0  # number of frames received
+        self.dropped = 0  # number of frames received, but not buffered
+        self.written = 0  # number of frames written
+        self._written_size = 0  # B
+        self._write_time = 0  # s, time spent writing the frames
+        self._tfirst = None  # time of the first frame received
+        self._tlast = None  # time of the latest frame received
+        self._error = None  # Exception raised by the writer
+        # Set when enough frames are received (or the writer failed)
+        self.finished = threading.Event()
+
+        self._thread = threading.Thread(target=self._write_frames,
+                                        name="Frame writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def on_frame(self, df, frame):
+        """
+        To be subscribed to the DataFlow
+        """
+        if self.finished.is_set():
+            return  # Frame sent just before the unsubscription
+
+        now = time.time()
+        if self._tfirst is None:
+            self._tfirst = now
+        self._tlast = now
+        self.received += 1
+
+        with self._lock:
+            if (self._queued_size > 0 and
+                self._queued_size + frame.nbytes > self._buffer_size):
+                # Counted instead of logged, to avoid log flooding
+                self.dropped += 1
+                frame = None
+            else:
+                self._queued_size += frame.nbytes
+
+        if frame is not None:
+            self._queue.put(frame)
+        if self._max_frames is not None and self.received >= self._max_frames:
+            self.finished.set()
+
+    def _write_frames(self):
+        """
+        Writes the frames of the queue, until None is received
+        """
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                return
+            try:
+                if self._error is None:
+                    tstart = time.time()
+                    self._writer.write_frame(frame)
+                    self._write_time += time.time() - tstart
+                    self._written_size += frame.nbytes
+                    self.written += 1
+                # else: an error happened => just empty the queue
+            except Exception as ex:
+                logging.exception("Failed to write frame %d", self.written)
+                self._error = ex
+                self.finished.set()
+            finally:
+                with self._lock:
+                    self._queued_size -= frame.nbytes
+
+    def close(self):
+        """
+        Waits for all the frames received to be written, and closes the writer.
+        It should be called after unsubscribing from the DataFlow.
+        return (dict str -> value): statistics of the recording, see
+          get_statistics()
+        raises IOError: if the frames couldn't be written
+        """
+        self.finished.set()
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            self._writer.close()
+        except Exception as ex:
+            logging.exception("Failed to close the recording")
+            raise IOError("Failed to close the recording: %s" % (ex,))
+        if self._error is not None:
+            raise IOError("Failed to write the frames: %s" % (self._error,))
+        return self.get_statistics()
+
+    def get_statistics(self):
+        """
+        return (dict str -> value): the number of frames received, dropped and
+          written, the average rate at which the frames were received (in Hz,
+          or None if unknown), and the bandwidth of the writer (in B/s, or None
+          if unknown).
+        """
+        if self.received > 1 and self._tlast > self._tfirst:
+            rate = (self.received - 1) / (self._tlast - self._tfirst)
+        else:
+            rate = None
+        if self._write_time > 0:
+            bandwidth = self._written_size / self._write_time
+        else:
+            bandwidth = None
+        return {"received": self.received,
+                "dropped": self.dropped,
+                "written": self.written,
+                "rate": rate,
+                "bandwidth": bandwidth}
+
+def record(comp_name, df_name, filename, duration=None, nframes=None, pretty=True):
+    """
+    Records all the frames sent by a dataflow, for a given time or a given
+    number of frames, and prints the statistics of the recording. The frames
+    are written to the file during the acquisition, so the recording can be
+    much bigger than the memory.
+    comp_name (string): name of the detector to find
+    df_name (string): name of the dataflow to access
+    filename (unicode): name of the output file (must be HDF5)
+    duration (None or 0 < float): maximum duration of the recording (in s)
+    nframes (None or 0 < int): maximum number of frames to record
+      If both duration and nframes are None, it records until interrupted.
+    pretty (bool): if True, display with pretty-printing
+    """
+    component = get_detector(comp_name)
+
+    # check the dataflow exists
+    try:
+        df = getattr(component, df_name)
+    except AttributeError:
+        raise ValueError("Failed to find data-flow '%s' on component %s" % (df_name, comp_name))
+
+    if not isinstance(df, model.DataFlowBase):
+        raise ValueError("%s.%s is not a data-flow" % (comp_name, df_name))
+
+    exporter = dataio.find_fittest_converter(filename)
+    if exporter.FORMAT != hdf5.FORMAT:
+        raise ValueError("Recording is only possible in %s format (%s)" %
+                         (hdf5.FORMAT, ", ".join(hdf5.EXTENSIONS)))
+
+    # By default, the frames are skipped if newer ones are already available.
+    # Only affects the frames received by this process.
+    df.max_discard = 0
+
+    # No compression, as it's typically slower than a fast camera
+    recorder = FrameRecorder(hdf5.FrameWriter(filename, compressed=False), nframes)
+    if duration is not None:
+        tend = time.time() + duration
+    logging.info("Recording %s.%s to %s", comp_name, df_name, filename)
+    df.subscribe(recorder.on_frame)
+    try:
+        while not recorder.finished.is_set():
+            if duration is not None:
+                left = tend - time.time()
+                if left <= 0:
+                    break
+            else:
+                left = 1
+            # Wait with a timeout, to be interruptible
+            recorder.finished.wait(min(left, 1))
+            logging.debug("Received %d frames", recorder.received)
+    except KeyboardInterrupt:
+        logging.info("Recording interrupted")
+    finally:
+        df.unsubscribe(recorder.on_frame)
+
+    logging.info("Writing the last frames...")
+    try:
+        stats = recorder.close()
+    except IOError as exc:
+        raise IOError(u"Failed to save to '%s': %s" % (filename, exc))
+    print_statistics(u"recording of %s.%s" % (component.name, df_name), stats, pretty)
+
+def print_statistics(name, stats, pretty):
+    """
+    print the statistics of a data pipeline
+    name (str): name of the element
+    stats (dict str -> value): statistics, as in DataFlow.statistics
+    pretty (bool): if True, display with pretty-printing
+    """
+    if pretty:
+        print(u"Statistics of %s:" % (name,))
+    for n, v in sorted(stats.items()):
+        if isinstance(v, dict):  # latency summary
+            if pretty:
+                if v["count"]:
+                    lat = (u"mean: %s, median: ≤ %s, 95%%: ≤ %s, max: %s" %
+                           tuple(units.readable_str(v[k], unit="s", sig=3)
+                                 for k in ("mean", "median", "p95", "max")))
+                else:
+                    lat = u"no data"
+                print(u"\t%s (%d values): %s" % (n, v["count"], lat))
+            else:
+                print(u"%s\t" % (n,) +
+                      u"\t".join(u"%s:%s" % kv for kv in sorted(v.items())))
+        else:
+            if pretty:
+                if n == "rate" and v is not None:
+                    v = units.readable_str(v, unit="Hz", sig=3)
+                elif n == "bandwidth" and v is not None:
+                    v = units.readable_str(v, unit="B/s", sig=3)
+                print(u"\t%s: %s" % (n, v))
+            else:
+                print(u"%s\tvalue:%s" % (n, v))
+
+def show_statistics(comp_name, df_name, pretty=True):
+    """
+    print the statistics of the data sent by a dataflow, as measured by the
+    component. As the component only records them while they are observed,
+    they are gathered during STATS_DURATION (or until interrupted).
+    comp_name (string): name of the detector to find
+    df_name (string): name of the dataflow to access
+    pretty (bool): if True, display with pretty-printing
+    """
+    component = get_detector(comp_name)
+
+    # check the dataflow exists
+    try:
+        df = getattr(component, df_name)
+    except AttributeError:
+        raise ValueError("Failed to find data-flow '%s' on component %s" % (df_name, comp_name))
+
+    if not isinstance(df, model.DataFlowBase):
+        raise ValueError("%s.%s is not a data-flow" % (comp_name, df_name))
+
+    # Subscribing to the statistics makes the component record them
+    def on_statistics(stats):
+        pass
+    df.statistics.subscribe(on_statistics)
+    try:
+        logging.info("Recording statistics of %s.%s for %g s",
+                     comp_name, df_name, STATS_DURATION)
+        time.sleep(STATS_DURATION)
+    except KeyboardInterrupt:
+        logging.info("Statistics recording interrupted")
+    finally:
+        stats = df.statistics.value
+        df.statistics.unsubscribe(on_statistics)
+    print_statistics("%s.%s" % (component.name, df_name), stats, pretty)
+
 def ensure_output_encoding():
     """
     Make sure the output encoding supports unicode
@@ -813,13 +1084,27 @@ def main(args):
     dm_grpe.add_argument("--acquire", "-a", dest="acquire", nargs="+",
                          metavar=("<component>", "data-flow"),
                          help="acquire an image (default data-flow is \"data\")")
+    dm_grpe.add_argument("--record", dest="record", nargs="+",
+                         metavar=("<component>", "data-flow"),
+                         help="record all the frames of a data-flow into an HDF5 "
+                         "file, during the given duration or for the given number of "
+                         "frames, or until interrupted (default data-flow is \"data\")")
     dm_grp.add_argument("--output", "-o", dest="output",
                         help="name of the file where the image should be saved "
                         "after acquisition. The file format is derived from the extension "
                         "(TIFF and HDF5 are supported).")
+    dm_grp.add_argument("--duration", dest="duration", type=float, metavar="<seconds>",
+                        help="maximum duration of the recording")
+    dm_grp.add_argument("--frames", dest="frames", type=int, metavar="<number>",
+                        help="maximum number of frames to record")
     dm_grpe.add_argument("--live", dest="live", nargs="+",
                          metavar=("<component>", "data-flow"),
                          help="display and update an image on the screen (default data-flow is \"data\")")
+    dm_grpe.add_argument("--statistics", dest="statistics", nargs="+",
+                         metavar=("<component>", "data-flow"),
+                         help="display the statistics (frames sent, durations, "
+                         "latencies) of a data-flow, recorded during %g s "
+                         "(default data-flow is \"data\")" % (STATS_DURATION,))
 
     options = parser.parse_args(args[1:])
 
@@ -858,12 +1143,18 @@ def main(args):
         options.list, options.stop, options.move,
         options.position, options.reference,
         options.listprop, options.setattr, options.upmd,
-        options.acquire, options.live)):
+        options.acquire, options.live, options.statistics, options.record)):
         logging.error("No action specified.")
         return 127
-    if options.acquire is not None and options.output is None:
+    if (options.acquire is not None or options.record is not None) and options.output is None:
         logging.error("Name of the output file must be specified.")
         return 127
+    if options.duration is not None and options.duration <= 0:
+        logging.error("Duration must be positive.")
+        return 127
+    if options.frames is not None and options.frames <= 0:
+        logging.error("Number of frames must be positive.")
+        return 127
     if options.setattr:
         for l in options.setattr:
             if len(l) < 3 or (len(l) - 1) % 2 == 1:
@@ -946,6 +1237,26 @@ def main(args):
             else:
                 raise ValueError("Live command accepts only one data-flow")
             live_display(component, dataflow)
+        elif options.statistics is not None:
+            component = options.statistics[0]
+            if len(options.statistics) == 1:
+                dataflow = "data"
+            elif len(options.statistics) == 2:
+                dataflow = options.statistics[1]
+            else:
+                raise ValueError("Statistics command accepts only one data-flow")
+            show_statistics(component, dataflow, pretty=not options.machine)
+        elif options.record is not None:
+            component = options.record[0]
+            if len(options.record) == 1:
+                dataflow = "data"
+            elif len(options.record) == 2:
+                dataflow = options.record[1]
+            else:
+                raise ValueError("Record command accepts only one data-flow")
+            filename = options.output.decode(sys.getfilesystemencoding())
+            record(component, dataflow, filename, options.duration, options.frames,
+                   pretty=not options.machine)
     except KeyboardInterrupt:
         logging.info("Interrupted before the end of the execution")
         return 1
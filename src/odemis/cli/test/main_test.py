@@ -26,14 +26,17 @@ from __future__ import division
 import Image
 import StringIO
 import logging
+import numpy
 from odemis import model
 import odemis
 from odemis.cli import main
+from odemis.dataio import hdf5
 from odemis.util import test
 import os
 import re
 import subprocess
 import sys
+import threading
 import time
 import unittest
 from unittest.case import skip
@@ -111,6 +114,56 @@ class TestWithoutBackend(unittest.TestCase):
             ret = exc.code
         self.assertNotEqual(ret, 0, "Wrongly succeeded trying to run scan with unknown class: '%s'" % cmdline)
 
+    def test_recorder(self):
+        """
+        Check the FrameRecorder writes all the frames
+        """
+        filename = "test-recorder" + hdf5.EXTENSIONS[0]
+        recorder = main.FrameRecorder(hdf5.FrameWriter(filename), max_frames=4)
+        for i in range(6):
+            frame = model.DataArray(numpy.zeros((20, 30), dtype=numpy.uint16) + i,
+                                    {model.MD_ACQ_DATE: time.time()})
+            recorder.on_frame(None, frame)
+            time.sleep(0.01)
+        self.assertTrue(recorder.finished.is_set())
+        stats = recorder.close()
+        self.assertEqual(stats["received"], 4)
+        self.assertEqual(stats["written"], 4)
+        self.assertEqual(stats["dropped"], 0)
+        self.assertGreater(stats["rate"], 0)
+
+        data = hdf5.read_data(filename)
+        self.assertEqual(data[0].shape, (1, 4, 1, 20, 30))
+        self.assertEqual(data[0][0, :, 0, 0, 0].tolist(), [0, 1, 2, 3])
+        os.remove(filename)
+
+    def test_recorder_full(self):
+        """
+        Check the FrameRecorder drops the frames when the buffer is full
+        """
+        class SlowWriter(object):
+            def __init__(self):
+                self.frames = []
+                self.go = threading.Event()
+            def write_frame(self, frame):
+                self.go.wait()
+                self.frames.append(frame)
+            def close(self):
+                pass
+
+        writer = SlowWriter()
+        fsize = 20 * 30 * 2
+        recorder = main.FrameRecorder(writer, buffer_size=2 * fsize)
+        for i in range(5):
+            frame = model.DataArray(numpy.zeros((20, 30), dtype=numpy.uint16) + i)
+            recorder.on_frame(None, frame)
+        writer.go.set()
+        stats = recorder.close()
+        self.assertEqual(stats["received"], 5)
+        self.assertEqual(stats["dropped"], 3)
+        self.assertEqual(stats["written"], 2)
+        self.assertEqual([f[0, 0] for f in writer.frames], [0, 1])
+
 #@skip("Simple")
 class TestWithBackend(unittest.TestCase):
     backend_was_running = False
@@ -336,6 +389,55 @@ class TestWithBackend(unittest.TestCase):
         im = Image.open(picture_name)
         self.assertEqual(im.format, "TIFF")
         self.assertEqual(im.size, size)
+
+    def test_record(self):
+        filename = "test-record.h5"
+        size = (256, 256)
+
+        try:
+            cmdline = ["cli", "--set-attr", "Camera", "resolution", "%d,%d" % size]
+            ret = main.main(cmdline)
+        except SystemExit as exc:
+            ret = exc.code
+        self.assertEqual(ret, 0, "trying to run '%s'" % cmdline)
+
+        # record a given number of frames
+        try:
+            out = StringIO.StringIO()
+            sys.stdout = out
+            cmdline = ["cli", "--record", "Camera", "--frames", "10", "--output=%s" % filename]
+            ret = main.main(cmdline)
+        except SystemExit as exc:
+            ret = exc.code
+        self.assertEqual(ret, 0, "trying to run '%s'" % cmdline)
+        output = out.getvalue()
+        self.assertIn("received: 10", output)
+
+        data = hdf5.read_data(filename)
+        self.assertEqual(len(data), 1)
+        # the frames which were dropped (if any) are not in the file
+        self.assertLessEqual(data[0].shape[1], 10)
+        self.assertEqual(data[0].shape[-2:], size[::-1])
+
+        # record during a given time
+        try:
+            cmdline = ["cli", "--record", "Camera", "--duration", "2", "--output=%s" % filename]
+            ret = main.main(cmdline)
+        except SystemExit as exc:
+            ret = exc.code
+        self.assertEqual(ret, 0, "trying to run '%s'" % cmdline)
+        data = hdf5.read_data(filename)
+        self.assertGreater(data[0].shape[1], 1)
+
+        # Only HDF5 is supported
+        try:
+            cmdline = ["cli", "--record", "Camera", "--frames", "2", "--output=test.tiff"]
+            ret = main.main(cmdline)
+        except SystemExit as exc:
+            ret = exc.code
+        self.assertNotEqual(ret, 0, "Wrongly succeeded trying to run '%s'" % cmdline)
+
+        os.remove(filename)
     
 if __name__ == "__main__":
     unittest.main()
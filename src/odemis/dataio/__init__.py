@@ -22,11 +22,13 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 """
 from __future__ import division
 
+from concurrent.futures.thread import ThreadPoolExecutor
 # for listing all the types of file format supported
 import importlib
 import logging
 from odemis.dataio import tiff
 import os
+import threading
 
 
 # The interface of a "format manager" is as follows:
@@ -130,3 +132,78 @@ def find_fittest_converter(filename, default=tiff, mode=os.O_WRONLY, allowlossy=
         conv = default
 
     return conv
+
+
+class ExportQueue(object):
+    """
+    Exports data to files in the background, so that the caller can continue
+    (eg, with the next acquisition) without waiting for the data to be
+    compressed and written to the disk.
+    The amount of data waiting to be exported is bounded: when the queue is
+    full, export() blocks until enough data has been written.
+    """
+
+    def __init__(self, max_size=512 * 2 ** 20, workers=1):
+        """
+        max_size (0 < int): maximum amount of data waiting to be exported (in
+          bytes). It's always possible to queue one data, even if it's bigger.
+        workers (0 < int): number of files exported simultaneously
+        """
+        self._max_size = max_size
+        # Threads are fine, as most of the work is done by the compression
+        # libraries, which release the GIL.
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._queued_size = 0 # bytes
+        self._cond = threading.Condition()
+
+    def export(self, filename, data, thumbnail=None, exporter=None):
+        """
+        Queues the data to be exported. Blocks if the queue is full.
+        The data must not be modified afterwards.
+        filename (unicode): name of the file to create
+        data (list of model.DataArray, or model.DataArray): the data to export
+        thumbnail (None or model.DataArray): image used as thumbnail for the file
+        exporter (None or module): the converter to use. If None, it's
+          selected based on the filename extension.
+        return (Future): represents the export, whose result is None once the
+          file is written, or raise the exception which happened during the
+          export.
+        """
+        if exporter is None:
+            exporter = find_fittest_converter(filename)
+        if isinstance(data, (list, tuple)):
+            size = sum(d.nbytes for d in data)
+        else:
+            size = data.nbytes
+
+        with self._cond:
+            # Back-pressure: wait for the previous data to be exported
+            while self._queued_size > 0 and self._queued_size + size > self._max_size:
+                logging.debug("Export queue full (%d bytes), waiting", self._queued_size)
+                self._cond.wait()
+            self._queued_size += size
+
+        args = (filename, data)
+        if thumbnail is not None:
+            args += (thumbnail,)
+        f = self._executor.submit(self._export, exporter, size, *args)
+        return f
+
+    def _export(self, exporter, size, filename, *args):
+        try:
+            logging.debug("Exporting %s", filename)
+            exporter.export(filename, *args)
+        except Exception:
+            logging.exception("Failed to export %s", filename)
+            raise
+        finally:
+            with self._cond:
+                self._queued_size -= size
+                self._cond.notify_all()
+
+    def shutdown(self, wait=True):
+        """
+        Stops accepting new data.
+        wait (bool): if True, blocks until all the data has been exported
+        """
+        self._executor.shutdown(wait)
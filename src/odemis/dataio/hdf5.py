@@ -36,6 +36,9 @@ FORMAT = "HDF5"
 # list of file-name extensions possible, the first one is the default when saving a file
 EXTENSIONS = [u".h5", u".hdf5"]
 
+# Size (in px) of the side of the chunks used to store the mosaic images
+MOSAIC_CHUNK_SIZE = 256
+
 # We are trying to follow the same format as SVI, as defined here:
 # http://www.svi.nl/HDF5
 # A file follows this structure:
@@ -89,16 +92,28 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     """
     assert(len(image.shape) >= 2)
     image_dataset = group.create_dataset(dataset_name, data=image, **kwargs)
+    _set_image_attributes(image_dataset)
+    if image_dataset.attrs["IMAGE_SUBCLASS"] == "IMAGE_GRAYSCALE":
+        image_dataset.attrs["IMAGE_MINMAXRANGE"] = [image.min(), image.max()]
+
+    return image_dataset
 
+def _set_image_attributes(image_dataset):
+    """
+    Set the attributes of a dataset to respect the HDF5 image specification.
+    The IMAGE_MINMAXRANGE of greyscale images is not set.
+    image_dataset (HDF Dataset): the dataset, of at least 2 dimensions
+    """
+    shape = image_dataset.shape
     # numpy.string_ is to force fixed-length string (necessary for compatibility)
     # FIXME: needs to be NULLTERM, not NULLPAD... but h5py doesn't allow to distinguish
     image_dataset.attrs["CLASS"] = numpy.string_("IMAGE")
     # Colour image?
-    if image.ndim == 3 and (image.shape[-3] == 3 or image.shape[-1] == 3):
+    if len(shape) == 3 and (shape[-3] == 3 or shape[-1] == 3):
         # TODO: check dtype is int?
         image_dataset.attrs["IMAGE_SUBCLASS"] = numpy.string_("IMAGE_TRUECOLOR")
         image_dataset.attrs["IMAGE_COLORMODEL"] = numpy.string_("RGB")
-        if image.shape[-3] == 3:
+        if shape[-3] == 3:
             # Stored as [pixel components][height][width]
             image_dataset.attrs["INTERLACE_MODE"] = numpy.string_("INTERLACE_PLANE")
         else: # This is the numpy standard
@@ -107,13 +122,10 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     else:
         image_dataset.attrs["IMAGE_SUBCLASS"] = numpy.string_("IMAGE_GRAYSCALE")
         image_dataset.attrs["IMAGE_WHITE_IS_ZERO"] = numpy.array(0, dtype="uint8")
-        image_dataset.attrs["IMAGE_MINMAXRANGE"] = [image.min(), image.max()]
 
     image_dataset.attrs["DISPLAY_ORIGIN"] = numpy.string_("UL") # not rotated
     image_dataset.attrs["IMAGE_VERSION"] = numpy.string_("1.2")
 
-    return image_dataset
-
 def _read_image_dataset(dataset):
     """
     Get a numpy array from a dataset respecting the HDF5 image specification.
@@ -1373,8 +1385,203 @@ def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
     f.close()
 
 
-# TODO: allow to append data to a file, or any other way to allow saving large
-# data without having everything in memory simultaneously.
+class MosaicWriter(object):
+    """
+    Writes large 2D images to an HDF5 file, tile by tile, so that the whole
+    images never have to be in memory simultaneously. The images are stored in
+    chunks, so that the file can be read back region by region.
+    The file is valid only once close() has been called.
+    """
+
+    def __init__(self, filename, compressed=True):
+        """
+        filename (unicode): name of the file to create (overwritten if it exists)
+        compressed (boolean): whether the file is compressed or not.
+        """
+        # h5py will extend the current file by default, so we want to make sure
+        # there is no file at all.
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        self._file = h5py.File(filename, "w")
+        self._compression = "gzip" if compressed else None
+        self._datasets = [] # list of HDF Dataset (5D)
+        self._ranges = [] # list of [min, max] or None if no data written yet
+
+    def add_image(self, shape, dtype, md):
+        """
+        Adds a new (empty) image to the file
+        shape (int, int): size of the whole image (Y, X)
+        dtype (numpy.dtype): type of the data
+        md (dict str -> value): metadata of the whole image
+        return (int): index of the image, to be passed to write_tile()
+        """
+        i = len(self._datasets)
+        ga = self._file.create_group("Acquisition%d" % i)
+        gi = ga.create_group("ImageData")
+        _h5py_enum_commit(ga, "StateEnumeration", _dtstate)
+
+        # Always in 5 dimensions, as _saveAsHDF5() does
+        shape5d = (1, 1, 1) + tuple(shape)
+        chunks = (1, 1, 1) + tuple(min(MOSAIC_CHUNK_SIZE, s) for s in shape)
+        ids = gi.create_dataset("Image", shape=shape5d, dtype=dtype, chunks=chunks,
+                                compression=self._compression, fillvalue=0)
+        _set_image_attributes(ids)
+
+        # Only the metadata (and the number of dimensions) of the image is used
+        md = md.copy()
+        img.mergeMetadata(md)
+        template = model.DataArray(numpy.zeros((1,) * 5, dtype=dtype), md)
+        _add_image_info(gi, ids, template)
+        _add_image_metadata(ga, template, None)
+        _add_svi_info(ga)
+
+        self._datasets.append(ids)
+        self._ranges.append(None)
+        return i
+
+    def write_tile(self, index, tile, pos):
+        """
+        Writes a part of an image. The parts of the tile outside of the image
+        are discarded.
+        index (int): index of the image, as returned by add_image()
+        tile (numpy.ndarray of 2 dims): the data
+        pos (int, int): position of the top-left pixel of the tile in the image
+          (Y, X). It can be negative.
+        """
+        ids = self._datasets[index]
+        t, l = pos
+        h, w = ids.shape[-2:]
+        # Clip the tile to the image
+        tt, tl = max(0, -t), max(0, -l)
+        tb, tr = min(tile.shape[0], h - t), min(tile.shape[1], w - l)
+        if tb <= tt or tr <= tl:
+            logging.debug("Tile at %s is outside of the image", pos)
+            return
+        sub = tile[tt:tb, tl:tr]
+        ids[0, 0, 0, t + tt:t + tb, l + tl:l + tr] = sub
+
+        rng = self._ranges[index]
+        mn, mx = sub.min(), sub.max()
+        if rng is None:
+            self._ranges[index] = [mn, mx]
+        else:
+            self._ranges[index] = [min(rng[0], mn), max(rng[1], mx)]
+
+    def close(self):
+        """
+        Finishes writing the file. No more data can be written afterwards.
+        return (None): the data is only in the file
+        """
+        for ids, rng in zip(self._datasets, self._ranges):
+            if ids.attrs["IMAGE_SUBCLASS"] == "IMAGE_GRAYSCALE":
+                if rng is None:
+                    rng = [0, 0]
+                ids.attrs["IMAGE_MINMAXRANGE"] = rng
+        self._file.close()
+        self._datasets = []
+
+
+class FrameWriter(object):
+    """
+    Writes a sequence of 2D frames (eg, a recording of a camera) to an HDF5
+    file, one frame at a time, so that the whole sequence never has to be in
+    memory. The frames are stored along the T dimension of a single image, with
+    one chunk per frame.
+    The file is valid only once close() has been called.
+    """
+
+    def __init__(self, filename, compressed=True):
+        """
+        filename (unicode): name of the file to create (overwritten if it exists)
+        compressed (boolean): whether the file is compressed or not. Note that
+          compression can be slower than the frame rate of a fast camera.
+        """
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        self._file = h5py.File(filename, "w")
+        self._compression = "gzip" if compressed else None
+        self._dataset = None # HDF Dataset (5D), created on the first frame
+        self._md = None # metadata of the first frame
+        self._range = None # [min, max]
+        self._dates = [] # acquisition date of each frame, or None if unknown
+        self.count = 0 # number of frames written
+
+    def write_frame(self, frame):
+        """
+        Appends a frame at the end of the sequence.
+        frame (DataArray of 2 dims): the data. All the frames must have the same
+          shape and dtype. The metadata of the first frame is used for the
+          whole sequence.
+        raises ValueError: if the frame doesn't fit the previous ones
+        """
+        if frame.ndim != 2:
+            raise ValueError("Frame must have 2 dimensions, but got shape %s" % (frame.shape,))
+        if self._dataset is None:
+            ga = self._file.create_group("Acquisition0")
+            gi = ga.create_group("ImageData")
+            # Always in 5 dimensions, as _saveAsHDF5() does. The T dimension is
+            # extended at every frame.
+            shape = (1, 0, 1) + frame.shape
+            ids = gi.create_dataset("Image", shape=shape, dtype=frame.dtype,
+                                    maxshape=(1, None, 1) + frame.shape,
+                                    chunks=(1, 1, 1) + frame.shape,
+                                    compression=self._compression)
+            _set_image_attributes(ids)
+            self._dataset = ids
+            self._md = getattr(frame, "metadata", {}).copy()
+        elif (frame.shape != self._dataset.shape[-2:] or
+              frame.dtype != self._dataset.dtype):
+            raise ValueError("Frame of shape %s and type %s doesn't fit recording of shape %s and type %s" %
+                             (frame.shape, frame.dtype, self._dataset.shape[-2:], self._dataset.dtype))
+
+        ids = self._dataset
+        ids.resize(self.count + 1, axis=1)
+        ids[0, self.count, 0] = frame
+        self.count += 1
+
+        self._dates.append(getattr(frame, "metadata", {}).get(model.MD_ACQ_DATE))
+        mn, mx = frame.min(), frame.max()
+        if self._range is None:
+            self._range = [mn, mx]
+        else:
+            self._range = [min(self._range[0], mn), max(self._range[1], mx)]
+
+    def close(self):
+        """
+        Finishes writing the file. No more frames can be written afterwards.
+        return (None): the data is only in the file
+        """
+        ids = self._dataset
+        try:
+            if ids is not None:
+                md = self._md
+                dates = self._dates
+                if len(dates) > 1 and None not in (dates[0], dates[-1]):
+                    # Average period between frames
+                    md[model.MD_PIXEL_DUR] = (dates[-1] - dates[0]) / (len(dates) - 1)
+                # The frames are always stored along T, in the last 2 dimensions,
+                # whatever their original dimensions (eg, "XT" for a time-correlator).
+                dims = md.get(model.MD_DIMS)
+                if dims is not None and dims != "YX":
+                    logging.info("Frames of dimensions %s recorded as YX", dims)
+                md[model.MD_DIMS] = "CTZYX"
+                img.mergeMetadata(md)
+                ga = self._file["Acquisition0"]
+                _h5py_enum_commit(ga, "StateEnumeration", _dtstate)
+                template = model.DataArray(numpy.zeros((1,) * 5, dtype=ids.dtype), md)
+                _add_image_info(ga["ImageData"], ids, template)
+                _add_image_metadata(ga, template, None)
+                _add_svi_info(ga)
+                if ids.attrs["IMAGE_SUBCLASS"] == "IMAGE_GRAYSCALE":
+                    ids.attrs["IMAGE_MINMAXRANGE"] = self._range
+        finally:
+            self._file.close()
+            self._dataset = None
+
 def export(filename, data, thumbnail=None):
     '''
     Write an HDF5 file with the given image and metadata
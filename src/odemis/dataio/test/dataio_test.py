@@ -16,10 +16,13 @@ You should have received a copy of the GNU General Public License along with Ode
 '''
 from __future__ import division
 
-from odemis import dataio
+import numpy
+from odemis import dataio, model
 from odemis.dataio import get_available_formats, get_converter, \
     find_fittest_converter
 import os
+import threading
+import time
 import unittest
 from unittest.case import skip
 
@@ -83,5 +86,80 @@ class TestDataIO(unittest.TestCase):
                    "For '%s', expected format %s but got %s" % (args[0], fmt_exp, fmt_mng.FORMAT))
 
 
+class SlowExporter(object):
+    """
+    Fake exporter, which takes time to "write" the data
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.exported = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def export(self, filename, data):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        if filename == "fail":
+            raise IOError("Failed to write file")
+        with self._lock:
+            self.exported.append(filename)
+            self.running -= 1
+
+
+class TestExportQueue(unittest.TestCase):
+
+    def test_export(self):
+        exporter = SlowExporter(0.1)
+        queue = dataio.ExportQueue(workers=2)
+        da = model.DataArray(numpy.zeros((100, 100), dtype=numpy.uint16))
+        tstart = time.time()
+        fs = [queue.export("f%d" % i, da, exporter=exporter) for i in range(4)]
+        # Shouldn't have waited for the export
+        self.assertLess(time.time() - tstart, 0.1)
+
+        queue.shutdown(wait=True)
+        for f in fs:
+            self.assertIsNone(f.result())
+        self.assertEqual(set(exporter.exported), {"f0", "f1", "f2", "f3"})
+        self.assertEqual(exporter.max_running, 2)
+
+    def test_back_pressure(self):
+        exporter = SlowExporter(0.2)
+        da = model.DataArray(numpy.zeros((100, 100), dtype=numpy.uint16))
+        # Only room for 2 data at a time
+        queue = dataio.ExportQueue(max_size=2 * da.nbytes)
+        tstart = time.time()
+        for i in range(4):
+            queue.export("f%d" % i, da, exporter=exporter)
+        # The 3rd one had to wait for the 1st one to be written, and the
+        # 4th one for the 2nd one
+        self.assertGreaterEqual(time.time() - tstart, 0.4)
+        queue.shutdown(wait=True)
+        self.assertEqual(len(exporter.exported), 4)
+
+        # Data bigger than the queue is still accepted
+        queue = dataio.ExportQueue(max_size=da.nbytes // 2)
+        f = queue.export("big", da, exporter=exporter)
+        f.result()
+        queue.shutdown()
+
+    def test_error(self):
+        exporter = SlowExporter(0)
+        queue = dataio.ExportQueue()
+        da = model.DataArray(numpy.zeros((10, 10), dtype=numpy.uint16))
+        f = queue.export("fail", da, exporter=exporter)
+        with self.assertRaises(IOError):
+            f.result()
+
+        # The queue is still usable
+        f = queue.export("ok", [da, da], exporter=exporter)
+        self.assertIsNone(f.result())
+        queue.shutdown()
+
+
 if __name__ == "__main__":
     unittest.main()
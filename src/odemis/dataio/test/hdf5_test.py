@@ -957,6 +957,92 @@ class TestHDF5IO(unittest.TestCase):
         self.assertEqual(im.shape, tshape)
         self.assertEqual(im[0, 0].tolist(), [0, 255, 0])
 
+    def testMosaicWriter(self):
+        """
+        Checks that a large image can be written tile by tile
+        """
+        shape = (600, 1000) # Y, X
+        dtype = numpy.dtype("uint16")
+        md = {model.MD_PIXEL_SIZE: (1e-6, 2e-6),
+              model.MD_POS: (1e-3, -2e-3),
+              model.MD_DESCRIPTION: "mosaic"}
+
+        writer = hdf5.MosaicWriter(FILENAME)
+        i = writer.add_image(shape, dtype, md)
+        tile = numpy.zeros((256, 256), dtype)
+        tile[1, 2] = 1000
+        writer.write_tile(i, tile + 5, (0, 0))
+        writer.write_tile(i, tile + 8, (100, 200)) # overlaps the first one
+        writer.write_tile(i, tile + 10, (500, 900)) # partly outside
+        writer.write_tile(i, tile + 10, (-300, 0)) # completely outside
+        writer.close()
+
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(len(rdata), 1)
+        im = rdata[0][0, 0, 0] # remove C,T,Z dimensions
+        self.assertEqual(im.shape, shape)
+        self.assertEqual(im[0, 0], 5)
+        self.assertEqual(im[1, 2], 1005)
+        self.assertEqual(im[100, 200], 8)
+        self.assertEqual(im[101, 202], 1008)
+        self.assertEqual(im[599, 999], 10)
+        self.assertEqual(im[599, 0], 0) # never written
+        self.assertEqual(rdata[0].metadata[model.MD_PIXEL_SIZE], md[model.MD_PIXEL_SIZE])
+        self.assertEqual(rdata[0].metadata[model.MD_POS], md[model.MD_POS])
+        self.assertEqual(rdata[0].metadata[model.MD_DESCRIPTION], md[model.MD_DESCRIPTION])
+
+    def testFrameWriter(self):
+        """
+        Checks that a sequence of frames can be written frame by frame
+        """
+        shape = (60, 80) # Y, X
+        dtype = numpy.dtype("uint16")
+        writer = hdf5.FrameWriter(FILENAME, compressed=False)
+        for i in range(5):
+            md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                  model.MD_EXP_TIME: 0.01,
+                  model.MD_ACQ_DATE: 1000 + i * 0.1}
+            frame = model.DataArray(numpy.zeros(shape, dtype) + i, md)
+            writer.write_frame(frame)
+        self.assertEqual(writer.count, 5)
+
+        # Different shape => refused
+        frame = model.DataArray(numpy.zeros((60, 81), dtype))
+        self.assertRaises(ValueError, writer.write_frame, frame)
+        writer.close()
+
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(len(rdata), 1)
+        im = rdata[0]
+        self.assertEqual(im.shape, (1, 5, 1) + shape)
+        self.assertEqual(im[0, :, 0, 10, 10].tolist(), list(range(5)))
+        self.assertEqual(im.metadata[model.MD_PIXEL_SIZE], (1e-6, 1e-6))
+        self.assertEqual(im.metadata[model.MD_ACQ_DATE], 1000)
+        # The average frame period
+        self.assertAlmostEqual(im.metadata[model.MD_PIXEL_DUR], 0.1)
+
+    def testFrameWriterDims(self):
+        """
+        Checks that frames with MD_DIMS (eg, from a time-correlator) can be recorded
+        """
+        shape = (1, 256) # X, T
+        dtype = numpy.dtype("uint32")
+        writer = hdf5.FrameWriter(FILENAME, compressed=False)
+        for i in range(3):
+            md = {model.MD_DIMS: "XT",
+                  model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                  model.MD_ACQ_DATE: 1000 + i * 0.1}
+            frame = model.DataArray(numpy.zeros(shape, dtype) + i, md)
+            writer.write_frame(frame)
+        writer.close()
+
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(len(rdata), 1)
+        im = rdata[0]
+        self.assertEqual(im.shape, (1, 3, 1) + shape)
+        self.assertEqual(im[0, :, 0, 0, 10].tolist(), list(range(3)))
+        self.assertEqual(im.metadata[model.MD_ACQ_DATE], 1000)
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
@@ -77,6 +77,15 @@ PHR800LVMAX = 2400  # mV
 
 HOLDOFFMAX = 210480  # ns
 
+# T3 records (cf ReadFiFo())
+T3WRAPAROUND = 65536  # the sync counter overflows every 2**16 sync periods
+T3HISTCHAN = 4096  # the start-stop time is 12 bits
+T3CHAN_SPECIAL = 0xf  # channel of the overflow and marker records
+
+# Number of records which can be held between the FIFO reader and the histogram
+# computation (= 16 MB)
+TTTR_BUFFER_SIZE = 2 ** 22
+
 
 class PHError(Exception):
     def __init__(self, errno, strerror, *args, **kwargs):
@@ -187,7 +196,7 @@ class PH300(model.Detector):
     """
 
     def __init__(self, name, role, device=None, children=None, daemon=None,
-                 disc_volt=None, zero_cross=None, **kwargs):
+                 disc_volt=None, zero_cross=None, tttr=False, **kwargs):
         """
         device (None or str): serial number (eg, 1020345) of the device to use
           or None if any device is fine.
@@ -195,6 +204,10 @@ class PH300(model.Detector):
          detector1 are valid) to the arguments.
         disc_volt (2 (0 <= float <= 0.8)): discriminator voltage for the APD 0 and 1 (in V)
         zero_cross (2 (0 <= float <= 2e-3)): zero cross voltage for the APD0 and 1 (in V)
+        tttr (bool): if True, the device runs in time-tagged (T3) mode: the
+          events are continuously read, and the histograms are computed by
+          software, either per dwell time or between markers. This avoids
+          the overhead of starting a measurement for every histogram.
         """
         if children is None:
             children = {}
@@ -215,8 +228,8 @@ class PH300(model.Detector):
 
         # TODO: metadata for indicating the range? cf WL_LIST?
 
-        # TODO: do we need TTTR mode?
-        self.Initialise(MODE_HIST)
+        self._tttr = tttr
+        self.Initialise(MODE_T3 if tttr else MODE_HIST)
         self._swVersion = self.GetLibraryVersion()
         self._metadata[model.MD_SW_VERSION] = self._swVersion
         mod, partnum, ver = self.GetHardwareInfo()
@@ -226,6 +239,8 @@ class PH300(model.Detector):
         self._metadata[model.MD_DET_TYPE] = model.MD_DT_NORMAL
 
         logging.info("Opened device %d (%s s/n %s)", self._idx, mod, sn)
+        if tttr and not self.GetFeatures() & FEATURE_TTTR:
+            raise HwError("PicoHarp300 %s doesn't support the TTTR mode" % (sn,))
 
         self.Calibrate()
 
@@ -255,7 +270,8 @@ class PH300(model.Detector):
 
         # Indicate first dim is time and second dim is (useless) X (in reversed order)
         self._metadata[model.MD_DIMS] = "XT"
-        self._shape = (HISTCHAN, 1, 2**16) # Histogram is 32 bits, but only return 16 bits info
+        nbins = T3HISTCHAN if tttr else HISTCHAN
+        self._shape = (nbins, 1, 2**16) # Histogram is 32 bits, but only return 16 bits info
 
         # Set the CFD parameters (in mV)
         for i, (dv, zc) in enumerate(zip(disc_volt, zero_cross)):
@@ -277,6 +293,13 @@ class PH300(model.Detector):
         # Make sure the device is synchronised and metadata is updated
         self._setSyncOffset(self.syncOffset.value)
 
+        if tttr:
+            # If True, each histogram contains the events between two markers
+            # (typically, sent by the e-beam scanner at the beginning of each
+            # pixel), instead of the events during dwellTime.
+            self.pixelMarker = model.BooleanVA(False, setter=self._setPixelMarker)
+            self._setPixelMarker(self.pixelMarker.value)
+
         # Wrapper for the dataflow
         self.data = BasicDataFlow(self)
         # Note: Apparently, the hardware supports reading the data, while it's
@@ -293,7 +316,7 @@ class PH300(model.Detector):
         # * "E" to end
         # * "T" to terminate
         self._genmsg = Queue.Queue()
-        self._generator = threading.Thread(target=self._acquire,
+        self._generator = threading.Thread(target=self._acquire_tttr if tttr else self._acquire,
                                            name="PicoHarp300 acquisition thread")
         self._generator.start()
 
@@ -358,6 +381,14 @@ class PH300(model.Detector):
         self._dll.PH_GetSerialNumber(self._idx, sn_str)
         return sn_str.value
 
+    def GetFeatures(self):
+        """
+        return (int): bitmask of the FEATURE_* supported by the device
+        """
+        features = c_int()
+        self._dll.PH_GetFeatures(self._idx, byref(features))
+        return features.value
+
     def Calibrate(self):
         logging.debug("Calibrating device %d", self._idx)
         self._dll.PH_Calibrate(self._idx)
@@ -494,6 +525,21 @@ class PH300(model.Detector):
         self._dll.PH_GetHistogram(self._idx, buf_ct, block)
         return buf
 
+    def GetFlags(self):
+        """
+        return (int): bitmask of the FLAG_* currently set
+        """
+        flags = c_int()
+        self._dll.PH_GetFlags(self._idx, byref(flags))
+        return flags.value
+
+    def SetMarkerEnable(self, en0, en1, en2, en3):
+        """
+        Select which marker inputs are recorded in the T2/T3 modes
+        en0 -> en3 (bool): True to record the corresponding marker
+        """
+        self._dll.PH_SetMarkerEnable(self._idx, int(en0), int(en1), int(en2), int(en3))
+
     def GetElapsedMeasTime(self):
         """
         return 0<=float: time since the measurement started (in s)
@@ -524,7 +570,7 @@ class PH300(model.Detector):
         #   counter overflow.
         # See also https://github.com/tsbischof/libpicoquant
 
-        assert 0 < count < TTREADMAX
+        assert 0 < count <= TTREADMAX
         buf = numpy.empty((count,), dtype=numpy.uint32)
         buf_ct = buf.ctypes.data_as(POINTER(c_uint32))
         nactual = c_int()
@@ -551,6 +597,11 @@ class PH300(model.Detector):
 
         return pxd
 
+    def _setPixelMarker(self, marker):
+        # Only the first marker is used
+        self.SetMarkerEnable(marker, False, False, False)
+        return marker
+
     def _setSyncOffset(self, offset):
         offset_ps = int(offset * 1e12)
         self.SetSyncOffset(offset_ps)
@@ -694,6 +745,111 @@ class PH300(model.Detector):
 
         logging.debug("Acquisition thread ended")
 
+    def _get_sync_period(self):
+        """
+        return (0<float): the period of the sync signal (in s)
+        raise IOError: if there is no sync signal
+        """
+        # The count rate is only updated every 100 ms, so it's only an
+        # approximation, but it's fine as the sync period is very stable.
+        rate = self.GetCountRate(0)
+        if rate <= 0:
+            raise IOError("No sync signal received")
+        return 1 / rate
+
+    def _acquire_tttr(self):
+        """
+        Acquisition thread, for the TTTR mode
+        Managed via the .genmsg Queue
+        """
+        try:
+            while True:
+                # Wait until we have a start (or terminate) message
+                self._acq_wait_start()
+
+                try:
+                    sync_period = self._get_sync_period()
+                except IOError:
+                    logging.error("No sync signal, cannot acquire in TTTR mode")
+                    continue
+
+                buf = RecordRingBuffer(TTTR_BUFFER_SIZE)
+                hister = T3Histogrammer(T3HISTCHAN)
+                reader_stop = threading.Event()
+                reader = threading.Thread(target=self._read_fifo,
+                                          args=(buf, reader_stop),
+                                          name="PicoHarp300 FIFO reader")
+
+                logging.debug("Starting new TTTR acquisition")
+                tstart = time.time()
+                self.StartMeas(ACQTMAX)
+                reader.start()
+                try:
+                    # Keep converting the events to histograms, until a stop
+                    # (or terminate) message comes
+                    while not self._acq_should_stop():
+                        tacq = self.dwellTime.value
+                        if self.pixelMarker.value:
+                            hister.window = None
+                        else:
+                            hister.window = max(1, int(round(tacq / sync_period)))
+
+                        recs = buf.read(timeout=0.1)
+                        if not recs.size and buf.closed:
+                            # The reader stopped (due to an error), so no
+                            # records will ever come
+                            logging.error("FIFO reader stopped, aborting the TTTR acquisition")
+                            break
+                        if buf.dropped:
+                            logging.error("Dropped %d records, as they were not processed fast enough",
+                                          buf.dropped)
+                            buf.dropped = 0
+                        for sync, hist in hister.add(recs):
+                            hmd = self._metadata.copy()
+                            hmd[model.MD_ACQ_DATE] = tstart + sync * sync_period
+                            if hister.window is None:
+                                hmd[model.MD_DWELL_TIME] = hister.last_duration * sync_period
+                            else:
+                                hmd[model.MD_DWELL_TIME] = tacq
+                            self.data.notify(model.DataArray(hist.reshape(1, -1), hmd))
+                finally:
+                    # Must always be called, whether the measurement finished or not
+                    reader_stop.set()
+                    reader.join(5)
+                    self.StopMeas()
+                logging.debug("Acquisition stopped")
+
+        except StopIteration:
+            logging.debug("Acquisition thread requested to terminate")
+        except Exception:
+            logging.exception("Failure in acquisition thread")
+        else:
+            logging.error("Acquisition thread ended without exception")
+
+        logging.debug("Acquisition thread ended")
+
+    def _read_fifo(self, buf, must_stop):
+        """
+        Thread which drains the FIFO of the device, as long as the TTTR
+          measurement runs.
+        buf (RecordRingBuffer): where to store the records read
+        must_stop (threading.Event): set when the reading should stop
+        """
+        try:
+            while not must_stop.is_set():
+                if self.GetFlags() & FLAG_FIFOFULL:
+                    logging.error("FIFO overrun, some events have been lost")
+                recs = self.ReadFiFo(TTREADMAX)
+                if recs.size:
+                    buf.write(recs)
+                if recs.size < TTREADMAX // 2:
+                    # The FIFO is not filling up quickly, so no need to hurry
+                    must_stop.wait(10e-3)
+        except Exception:
+            logging.exception("Failure while reading the FIFO")
+        finally:
+            buf.close()
+
     @classmethod
     def scan(cls):
         """
@@ -772,6 +928,160 @@ class PH300RawDetector(model.Detector):
         self.data.notify(img)
 
 
+class RecordRingBuffer(object):
+    """
+    Fixed-size FIFO of records, to pass the events read from the device to the
+    thread computing the histograms, without allocating memory for each read.
+    If the records are not consumed fast enough, the oldest ones are dropped.
+    """
+
+    def __init__(self, size, dtype=numpy.uint32):
+        """
+        size (0<int): maximum number of records held
+        dtype (numpy.dtype): type of a record
+        """
+        self._buf = numpy.empty(size, dtype=dtype)
+        self._start = 0  # position of the oldest record
+        self._count = 0  # number of records held
+        self._closed = False
+        self._cond = threading.Condition()
+        self.dropped = 0  # number of records dropped since last reset
+
+    def write(self, recs):
+        """
+        Append records to the buffer
+        recs (numpy.ndarray): the records to add
+        """
+        size = self._buf.size
+        with self._cond:
+            if recs.size > size:
+                self.dropped += recs.size - size
+                recs = recs[-size:]
+            overflow = self._count + recs.size - size
+            if overflow > 0:
+                self.dropped += overflow
+                self._start = (self._start + overflow) % size
+                self._count -= overflow
+
+            end = (self._start + self._count) % size
+            n1 = min(recs.size, size - end)
+            self._buf[end:end + n1] = recs[:n1]
+            self._buf[:recs.size - n1] = recs[n1:]
+            self._count += recs.size
+            self._cond.notify()
+
+    def read(self, timeout=None):
+        """
+        Take all the records in the buffer
+        timeout (None or 0<float): maximum time to wait for records to be
+          available
+        return (numpy.ndarray): the records, in order. It is empty if no record
+          was available within the given time (or if the buffer is closed).
+        """
+        size = self._buf.size
+        with self._cond:
+            if not self._count and not self._closed:
+                self._cond.wait(timeout)
+            n1 = min(self._count, size - self._start)
+            recs = numpy.concatenate((self._buf[self._start:self._start + n1],
+                                      self._buf[:self._count - n1]))
+            self._start = (self._start + self._count) % size
+            self._count = 0
+        return recs
+
+    def close(self):
+        """
+        Indicate that no more records will be written (and unblock the reader)
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    @property
+    def closed(self):
+        """
+        True if no more records will be written
+        """
+        return self._closed
+
+
+class T3Histogrammer(object):
+    """
+    Computes the histograms of the start-stop times from a stream of T3
+    records. Each histogram either contains the events of a given number of
+    sync periods, or the events between two markers.
+    """
+
+    def __init__(self, nbins=T3HISTCHAN):
+        """
+        nbins (0<int): number of bins of the histogram
+        """
+        self._nbins = nbins
+        # (None or 0<int): number of sync periods per histogram, or None to
+        # separate the histograms on the markers
+        self.window = None
+        self.last_duration = 0  # number of sync periods of the last histogram
+        self._noverflows = 0  # number of overflows of the sync counter so far
+        self._start = None  # sync count at the beginning of the current histogram
+        self._hist = numpy.zeros(nbins, dtype=numpy.uint32)
+
+    def add(self, recs):
+        """
+        Process new records
+        recs (numpy.ndarray of uint32): T3 records, in order
+        return (list of (int, numpy.ndarray of uint32)): for each histogram
+          completed, the sync count at which it started, and the histogram.
+        """
+        if not recs.size:
+            return []
+
+        # Decode the records
+        chan = recs >> 28
+        dtime = (recs >> 16) & 0xfff
+        special = (chan == T3CHAN_SPECIAL)
+        ovfl = special & (dtime == 0)
+        # The sync count, taking into account the overflows
+        nsync = (recs & 0xffff).astype(numpy.int64)
+        nsync += (self._noverflows + numpy.cumsum(ovfl)) * T3WRAPAROUND
+        self._noverflows += int(numpy.count_nonzero(ovfl))
+        photons = ~special & (chan >= 1) & (chan <= 4)
+
+        # Find the index of the records which start a new histogram
+        prev = 0
+        if self.window is None:
+            bounds = numpy.flatnonzero(special & (dtime != 0))
+            if self._start is None:
+                # The events before the first marker are not part of any pixel
+                if not bounds.size:
+                    return []
+                prev = bounds[0]
+                self._start = int(nsync[prev])
+                bounds = bounds[1:]
+            starts = nsync[bounds]
+        else:
+            if self._start is None:
+                self._start = int(nsync[0])
+            idx = (nsync - self._start) // self.window
+            starts = self._start + numpy.arange(1, idx[-1] + 1) * self.window
+            bounds = numpy.searchsorted(nsync, starts)
+
+        hists = []
+        for b, s in zip(bounds, starts):
+            self._accumulate(dtime[prev:b][photons[prev:b]])
+            self.last_duration = int(s) - self._start
+            hists.append((self._start, self._hist))
+            self._hist = numpy.zeros(self._nbins, dtype=numpy.uint32)
+            self._start = int(s)
+            prev = b
+        self._accumulate(dtime[prev:][photons[prev:]])
+
+        return hists
+
+    def _accumulate(self, dtime):
+        if dtime.size:
+            self._hist += numpy.bincount(dtime, minlength=self._nbins)[:self._nbins].astype(numpy.uint32)
+
+
 class BasicDataFlow(model.DataFlow):
     def __init__(self, detector):
         """
@@ -836,6 +1146,14 @@ class FakePHDLL(object):
         self._acq_start = None
         self._acq_end = None
 
+        # For the T3 mode
+        self._sync_rate = 1e6  # Hz
+        self._photon_prob = 0.01  # probability of detecting a photon per sync period
+        self._marker_period = 1000  # sync periods between two markers (= pixel)
+        self._markers_en = (0, 0, 0, 0)
+        self._nsyncs_read = 0  # number of sync periods already sent as records
+        self._fifo = numpy.empty((0,), dtype=numpy.uint32)  # records not yet read
+
     def PH_OpenDevice(self, i, sn_str):
         if i == self._idx:
             sn_str.value = self._sn
@@ -862,9 +1180,24 @@ class FakePHDLL(object):
     def PH_Calibrate(self, i):
         pass
 
+    def PH_GetFeatures(self, i, p_features):
+        features = _deref(p_features, c_int)
+        features.value = FEATURE_DLL | FEATURE_TTTR | FEATURE_MARKERS
+
+    def PH_GetFlags(self, i, p_flags):
+        flags = _deref(p_flags, c_int)
+        flags.value = 0
+
     def PH_GetCountRate(self, i, channel, p_rate):
         rate = _deref(p_rate, c_int)
-        rate.value = random.randint(0, 5000)
+        if _val(channel) == 0 and self._mode in (MODE_T2, MODE_T3):
+            # In T-modes, channel 0 is the sync, which is very stable
+            rate.value = int(self._sync_rate)
+        else:
+            rate.value = random.randint(0, 5000)
+
+    def PH_SetMarkerEnable(self, i, en0, en1, en2, en3):
+        self._markers_en = (_val(en0), _val(en1), _val(en2), _val(en3))
 
     def PH_GetBaseResolution(self, i, p_resolution, p_binsteps):
         resolution = _deref(p_resolution, c_double)
@@ -906,6 +1239,8 @@ class FakePHDLL(object):
             raise PHError(-16, PHDLL.err_code[-16])
         self._acq_start = time.time()
         self._acq_end = self._acq_start + _val(tacq) * 1e-3
+        self._nsyncs_read = 0
+        self._fifo = numpy.empty((0,), dtype=numpy.uint32)
 
     def PH_StopMeas(self, i):
         self._acq_start = None
@@ -939,3 +1274,58 @@ class FakePHDLL(object):
 
         # Old numpy doesn't support dtype argument for randint
         ndbuffer[...] = numpy.random.randint(0, maxval, n).astype(numpy.uint32)
+
+    def PH_ReadFiFo(self, i, p_buffer, count, p_nactual):
+        nactual = _deref(p_nactual, c_int)
+        if self._mode != MODE_T3:
+            raise PHError(-18, PHDLL.err_code[-18])  # ERROR_INVALID_MODE
+
+        if self._acq_start is not None:
+            # Generate the events which happened since the previous read
+            now = min(time.time(), self._acq_end)
+            nsyncs = int((now - self._acq_start) * self._sync_rate)
+            if nsyncs > self._nsyncs_read:
+                recs = self._generate_t3(self._nsyncs_read, nsyncs)
+                self._fifo = numpy.concatenate((self._fifo, recs))
+                self._nsyncs_read = nsyncs
+
+        n = min(_val(count), self._fifo.size)
+        p = cast(p_buffer, POINTER(c_uint32))
+        ndbuffer = numpy.ctypeslib.as_array(p, (_val(count),))
+        ndbuffer[:n] = self._fifo[:n]
+        self._fifo = self._fifo[n:]
+        nactual.value = n
+
+    def _generate_t3(self, first, last):
+        """
+        Simulates the T3 records of a sync range
+        first (int): first sync period
+        last (int): last sync period (excluded)
+        return (numpy.ndarray of uint32): the records, in order
+        """
+        # Photons arrive randomly, with an exponential decay after the sync
+        nph = numpy.random.binomial(last - first, self._photon_prob)
+        ph_sync = numpy.random.randint(first, last, nph).astype(numpy.int64)
+        ph_dtime = (numpy.random.exponential(200, nph) + 100).astype(numpy.int64)
+        ph_dtime = numpy.clip(ph_dtime // (2 ** self._bins), 0, T3HISTCHAN - 1)
+        ph_recs = (1 << 28) | (ph_dtime << 16) | (ph_sync % T3WRAPAROUND)
+
+        # The sync counter overflows
+        of_sync = numpy.arange(-(-first // T3WRAPAROUND) * T3WRAPAROUND, last,
+                               T3WRAPAROUND, dtype=numpy.int64)
+        of_sync = of_sync[of_sync > 0]
+        of_recs = numpy.zeros(of_sync.shape, dtype=numpy.int64) | (T3CHAN_SPECIAL << 28)
+
+        # The marker 1, at every "pixel"
+        if self._markers_en[0]:
+            mk_sync = numpy.arange(-(-first // self._marker_period) * self._marker_period,
+                                   last, self._marker_period, dtype=numpy.int64)
+        else:
+            mk_sync = numpy.empty((0,), dtype=numpy.int64)
+        mk_recs = (T3CHAN_SPECIAL << 28) | (1 << 16) | (mk_sync % T3WRAPAROUND)
+
+        # Order by time, with the overflow first, so that it applies to the
+        # events at the same sync period
+        syncs = numpy.concatenate((of_sync * 2, mk_sync * 2 + 1, ph_sync * 2 + 1))
+        recs = numpy.concatenate((of_recs, mk_recs, ph_recs))
+        return recs[numpy.argsort(syncs, kind="mergesort")].astype(numpy.uint32)
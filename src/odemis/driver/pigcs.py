@@ -22,6 +22,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import Queue
+import collections
 from concurrent.futures import CancelledError
 import glob
 import logging
@@ -487,6 +488,28 @@ class Controller(object):
 
         return lines
 
+    def getPositionQuery(self, axis):
+        """
+        Used to read the position of several axes with only one exchange on the
+        bus (see Bus._updatePosition()).
+        Should be called while holding the bus access.
+        axis (int): the axis
+        return (None or str): the command to send (without address prefix but
+          with \n) to read the position, or None if the position cannot be read
+          this way (in which case getPosition() should be used).
+        """
+        return None
+
+    def parsePositionReport(self, axis, report):
+        """
+        Decodes the report of the command returned by getPositionQuery()
+        axis (int): the axis
+        report (str): the report received
+        return (float): the current position of the given axis
+        raise ValueError: if the report cannot be decoded
+        """
+        raise NotImplementedError("Position cannot be read via a query")
+
     re_err_ans = r"(-?\d+)$" # ex: ("0 1 ")[-54](\n)
     def recoverTimeout(self):
         """
@@ -729,6 +752,17 @@ class Controller(object):
             raise NotImplementedError("Command %s not supported by the controller" % (com,))
 
         resp = self._sendQueryCommand("%s %d\n" % (com, axis))
+        return self._parseAxisValue(com, axis, resp)
+
+    def _parseAxisValue(self, com, axis, resp):
+        """
+        Decodes the value of a report for a command with axis.
+        com (str): the 4 letter command (including the ?)
+        axis (1<int<16): axis number
+        resp (str): the report (ex: 1=25.3)
+        returns (int or float or str): value returned depending on the type detected
+        raise ValueError: if the report cannot be decoded
+        """
         try:
             value_str = resp.split("=")[1]
         except IndexError:
@@ -1749,6 +1783,16 @@ class CLAbsController(Controller):
         self._lastpos[axis] = (pos, time.time())
         return pos
 
+    def getPositionQuery(self, axis):
+        if "POS?" not in self._avail_cmds:
+            return None
+        return "POS? %d\n" % (axis,)
+
+    def parsePositionReport(self, axis, report):
+        pos = self._parseAxisValue("POS?", axis, report) * self._upm[axis]
+        self._lastpos[axis] = (pos, time.time())
+        return pos
+
     def isMoving(self, axes=None):
         """
         Indicate whether the motors are moving (ie, last requested move is over)
@@ -2229,6 +2273,19 @@ class CLRelController(Controller):
         with self._pos_lock[axis]:
             return self.GetPosition(axis) * self._upm[axis]
 
+    def getPositionQuery(self, axis):
+        if "POS?" not in self._avail_cmds:
+            return None
+        # Don't read the position while the encoder is turned on/off. As the
+        # bus access is held, it cannot start after this check.
+        if not self._pos_lock[axis].acquire(False):
+            return None
+        self._pos_lock[axis].release()
+        return "POS? %d\n" % (axis,)
+
+    def parsePositionReport(self, axis, report):
+        return self._parseAxisValue("POS?", axis, report) * self._upm[axis]
+
     def getTargetPosition(self, axis):
         return self.GetTargetPosition(axis) * self._upm[axis]
 
@@ -2855,8 +2912,36 @@ class Bus(model.Actuator):
             pos = self.position._value.copy()
 
         npos = {}
-        for a, (controller, channel) in self._axis_to_cc.items():
-            if axes is None or a in axes:
+        toread = [(a, cc) for a, cc in self._axis_to_cc.items() if axes is None or a in axes]
+
+        # Read the position of all the axes which support it in one go, to
+        # avoid waiting for each report before sending the next query.
+        queried = []  # axis, controller, channel
+        queries = []  # address, command
+        with self.accesser.ser_access:
+            for a, (controller, channel) in toread:
+                q = controller.getPositionQuery(channel)
+                if q is not None:
+                    queried.append((a, controller, channel))
+                    queries.append((controller.address, q))
+
+            if len(queries) > 1:
+                try:
+                    reports = self.accesser.sendQueryCommands(queries)
+                except IOError:
+                    logging.warning("Failed to read position of axes %s at once",
+                                    [a for a, ct, ch in queried], exc_info=True)
+                    self.accesser.flushInput()
+                else:
+                    for (a, controller, channel), rep in zip(queried, reports):
+                        try:
+                            npos[a] = controller.parsePositionReport(channel, rep)
+                        except ValueError:
+                            logging.warning("Failed to decode position of axis %s: %s", a, rep)
+
+        # The other axes (or if it failed) are read one at a time
+        for a, (controller, channel) in toread:
+            if a not in npos:
                 try:
                     npos[a] = controller.getPosition(channel)
                 except PIGCSError:
@@ -3184,6 +3269,8 @@ class Bus(model.Actuator):
         for controller in ctlrs:
             controller.terminate()
 
+        logging.debug("Latency of the queries: %s", self.accesser.latency.to_dict())
+
     def selfTest(self):
         """
         No move should be going one while doing a self-test
@@ -3390,6 +3477,131 @@ class Bus(model.Actuator):
         return sock
 
 
+class ReportParser(object):
+    """
+    Splits the data received from the bus into the reports of each of the
+    queries sent. Several queries, to different controllers, can be sent at
+    once, and the reports are matched to the queries in order, for each
+    controller (as each controller answers its queries in order).
+    The basic is simple. A report starts with a prefix ("0 <addr> "), and
+    finishes with \n. If it actually finishes with " \n", then it's just a new
+    line and not the end of the report.
+    However, it gets muddy sometimes with empty answers. For instance, it can
+    answer "0 1 \n", which is an empty answer. But some controllers answer
+    "1 HLP\n" with "0 1 \nBla bla \nBla\n"
+    """
+    def __init__(self, queries):
+        """
+        queries (list of (None or 1<=int<=16 or 254, str)): address and command
+          of each query, in the order they are sent. If the address is None,
+          it must be the only address used.
+        """
+        self._queries = queries
+        # address -> indices of the queries, in order
+        self._indices = collections.OrderedDict()
+        for i, (addr, com) in enumerate(queries):
+            self._indices.setdefault(addr, []).append(i)
+        assert(None not in self._indices or len(self._indices) == 1)
+
+        # address -> list of (report, time of reception)
+        self._reports = dict((a, []) for a in self._indices)
+        self._buf = ""  # received data not yet processed
+        self._cur_addr = None  # address of the multi-line report being received
+        self._cur_lines = None  # lines received of the multi-line report, or None
+        self._last_addr = None  # address of the last report received
+        self.start_time = time.time()
+
+    def _find_address(self, l):
+        """
+        return (None or int, str): the address corresponding to the prefix of
+          the line, and the line without prefix
+        raise LookupError: if no prefix matches
+        """
+        for addr in self._indices:
+            if addr is None:
+                return addr, l
+            prefix = "0 %d " % addr
+            if l.startswith(prefix):
+                return addr, l[len(prefix):]
+        raise LookupError("No prefix found")
+
+    def feed(self, data):
+        """
+        Process data received from the bus
+        data (str): the data received
+        return (bool): True if all the reports have been received
+        raise IOError: if the data doesn't look like a report
+        """
+        self._buf += data
+        lines = self._buf.split("\n")
+        # if the data finishes with \n, last split is empty
+        lines, self._buf = lines[:-1], lines[-1]
+        if lines:
+            logging.debug("Received: '%s'", "\n".join(lines).encode('string_escape'))
+
+        for l in lines:
+            if self._cur_lines is None:
+                try:
+                    self._cur_addr, l = self._find_address(l)
+                except LookupError:
+                    # Maybe the previous line was actually continuing (but the hardware is strange)?
+                    reports = self._reports.get(self._last_addr)
+                    if reports and reports[-1][0] == "":
+                        logging.debug("Reconcidering previous line as beginning of multi-line")
+                        reports.pop()
+                        self._cur_addr = self._last_addr
+                    else:
+                        logging.debug("Failed to decode answer '%s'", l.encode('string_escape'))
+                        full_com = "".join(c for a, c in self._queries)
+                        raise IOError("Report prefix unexpected after '%s': '%s'." %
+                                      (full_com.encode('string_escape'), l))
+                self._cur_lines = []
+
+            if l[-1:] == " ":  # multi-line
+                self._cur_lines.append(l[:-1])  # remove the space indicating multi-line
+            else:
+                # End of the report for that query
+                self._cur_lines.append(l)
+                if len(self._cur_lines) == 1:
+                    rep = self._cur_lines[0]
+                else:
+                    rep = self._cur_lines
+                self._reports[self._cur_addr].append((rep, time.time()))
+                self._last_addr = self._cur_addr
+                self._cur_lines = None
+
+        return self.is_complete()
+
+    def is_complete(self):
+        """
+        return (bool): True if it looks like all the reports have been received
+        """
+        if self._cur_lines is not None or self._buf:
+            return False
+        return all(len(self._reports[a]) >= len(idx) for a, idx in self._indices.items())
+
+    def get_reports(self):
+        """
+        Must only be called once all the reports have been received
+        return (list of (str or list of str), list of float): for each query,
+          the report (as a list of lines, if it's multi-line), and the latency
+          (time between sending and receiving the report, in s)
+        """
+        reports = [None] * len(self._queries)
+        latencies = [None] * len(self._queries)
+        for addr, idx in self._indices.items():
+            reps = self._reports[addr]
+            if len(reps) > len(idx):
+                logging.warning("Skipping previous answers from hardware %r",
+                                [r for r, t in reps[:-len(idx)]])
+                reps = reps[-len(idx):]
+            for i, (r, t) in zip(idx, reps):
+                reports[i] = r
+                latencies[i] = t - self.start_time
+
+        return reports, latencies
+
+
 class SerialBusAccesser(object):
     """
     Manages connections to the low-level bus
@@ -3398,6 +3610,8 @@ class SerialBusAccesser(object):
         self.serial = ser
         # to acquire before sending anything on the serial port
         self.ser_access = threading.RLock()
+        # duration between sending a query and receiving its report
+        self.latency = model.LatencyHistogram()
         self.driverInfo = "serial driver: %s" % (driver.getSerialDriver(ser.port),)
 
     def terminate(self):
@@ -3425,10 +3639,11 @@ class SerialBusAccesser(object):
         """
         Send a command and return its report (raw)
         addr (None or 1<=int<=16): address of the controller
-        com (string): the command to send (without address prefix but with \n)
+        com (str or list of str): the command(s) to send (without address prefix but with \n)
         return (string or list of strings): the report without prefix
            (e.g.,"0 1") nor newline.
            If answer is multiline: returns a list of each line
+           If command was a list: one str or list of str per command
         Note: multiline answers seem to always begin with a \x00 character, but
          it's left as is.
         raise:
@@ -3437,89 +3652,59 @@ class SerialBusAccesser(object):
            IOError: if error during the communication (such as the protocol is
               not respected)
         """
-        assert(addr is None or 1 <= addr <= 16 or addr == 254)
-
         if isinstance(com, basestring):
-            com = [com]
-            multicom = False
+            return self.sendQueryCommands([(addr, com)])[0]
         else:
-            multicom = True
+            return self.sendQueryCommands([(addr, c) for c in com])
 
-        for c in com:
+    def sendQueryCommands(self, queries):
+        """
+        Send several commands at once (possibly to different controllers), and
+        return their reports (raw). This avoids waiting for each report before
+        sending the next command.
+        queries (list of (None or 1<=int<=16, str)): the address and command
+          of each query (without address prefix but with \n)
+        return (list of (str or list of str)): the report of each query, in the
+          same order (see sendQueryCommand())
+        raise:
+           HwError: if error communicating with the hardware, probably due to
+              the hardware not being in a good state (or connected)
+           IOError: if error during the communication (such as the protocol is
+              not respected)
+        """
+        full_com = ""
+        for addr, c in queries:
+            assert(addr is None or 1 <= addr <= 16 or addr == 254)
             assert(len(c) <= 100)  # commands can be quite long (with floats)
-
-        if addr is None:
-            full_com = "".join(com)
-            prefix = ""
-        else:
-            full_com = "".join("%d %s" % (addr, c) for c in com)
-            prefix = "0 %d " % addr
+            if addr is None:
+                full_com += c
+            else:
+                full_com += "%d %s" % (addr, c)
 
         with self.ser_access:
             logging.debug("Sending: '%s'", full_com.encode('string_escape'))
+            parser = ReportParser(queries)
             self.serial.write(full_com)
 
             # ensure everything is received, before expecting an answer
             self.serial.flush()
 
-            ans = ""  # received data not yet processed
-            ret = []  # one answer per command
-            continuing = False
             while True:
-                char = self.serial.read()  # empty if timeout
-                if not char:
+                # Read everything already received, or wait for at least one byte
+                data = self.serial.read(max(1, self.serial.inWaiting()))  # empty if timeout
+                if not data:
                     raise model.HwError("Controller %s timed out, check the device is "
-                                        "plugged in and turned on." % addr)
-                ans += char
-
-                anssplited = ans.split("\n")
-                # if the answer finishes with \n, last split is empty
-                anssplited, ans = anssplited[:-1], anssplited[-1]
-                if anssplited:
-                    logging.debug("Received: '%s'", "\n".join(anssplited).encode('string_escape'))
-
-                for l in anssplited:
-                    if not continuing:
-                        lines = []  # one string per answer line
-                        # remove the prefix
-                        if l.startswith(prefix):
-                            l = l[len(prefix):]
-                        else:
-                            # Maybe the previous line was actually continuing (but the hardware is strange)?
-                            if ret and ret[-1] == "":
-                                logging.debug("Reconcidering previous line as beginning of multi-line")
-                                ret = ret[:-1]
-                            else:
-                                logging.debug("Failed to decode answer '%s'", l.encode('string_escape'))
-                                raise IOError("Report prefix unexpected after '%s': '%s'." % (full_com, l))
-
-                    if l[-1:] == " ":  # multi-line
-                        continuing = True
-                        lines.append(l[:-1])  # remove the space indicating multi-line
-                    else:
-                        # End of the answer for that command
-                        continuing = False
-                        lines.append(l)
-                        if len(lines) == 1:
-                            ret.append(lines[0])
-                        else:
-                            ret.append(lines)
-
-                # does it look like we received the end of an answer?
-                if not continuing and not ans and len(ret) >= len(com):
+                                        "plugged in and turned on." %
+                                        (", ".join(str(a) for a, c in queries),))
+                if parser.feed(data):
                     break
 
-        if len(ret) > len(com):
-            logging.warning("Skipping previous answers from hardware %r",
-                            ret[:-len(com)])
-            ret = ret[-len(com):]
-        elif len(ret) < len(com):
-            logging.error("Expected %d answers but only got %d", len(com), len(ret))
-
-        if not multicom:
-            return ret[0]
-        else:
-            return ret
+        reports, latencies = parser.get_reports()
+        for l in latencies:
+            self.latency.add(l)
+        if len(queries) > 1:
+            logging.debug("Received %d reports in %g ms", len(queries), latencies[-1] * 1e3)
+        return reports
 
     def flushInput(self):
         """
@@ -3548,6 +3733,8 @@ class IPBusAccesser(object):
         self.socket = socket
         # to acquire before sending anything on the socket
         self.ser_access = threading.RLock()
+        # duration between sending a query and receiving its report
+        self.latency = model.LatencyHistogram()
 
         if master is None:
             self.driverInfo = "TCP/IP connection"
@@ -3594,45 +3781,48 @@ class IPBusAccesser(object):
            IOError: if error during the communication (such as the protocol is
               not respected)
         """
-        assert(addr is None or 1 <= addr <= 16 or addr == 254)
-
         if isinstance(com, basestring):
-            com = [com]
-            multicom = False
+            return self.sendQueryCommands([(addr, com)])[0]
         else:
-            multicom = True
+            return self.sendQueryCommands([(addr, c) for c in com])
 
-        for c in com:
+    def sendQueryCommands(self, queries):
+        """
+        Send several commands at once (possibly to different controllers), and
+        return their reports (raw). This avoids waiting for each report before
+        sending the next command.
+        queries (list of (None or 1<=int<=16, str)): the address and command
+          of each query (without address prefix but with \n)
+        return (list of (str or list of str)): the report of each query, in the
+          same order (see sendQueryCommand())
+        raise:
+           HwError: if error communicating with the hardware, probably due to
+              the hardware not being in a good state (or connected)
+           IOError: if error during the communication (such as the protocol is
+              not respected)
+        """
+        full_com = ""
+        for addr, c in queries:
+            assert(addr is None or 1 <= addr <= 16 or addr == 254)
             assert(len(c) <= 100)  # commands can be quite long (with floats)
-
-        if addr is None:
-            full_com = "".join(com)
-            prefix = ""
-        else:
-            full_com = "".join("%d %s" % (addr, c) for c in com)
-            prefix = "0 %d " % addr
+            if addr is None:
+                full_com += c
+            else:
+                full_com += "%d %s" % (addr, c)
 
         with self.ser_access:
             logging.debug("Sending: '%s'", full_com.encode('string_escape'))
+            parser = ReportParser(queries)
             self.socket.sendall(full_com)
 
-            # Read the answer
-            # The basic is simple. An answer starts with a prefix, and finishes
-            # with \n. If it actually finishes with " \n", then it's just a new
-            # line and not the end of the answer.
-            # However, it gets muddy sometimes with empty answers. For instance,
-            # it can answer "0 1 \n", which is an empty answer. But some
-            # controllers answer "1 HLP\n" with "0 1 \nBla bla \nBla\n"
             end_time = time.time() + 0.5
-            ans = ""  # received data not yet processed
-            ret = []  # one answer per command
-            continuing = False
             while True:
                 try:
                     data = self.socket.recv(4096)
                 except socket.timeout:
                     raise model.HwError("Controller %s timed out, check the device is "
-                                        "plugged in and turned on." % addr)
+                                        "plugged in and turned on." %
+                                        (", ".join(str(a) for a, c in queries),))
                 # If the master is already accessed from somewhere else it will just
                 # immediately answer an empty message
                 if not data:
@@ -3644,59 +3834,15 @@ class IPBusAccesser(object):
                     time.sleep(0.01)
                     continue
 
-                logging.debug("Received: '%s'", data.encode('string_escape'))
-                ans += data
-
-                anssplited = ans.split("\n")
-                # if the answer finishes with \n, last split is empty
-                anssplited, ans = anssplited[:-1], anssplited[-1]
-
-                for l in anssplited:
-                    # logging.debug("Processing %s", l)
-                    if not continuing:
-                        lines = []  # one string per answer line
-                        # remove the prefix
-                        if l.startswith(prefix):
-                            l = l[len(prefix):]
-                        else:
-                            # Maybe the previous line was actually continuing (but the hardware is strange)?
-                            if ret and ret[-1] == "":
-                                logging.debug("Reconcidering previous line as beginning of multi-line")
-                                ret = ret[:-1]
-                            else:
-                                # TODO: maybe we got some garbage data from before,
-                                # check if there is already data available that fits the
-                                # prefix. (=> keep reading but with a short timeout)
-                                logging.debug("Failed to decode answer '%s'", l.encode('string_escape'))
-                                raise IOError("Report prefix unexpected after '%s': '%s'." % (full_com, l))
-
-                    if l[-1:] == " ":  # multi-line
-                        continuing = True
-                        lines.append(l[:-1])  # remove the space indicating multi-line
-                    else:
-                        # End of the answer for that command
-                        continuing = False
-                        lines.append(l)
-                        if len(lines) == 1:
-                            ret.append(lines[0])
-                        else:
-                            ret.append(lines)
-
-                # does it look like we received the end of an answer?
-                if not continuing and not ans and len(ret) >= len(com):
+                if parser.feed(data):
                     break
 
-        if len(ret) > len(com):
-            logging.warning("Skipping previous answers from hardware %r",
-                            ret[:-len(com)])
-            ret = ret[-len(com):]
-        elif len(ret) < len(com):
-            logging.error("Expected %d answers but only got %d", len(com), len(ret))
-
-        if not multicom:
-            return ret[0]
-        else:
-            return ret
+        reports, latencies = parser.get_reports()
+        for l in latencies:
+            self.latency.add(l)
+        if len(queries) > 1:
+            logging.debug("Received %d reports in %g ms", len(queries), latencies[-1] * 1e3)
+        return reports
 
     def flushInput(self):
         """
@@ -3831,13 +3977,20 @@ class E861Simulator(object):
         while len(ret) < size:
             time.sleep(0.01)
             left = size - len(ret)
-            ret += self._output_buf[:left]
-            self._output_buf = self._output_buf[len(ret):]
+            data = self._output_buf[:left]
+            self._output_buf = self._output_buf[len(data):]
+            ret += data
             if self.timeout and time.time() > end_time:
                 break
 
         return ret
 
+    def inWaiting(self):
+        """
+        return (int): number of bytes ready to be read
+        """
+        return len(self._output_buf)
+
     def close(self):
         # using read or write will fail after that
         del self._output_buf
@@ -4207,13 +4360,20 @@ class DaisyChainSimulator(object):
         while len(ret) < size:
             time.sleep(0.01)
             left = size - len(ret)
-            ret += self._output_buf[:left]
-            self._output_buf = self._output_buf[len(ret):]
+            data = self._output_buf[:left]
+            self._output_buf = self._output_buf[len(data):]
+            ret += data
             if self.timeout and time.time() > end_time:
                 break
 
         return ret
 
+    def inWaiting(self):
+        """
+        return (int): number of bytes ready to be read
+        """
+        return len(self._output_buf)
+
     def _thread_read_serial(self, ser):
         """
         Push the output of the given serial port into our output
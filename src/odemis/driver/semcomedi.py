@@ -23,6 +23,7 @@ from __future__ import division
 
 import Queue
 import collections
+import ctypes
 import functools
 import gc
 import glob
@@ -34,6 +35,7 @@ from numpy.core import umath
 from odemis import model
 import odemis
 from odemis.model import roattribute, oneway
+from odemis.util import driver
 import os
 import re
 import threading
@@ -109,6 +111,12 @@ NI_AO_TRIG_AI_START1 = 19  # Trigger number for AI Start1 (= beginning of a comm
 ACQ_CMD_UPD = 1
 ACQ_CMD_TERM = 2
 
+# Number of values read at once, when decimating while reading
+READ_CHUNK_SIZE = 2 ** 16
+
+# Minimum time (in s) between two blocks of rows sent on .partialData
+PARTIAL_PERIOD = 0.1
+
 # helper functions
 def get_best_dtype_for_acc(idtype, count):
     """
@@ -130,6 +138,86 @@ def get_best_dtype_for_acc(idtype, count):
     return adtype
 
 
+class Decimator(object):
+    """
+    Averages the samples read for each pixel as soon as they are received, and
+    stores the result directly into the output arrays. This avoids keeping all
+    the (oversampled) raw data in memory.
+    The samples are expected in the order of acquisition: for each pixel,
+    spp times the value of each channel.
+    """
+    def __init__(self, nchans, spp, margin, outputs, adtype, divisor=None):
+        """
+        nchans (int): number of channels read (interleaved)
+        spp (int): number of samples per pixel for each channel
+        margin (int): number of pixels at the beginning of each line which are
+          discarded
+        outputs (list of 2D ndarrays or None): for each channel, the output array,
+          of shape lines x pixels (not including the margin). If None, the
+          data is just discarded.
+        adtype (dtype): intermediary type to use for the accumulator
+        divisor (None or int): the value by which the sum of the samples of a
+          pixel is divided. If None, it's spp (ie, the mean is computed).
+        """
+        self._nchans = nchans
+        self._spp = spp
+        self._margin = margin
+        self._outputs = outputs
+        self._adtype = adtype
+        self._divisor = spp if divisor is None else divisor
+        if outputs is None:
+            self._linelen = margin + 1
+            self._npixels = 1
+        else:
+            shape = outputs[0].shape
+            self._linelen = margin + shape[1]
+            self._npixels = shape[0] * self._linelen
+        self._ipixel = 0  # number of pixels already received
+        self._pending = None  # samples received of the next pixel (not complete)
+
+    @property
+    def done(self):
+        """
+        True if all the pixels have been received
+        """
+        return self._ipixel >= self._npixels
+
+    def add(self, data):
+        """
+        Process the next samples received. The extra samples, after all the
+         pixels are received, are discarded.
+        data (1D ndarray): the raw samples
+        """
+        if self._pending is not None:
+            data = numpy.concatenate((self._pending, data))
+            self._pending = None
+
+        gsz = self._spp * self._nchans
+        n = min(data.size // gsz, self._npixels - self._ipixel)
+        if n > 0 and self._outputs is not None:
+            px = data[:n * gsz].reshape(n, self._spp, self._nchans)
+            if self._spp == 1:
+                acc = px[:, 0, :]
+            else:
+                acc = umath.add.reduce(px, axis=1, dtype=self._adtype)
+            if self._divisor != 1:
+                acc = acc / self._divisor
+
+            # Find the position of each pixel, and skip the margin
+            lines, cols = divmod(numpy.arange(self._ipixel, self._ipixel + n),
+                                 self._linelen)
+            cols -= self._margin
+            keep = cols >= 0
+            if not keep.all():
+                lines, cols, acc = lines[keep], cols[keep], acc[keep]
+            for i, o in enumerate(self._outputs):
+                o[lines, cols] = acc[:, i]
+
+        self._ipixel += n
+        if not self.done and data.size > n * gsz:
+            self._pending = data[n * gsz:].copy()
+
+
 def _get_linux_version():
     """
     return (tuple of 3 int): major, minor, micro
@@ -150,6 +238,139 @@ class CancelledError(Exception):
     pass
 
 
+class ComediConverter(object):
+    """
+    Converts values between raw and physical units, with a converter of comedi.
+    Calling it converts one value, while convert() converts a whole array.
+    This generic version calls comedi for each element, which is very slow
+    (~2µs/element). The subclasses do the same computation as comedi, but with
+    numpy, on the whole array at once.
+    """
+    def __init__(self, func, dtype):
+        """
+        func (callable number -> number): the comedi conversion of one value
+        dtype (numpy.dtype): type of the converted values
+        """
+        self._func = func
+        self.dtype = numpy.dtype(dtype)
+
+    def __call__(self, value):
+        return self._func(value)
+
+    def convert(self, data):
+        """
+        Converts all the values of an array
+        data (numpy.ndarray): the values to convert
+        return (numpy.ndarray of same shape as data, and of type .dtype)
+        """
+        out = numpy.empty(data.shape, dtype=self.dtype)
+        for i, v in numpy.ndenumerate(data):
+            # item() converts to a python int/float, as expected by comedi
+            out[i] = self._func(v.item())
+        return out
+
+
+class PolynomialConverter(ComediConverter):
+    """
+    Converts values following a comedi calibration polynomial (same as
+    comedi.to_physical() and comedi.from_physical())
+    """
+    def __init__(self, func, dtype, coefficients, origin, direction, maxdata):
+        """
+        coefficients (list of floats): coefficients of the polynomial, from
+          lowest order term to highest
+        origin (float): expansion origin of the polynomial
+        direction (enum): comedi.TO_PHYSICAL or comedi.FROM_PHYSICAL
+        maxdata (int): the maximum raw value
+        """
+        ComediConverter.__init__(self, func, dtype)
+        self._coefs = coefficients
+        self._origin = origin
+        self._direction = direction
+        self._maxdata = maxdata
+
+    def convert(self, data):
+        x = numpy.asarray(data, dtype=numpy.double) - self._origin
+        # Same order of operations as comedi, to get the same rounding
+        value = numpy.zeros(x.shape, dtype=numpy.double)
+        term = numpy.ones(x.shape, dtype=numpy.double)
+        for c in self._coefs:
+            value += c * term
+            term *= x
+
+        if self._direction == comedi.TO_PHYSICAL:
+            return value.astype(self.dtype, copy=False)
+        else:
+            # comedi doesn't clip the high values, but they would overflow anyway
+            numpy.clip(value, 0, self._maxdata, out=value)
+            return numpy.rint(value).astype(self.dtype)
+
+
+class LinearConverter(ComediConverter):
+    """
+    Converts values linearly according to the range (same as comedi.to_phys()
+    and comedi.from_phys()), for non calibrated devices.
+    """
+    def __init__(self, func, dtype, rmin, rmax, direction, maxdata):
+        """
+        rmin (float): physical value corresponding to the raw value 0
+        rmax (float): physical value corresponding to the raw value maxdata
+        direction (enum): comedi.TO_PHYSICAL or comedi.FROM_PHYSICAL
+        maxdata (int): the maximum raw value
+        """
+        ComediConverter.__init__(self, func, dtype)
+        self._min = rmin
+        self._max = rmax
+        self._direction = direction
+        self._maxdata = maxdata
+
+    def convert(self, data):
+        x = numpy.array(data, dtype=numpy.double)  # copy, to compute in-place
+        if self._direction == comedi.TO_PHYSICAL:
+            oor = (x == 0) | (x == self._maxdata)
+            x *= (self._max - self._min)
+            x /= self._maxdata
+            x += self._min
+            # The values at the limits are probably out of range (cf OOR_NAN)
+            x[oor] = numpy.nan
+            return x.astype(self.dtype, copy=False)
+        else:
+            x -= self._min
+            x /= (self._max - self._min)
+            x *= self._maxdata
+            numpy.clip(x, 0, self._maxdata, out=x)
+            x += 0.5
+            return numpy.floor(x).astype(self.dtype)
+
+
+class _PolynomialStruct(ctypes.Structure):
+    """
+    Same as comedi_polynomial_t
+    """
+    _fields_ = [("coefficients", ctypes.c_double * 4),  # COMEDI_MAX_NUM_POLYNOMIAL_COEFFICIENTS
+                ("expansion_origin", ctypes.c_double),
+                ("order", ctypes.c_uint)]
+
+
+def _get_poly_coefficients(poly):
+    """
+    Reads the coefficients of a comedi polynomial
+    poly (comedi.polynomial_t): the polynomial
+    return (list of float): the coefficients, from lowest order term to highest
+    raise ValueError: if the coefficients cannot be read
+    """
+    # The SWIG wrapper doesn't give access to the values of the array of
+    # coefficients, so read them directly from the C structure.
+    try:
+        cpoly = _PolynomialStruct.from_address(int(poly.this))
+    except (AttributeError, TypeError) as ex:
+        raise ValueError("Failed to access the polynomial: %s" % (ex,))
+    if (cpoly.order != poly.order or cpoly.order >= len(cpoly.coefficients) or
+        cpoly.expansion_origin != poly.expansion_origin):
+        raise ValueError("Polynomial structure doesn't match (order %d)" % (poly.order,))
+    return list(cpoly.coefficients[:cpoly.order + 1])
+
+
 class SEMComedi(model.HwComponent):
     '''
     A generic HwComponent which provides children for controlling the scanning
@@ -255,7 +476,7 @@ class SEMComedi(model.HwComponent):
         comedi.set_global_oor_behavior(comedi.OOR_NAN)
         self._init_calibration()
 
-        # converters: dict (3-tuple int->number callable(number)):
+        # converters: dict (3-tuple int -> ComediConverter):
         # subdevice, channel, range -> converter from value to value
         self._convert_to_phys = {}
         self._convert_from_phys = {}
@@ -547,9 +768,15 @@ class SEMComedi(model.HwComponent):
         channel (int): the channel index
         range (int): the range index
         direction (enum): comedi.COMEDI_TO_PHYSICAL or comedi.COMEDI_FROM_PHYSICAL
-        return a callable number -> number
+        return (ComediConverter): callable number -> number, which can also
+          convert arrays
         """
         assert(direction in [comedi.TO_PHYSICAL, comedi.FROM_PHYSICAL])
+        if direction == comedi.TO_PHYSICAL:
+            dtype = numpy.double
+        else:
+            dtype = self._get_dtype(subdevice)
+        maxdata = comedi.get_maxdata(self._device, subdevice, channel)
 
         # 3 possibilities:
         # * the device is hard-calibrated -> simple converter from get_hardcal_converter
@@ -582,25 +809,49 @@ class SEMComedi(model.HwComponent):
             # not calibrated
             logging.debug("creating a non calibrated converter for s%dc%dr%d",
                           subdevice, channel, range)
-            maxdata = comedi.get_maxdata(self._device, subdevice, channel)
             range_info = comedi.get_range(self._device, subdevice,
                                           channel, range)
             # using default parameter to copy values into local-scope
             if direction == comedi.TO_PHYSICAL:
-                return lambda d, r = range_info, m = maxdata: comedi.to_phys(d, r, m)
+                func = lambda d, r = range_info, m = maxdata: comedi.to_phys(d, r, m)
             else:
-                return lambda d, r = range_info, m = maxdata: comedi.from_phys(d, r, m)
+                func = lambda d, r = range_info, m = maxdata: comedi.from_phys(d, r, m)
+            converter = LinearConverter(func, dtype, range_info.min, range_info.max,
+                                        direction, maxdata)
         else:
             # calibrated: return polynomial-based converter
             logging.debug("creating a calibrated converter for s%dc%dr%d",
                           subdevice, channel, range)
             if direction == comedi.TO_PHYSICAL:
-                return lambda d, p = poly: comedi.to_physical(d, p)
+                func = lambda d, p = poly: comedi.to_physical(d, p)
             else:
                 if poly.order > 1:
                     logging.info("polynomial of order %d, linear conversion would be imprecise",
                                  poly.order)
-                return lambda d, p = poly: comedi.from_physical(d, p)
+                func = lambda d, p = poly: comedi.from_physical(d, p)
+            try:
+                coefs = _get_poly_coefficients(poly)
+            except ValueError:
+                logging.warning("Failed to read the calibration polynomial, "
+                                "will convert values one at a time", exc_info=True)
+                return ComediConverter(func, dtype)
+            converter = PolynomialConverter(func, dtype, coefs, poly.expansion_origin,
+                                            direction, maxdata)
+
+        # Check that the fast conversion gives the same result as comedi
+        if direction == comedi.TO_PHYSICAL:
+            samples = numpy.array([1, maxdata // 3, maxdata // 2, maxdata - 1])
+        else:
+            range_info = comedi.get_range(self._device, subdevice, channel, range)
+            samples = numpy.linspace(range_info.min, range_info.max, 6)[1:-1]
+        expected = [func(v.item()) for v in samples]
+        if not numpy.allclose(converter.convert(samples), expected, rtol=1e-9, atol=1e-9):
+            logging.warning("Fast conversion for s%dc%dr%d differs from comedi (%s != %s), "
+                            "will convert values one at a time", subdevice, channel,
+                            range, converter.convert(samples), expected)
+            return ComediConverter(func, dtype)
+
+        return converter
 
     def _get_converter(self, subdevice, channel, range, direction):
         """
@@ -609,14 +860,20 @@ class SEMComedi(model.HwComponent):
         channel (int): the channel index
         range (int): the range index
         direction (enum): comedi.COMEDI_TO_PHYSICAL or comedi.COMEDI_FROM_PHYSICAL
-        return a callable number -> number
+        return (ComediConverter): callable number -> number, which can also
+          convert arrays
         """
+        if direction == comedi.TO_PHYSICAL:
+            cache = self._convert_to_phys
+        else:
+            cache = self._convert_from_phys
+
         # get the cached converter, or create a new one
         try:
-            converter = self._convert_to_phys[subdevice, channel, range]
+            converter = cache[subdevice, channel, range]
         except KeyError:
             converter = self._get_converter_actual(subdevice, channel, range, direction)
-            self._convert_to_phys[subdevice, channel, range] = converter
+            cache[subdevice, channel, range] = converter
 
         return converter
 
@@ -655,44 +912,10 @@ class SEMComedi(model.HwComponent):
           same as the channels and ranges. dtype should be uint (of any size)
         return (numpy.ndarray of the same shape as data, dtype=double): physical values
         """
-        # FIXME: this is very slow (2us/element), might need to go into numba,
-        # cython, C, or be avoided.
         array = numpy.empty(shape=data.shape, dtype=numpy.double)
-        converters = []
         for i, c in enumerate(channels):
-            converters.append(self._get_converter(subdevice, c, ranges[i],
-                                                  comedi.TO_PHYSICAL))
-
-        # converter needs lsampl (uint32). So for lsampl devices, it's pretty
-        # straightforward, just a matter of convincing SWIG that a numpy.uint32
-        # is a uint32. For sampl devices, everything needs to be converted.
-
-        # Note: it should be possible to access always the values as ctypes
-        # using data.ctypes.strides and
-        # cbuf = data.ctypes.data_as(ctypes.POINTER(ctypes.c_uint32))
-        # but ctypes.addressof(cbuf) != data.ctypes.data
-        # which is a sign of copy (bad)
-        try:
-            flat_data = numpy.reshape(data, numpy.prod(data.shape))
-            cbuf = numpy.ctypeslib.as_ctypes(flat_data)
-        except TypeError:
-            # strided array
-            cbuf = None
-
-        if data.dtype.char == 'L' and cbuf is not None:
-            logging.debug("Using casting to access the raw data")
-            # can just force-cast to a ctype buffer of unsigned int (that swig accepts)
-            # TODO: maybe could be speed-up by something like vectorize()/map()?
-            flat_array = numpy.reshape(array, numpy.prod(data.shape))
-            nchans = len(channels)
-            for i in range(flat_data.size / nchans):
-                for j in range(nchans):
-                    flat_array[nchans * i + j] = converters[j](cbuf[nchans * i + j])
-        else:
-            # Needs real conversion
-            logging.debug("Using full conversion of the raw data")
-            for i, v in numpy.ndenumerate(data):
-                array[i] = converters[i[-1]](int(v))
+            converter = self._get_converter(subdevice, c, ranges[i], comedi.TO_PHYSICAL)
+            array[..., i] = converter.convert(data[..., i])
 
         return array
 
@@ -707,22 +930,12 @@ class SEMComedi(model.HwComponent):
         return (numpy.ndarray of the same shape as data): raw values, the dtype
           fits the subdevice
         """
-        # FIXME: this is very slow (2us/element), might need to go into numba,
-        # cython, C, or be avoided.
         dtype = self._get_dtype(subdevice)
         # forcing the order is not necessary but just to ensure good performance
         buf = numpy.empty(shape=data.shape, dtype=dtype, order='C')
-
-        # prepare the converters
-        converters = []
         for i, c in enumerate(channels):
-            converters.append(self._get_converter(subdevice, c, ranges[i],
-                                                  comedi.FROM_PHYSICAL))
-
-        # TODO: check if it's possible to avoid multiple type conversion in the call
-
-        for i, v in numpy.ndenumerate(data):
-            buf[i] = converters[i[-1]](v)
+            converter = self._get_converter(subdevice, c, ranges[i], comedi.FROM_PHYSICAL)
+            buf[..., i] = converter.convert(data[..., i])
 
         return buf
 
@@ -951,7 +1164,7 @@ class SEMComedi(model.HwComponent):
         comedi.command(self._device, cmd)
 
     def write_read_2d_data_raw(self, wchannels, wranges, rchannels, rranges,
-                               period, margin, osr, dpr, data):
+                               period, margin, osr, dpr, data, on_lines=None):
         """
         write data on the given analog output channels and read synchronously on
          the given analog input channels and convert back to 2d array
@@ -967,6 +1180,9 @@ class SEMComedi(model.HwComponent):
         data (3D numpy.ndarray of int): array to write (raw values)
           first dimension is along the slow axis, second is along the fast axis,
           third is along the channels
+        on_lines (None or callable (list of 2D numpy.array, int, int)): called
+          every time some lines have been completely acquired, with the (partly
+          filled) buffers and the first and last (excluded) lines just acquired.
         return (list of 2D numpy.array with shape=(data.shape[0], data.shape[1]-margin)
          and dtype=device type): the data read (raw) for each channel, after
          decimation.
@@ -988,7 +1204,8 @@ class SEMComedi(model.HwComponent):
         if linesz < self._max_bufsz and not force_per_pixel:
             lines = self._max_bufsz // linesz
             return self._write_read_2d_lines(wchannels, wranges, rchannels, rranges,
-                                             period, margin, osr, lines, data)
+                                             period, margin, osr, lines, data,
+                                             on_lines)
 
         # fit a pixel
         max_dpr = (self._max_bufsz / self._reader.dtype.itemsize) // osr
@@ -1001,7 +1218,8 @@ class SEMComedi(model.HwComponent):
                               "<= %d", pixelsz / 2 ** 20, dpr, max_dpr)
 
             return self._write_read_2d_pixel(wchannels, wranges, rchannels, rranges,
-                                             period, margin, osr, dpr, data)
+                                             period, margin, osr, dpr, data,
+                                             on_lines)
 
         # separate each pixel into #dpr acquisitions
         pixelsz = nrchans * osr * self._reader.dtype.itemsize
@@ -1012,10 +1230,11 @@ class SEMComedi(model.HwComponent):
                           pixelsz / 2 ** 20, osr, dpr)
 
         return self._write_read_2d_subpixel(wchannels, wranges, rchannels, rranges,
-                                            period, margin, osr, dpr, data)
+                                            period, margin, osr, dpr, data,
+                                            on_lines)
 
     def _write_read_2d_lines(self, wchannels, wranges, rchannels, rranges,
-                             period, margin, osr, maxlines, data):
+                             period, margin, osr, maxlines, data, on_lines=None):
         """
         Implementation of write_read_2d_data_raw by reading the input data n
           lines at a time.
@@ -1046,46 +1265,21 @@ class SEMComedi(model.HwComponent):
             wdata = data[x:x + lines, :, :] # just a couple of lines
             wdata = wdata.reshape(-1, wdata.shape[2]) # flatten X/Y
             islast = (x + lines >= data.shape[0])
-            rbuf = self._write_read_raw_one_cmd(wchannels, wranges, rchannels,
+            # decimate directly into each buffer, while reading
+            decimator = Decimator(len(rchannels), osr, margin,
+                                  [b[x:x + lines] for b in buf], adtype)
+            self._write_read_raw_one_cmd(wchannels, wranges, rchannels,
                                     rranges, period, osr, wdata, margin,
-                                    rest=(islast and self._scanner.fast_park))
-
-            # decimate into each buffer
-            for i, b in enumerate(buf):
-                self._scan_raw_to_lines(rshape, margin, osr, x,
-                                        rbuf[..., i], b[x:x + lines, ...], adtype)
-
+                                    rest=(islast and self._scanner.fast_park),
+                                    decimator=decimator)
+            if on_lines:
+                on_lines(buf, x, x + lines)
             x += lines
 
         return buf
 
-    @staticmethod
-    def _scan_raw_to_lines(shape, margin, osr, x, data, oarray, adtype):
-        """
-        Converts a linear array resulting from a scan with oversampling to a 2D array
-        shape (2-tuple int): H,W dimension of the scanned image (margin not included)
-        margin (int): amount of useless pixels at the beginning of each line
-        osr (int): over-sampling rate
-        x (int): x position of the line in the output array
-        data (1D ndarray): the raw linear array (including oversampling), of one channel
-        oarray (2D ndarray): the output array, already allocated, of shape self.shape
-        adtype (dtype): intermediary type to use for the accumulator
-        """
-        # reshape to a 3D array with margin and sub-samples
-        rectangle = data.reshape((-1, shape[1] + margin, osr))
-        # trim margin
-        tr_rect = rectangle[:, margin:, :]
-        if osr == 1:
-            # only one sample per pixel => copy
-            oarray[...] = tr_rect[:, :, 0]
-        else:
-            # inspired by _mean() from numpy, but save the accumulated value in
-            # a separate array of a big enough dtype.
-            acc = umath.add.reduce(tr_rect, axis=2, dtype=adtype)
-            umath.true_divide(acc, osr, out=oarray, casting='unsafe', subok=False)
-
     def _write_read_2d_pixel(self, wchannels, wranges, rchannels, rranges,
-                             period, margin, osr, dpr, data):
+                             period, margin, osr, dpr, data, on_lines=None):
         """
         Implementation of write_read_2d_data_raw by reading the input data one
           pixel at a time.
@@ -1108,21 +1302,23 @@ class SEMComedi(model.HwComponent):
             wdata[:] = data[x, y, :] # copy the same pixel data * dpr
             if y < margin:
                 ss = dpr
+                outputs = None  # discard
             else:
                 ss = 0
+                outputs = [b[x:x + 1, y - margin:y - margin + 1] for b in buf]
             islast = ((x + 1, y + 1) == data.shape)
-            rbuf = self._write_read_raw_one_cmd(wchannels, wranges, rchannels,
+            # decimate directly into each buffer, while reading
+            decimator = Decimator(len(rchannels), osr * dpr, 0, outputs, adtype)
+            self._write_read_raw_one_cmd(wchannels, wranges, rchannels,
                                     rranges, period / dpr, osr, wdata, ss,
-                                    rest=(islast and self._scanner.fast_park))
-
-            # decimate into each buffer
-            for i, b in enumerate(buf):
-                self._scan_raw_to_pixel(rshape, margin, osr, dpr, x, y,
-                                        rbuf[..., i], b, adtype)
+                                    rest=(islast and self._scanner.fast_park),
+                                    decimator=decimator)
+            if on_lines and y == data.shape[1] - 1:
+                on_lines(buf, x, x + 1)
         return buf
 
     def _write_read_2d_subpixel(self, wchannels, wranges, rchannels, rranges,
-                                period, margin, osr, dpr, data):
+                                period, margin, osr, dpr, data, on_lines=None):
         """
         Implementation of write_read_2d_data_raw by reading the input data one
          part of a pixel at a time.
@@ -1151,38 +1347,30 @@ class SEMComedi(model.HwComponent):
             wdata = data[x, y].reshape(1, data.shape[2]) # add a "time" dimension == 1
             for d in range(dpr):
                 islast = ((x + 1, y + 1, d + 1) == data.shape + (dpr,))
-                rbuf = self._write_read_raw_one_cmd(wchannels, wranges, rchannels,
+                if y < margin:
+                    outputs = None  # discard
+                else:
+                    # sum into intermediary buffer
+                    outputs = [px_rbuf[d:d + 1, i:i + 1] for i in range(nrchans)]
+                decimator = Decimator(nrchans, osr, 0, outputs, adtype, divisor=1)
+                self._write_read_raw_one_cmd(wchannels, wranges, rchannels,
                                         rranges, period / dpr, osr, wdata, ss,
-                                        rest=(islast and self._scanner.fast_park))
-                # decimate into intermediary buffer
-                px_rbuf[d] = numpy.sum(rbuf, axis=0, dtype=adtype) / (osr * dpr)
+                                        rest=(islast and self._scanner.fast_park),
+                                        decimator=decimator)
 
-            # decimate into each buffer
-            for i, b in enumerate(buf):
-                self._scan_raw_to_pixel(rshape, margin, 1, dpr, x, y,
-                                        px_rbuf[..., i], b, adtype)
+            # mean into each buffer
+            if y >= margin:
+                for i, b in enumerate(buf):
+                    b[x, y - margin] = umath.add.reduce(px_rbuf[:, i], dtype=adtype) / (osr * dpr)
 
-        return buf
+            if on_lines and y == data.shape[1] - 1:
+                on_lines(buf, x, x + 1)
 
-    @staticmethod
-    def _scan_raw_to_pixel(shape, margin, osr, dpr, x, y, data, oarray, adtype):
-        """
-        Converts acquired data for one pixel resulting into the pixel for the a 2D array
-        shape (2-tuple int): H,W dimension of the scanned image (margin not included)
-        margin (int): amount of useless pixels at the beginning of each line
-        osr (int): over-sampling rate
-        dpr (int): duplication rate
-        x (int): x position of the pixel in the input array
-        y (int): y position of the pixel in the input array
-        data (1D ndarray): the raw data (including oversampling), of one channel
-        oarray (2D ndarray): the output array, already allocated, of shape self.shape
-        """
-        if y < margin:
-            return
-        oarray[x, y - margin] = numpy.sum(data, dtype=adtype) / (osr * dpr)
+        return buf
 
     def _fake_write_read_raw_one_cmd(self, wchannels, wranges, rchannels, rranges,
-                                     period, osr, data, settling_samples, rest=False):
+                                     period, osr, data, settling_samples, rest=False,
+                                     decimator=None):
         """
         Imitates _write_read_raw_one_cmd() but works with the comedi_test driver,
           just read data.
@@ -1220,7 +1408,7 @@ class SEMComedi(model.HwComponent):
             self._writer.prepare(wbuf, expected_time)
 
             # prepare read buffer info
-            self._reader.prepare(nrscans * nrchans, expected_time)
+            self._reader.prepare(nrscans * nrchans, expected_time, decimator)
 
         # FIXME: some times, after many fine acquisitions, this command fails
         # with "ComediError: returned -1 -> (16) Device or resource busy"
@@ -1248,6 +1436,8 @@ class SEMComedi(model.HwComponent):
         logging.debug("Waiting %g s for the acquisition to finish", timeout)
         rbuf = self._reader.wait(timeout)
         self._writer.wait(0.1)
+        if decimator is not None:
+            return None
         # reshape to 2D
         rbuf.shape = (nrscans, nrchans)
         if rest:
@@ -1256,7 +1446,8 @@ class SEMComedi(model.HwComponent):
         return rbuf
 
     def _write_read_raw_one_cmd(self, wchannels, wranges, rchannels, rranges,
-                                period, osr, data, settling_samples, rest=False):
+                                period, osr, data, settling_samples, rest=False,
+                                decimator=None):
         """
         write data on the given analog output channels and read synchronously
           on the given analog input channels in one command
@@ -1273,9 +1464,11 @@ class SEMComedi(model.HwComponent):
         settling_samples (int): number of first write samples used for the
           settling of the beam, and so don't need to trigger newPosition
         rest (boolean): if True, will add one more write to set to rest position
-        return (2D numpy.array with dtype=device type)
+        decimator (None or Decimator): if provided, the data is passed to it
+          while it's read, instead of being returned.
+        return (None or 2D numpy.array with dtype=device type)
             the raw data read (first dimension is data.shape[0] * osr) for each
-            channel (as second dimension).
+            channel (as second dimension). None if a decimator is provided.
         raises:
             IOError: in case of timeout or cancellation
         """
@@ -1308,7 +1501,7 @@ class SEMComedi(model.HwComponent):
             self.setup_timed_command(self._ai_subdevice, rchannels, rranges,
                                      rperiod_ns, stop_arg=nrscans, aref=comedi.AREF_DIFF)
             # prepare to read
-            self._reader.prepare(nrscans * nrchans, expected_time)
+            self._reader.prepare(nrscans * nrchans, expected_time, decimator)
 
             # create a command for writing
             # HACK WARNING:
@@ -1362,6 +1555,8 @@ class SEMComedi(model.HwComponent):
         rbuf = self._reader.wait(timeout)
         if nwscans != 1:
             self._writer.wait() # writer is faster, so there should be no wait
+        if decimator is not None:
+            return None
         # reshape to 2D
         rbuf.shape = (nrscans, nrchans)
         if rest:
@@ -1802,8 +1997,9 @@ class SEMComedi(model.HwComponent):
             mdi.update(dmdi)
 
         # write and read the raw data
+        on_lines = self._get_partial_notifier(detectors, md)
         rbuf = self.write_read_2d_data_raw(wchannels, wranges, rchannels,
-                            rranges, period, margin, osr, dpr, scan)
+                            rranges, period, margin, osr, dpr, scan, on_lines)
 
         # logging.debug("Converting raw data to physical: %s", rbuf)
         # TODO decimate/convert the data while reading, to save time, or do not convert at all
@@ -1821,6 +2017,46 @@ class SEMComedi(model.HwComponent):
 
         return rdas
 
+    def _get_partial_notifier(self, detectors, md):
+        """
+        Creates the function to send the blocks of rows on the .partialData
+          of the detectors, while the frame is being acquired.
+        detectors (list of AnalogDetectors)
+        md (list of dict): the metadata of the frame of each detector
+        return (None or callable (list of 2D numpy.array, int, int)): function
+          to pass as on_lines to write_read_2d_data_raw(), or None if no
+          detector has subscribers to its .partialData.
+        """
+        if not any(d.partialData.active for d in detectors):
+            return None
+
+        # first row not yet sent, and time of the last block sent
+        state = {"row": 0, "time": time.time()}
+
+        def send_rows(bufs, r0, r1):
+            now = time.time()
+            if r1 >= bufs[0].shape[0]:
+                return  # The complete frame is going to be sent via .data
+            if now - state["time"] < PARTIAL_PERIOD:
+                return  # Too soon, group with the next rows
+
+            r0 = state["row"]
+            for d, b, mdi in zip(detectors, bufs, md):
+                if not d.partialData.active:
+                    continue
+                block = b[r0:r1]
+                if d.inverted:
+                    block = (d.shape[0] - 1) - block
+                else:
+                    block = block.copy()  # The buffer is still being filled
+                bmd = mdi.copy()
+                bmd[model.MD_FRAME_ROWS] = (r0, r1, b.shape[0])
+                d.partialData.notify(model.DataArray(block, bmd))
+            state["row"] = r1
+            state["time"] = now
+
+        return send_rows
+
     def _acquire_counting_detector(self, detectors):
         """
         Run the acquisition for one counting detector (and the other detectors
@@ -2064,16 +2300,23 @@ class Reader(Accesser):
         self.dtype = parent._get_dtype(self._subdevice)
         self.buf = None
         self.count = None
+        self.decimator = None
+        self._nread = 0  # number of values read
         self._lock = threading.Lock()
 
-    def prepare(self, count, duration):
+    def prepare(self, count, duration, decimator=None):
         """
         count: number of values to read
         duration: expected total duration it will take (in s)
+        decimator (None or Decimator): if provided, the data is passed to it
+          by chunks, as soon as it's received, instead of being stored in .buf
         """
         with self._lock:
             self.count = count
             self.duration = duration
+            self.decimator = decimator
+            self.buf = None
+            self._nread = 0
             self.cancelled = False
             if self.thread and self.thread.isAlive():
                 logging.warning("Preparing a new acquisition while previous one is not over")
@@ -2090,7 +2333,17 @@ class Reader(Accesser):
     def _thread(self):
         """To be called in a separate thread"""
         try:
-            self.buf = numpy.fromfile(self.file, dtype=self.dtype, count=self.count)
+            if self.decimator is None:
+                self.buf = numpy.fromfile(self.file, dtype=self.dtype, count=self.count)
+                self._nread = self.buf.size
+            else:
+                while self._nread < self.count:
+                    chunk = numpy.fromfile(self.file, dtype=self.dtype,
+                                           count=min(self.count - self._nread, READ_CHUNK_SIZE))
+                    if chunk.size == 0:
+                        break
+                    self.decimator.add(chunk)
+                    self._nread += chunk.size
             logging.debug("read took %g s", time.time() - self._begin)
             # Kernel 4.4+ requires to cancel reading (it's also possible to try
             # to read further and get a EOF, but if the device has extra data,
@@ -2120,11 +2373,11 @@ class Reader(Accesser):
             logging.warning("Reading thread is still running after %g s", timeout)
             self.cancel()
 
-        # the result should be in self.buf
-        if self.buf is None:
+        # the result should be in self.buf (or passed to the decimator)
+        if self.buf is None and self.decimator is None:
             raise IOError("Failed to read all the %d expected values" % self.count)
-        elif self.buf.size != self.count:
-            raise IOError("Read only %d values from the %d expected" % (self.buf.size, self.count))
+        elif self._nread != self.count:
+            raise IOError("Read only %d values from the %d expected" % (self._nread, self.count))
 
         return self.buf
 
@@ -2262,12 +2515,17 @@ class MMapReader(Reader):
     def close(self):
         Reader.close(self)
 
-    def prepare(self, count, duration):
+    def prepare(self, count, duration, decimator=None):
         with self._lock:
             self.count = count
             self.duration = duration
-            self.buf = numpy.empty(count, dtype=self.dtype)
-            self.remaining = self.buf.nbytes
+            self.decimator = decimator
+            if decimator is None:
+                self.buf = numpy.empty(count, dtype=self.dtype)
+            else:
+                self.buf = None
+            self._nread = 0
+            self.remaining = count * self.dtype.itemsize
             self.buf_offset = 0
             self.mmap.seek(0)
             self.cancelled = False
@@ -2280,7 +2538,7 @@ class MMapReader(Reader):
     # Code inspired by pycomedi
     def _thread(self):
         # time it takes to read 10% of the buffer at maximum speed
-        sleep_time = ((self.mmap_size / 10) / self.buf.itemsize) * self.parent._min_ai_periods[1]
+        sleep_time = ((self.mmap_size / 10) / self.dtype.itemsize) * self.parent._min_ai_periods[1]
         # at least 1 ms, for scheduler, and 100 ms for cancel latency
         sleep_time = min(0.1, max(sleep_time, 0.001))
         try:
@@ -2288,7 +2546,7 @@ class MMapReader(Reader):
                 # a bit of time to fill the buffer
                 if self.remaining < (self.mmap_size / 10):
                     # almost the end, finish quickly
-                    sleep_time = self.remaining / self.buf.itemsize * self.parent._min_ai_periods[1]
+                    sleep_time = self.remaining / self.dtype.itemsize * self.parent._min_ai_periods[1]
                 time.sleep(sleep_time)
                 comedi.poll(self._device, self._subdevice) # the NI driver _requires_ this to ensure the buffer content is correct after a mark_read
 
@@ -2311,11 +2569,19 @@ class MMapReader(Reader):
         else:
             wrap = False
 
-        # mmap_action = copy to numpy array
-        offset = self.buf_offset / self.buf.itemsize
-        s = read_size / self.buf.itemsize
-        self.buf[offset:offset + s] = numpy.fromstring(self.mmap.read(read_size),
-                                                       dtype=self.dtype)
+        offset = self.buf_offset // self.dtype.itemsize
+        s = read_size // self.dtype.itemsize
+        if self.decimator is None:
+            # mmap_action = copy to numpy array
+            self.buf[offset:offset + s] = numpy.fromstring(self.mmap.read(read_size),
+                                                           dtype=self.dtype)
+        else:
+            # Directly pass the data in the mmap, without copy
+            pos = self.mmap.tell()
+            self.decimator.add(numpy.frombuffer(self.mmap, dtype=self.dtype,
+                                                count=s, offset=pos))
+            self.mmap.seek(pos + read_size)
+        self._nread += s
         comedi.mark_buffer_read(self._device, self._subdevice, read_size)
         if wrap:
             self.mmap.seek(0)
@@ -2337,12 +2603,12 @@ class MMapReader(Reader):
             logging.warning("Reading thread is still running after %g s", timeout)
             self.cancel()
 
-        # the result should be in self.buf
-        if self.buf is None:
+        # the result should be in self.buf (or passed to the decimator)
+        if self.buf is None and self.decimator is None:
             raise IOError("Failed to read all the %d expected values" % self.count)
         elif self.remaining != 0:
             raise IOError("Read only %d values from the %d expected" %
-                          (self.count - self.remaining / self.buf.itemsize), self.count)
+                          (self._nread, self.count))
 
         return self.buf
 
@@ -3275,6 +3541,8 @@ class AnalogDetector(model.Detector):
                                      channel)
         self._shape = (maxdata + 1,) # only one point
         self.data = SEMDataFlow(self, parent)
+        # Blocks of rows of the frame being acquired by .data (with MD_FRAME_ROWS)
+        self.partialData = driver.PartialDataFlow()
 
         # Special event to request software unblocking on the scan
         self.softwareTrigger = model.Event()
@@ -27,7 +27,7 @@ import logging
 import math
 import numpy
 from odemis import model, util, dataio
-from odemis.util import img
+from odemis.util import driver, img
 import os
 from scipy import ndimage
 import threading
@@ -35,6 +35,15 @@ import time
 import weakref
 
 
+# Number of rows in the noise bank. The noise of each row of a frame is picked
+# randomly from these rows, so it should be big enough to not see any pattern.
+NOISE_BANK_ROWS = 256
+# Maximum number of scan indices cached
+MAX_SCAN_INDICES_CACHED = 8
+# Minimum time (in s) between two blocks of rows sent on .partialData
+PARTIAL_PERIOD = 0.1
+
+
 class SimSEM(model.HwComponent):
     '''
     This is an extension of the model.HwComponent class. It first reads and
@@ -324,19 +333,39 @@ class Detector(model.Detector):
     of the fake SEM. It sets up a Dataflow and notifies it every time that a fake
     SEM image is generated. It also keeps and updates a “drift vector”
     """
-    def __init__(self, name, role, parent, **kwargs):
+    def __init__(self, name, role, parent, noise=0, **kwargs):
         """
         Note: parent should have a child "scanner" already initialised
+        noise (0 <= float): standard deviation of the noise (in counts) added to
+          the image, for a dwell time of 1 µs. As with a real detector, the noise
+          decreases with the square root of the dwell time. 0 disables the noise.
         """
         # It will set up ._shape and .parent
         model.Detector.__init__(self, name, role, parent=parent, **kwargs)
         self.data = SEMDataFlow(self, parent)
+        # Blocks of rows of the frame being acquired by .data (with MD_FRAME_ROWS)
+        self.partialData = driver.PartialDataFlow()
         self._acquisition_thread = None
         self._acquisition_lock = threading.Lock()
         self._acquisition_init_lock = threading.Lock()
         self._acquisition_must_stop = threading.Event()
 
         self.fake_img = self.parent.fake_img
+
+        # Caches to speed up the simulation, as most of the time the settings
+        # are the same from one frame to the next one
+        self._scan_indices = {}  # (lt, scale, res) -> (rows, cols)
+        self._last_frame = None  # (settings, ndarray) of the latest frame simulated
+
+        if noise < 0:
+            raise ValueError("noise must be positive, but got %s" % (noise,))
+        self._noise = noise
+        if noise:
+            # Gaussian noise is slow to generate, so a bank of it is generated
+            # once, and a random part of it is picked for each frame.
+            self._noise_bank = numpy.random.normal(0, 1, (NOISE_BANK_ROWS,
+                                                          self.fake_img.shape[1] + NOISE_BANK_ROWS))
+            self._noise_bank = self._noise_bank.astype(numpy.float32)
         # The shape is just one point, the depth
         idt = numpy.iinfo(self.fake_img.dtype)
         data_depth = idt.max - idt.min + 1
@@ -417,6 +446,60 @@ class Detector(model.Detector):
         if abs(self.current_drift) == self.drift_bound:
             self.drift_factor = -self.drift_factor
 
+    def _get_scan_indices(self, lt, scale, res):
+        """
+        Computes the pixels of the fake image which are scanned
+        lt (float, float): position of the top-left pixel (X, Y) in the fake image
+        scale (float, float): distance between two pixels (X, Y)
+        res (int, int): number of pixels scanned (X, Y)
+        return (slice or ndarray of int, slice or ndarray of int): the rows and
+          the columns of the fake image to use. Slices are used whenever the
+          pixels are regularly spaced, as it's faster than fancy indexing.
+        """
+        key = (lt, scale, res)
+        try:
+            return self._scan_indices[key]
+        except KeyError:
+            pass
+
+        indices = []
+        for o, s, r in zip(lt, scale, res):
+            # Same as round() (ie, half away from zero), as all the values are positive
+            coord = numpy.floor(o + numpy.arange(r) * s + 0.5).astype(numpy.intp)
+            if r == 1:
+                indices.append(slice(coord[0], coord[0] + 1))
+                continue
+            step = coord[1] - coord[0]
+            if step > 0 and (numpy.diff(coord) == step).all():
+                indices.append(slice(coord[0], coord[-1] + 1, step))
+            else:
+                indices.append(coord)
+        cols, rows = indices
+
+        if len(self._scan_indices) >= MAX_SCAN_INDICES_CACHED:
+            self._scan_indices.clear()
+        self._scan_indices[key] = rows, cols
+        return rows, cols
+
+    def _add_noise(self, sim_img, dwelltime, bpp):
+        """
+        Adds (Gaussian) noise on the image
+        sim_img (ndarray of uint): the image
+        dwelltime (0 < float): dwell time used, which reduces the noise
+        bpp (int): number of bits per pixel of the image (as in MD_BPP)
+        return (ndarray): the image with noise, of the same dtype, and within
+          the range of values of the bpp
+        """
+        amplitude = self._noise * math.sqrt(1e-6 / dwelltime)
+        # Pick random rows from the bank, and a random horizontal offset
+        rows = numpy.random.randint(0, NOISE_BANK_ROWS, sim_img.shape[0])
+        offset = numpy.random.randint(0, NOISE_BANK_ROWS)
+        noise = self._noise_bank[rows, offset:offset + sim_img.shape[1]]
+        noise *= amplitude
+        noise += sim_img
+        numpy.clip(noise, 0, 2 ** bpp - 1, out=noise)
+        return noise.astype(sim_img.dtype)
+
     def _simulate_image(self):
         """
         Generates the fake output based on the translation, resolution and
@@ -448,29 +531,54 @@ class Detector(model.Detector):
             lt = (center[0] + pxs_pos[0] - (res[0] / 2) * scale[0],
                   center[1] + pxs_pos[1] - (res[1] / 2) * scale[1])
             assert(lt[0] >= 0 and lt[1] >= 0)
-            # compute each row and column that will be included
-            coord = ([int(round(lt[0] + i * scale[0])) for i in range(res[0])],
-                     [int(round(lt[1] + i * scale[1])) for i in range(res[1])])
-            sim_img = self.fake_img[numpy.ix_(coord[1], coord[0])] # copy
 
-            # reduce image depth if requested
             bpp = self.bpp.value
-            if bpp < 16:
-                mind, maxd = sim_img.min(), sim_img.max()
-                maxf = 2 ** bpp - 1
-                b = maxf / max(1, (maxd - mind))
-                # Multiply by a float and drop to the original dtype
-                numpy.multiply(sim_img - mind, b, out=sim_img, casting="unsafe")
-                if bpp <= 8:
-                    sim_img = sim_img.astype(numpy.uint8)
-
-            metadata[model.MD_BPP] = bpp
-
             if self.parent._focus:
-                # apply the defocus
+                # the defocus
                 pos = self.parent._focus.position.value['z']
                 dist = abs(pos - self.parent._focus._good_focus) * 1e4
-                sim_img = ndimage.gaussian_filter(sim_img, sigma=dist)
+            else:
+                dist = 0
+
+            # If all the settings are the same as the latest frame, the output
+            # is the same. That's very common in live view, as the drift only
+            # changes every few seconds.
+            settings = (lt, scale, res, bpp, dist)
+            if self._last_frame and self._last_frame[0] == settings:
+                sim_img = self._last_frame[1].copy()
+            else:
+                # compute each row and column that will be included
+                rows, cols = self._get_scan_indices(lt, scale, res)
+                if isinstance(rows, slice) and isinstance(cols, slice):
+                    sim_img = self.fake_img[rows, cols].copy()
+                else:
+                    if isinstance(rows, slice):
+                        rows = numpy.arange(rows.start, rows.stop, rows.step)
+                    if isinstance(cols, slice):
+                        cols = numpy.arange(cols.start, cols.stop, cols.step)
+                    sim_img = self.fake_img[numpy.ix_(rows, cols)]  # copy
+                sim_img = numpy.asarray(sim_img)  # Just the data, metadata is added later
+
+                # reduce image depth if requested
+                if bpp < 16:
+                    mind, maxd = sim_img.min(), sim_img.max()
+                    maxf = 2 ** bpp - 1
+                    b = maxf / max(1, (maxd - mind))
+                    # Multiply by a float and drop to the original dtype
+                    numpy.multiply(sim_img - mind, b, out=sim_img, casting="unsafe")
+                    if bpp <= 8:
+                        sim_img = sim_img.astype(numpy.uint8)
+
+                if dist:
+                    # apply the defocus
+                    sim_img = ndimage.gaussian_filter(sim_img, sigma=dist)
+
+                self._last_frame = (settings, sim_img.copy())
+
+            if self._noise:
+                sim_img = self._add_noise(sim_img, scanner.dwellTime.value, bpp)
+
+            metadata[model.MD_BPP] = bpp
 
             # update fake output metadata
             metadata[model.MD_POS] = updated_phy_pos
@@ -494,15 +602,49 @@ class Detector(model.Detector):
                 dwelltime = self.parent._scanner.dwellTime.value
                 resolution = self.parent._scanner.resolution.value
                 duration = numpy.prod(resolution) * dwelltime
-                if self._acquisition_must_stop.wait(duration):
+                tend = time.time() + duration
+                # The image is simulated during the "scanning" time, so that the
+                # frame rate only depends on the dwell time and resolution
+                # (as long as the simulation is faster).
+                sim_img = self._simulate_image()
+                if self.partialData.active:
+                    if self._send_partial(sim_img, tend - duration, dwelltime):
+                        break
+                if self._acquisition_must_stop.wait(max(0, tend - time.time())):
                     break
-                callback(self._simulate_image())
+                callback(sim_img)
         except Exception:
             logging.exception("Unexpected failure during image acquisition")
         finally:
             logging.debug("Acquisition thread closed")
             self._acquisition_must_stop.clear()
 
+    def _send_partial(self, sim_img, tstart, dwelltime):
+        """
+        Sends the frame on .partialData, as blocks of rows, at the time each
+        block would be completely scanned. The last block is not sent, as it
+        completes the frame, which is sent on .data.
+        sim_img (DataArray): the complete frame
+        tstart (float): time at which the scanning of the frame started
+        dwelltime (float): time spent on each pixel
+        return (bool): True if the acquisition was requested to stop
+        """
+        h, w = sim_img.shape
+        line_dur = w * dwelltime
+        nrows = max(1, int(PARTIAL_PERIOD / line_dur))
+        if nrows >= h:
+            return False  # Frame is fast enough, no need to split it
+
+        for r0 in range(0, h - nrows, nrows):
+            r1 = r0 + nrows
+            if self._acquisition_must_stop.wait(max(0, tstart + r1 * line_dur - time.time())):
+                return True
+            md = sim_img.metadata.copy()
+            md[model.MD_FRAME_ROWS] = (r0, r1, h)
+            self.partialData.notify(model.DataArray(sim_img[r0:r1], md))
+
+        return False
+
 
 class SEMDataFlow(model.DataFlow):
     """
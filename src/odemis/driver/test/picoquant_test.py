@@ -22,6 +22,7 @@ from __future__ import division
 
 import copy
 import logging
+import numpy
 from odemis import model
 from odemis.driver import picoquant
 import os
@@ -69,6 +70,58 @@ class TestPH300Static(unittest.TestCase):
         wrong_config["device"] = "NOTAGOODSN"
         self.assertRaises(Exception, picoquant.PH300, **wrong_config)
 
+    def test_ring_buffer(self):
+        buf = picoquant.RecordRingBuffer(10)
+        buf.write(numpy.arange(4, dtype=numpy.uint32))
+        buf.write(numpy.arange(4, 8, dtype=numpy.uint32))
+        numpy.testing.assert_array_equal(buf.read(), range(8))
+
+        # Wraps around, and drops the oldest records
+        buf.write(numpy.arange(8, 20, dtype=numpy.uint32))
+        numpy.testing.assert_array_equal(buf.read(), range(10, 20))
+        self.assertEqual(buf.dropped, 2)
+
+        self.assertEqual(buf.read(timeout=0.1).size, 0)
+
+        # Once closed, the remaining records can still be read
+        buf.write(numpy.arange(3, dtype=numpy.uint32))
+        buf.close()
+        self.assertTrue(buf.closed)
+        numpy.testing.assert_array_equal(buf.read(timeout=10), range(3))
+        self.assertEqual(buf.read(timeout=10).size, 0)
+
+    def test_histogrammer(self):
+        """
+        Check the histograms computed from (simulated) T3 records
+        """
+        fake = picoquant.FakePHDLL()
+        fake.PH_SetMarkerEnable(0, 1, 0, 0, 0)
+        recs = fake._generate_t3(0, 300000)
+
+        # Compute the expected histograms directly from the records
+        chan = recs >> 28
+        dtime = (recs >> 16) & 0xfff
+        ovfl = (chan == picoquant.T3CHAN_SPECIAL) & (dtime == 0)
+        nsync = (recs & 0xffff) + numpy.cumsum(ovfl) * picoquant.T3WRAPAROUND
+        photons = (chan == 1)
+
+        def expected_hist(start, end):
+            sel = photons & (nsync >= start) & (nsync < end)
+            return numpy.bincount(dtime[sel], minlength=picoquant.T3HISTCHAN)
+
+        for window, period in ((10000, 10000), (None, fake._marker_period)):
+            hister = picoquant.T3Histogrammer(picoquant.T3HISTCHAN)
+            hister.window = window
+            hists = []
+            for r in numpy.array_split(recs, 17):  # Records arrive in blocks
+                hists.extend(hister.add(r))
+
+            self.assertEqual(len(hists), 300000 // period - 1)
+            for i, (start, h) in enumerate(hists):
+                self.assertEqual(start, i * period)
+                self.assertEqual(h.shape, (picoquant.T3HISTCHAN,))
+                numpy.testing.assert_array_equal(h, expected_hist(start, start + period))
+
 
 class TestPH300(unittest.TestCase):
     """
@@ -160,5 +213,94 @@ class TestPH300(unittest.TestCase):
         self._cnt += 1
         self._lastdata = data
 
+
+class TestPH300TTTR(unittest.TestCase):
+    """
+    Tests of the TTTR mode
+    """
+    @classmethod
+    def setUpClass(cls):
+        config = copy.deepcopy(CONFIG_PH)
+        config["tttr"] = True
+        cls.dev = picoquant.PH300(**config)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dev.terminate()
+        time.sleep(1)
+
+    def test_acquire_sub(self):
+        """Histograms of each dwell time are sent continuously"""
+        dt = 10e-3  # s
+        self.dev.dwellTime.value = dt
+        self.dev.pixelMarker.value = False
+        exp_shape = self.dev.shape[-2::-1]
+
+        self._data = []
+        self.dev.data.subscribe(self._on_det)
+        time.sleep(2)
+        self.dev.data.unsubscribe(self._on_det)
+
+        # No overhead per histogram => the number received only depends on the dwell time
+        self.assertGreater(len(self._data), 2 / dt * 0.8)
+        dates = [d.metadata[model.MD_ACQ_DATE] for d in self._data]
+        for d, dn in zip(dates[:-1], dates[1:]):
+            self.assertAlmostEqual(dn - d, dt, places=4)
+        for d in self._data:
+            self.assertEqual(d.shape, exp_shape)
+            self.assertEqual(d.metadata[model.MD_DWELL_TIME], dt)
+
+    def test_acquire_marker(self):
+        """Histograms are separated by the markers"""
+        if not TEST_NOHW:
+            self.skipTest("Needs a scanner sending markers")
+        self.dev.pixelMarker.value = True
+        data = self.dev.data.get()
+        self.assertEqual(data.shape, self.dev.shape[-2::-1])
+        self.assertGreater(data.metadata[model.MD_DWELL_TIME], 0)
+        self.dev.pixelMarker.value = False
+
+    def test_reader_failure(self):
+        """The acquisition stops if the FIFO cannot be read anymore"""
+        self.dev.dwellTime.value = 10e-3
+        self.dev.pixelMarker.value = False
+
+        # Count how often the acquisition thread polls the buffer
+        nreads = [0]
+        orig_buf_cls = picoquant.RecordRingBuffer
+        class CountingRingBuffer(orig_buf_cls):
+            def read(self, timeout=None):
+                nreads[0] += 1
+                return orig_buf_cls.read(self, timeout)
+
+        def failing_read_fifo(count):
+            raise IOError("Simulated FIFO failure")
+
+        picoquant.RecordRingBuffer = CountingRingBuffer
+        self.dev.ReadFiFo = failing_read_fifo
+        try:
+            self._data = []
+            self.dev.data.subscribe(self._on_det)
+            time.sleep(1)
+            self.dev.data.unsubscribe(self._on_det)
+        finally:
+            picoquant.RecordRingBuffer = orig_buf_cls
+            del self.dev.ReadFiFo
+
+        self.assertEqual(self._data, [])
+        # The acquisition should have stopped, instead of polling the closed
+        # buffer over and over (it would normally poll at most every 0.1s)
+        self.assertLess(nreads[0], 10)
+
+        # A new acquisition works again
+        self._data = []
+        self.dev.data.subscribe(self._on_det)
+        time.sleep(0.5)
+        self.dev.data.unsubscribe(self._on_det)
+        self.assertGreater(len(self._data), 0)
+
+    def _on_det(self, df, data):
+        self._data.append(data)
+
 if __name__ == "__main__":
     unittest.main()
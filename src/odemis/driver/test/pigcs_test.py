@@ -159,6 +159,42 @@ class TestFakeCL(TestController):
         self.config_ctrl = CONFIG_CTRL_CL
 
 
+#@skip("faster")
+class TestFakePipeline(unittest.TestCase):
+    """
+    Test sending several queries at once, on the simulator
+    """
+    def setUp(self):
+        self.ser = pigcs.FakeBus._openSerialPort(PORT, _addresses={1: True, 2: False})
+        self.accesser = pigcs.SerialBusAccesser(self.ser)
+
+    def tearDown(self):
+        self.accesser.terminate()
+
+    def test_multi_address(self):
+        queries = [(1, "*IDN?\n"), (2, "ERR?\n"), (1, "ERR?\n"), (2, "*IDN?\n")]
+        reports = self.accesser.sendQueryCommands(queries)
+        self.assertEqual(len(reports), len(queries))
+        self.assertIn("Physik Instrumente", reports[0])
+        self.assertEqual(reports[1], "0")
+        self.assertEqual(reports[2], "0")
+        self.assertIn("Physik Instrumente", reports[3])
+        self.assertEqual(self.accesser.latency.count, len(queries))
+
+        # Same reports as when sent one at a time
+        for (addr, com), rep in zip(queries, reports):
+            self.assertEqual(self.accesser.sendQueryCommand(addr, com), rep)
+
+    def test_position(self):
+        ctrl = pigcs.Controller(self.accesser, *CONFIG_CTRL_CL)
+        q = ctrl.getPositionQuery(1)
+        self.assertIsNotNone(q)
+        reports = self.accesser.sendQueryCommands([(1, q), (2, "ERR?\n")])
+        pos = ctrl.parsePositionReport(1, reports[0])
+        self.assertAlmostEqual(pos, ctrl.getPosition(1))
+        ctrl.terminate()
+
+
 #@skip("faster")
 class TestActuator(unittest.TestCase):
 
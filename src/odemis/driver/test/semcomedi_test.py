@@ -150,6 +150,33 @@ class TestSEMStatic(unittest.TestCase):
             comp = diffx >= 0 # must be decreasing
         self.assertTrue(comp.all())
 
+    def test_decimator(self):
+        """
+        Test the Decimator gives the mean of each pixel, whatever the size of
+        the chunks of data received
+        """
+        osr, margin, nchans = 4, 2, 2
+        shape = (5, 11)
+        dtype = numpy.dtype("uint16")
+        adtype = semcomedi.get_best_dtype_for_acc(dtype, osr)
+        raw = numpy.random.randint(0, 2 ** 16, (shape[0], shape[1] + margin, osr, nchans)).astype(dtype)
+        # Extra data (eg, read while going to the rest position) should be discarded
+        extra = numpy.random.randint(0, 2 ** 16, osr * nchans).astype(dtype)
+        data = numpy.concatenate((raw.ravel(), extra))
+
+        outputs = [numpy.zeros(shape, dtype=dtype) for i in range(nchans)]
+        decimator = semcomedi.Decimator(nchans, osr, margin, outputs, adtype)
+        i = 0
+        while i < data.size:
+            n = numpy.random.randint(1, 50)
+            decimator.add(data[i:i + n])
+            i += n
+        self.assertTrue(decimator.done)
+
+        for c, o in enumerate(outputs):
+            exp = raw[:, margin:, :, c].astype(numpy.float64).mean(axis=2).astype(dtype)
+            numpy.testing.assert_array_equal(o, exp)
+
 #@unittest.skip("simple")
 class TestSEM(unittest.TestCase):
     """
@@ -197,6 +224,42 @@ class TestSEM(unittest.TestCase):
         size = self.scanner.resolution.value
         return size[0] * size[1] * dwell + size[1] * settle
 
+    def test_conversion(self):
+        """
+        Check the conversion of arrays gives the same result as converting each
+        value with comedi, and is faster
+        """
+        sem = self.sem
+        channels = CONFIG_SCANNER["channels"]
+        ranges = [0] * len(channels)
+
+        # Physical -> raw (as used to generate the scan)
+        rng = semcomedi.comedi.get_range(sem._device, sem._ao_subdevice, channels[0], 0)
+        phys = numpy.random.uniform(rng.min, rng.max, (64, 64, len(channels)))
+        start = time.time()
+        raw = sem._array_from_phys(sem._ao_subdevice, channels, ranges, phys)
+        dur_fast = time.time() - start
+
+        start = time.time()
+        exp_raw = numpy.empty(raw.shape, dtype=raw.dtype)
+        for i, v in numpy.ndenumerate(phys):
+            exp_raw[i] = sem._from_phys(sem._ao_subdevice, channels[i[-1]], 0, float(v))
+        dur_slow = time.time() - start
+        numpy.testing.assert_array_equal(raw, exp_raw)
+        logging.info("Converted %d values to raw in %g s, instead of %g s (%g Mvalues/s)",
+                     phys.size, dur_fast, dur_slow, phys.size / dur_fast / 1e6)
+        self.assertLess(dur_fast, dur_slow)
+
+        # Raw -> physical (as would be used for the detector data)
+        ai_chans = [CONFIG_SED["channel"]]
+        maxdata = semcomedi.comedi.get_maxdata(sem._device, sem._ai_subdevice, ai_chans[0])
+        raw = numpy.random.randint(0, maxdata + 1, (64, 64, 1)).astype(sem._get_dtype(sem._ai_subdevice))
+        phys = sem._array_to_phys(sem._ai_subdevice, ai_chans, [0], raw)
+        exp_phys = numpy.empty(raw.shape, dtype=numpy.double)
+        for i, v in numpy.ndenumerate(raw):
+            exp_phys[i] = sem._to_phys(sem._ai_subdevice, ai_chans[0], 0, int(v))
+        numpy.testing.assert_allclose(phys, exp_phys, rtol=1e-12)
+
 #     @unittest.skip("simple")
     def test_acquire(self):
         self.scanner.dwellTime.value = 10e-6 # s
@@ -23,6 +23,7 @@ from __future__ import division
 import Pyro4
 import copy
 import logging
+import numpy
 from odemis import model
 from odemis.driver import simsem
 import os
@@ -79,6 +80,45 @@ class TestSEMStatic(unittest.TestCase):
         wrong_config["children"]["scanner"]["channels"] = [1, 1]
         self.assertRaises(Exception, simsem.SimSEM, **wrong_config)
 
+        wrong_config = copy.deepcopy(CONFIG_SEM)
+        wrong_config["children"]["detector0"]["noise"] = -5
+        self.assertRaises(ValueError, simsem.SimSEM, **wrong_config)
+
+    def test_noise(self):
+        """
+        Check the noise changes every frame, and decreases with the dwell time
+        """
+        config = copy.deepcopy(CONFIG_SEM)
+        config["drift_period"] = None
+        config["children"]["detector0"]["noise"] = 100
+        sem = simsem.SimSEM(**config)
+        for child in sem.children.value:
+            if child.name == CONFIG_SED["name"]:
+                sed = child
+            elif child.name == CONFIG_SCANNER["name"]:
+                scanner = child
+
+        scanner.resolution.value = (256, 256)
+        scanner.dwellTime.value = 1e-6
+        im1 = sed.data.get()
+        im2 = sed.data.get()
+        diff_short = numpy.std(im1.astype(numpy.float64) - im2)
+        self.assertGreater(diff_short, 0)
+
+        scanner.dwellTime.value = 100e-6
+        im1 = sed.data.get()
+        im2 = sed.data.get()
+        diff_long = numpy.std(im1.astype(numpy.float64) - im2)
+        self.assertLess(diff_long, diff_short)
+
+        # The noise stays within the range of the bits per pixel
+        for bpp in sed.bpp.choices:
+            sed.bpp.value = bpp
+            im = sed.data.get()
+            self.assertEqual(im.metadata[model.MD_BPP], bpp)
+            self.assertLessEqual(im.max(), 2 ** bpp - 1)
+        sem.terminate()
+
     def test_pickle(self):
         try:
             os.remove("testds")
@@ -157,6 +197,30 @@ class TestSEM(unittest.TestCase):
         self.assertGreaterEqual(duration, expected_duration, "Error execution took %f s, less than exposure time %d." % (duration, expected_duration))
         self.assertIn(model.MD_DWELL_TIME, im.metadata)
 
+    def test_acquire_rate(self):
+        """
+        Check the frame rate of big images only depends on the dwell time
+        """
+        self.scanner.resolution.value = (1024, 1024)
+        self.size = self.scanner.resolution.value
+        self.scanner.dwellTime.value = 1e-6  # s
+        expected_duration = numpy.prod(self.size) * self.scanner.dwellTime.value
+
+        # Acquire for the time needed to scan 5.5 frames
+        number = 5
+        self.left = 1000  # never reached
+        self.sed.data.subscribe(self.receive_image)
+        time.sleep((number + 0.5) * expected_duration)
+        self.sed.data.unsubscribe(self.receive_image)
+        nframes = 1000 - self.left
+
+        logging.info("Acquired %d frames of %s px in %g s (expected %d)",
+                     nframes, self.size, (number + 0.5) * expected_duration, number)
+        # Cannot be faster than the scanning
+        self.assertLessEqual(nframes, number + 1)
+        # Loose, to not fail on a busy computer
+        self.assertGreaterEqual(nframes, number // 2 + 1)
+
     def test_acquire_8bpp(self):
         self.sed.bpp.value = 8
         self.scanner.dwellTime.value = 10e-6  # s
@@ -337,6 +401,48 @@ class TestSEM(unittest.TestCase):
 
         self.assertEqual(self.left, 0)
 
+    def test_partial_data(self):
+        """
+        Check the blocks of rows are sent while the frame is being scanned
+        """
+        self.scanner.resolution.value = (256, 200)
+        self.size = self.scanner.resolution.value
+        self.scanner.dwellTime.value = 20e-6  # s => ~1 s per frame
+        expected_duration = self.compute_expected_duration()
+
+        blocks = []
+        def receive_block(df, block):
+            blocks.append((time.time(), block))
+
+        self.sed.partialData.subscribe(receive_block)
+        start = time.time()
+        im = self.sed.data.get()
+        end = time.time()
+        self.sed.partialData.unsubscribe(receive_block)
+
+        self.assertGreater(len(blocks), 2)
+        prev_end = 0
+        for t, b in blocks:
+            r0, r1, h = b.metadata[model.MD_FRAME_ROWS]
+            self.assertEqual(h, im.shape[0])
+            self.assertEqual(r0, prev_end)
+            self.assertEqual(b.shape, (r1 - r0, im.shape[1]))
+            self.assertEqual(b.metadata[model.MD_ACQ_DATE], im.metadata[model.MD_ACQ_DATE])
+            numpy.testing.assert_array_equal(b, im[r0:r1])
+            prev_end = r1
+        self.assertLess(prev_end, im.shape[0])  # Last rows are only in the frame
+
+        # The first block is received well before the end of the frame
+        self.assertLess(blocks[0][0] - start, expected_duration / 2)
+        self.assertLessEqual(blocks[-1][0], end)
+
+        # No acquisition is started when only subscribed to the partial data
+        self.sed.partialData.subscribe(receive_block)
+        nblocks = len(blocks)
+        time.sleep(expected_duration * 1.5)
+        self.sed.partialData.unsubscribe(receive_block)
+        self.assertEqual(len(blocks), nblocks)
+
     def test_acquire_with_va(self):
         """
         Change some settings before and while acquiring
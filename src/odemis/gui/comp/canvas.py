@@ -139,6 +139,24 @@ Graphical data is drawn using the following sequence of method calls:
 
             * Refresh/Update canvas
 
+Partial redraw
+~~~~~~~~~~~~~~
+
+Redrawing the whole buffer is costly, so `BitmapCanvas` only redraws the areas
+which have changed, when possible. `set_images` compares the new images with
+the previous ones, and marks as dirty the area of the buffer covered by each
+image which changed (before and after the change). When the drawing update was
+requested with `request_drawing_update(partial=True)`, `draw` only recomposes
+the dirty area (background, all the images and world overlays, clipped to the
+area). In every other case (direct call to `update_drawing`, change of scale,
+position, buffer size...), the whole buffer is redrawn.
+
+While the canvas is hidden, the drawing is only updated every
+`HIDDEN_DRAW_PERIOD` (so that the thumbnail stays up-to-date), and it is
+completed as soon as the canvas is shown again.
+
+The duration of each drawing is recorded in `draw_stats`.
+
 """
 
 from __future__ import division
@@ -148,16 +166,18 @@ import cairo
 from decorator import decorator
 import logging
 import math
-from odemis import util
+from odemis import util, model
 from odemis.gui import BLEND_DEFAULT, BLEND_SCREEN, BufferSizeEvent
 from odemis.gui.comp.overlay.base import WorldOverlay, ViewOverlay
 from odemis.gui.evt import EVT_KNOB_ROTATE, EVT_KNOB_PRESS
 from odemis.gui.util import call_in_wx_main
-from odemis.gui.util.img import add_alpha_byte, apply_rotation, apply_shear, apply_flip, get_sub_img
+from odemis.gui.util.img import add_alpha_byte, apply_rotation, apply_shear, apply_flip, get_sub_img, \
+    calc_bounding_box
 from odemis.util import intersect
 from odemis.util.conversion import wxcol_to_frgb
 import os
 import sys
+import time
 import wx
 
 from odemis.gui import img
@@ -169,6 +189,30 @@ CAN_DRAG = 1    # Content can be dragged
 CAN_FOCUS = 2   # Can adjust focus
 CAN_ZOOM = 4    # Can adjust scale
 
+# Minimum time between two drawings when the canvas is hidden
+HIDDEN_DRAW_PERIOD = 2  # s
+
+
+def _union_rect(ra, rb):
+    """ Computes the smallest rectangle containing two rectangles
+
+    :param ra: (None or 4 numbers) left, top, width, height
+    :param rb: (None or 4 numbers) left, top, width, height
+    :return: (None or 4 numbers) left, top, width, height. None if both are None.
+
+    """
+
+    if ra is None:
+        return rb
+    if rb is None:
+        return ra
+
+    l = min(ra[0], rb[0])
+    t = min(ra[1], rb[1])
+    r = max(ra[0] + ra[2], rb[0] + rb[2])
+    b = max(ra[1] + ra[3], rb[1] + rb[3])
+    return l, t, r - l, b - t
+
 
 @decorator
 def ignore_if_disabled(f, self, *args, **kwargs):
@@ -260,6 +304,14 @@ class BufferedCanvas(wx.Panel):
         # Timer used to set a maximum of frames per second
         self.draw_timer = wx.PyTimer(self.on_draw_timer)
 
+        # If True, the whole buffer must be redrawn at the next drawing update.
+        # Otherwise, only the areas which have changed (cf BitmapCanvas).
+        self._redraw_all = True
+        # True while the drawing is updated due to request_drawing_update()
+        self._drawing_requested = False
+        # True if the buffer is out-of-date, because the canvas was hidden
+        self._draw_skipped = False
+
     @property
     def buffer_size(self):
         return self._bmp_buffer_size
@@ -475,6 +527,10 @@ class BufferedCanvas(wx.Panel):
 
         """
 
+        # The drawing was postponed while the canvas was hidden
+        if self._draw_skipped:
+            self.draw()
+
         dc_view = wx.PaintDC(self)
 
         # Blit the appropriate area from the buffer to the view port
@@ -507,7 +563,11 @@ class BufferedCanvas(wx.Panel):
         """ Update the drawing when the on draw timer fires """
         # thread_name = threading.current_thread().name
         # logging.debug("Drawing timer in thread %s", thread_name)
-        self.update_drawing()
+        self._drawing_requested = True
+        try:
+            self.update_drawing()
+        finally:
+            self._drawing_requested = False
 
     # ########### END Event Handlers ############
 
@@ -536,6 +596,7 @@ class BufferedCanvas(wx.Panel):
         # Make new off-screen bitmap
         self._bmp_buffer = wx.EmptyBitmap(*size)
         self._bmp_buffer_size = size
+        self._redraw_all = True
 
         # Create a new DC, needed on Windows
         if os.name == "nt":
@@ -547,7 +608,7 @@ class BufferedCanvas(wx.Panel):
 
         wx.PostEvent(self, BufferSizeEvent())
 
-    def request_drawing_update(self, delay=0.1):
+    def request_drawing_update(self, delay=0.1, partial=False):
         """ Schedule an update of the buffer if the timer is not already running
 
         .. warning:: always call this method from the main GUI thread! If you're unsure about the
@@ -555,9 +616,15 @@ class BufferedCanvas(wx.Panel):
 
         :param delay: (float) maximum number of seconds to wait before the
             buffer will be updated.
+        :param partial: (bool) If True, only the areas of the buffer known to have changed (eg,
+            the images updated via `set_images`) need to be redrawn. Otherwise, the whole buffer
+            is redrawn.
 
         """
 
+        if not partial:
+            self._redraw_all = True
+
         try:
             if not self.draw_timer.IsRunning():
                 # TODO: can we change this around? So that we immediately draw when no timer is
@@ -804,9 +871,26 @@ class BitmapCanvas(BufferedCanvas):
         self.scale = 1.0  # px/wu
         self.margins = (0, 0)
 
+        # Key of each image in .images, to detect which ones have changed
+        self._images_keys = [None]
+        # Area of the buffer which needs to be redrawn (left, top, width, height), or None
+        self._b_dirty_rect = None
+        # Geometry (see _get_draw_state()) at the time the dirty area was computed
+        self._dirty_geometry = None
+        # State of the canvas at the latest drawing
+        self._drawn_state = None
+        # Time of the latest drawing while the canvas was hidden
+        self._last_hidden_draw = 0
+
+        # Number and duration of the drawings (full or partial), and number of
+        # drawings skipped because the canvas was hidden (as "dropped").
+        self.draw_stats = model.PipelineStatistics()
+
     def clear(self):
         """ Remove the images and clear the canvas """
         self.images = [None]
+        self._images_keys = [None]
+        self._redraw_all = True
         BufferedCanvas.clear(self)
 
     def set_images(self, im_args):
@@ -834,14 +918,18 @@ class BitmapCanvas(BufferedCanvas):
 
         # TODO:
         # * take an image composition tree (operator + images + scale + pos)
-        # * allow to indicate just one image has changed (and so the rest
-        #   doesn't need to be recomputed)
+
+        # Area covered by the current images, before their metadata is updated
+        old_bboxes = [None if im is None else self._calc_img_buffer_bbox(im)
+                      for im in self.images]
 
         images = []
+        keys = []
 
         for args in im_args:
             if args is None:
                 images.append(None)
+                keys.append(None)
             else:
                 im, w_pos, scale, keepalpha, rotation, shear, flip, blend_mode, name = args
 
@@ -865,8 +953,49 @@ class BitmapCanvas(BufferedCanvas):
                 im.metadata['name'] = name
 
                 images.append(im)
+                # The old images are still referenced, so the id cannot be reused
+                keys.append((id(im), w_pos, scale, keepalpha, rotation, shear, flip, blend_mode))
+
+        # Mark as dirty the area of the images which have changed
+        if len(keys) != len(self._images_keys):
+            # The opacity of all the images depends on the number of images
+            self._redraw_all = True
+        else:
+            for im, key, okey, obbox in zip(images, keys, self._images_keys, old_bboxes):
+                if key != okey:
+                    if obbox is not None:
+                        self._mark_dirty(obbox)
+                    if im is not None:
+                        self._mark_dirty(self._calc_img_buffer_bbox(im))
 
         self.images = images
+        self._images_keys = keys
+
+    def _mark_dirty(self, b_rect):
+        """ Indicate an area of the buffer must be redrawn at the next (partial) drawing
+
+        :param b_rect: (4 ints) left, top, width, height in buffer coordinates
+
+        """
+
+        geometry = self._get_draw_state()[:3]
+        if self._b_dirty_rect is not None and geometry != self._dirty_geometry:
+            # The previous area doesn't correspond to the same buffer anymore
+            self._redraw_all = True
+        self._dirty_geometry = geometry
+        self._b_dirty_rect = _union_rect(self._b_dirty_rect, b_rect)
+
+    def _get_draw_state(self, interpolate_data=False):
+        """ Return everything, except the images, which influences the content of the buffer
+
+        If it changes between two drawings, the whole buffer must be redrawn. The first 3 elements
+        are the geometry of the buffer.
+
+        """
+
+        return (self.w_buffer_center, self.scale, self._bmp_buffer_size,
+                self.background_offset, self.background_brush, self.merge_ratio,
+                interpolate_data, tuple(self.world_overlays))
 
     def draw(self, interpolate_data=False):
         """ Draw the images and overlays into the buffer
@@ -880,14 +1009,52 @@ class BitmapCanvas(BufferedCanvas):
 
         # Don't draw anything if the canvas is disabled, leave the current buffer intact.
         if not self.IsEnabled() or 0 in self.GetClientSizeTuple():
+            self._redraw_all = True
             return
 
+        if not self.IsShownOnScreen():
+            # Only draw from time to time (for the thumbnail), and update once shown again
+            left = self._last_hidden_draw + HIDDEN_DRAW_PERIOD - time.time()
+            if left > 0:
+                if not self._drawing_requested:
+                    self._redraw_all = True
+                self._draw_skipped = True
+                self.draw_stats.dropped += 1
+                self.request_drawing_update(left, partial=True)
+                return
+            self._last_hidden_draw = time.time()
+
+        # Find out which area needs to be redrawn
+        state = self._get_draw_state(interpolate_data)
+        buffer_rect = (0, 0) + self._bmp_buffer_size
+        if (self._redraw_all or not self._drawing_requested or state != self._drawn_state or
+                (self._b_dirty_rect is not None and self._dirty_geometry != state[:3])):
+            b_rect = buffer_rect
+        elif self._b_dirty_rect is None:
+            b_rect = None
+        else:
+            b_rect = intersect(self._b_dirty_rect, buffer_rect)
+
+        self._redraw_all = False
+        self._b_dirty_rect = None
+        self._drawn_state = state
+        self._draw_skipped = False
+        if b_rect is None:
+            # logging.debug("Skipping draw: nothing changed")
+            return
+
+        tstart = time.time()
+        partial = (b_rect != buffer_rect)
         ctx = wxcairo.ContextFromDC(self._dc_buffer)
+        if partial:
+            # Everything drawn will only modify the dirty area
+            ctx.rectangle(*b_rect)
+            ctx.clip()
 
         self._draw_background(ctx)
         ctx.identity_matrix()  # Reset the transformation matrix
 
-        self._draw_merged_images(ctx, interpolate_data)
+        self._draw_merged_images(ctx, interpolate_data, b_rect)
         ctx.identity_matrix()  # Reset the transformation matrix
 
         # Remember that the device context being passed belongs to the *buffer* and the view
@@ -898,7 +1065,9 @@ class BitmapCanvas(BufferedCanvas):
             o.draw(ctx, self.w_buffer_center, self.scale)
             ctx.restore()
 
-    def _draw_merged_images(self, ctx, interpolate_data=False):
+        self.draw_stats.record(None, tstart, time.time(), "partial_draw" if partial else "draw")
+
+    def _draw_merged_images(self, ctx, interpolate_data=False, b_rect=None):
         """ Draw the images on the DC buffer, centred around their _dc_center, with their own
         scale and an opacity of "mergeratio" for im1.
 
@@ -908,6 +1077,8 @@ class BitmapCanvas(BufferedCanvas):
         without transparency
 
         :param interpolate_data: (boolean) Apply interpolation if True
+        :param b_rect: (None or 4 ints) area of the buffer being redrawn (left, top, width,
+            height). The images outside of it are not drawn. None for the whole buffer.
 
         :return: (int) Frames per second
 
@@ -959,7 +1130,8 @@ class BitmapCanvas(BufferedCanvas):
                     shear=im.metadata['dc_shear'],
                     flip=im.metadata['dc_flip'],
                     blend_mode=im.metadata['blend_mode'],
-                    interpolate_data=interpolate_data
+                    interpolate_data=interpolate_data,
+                    b_clip_rect=b_rect
                 )
 
             if not images or last_image.metadata['blend_mode'] == BLEND_SCREEN:
@@ -982,12 +1154,13 @@ class BitmapCanvas(BufferedCanvas):
                 shear=last_image.metadata['dc_shear'],
                 flip=last_image.metadata['dc_flip'],
                 blend_mode=last_image.metadata['blend_mode'],
-                interpolate_data=interpolate_data
+                interpolate_data=interpolate_data,
+                b_clip_rect=b_rect
             )
 
     def _draw_image(self, ctx, im_data, w_im_center, opacity=1.0,
                     im_scale=(1.0, 1.0), rotation=None, shear=None, flip=None,
-                    blend_mode=BLEND_DEFAULT, interpolate_data=False):
+                    blend_mode=BLEND_DEFAULT, interpolate_data=False, b_clip_rect=None):
         """ Draw the given image to the Cairo context
 
         The buffer is considered to have it's 0,0 origin at the top left
@@ -1002,6 +1175,8 @@ class BitmapCanvas(BufferedCanvas):
         :param flip: (wx.HORIZONTAL | wx.VERTICAL) If and how to flip the image
         :param blend_mode: (int) Graphical blending type used for transparency
         :param interpolate_data: (boolean) Apply interpolation if True
+        :param b_clip_rect: (None or 4 ints) area of the buffer being redrawn. If the image is
+            outside of it, it's not drawn.
 
         """
 
@@ -1030,6 +1205,11 @@ class BitmapCanvas(BufferedCanvas):
             logging.debug("Skipping draw: no intersection with buffer")
             return
 
+        # Outside of the area being redrawn (typically, the image hasn't changed)
+        if (b_clip_rect is not None and
+                not intersect(b_clip_rect, calc_bounding_box(b_im_rect, rotation, shear))):
+            return
+
         # logging.debug("Intersection (%s, %s, %s, %s)", *intersection)
         # Cache the current transformation matrix
         ctx.save()
@@ -1145,6 +1325,19 @@ class BitmapCanvas(BufferedCanvas):
 
         return b_topleft + final_size
 
+    def _calc_img_buffer_bbox(self, im):
+        """ Compute the area of the buffer covered by an image, once rotated and sheared
+
+        :param im: (DataArray) image, as stored by set_images()
+
+        :return: (int, int, int, int) left, top, width, height
+
+        """
+
+        b_im_rect = self._calc_img_buffer_rect(im, im.metadata['dc_scale'],
+                                               im.metadata['dc_center'])
+        return calc_bounding_box(b_im_rect, im.metadata['dc_rotation'], im.metadata['dc_shear'])
+
     # Position conversion
 
     def world_to_buffer(self, pos, offset=(0, 0)):
@@ -1485,6 +1678,10 @@ class DraggableCanvas(BitmapCanvas):
         out of scope at the end of this method.
         """
 
+        # The drawing was postponed while the canvas was hidden
+        if self._draw_skipped:
+            self.draw()
+
         # Fix to prevent flicker from the Cairo view overlay rendering under Windows
         if os.name == 'nt':
             dc_view = wx.BufferedPaintDC(self)
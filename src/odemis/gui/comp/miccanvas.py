@@ -38,6 +38,7 @@ from odemis.gui.util.img import format_rgba_darray
 from odemis.model import VigilantAttributeBase
 from odemis.util import units
 import time
+import weakref
 import wx
 from wx.lib.imageutils import stepColour
 
@@ -123,6 +124,10 @@ class DblMicroscopeCanvas(canvas.DraggableCanvas):
         # Simple image caching dictionary {obj_id: rgb image}
         self.images_cache = {}
 
+        # Streams which have received a display request from this canvas
+        self._display_req_streams = weakref.WeakSet()
+        self.Bind(wx.EVT_WINDOW_DESTROY, self._on_destroy, source=self)
+
     # Ability manipulation
 
     def disable_zoom(self):
@@ -242,6 +247,8 @@ class DblMicroscopeCanvas(canvas.DraggableCanvas):
             self.add_view_overlay(self._fps_ol)
         elif self._fps_ol:
             self.remove_view_overlay(self._fps_ol)
+            logging.info("Drawing statistics of %s: %s", self.microscope_view.name.value
+                         if self.microscope_view else self, self.draw_stats.to_dict())
 
         self.Refresh(eraseBackground=False)
 
@@ -436,6 +443,9 @@ class DblMicroscopeCanvas(canvas.DraggableCanvas):
         # Replace the old cache, so the obsolete RGBA images can be garbage collected
         self.images_cache = im_cache
 
+        # There might be new streams
+        self._update_display_requests()
+
         # TODO: Canvas needs to accept the NDArray (+ specific attributes recorded separately).
         self.set_images(ims)
 
@@ -465,12 +475,17 @@ class DblMicroscopeCanvas(canvas.DraggableCanvas):
             self.fit_view_to_content()
             self.fit_view_to_next_image = False
         # logging.debug("Will update drawing for new image")
-        wx.CallAfter(self.request_drawing_update)
+        # Only the area of the images which changed needs to be redrawn (if
+        # the view was fit, everything will be redrawn anyway)
+        wx.CallAfter(self.request_drawing_update, partial=True)
 
     def update_drawing(self):
-        """ Update the drawing and thumbnail """
-        # TODO: detect that the canvas is not visible, and so should no/less frequently be updated?
-        # The difficulty is that it must be redrawn as soon as it's shown again.
+        """ Update the drawing and thumbnail
+
+        Note: when the canvas is hidden, draw() only actually updates the buffer every
+        HIDDEN_DRAW_PERIOD, which is enough for the thumbnail.
+
+        """
 
         super(DblMicroscopeCanvas, self).update_drawing()
 
@@ -492,6 +507,42 @@ class DblMicroscopeCanvas(canvas.DraggableCanvas):
         pos = self.physical_to_world_pos(phy_pos)
         # skip ourselves, to avoid asking the stage to move to (almost) the same position
         super(DblMicroscopeCanvas, self).recenter_buffer(pos)
+        self._update_display_requests()
+
+    def _update_display_requests(self):
+        """
+        Indicates to the streams which area is displayed by the canvas, so that
+        the live streams only project the data needed.
+        """
+        if not self.microscope_view:
+            return
+
+        mpp = self.microscope_view.mpp.value
+        c = self.microscope_view.view_pos.value
+        # The buffer is bigger than the view, so it's fine while dragging
+        hw, hh = (b * mpp / 2 for b in self.buffer_size)
+        rect = (c[0] - hw, c[1] - hh, c[0] + hw, c[1] + hh)
+        streams = [s for s in self.microscope_view.getStreams()
+                   if hasattr(s, "setDisplayRequest")]
+
+        # Streams not in the view anymore are not displayed by this canvas
+        for s in set(self._display_req_streams) - set(streams):
+            s.removeDisplayRequest(id(self))
+
+        for s in streams:
+            s.setDisplayRequest(id(self), rect, mpp)
+        self._display_req_streams = weakref.WeakSet(streams)
+
+    def _remove_display_requests(self):
+        """
+        Removes the display requests of this canvas from all the streams
+        """
+        for s in list(self._display_req_streams):
+            s.removeDisplayRequest(id(self))
+        self._display_req_streams = weakref.WeakSet()
+
+    def _on_destroy(self, evt):
+        self._remove_display_requests()
 
     def recenter_buffer(self, world_pos):
         """
@@ -544,6 +595,7 @@ class DblMicroscopeCanvas(canvas.DraggableCanvas):
     def _on_view_mpp(self, mpp):
         """ Called when the view.mpp is updated """
         self.scale = 1 / mpp
+        self._update_display_requests()
         wx.CallAfter(self.request_drawing_update)
 
     def on_size(self, event):
@@ -569,6 +621,7 @@ class DblMicroscopeCanvas(canvas.DraggableCanvas):
                 self.microscope_view.mpp.value = self.microscope_view.mpp.clip(new_mpp)
         super(DblMicroscopeCanvas, self).on_size(event)
         self._previous_size = new_size
+        self._update_display_requests()
 
     @microscope_view_check
     def Zoom(self, inc, block_on_zero=False):
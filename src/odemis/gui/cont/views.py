@@ -333,11 +333,13 @@ class OverviewController(object):
         # Calculate the stream size if the the ebeam is active
         for strm in self._data_model.streams.value:
             if strm.is_active and isinstance(strm, EMStream):
-                image = strm.image.value
-                if image is not None:
-                    pixel_size = image.metadata.get(MD_PIXEL_SIZE, None)
+                # Use the raw data, as the image might only contain the part
+                # displayed (cf Stream.setDisplayRequest())
+                if strm.raw:
+                    raw = strm.raw[0]
+                    pixel_size = raw.metadata.get(MD_PIXEL_SIZE, None)
                     if pixel_size is not None:
-                        x, y, _ = image.shape
+                        y, x = raw.shape[-2:]
                         p_size = (x * pixel_size[0], y * pixel_size[1])
 
                         # TODO: tracking doesn't work, since the  pixel size
@@ -462,7 +464,7 @@ class ViewButtonController(object):
         # Create an image from the 4 thumbnails in a 2x2 layout with small
         # border. The button without a viewport attached is assumed to be the
         # one assigned to the 2x2 view
-        btn_all = [b for b, (vp, _) in self.buttons.items() if vp is None][0]
+        btn_all = [b for b, (vp, l) in self.buttons.items() if vp is None][0]
         border_width = 2  # px
         size = max(1, btn_all.thumbnail_size.x), max(1, btn_all.thumbnail_size.y)
         size_sub = (max(1, (size[0] - border_width) // 2),
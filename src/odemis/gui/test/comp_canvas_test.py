@@ -218,6 +218,88 @@ class TestDblMicroscopeCanvas(test.GuiTestCase):
                       result_im.Height / 2 - 200 + shift[1])
         self.assertEqual(px2, (0, 0, 255))
 
+    # @unittest.skip("simple")
+    def test_partial_redraw(self):
+        """
+        Check that when only one image changes, only its area is redrawn, with
+        the same result as a full redraw
+        """
+        mpp = 0.00001
+        self.view.mpp.value = mpp
+        self.view.show_crosshair.value = False
+        test.gui_loop(500)
+
+        # A big green image, and a small red one on top
+        im_big = model.DataArray(numpy.zeros((301, 301, 4), dtype="uint8"))
+        im_big[:, :, 1] = 255
+        im_big[:, :, 3] = 255
+        im_small = model.DataArray(numpy.zeros((21, 21, 4), dtype="uint8"))
+        im_small[:, :, 2] = 255
+        im_small[:, :, 3] = 255
+
+        def get_args(im, pos):
+            return im, pos, (mpp, mpp), True, 0, 0, 0, None, "test"
+
+        self.canvas.set_images([get_args(im_big, (0, 0)),
+                                get_args(im_small, (50 * mpp, 50 * mpp))])
+        self.canvas.request_drawing_update()
+        test.gui_loop(500)
+        self.assertNotIn("partial_draw", self.canvas.draw_stats.latencies)
+
+        # Only the small image changes (new data, and moved)
+        im_small2 = model.DataArray(numpy.zeros((21, 21, 4), dtype="uint8"))
+        im_small2[:, :, 0] = 255
+        im_small2[:, :, 3] = 255
+        self.canvas.set_images([get_args(im_big, (0, 0)),
+                                get_args(im_small2, (60 * mpp, 40 * mpp))])
+        self.canvas.request_drawing_update(partial=True)
+        test.gui_loop(500)
+        self.assertEqual(self.canvas.draw_stats.latencies["partial_draw"].count, 1)
+        partial_im = get_image_from_buffer(self.canvas)
+
+        # Force a full redraw, which should give exactly the same image
+        self.canvas.update_drawing()
+        test.gui_loop(100)
+        full_im = get_image_from_buffer(self.canvas)
+        self.assertEqual(partial_im.GetData(), full_im.GetData())
+
+        # Nothing changed => no need to draw anything
+        ndraws = self.canvas.draw_stats.received
+        self.canvas.set_images([get_args(im_big, (0, 0)),
+                                get_args(im_small2, (60 * mpp, 40 * mpp))])
+        self.canvas.request_drawing_update(partial=True)
+        test.gui_loop(500)
+        self.assertEqual(self.canvas.draw_stats.received, ndraws)
+
+    def test_display_requests(self):
+        """
+        Check the display requests of the canvas are removed from the streams
+        when they leave the view, and when the canvas is destroyed
+        """
+        mpp = 0.00001
+        im1 = model.DataArray(numpy.zeros((11, 11, 3), dtype="uint8"))
+        im1.metadata[model.MD_PIXEL_SIZE] = (mpp * 10, mpp * 10)
+        im1.metadata[model.MD_POS] = (0, 0)
+        im1.metadata[model.MD_DIMS] = "YXC"
+        stream1 = RGBStream("s1", im1)
+
+        self.view.addStream(stream1)
+        test.gui_loop(500)
+        self.assertIn(id(self.canvas), stream1._display_reqs)
+
+        self.view.removeStream(stream1)
+        test.gui_loop(500)
+        self.assertNotIn(id(self.canvas), stream1._display_reqs)
+
+        self.view.addStream(stream1)
+        test.gui_loop(500)
+        self.assertIn(id(self.canvas), stream1._display_reqs)
+
+        canvas_id = id(self.canvas)
+        self.canvas.Destroy()
+        test.gui_loop(100)
+        self.assertNotIn(canvas_id, stream1._display_reqs)
+
     # @unittest.skip("simple")
     def test_zoom_move(self):
         mpp = 0.00001
@@ -25,6 +25,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import cairo
+from concurrent.futures.thread import ThreadPoolExecutor
 import logging
 import math
 import numpy
@@ -34,6 +35,7 @@ from odemis.gui.comp.overlay.base import Label
 from odemis.util import intersect, fluo, conversion
 from odemis.util import polar, img
 from odemis.util import units
+from scipy import ndimage
 import time
 import wx
 
@@ -44,6 +46,10 @@ import odemis.gui.img as guiimg
 BAR_PLOT_COLOUR = (0.5, 0.5, 0.5)
 CROP_RES_LIMIT = 1024
 MAX_RES_FACTOR = 5  # upper limit resolution factor to exported image
+EXPORT_BAND_HEIGHT = 256  # px, number of lines of the exported image drawn at once
+# Max number of bands drawn simultaneously. Threads are fine, as Cairo
+# releases the GIL while drawing.
+EXPORT_THREADS = 4
 SPEC_PLOT_SIZE = 1024
 SPEC_SCALE_WIDTH = 150  # ticks + text vertically
 SPEC_SCALE_HEIGHT = 100  # ticks + text horizontally
@@ -177,6 +183,34 @@ def apply_shear(ctx, shear, b_im_rect):
         ctx.translate(-shear_x, -shear_y)
 
 
+def calc_bounding_box(b_rect, rotation=None, shear=None):
+    """ Computes the area covered by a rectangle after rotation and shear
+
+    The transformations are applied around the center of the rectangle, as in
+    apply_rotation() and apply_shear(). The result is slightly bigger than needed,
+    to take into account rounding and interpolation.
+
+    b_rect (4 floats): left, top, width, height
+    rotation (None or float): rotation in radians
+    shear (None or float): shear
+    returns (4 ints): left, top, width, height
+    """
+    x, y, w, h = b_rect
+    cx, cy = x + w / 2, y + h / 2
+    if shear:
+        # Whatever the direction of the shear, it's within this box
+        w, h = w + abs(shear) * h, h + abs(shear) * w
+    if rotation:
+        cosr, sinr = abs(math.cos(rotation)), abs(math.sin(rotation))
+        w, h = w * cosr + h * sinr, w * sinr + h * cosr
+
+    l = int(math.floor(cx - w / 2)) - 1
+    t = int(math.floor(cy - h / 2)) - 1
+    r = int(math.ceil(cx + w / 2)) + 1
+    b = int(math.ceil(cy + h / 2)) + 1
+    return l, t, r - l, b - t
+
+
 def apply_flip(ctx, flip, b_im_rect):
     """
     Applies flip to the given cairo context
@@ -574,7 +608,8 @@ def calc_img_buffer_rect(im_data, im_scale, w_im_center, buffer_center, buffer_s
 
 def draw_image(ctx, im_data, w_im_center, buffer_center, buffer_scale,
                buffer_size, opacity=1.0, im_scale=(1.0, 1.0), rotation=None,
-               shear=None, flip=None, blend_mode=BLEND_DEFAULT, interpolate_data=False):
+               shear=None, flip=None, blend_mode=BLEND_DEFAULT, interpolate_data=False,
+               b_clip_rect=None):
     """ Draw the given image to the Cairo context
 
     The buffer is considered to have it's 0,0 origin at the top left
@@ -592,6 +627,8 @@ def draw_image(ctx, im_data, w_im_center, buffer_center, buffer_scale,
     flip (wx.HORIZONTAL | wx.VERTICAL): If and how to flip the image
     blend_mode (int): Graphical blending type used for transparency
     interpolate_data (boolean): apply interpolation if True
+    b_clip_rect (None or 4 ints): left, top, width, height of the only part of
+      the buffer which is drawn (eg, when drawing by bands). None for the whole buffer.
 
     """
 
@@ -611,9 +648,13 @@ def draw_image(ctx, im_data, w_im_center, buffer_center, buffer_scale,
         return
 
     # Get the intersection with the actual buffer
-    buffer_rect = (0, 0) + buffer_size
-
-    intersection = intersect(buffer_rect, b_im_rect)
+    if b_clip_rect is None:
+        buffer_rect = (0, 0) + buffer_size
+        intersection = intersect(buffer_rect, b_im_rect)
+    else:
+        # As the clip area can be much smaller than the image, it's important
+        # to take into account the transformations
+        intersection = intersect(b_clip_rect, calc_bounding_box(b_im_rect, rotation, shear))
 
     # No intersection means nothing to draw
     if not intersection:
@@ -634,7 +675,11 @@ def draw_image(ctx, im_data, w_im_center, buffer_center, buffer_scale,
     height_ratio = float(im_scale[1]) / float(buffer_scale[1])
     total_scale = total_scale_x, total_scale_y = (width_ratio, height_ratio)
 
-    if total_scale_x > 1.0 or total_scale_y > 1.0:
+    # Only drawing part of the buffer, with transformations: the part of the image
+    # needed is not just the rectangle corresponding to the intersection.
+    can_crop = b_clip_rect is None or not (rotation or shear or flip)
+
+    if (total_scale_x > 1.0 or total_scale_y > 1.0) and can_crop:
         logging.debug("Up scaling required")
 
         # If very little data is trimmed, it's better to scale the entire image than to create
@@ -1611,7 +1656,8 @@ def get_ordered_images(streams, raw=False):
         # FluoStreams are merged using the "Screen" method that handles colour
         # merging without decreasing the intensity.
         if not raw:
-            data = s.image.value
+            # The whole image, even if only part of it is displayed
+            data = s.getFullImage()
         else:
             data_raw = s.raw[0]
 
@@ -1755,9 +1801,13 @@ def get_sub_img(b_intersect, b_im_rect, im_data, total_scale):
     b_new = ((l * total_scale[0]) + b_im_rect[0],
              (t * total_scale[1]) + b_im_rect[1])
 
-    # We need to copy the data, since cairo.ImageSurface.create_for_data expects a single
-    # segment buffer object (i.e. the data must be contiguous)
-    im_data = im_data[t:b, l:r].copy()
+    # cairo.ImageSurface.create_for_data expects a single segment buffer object
+    # (i.e. the data must be contiguous). If all the width is needed, the rows
+    # of the original data are already contiguous, otherwise we need to copy.
+    if l == 0 and r >= im_w - 1 and im_data.flags.c_contiguous:
+        im_data = im_data[t:b]
+    else:
+        im_data = im_data[t:b, l:r].copy()
 
     return im_data, b_new
 
@@ -1778,13 +1828,6 @@ def images_to_export_data(streams, view_hfw, view_pos,
     if not images:
         raise LookupError("There is no stream data to be exported")
 
-    if interpolate_data and im_min_type != numpy.uint8:
-        # TODO: make interpolation work also with 16 bits and higher data type
-        # For now, as Cairo is convinced it's RGB, it computes wrong data.
-        # cf util.img.rescale_hq() before casting to RGB?
-        logging.debug("Disabling interpolation as data is not 8 bits")
-        interpolate_data = False
-
     # Find min pixel size
     min_pxs = min(im.metadata['dc_scale'] for im in images)
 
@@ -1842,103 +1885,173 @@ def images_to_export_data(streams, view_hfw, view_pos,
 
     # TODO: make sure that Y dim of the buffer_size is not crazy high
 
-    # Make surface based on the maximum resolution
-    data_to_draw = numpy.zeros((buffer_size[1], buffer_size[0], 4), dtype=numpy.uint8)
-    surface = cairo.ImageSurface.create_for_data(
-        data_to_draw, cairo.FORMAT_ARGB32, buffer_size[0], buffer_size[1])
-    ctx = cairo.Context(surface)
-
-    # The list of images to export
-    data_to_export = []
-
+    # Opacity of each image
     n = len(images)
-    last_image = images.pop()
-    # For every image, except the last
-    i = 0
+    ratios = []
     for i, im in enumerate(images):
-        if im.metadata['blend_mode'] == BLEND_SCREEN or raw:
+        if im.metadata['blend_mode'] == BLEND_SCREEN or raw or n == 1:
             # No transparency in case of "raw" export
-            merge_ratio = 1.0
+            ratios.append(1.0)
+        elif i < n - 1:
+            ratios.append(1 - i / n)
         else:
-            merge_ratio = 1 - i / n
+            ratios.append(draw_merge_ratio)
 
-        draw_image(
-            ctx,
-            im,
-            im.metadata['dc_center'],
-            buffer_center,
-            buffer_scale,
-            buffer_size,
-            merge_ratio,
-            im_scale=im.metadata['dc_scale'],
-            rotation=im.metadata['dc_rotation'],
-            shear=im.metadata['dc_shear'],
-            flip=im.metadata['dc_flip'],
-            blend_mode=im.metadata['blend_mode'],
-            interpolate_data=interpolate_data
-        )
+    # Each output is (images, opacities, stream for the legend, date)
+    if raw:
+        # One output per image
+        last_date = images[-1].metadata['date']
+        outputs = [([im], [1.0], im.metadata['stream'], last_date) for im in images]
+    else:
+        # Take the newest date (as in the GUI)
+        date = max(im.metadata['date'] for im in images)
+        outputs = [(images, ratios, None, date)]
+
+    # The legend doesn't depend on the drawing, so it's created first, and the
+    # images are directly drawn into the final array, band by band. So, on top
+    # of the output, there is only need for memory for a few bands.
+    data_to_export = []
+    for ims, opacities, stream, date in outputs:
+        legend_rgb = draw_export_legend(images, buffer_size, buffer_scale,
+                                        view_hfw[0], date, stream, logo=logo)
         if raw:
-            # Create legend
-            legend_rgb = draw_export_legend(images + [last_image], buffer_size, buffer_scale,
-                                                view_hfw[0], last_image.metadata['date'],
-                                                im.metadata['stream'], logo=logo)
+            legend = _adapt_rgb_to_raw(legend_rgb, stream, im_min_type)
+            data = numpy.zeros((buffer_size[1] + legend.shape[0], buffer_size[0]),
+                               dtype=im_min_type)
+            md = {model.MD_DESCRIPTION: ims[0].metadata['name']}
+        else:
+            legend = legend_rgb
+            legend[:, :, [2, 0]] = legend[:, :, [0, 2]]
+            data = numpy.zeros((buffer_size[1] + legend.shape[0], buffer_size[0], 4),
+                               dtype=numpy.uint8)
+            md = {model.MD_DIMS: 'YXC'}
+
+        data[buffer_size[1]:] = legend
+        _draw_export_bands(data[:buffer_size[1]], ims, opacities, buffer_center,
+                           buffer_scale, buffer_size, raw, im_min_type,
+                           interpolate_data)
+        data_to_export.append(model.DataArray(data, md))
 
-            legend_as_raw = _adapt_rgb_to_raw(legend_rgb, im.metadata['stream'], im_min_type)
-            new_data_to_draw = _unpack_raw_data(data_to_draw, im_min_type)
-            data_with_legend = numpy.append(new_data_to_draw, legend_as_raw, axis=0)
+    return data_to_export
 
-            md = {model.MD_DESCRIPTION: im.metadata['name']}
-            data_to_export.append(model.DataArray(data_with_legend, md))
 
-            data_to_draw = numpy.zeros((buffer_size[1], buffer_size[0], 4), dtype=numpy.uint8)
-            surface = cairo.ImageSurface.create_for_data(
-                data_to_draw, cairo.FORMAT_ARGB32, buffer_size[0], buffer_size[1])
-            ctx = cairo.Context(surface)
+def _draw_export_bands(data, images, opacities, buffer_center, buffer_scale,
+                       buffer_size, raw, dtype, interpolate_data):
+    """
+    Draws images into the exported data, by horizontal bands (in parallel)
+    data (ndarray Y,X,4 or Y,X): the exported image, of the size of the buffer.
+      It's RGB (ready to be saved), or raw data if raw is True. Updated in place.
+    images (list of DataArray): the images (as returned by convert_streams_to_images())
+    opacities (list of float): opacity of each image
+    raw (bool): if True, the images contain raw data packed into RGBA
+    dtype (numpy.dtype): type of the raw data
+    interpolate_data (bool): apply interpolation if True
+    """
+    # Cairo would interpolate each byte of the packed raw data separately, so
+    # in such case the raw data is directly resampled.
+    if raw and interpolate_data:
+        raw_images = [_unpack_raw_data(im, dtype) for im in images]
+
+    def draw_band(top):
+        bottom = min(top + EXPORT_BAND_HEIGHT, buffer_size[1])
+        b_band_rect = (0, top, buffer_size[0], bottom - top)
+        band = data[top:bottom]
+
+        if raw and interpolate_data:
+            for im, im_raw in zip(images, raw_images):
+                _resample_raw_image(band, top, im, im_raw, buffer_center,
+                                    buffer_scale, buffer_size)
+            return
 
-    if not images or last_image.metadata['blend_mode'] == BLEND_SCREEN or raw:
-        merge_ratio = 1.0
-    else:
-        merge_ratio = draw_merge_ratio
-
-    draw_image(
-        ctx,
-        last_image,
-        last_image.metadata['dc_center'],
-        buffer_center,
-        buffer_scale,
-        buffer_size,
-        merge_ratio,
-        im_scale=last_image.metadata['dc_scale'],
-        rotation=last_image.metadata['dc_rotation'],
-        shear=last_image.metadata['dc_shear'],
-        flip=last_image.metadata['dc_flip'],
-        blend_mode=last_image.metadata['blend_mode'],
-        interpolate_data=interpolate_data
-    )
-    # Create legend
-    if raw:
-        date = last_image.metadata['date']
-    else:
-        # Take the newest date (as in the GUI)
-        date = max(im.metadata['date'] for im in images + [last_image])
+        if raw:
+            rgba = numpy.zeros((bottom - top, buffer_size[0], 4), dtype=numpy.uint8)
+        else:
+            # Rows of the data are contiguous, so cairo can directly draw on them
+            rgba = band
+        surface = cairo.ImageSurface.create_for_data(
+            rgba, cairo.FORMAT_ARGB32, buffer_size[0], bottom - top)
+        ctx = cairo.Context(surface)
+        ctx.translate(0, -top)
+
+        for im, opacity in zip(images, opacities):
+            draw_image(
+                ctx,
+                im,
+                im.metadata['dc_center'],
+                buffer_center,
+                buffer_scale,
+                buffer_size,
+                opacity,
+                im_scale=im.metadata['dc_scale'],
+                rotation=im.metadata['dc_rotation'],
+                shear=im.metadata['dc_shear'],
+                flip=im.metadata['dc_flip'],
+                blend_mode=im.metadata['blend_mode'],
+                interpolate_data=interpolate_data,
+                b_clip_rect=b_band_rect
+            )
 
-    legend_rgb = draw_export_legend(images + [last_image], buffer_size, buffer_scale,
-                                        view_hfw[0], date,
-                                        last_image.metadata['stream'] if raw else None,
-                                        logo=logo)
-    if raw:
-        new_data_to_draw = _unpack_raw_data(data_to_draw, im_min_type)
-        # Turn legend to grayscale
-        legend_as_raw = _adapt_rgb_to_raw(legend_rgb, last_image.metadata['stream'], im_min_type)
-        data_with_legend = numpy.append(new_data_to_draw, legend_as_raw, axis=0)
-        md = {model.MD_DESCRIPTION: last_image.metadata['name']}
-    else:
-        data_with_legend = numpy.append(data_to_draw, legend_rgb, axis=0)
-        data_with_legend[:, :, [2, 0]] = data_with_legend[:, :, [0, 2]]
-        md = {model.MD_DIMS: 'YXC'}
-    data_to_export.append(model.DataArray(data_with_legend, md))
+        if raw:
+            band[...] = _unpack_raw_data(rgba, dtype)
+        else:
+            band[:, :, [2, 0]] = band[:, :, [0, 2]]
 
-    return data_to_export
+    executor = ThreadPoolExecutor(max_workers=EXPORT_THREADS)
+    try:
+        # Wait for all the bands, and pass on any exception
+        list(executor.map(draw_band, range(0, buffer_size[1], EXPORT_BAND_HEIGHT)))
+    finally:
+        executor.shutdown()
+
+
+def _resample_raw_image(data, b_top, im, im_raw, buffer_center, buffer_scale, buffer_size):
+    """
+    Draws raw data into a band of the buffer, with bilinear interpolation.
+    The same position and transformations as draw_image() are used.
+    data (ndarray Y,X): the band of the buffer. It is completely overwritten.
+    b_top (int): position of the top of the band in the buffer
+    im (DataArray): the image (as returned by convert_streams_to_images())
+    im_raw (ndarray Y,X): the raw data of the image
+    """
+    b_im_rect = calc_img_buffer_rect(im, im.metadata['dc_scale'], im.metadata['dc_center'],
+                                     buffer_center, buffer_scale, buffer_size)
+    if b_im_rect[2] < 1 or b_im_rect[3] < 1:
+        logging.debug("Skipping draw: too small")
+        return
+
+    # Let Cairo compute the transformation from the image to the band
+    ctx = cairo.Context(cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1))
+    ctx.translate(0, -b_top)
+    apply_rotation(ctx, im.metadata['dc_rotation'], b_im_rect)
+    apply_shear(ctx, im.metadata['dc_shear'], b_im_rect)
+    apply_flip(ctx, im.metadata['dc_flip'], b_im_rect)
+    ctx.translate(b_im_rect[0], b_im_rect[1])
+    ctx.scale(im.metadata['dc_scale'][0] / buffer_scale[0],
+              im.metadata['dc_scale'][1] / buffer_scale[1])
+
+    # Inverse transformation: band -> image
+    mat = ctx.get_matrix()
+    mat.invert()
+    x0, y0 = mat.transform_point(0, 0)
+    xx, yx = (v - o for v, o in zip(mat.transform_point(1, 0), (x0, y0)))
+    xy, yy = (v - o for v, o in zip(mat.transform_point(0, 1), (x0, y0)))
+
+    # The centre of the pixel (r, c) of the band is at (c + 0.5, r + 0.5), and
+    # the centre of the pixel (r, c) of the image too.
+    matrix = [[yy, yx], [xy, xx]]
+    offset = [y0 + (yx + yy) / 2 - 0.5, x0 + (xx + xy) / 2 - 0.5]
+    resampled = ndimage.affine_transform(im_raw, matrix, offset, output_shape=data.shape,
+                                         output=numpy.float64, order=1, mode="nearest")
+    # Only keep the pixels which are within the image (up to the border of the
+    # last pixels), the rest is black, as with Cairo.
+    rows = numpy.arange(data.shape[0])[:, numpy.newaxis]
+    cols = numpy.arange(data.shape[1])[numpy.newaxis, :]
+    im_rows = matrix[0][0] * rows + matrix[0][1] * cols + offset[0]
+    im_cols = matrix[1][0] * rows + matrix[1][1] * cols + offset[1]
+    outside = ((im_rows < -0.5) | (im_rows >= im_raw.shape[0] - 0.5) |
+               (im_cols < -0.5) | (im_cols >= im_raw.shape[1] - 0.5))
+    resampled[outside] = 0
+    data[...] = numpy.round(resampled)
 
 
 def _adapt_rgb_to_raw(imrgb, stream, dtype):
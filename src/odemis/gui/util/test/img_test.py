@@ -107,6 +107,25 @@ class TestRGBA(unittest.TestCase):
         self.assertTrue((bgraim[2, 2] == [200, 100, 1, 0]).all())
 
 
+class TestGetSubImg(unittest.TestCase):
+
+    def test_whole_rows(self):
+        im = model.DataArray(numpy.zeros((100, 50, 4), dtype=numpy.uint8))
+
+        # Only the middle rows are needed => no copy
+        sub, tl = img.get_sub_img((0, 50, 100, 40), (0, 0, 100, 200), im, (2, 2))
+        self.assertEqual(sub.shape[1:], (50, 4))
+        self.assertEqual(tl, (0, 50))
+        self.assertTrue(numpy.may_share_memory(sub, im))
+        self.assertTrue(sub.flags.c_contiguous)
+
+        # Only part of the width => copy, to be contiguous
+        sub, tl = img.get_sub_img((20, 50, 40, 40), (0, 0, 100, 200), im, (2, 2))
+        self.assertLess(sub.shape[1], 50)
+        self.assertFalse(numpy.may_share_memory(sub, im))
+        self.assertTrue(sub.flags.c_contiguous)
+
+
 class TestARExport(unittest.TestCase):
 
     def test_ar_frame(self):
@@ -507,6 +526,35 @@ class TestSpatialExport(unittest.TestCase):
         self.assertEqual(len(exp_data[1].shape), 2)  # grayscale
         self.assertEqual(exp_data[0].shape, exp_data[1].shape)  # all exported images must have the same shape
 
+    def test_raw_interpolation(self):
+        """
+        Raw data with more than 8 bits can be exported with interpolation
+        """
+        data = numpy.zeros((100, 200), dtype=numpy.uint16)
+        data[:] = numpy.linspace(0, 60000, data.shape[1])
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6), model.MD_POS: (1e-3, 2e-3),
+              model.MD_DESCRIPTION: "Gradient", model.MD_ACQ_DATE: time.time()}
+        grad_stream = stream.StaticSEMStream(md[model.MD_DESCRIPTION], model.DataArray(data, md))
+        time.sleep(0.5)
+
+        view_hfw = (200e-6, 100e-6)
+        view_pos = (1e-3, 2e-3)
+        draw_merge_ratio = 0.3
+        exp_data = img.images_to_export_data([grad_stream], view_hfw, view_pos,
+                                             draw_merge_ratio, True, interpolate_data=True)
+        self.assertEqual(len(exp_data), 1)
+        self.assertEqual(exp_data[0].dtype, numpy.uint16)
+        # Up-scaled, to fit the minimum resolution
+        self.assertGreaterEqual(exp_data[0].shape[1], img.CROP_RES_LIMIT)
+
+        # The gradient is still smooth (ie, not interpolated byte per byte)
+        row = exp_data[0][10, 5:-5].astype(numpy.int32)
+        self.assertTrue((numpy.diff(row) >= 0).all())
+        self.assertGreater(row.max(), 50000)
+        # More values than the original data => interpolated
+        self.assertGreater(len(numpy.unique(row)), data.shape[1])
+
+
     def test_no_intersection(self):
         """
         Data has no intersection with the window view
@@ -30,6 +30,7 @@ import multiprocessing
 import os
 import threading
 import urllib
+import zmq
 
 
 # Pyro4.config.COMMTIMEOUT = 30.0 # a bit of timeout
@@ -348,6 +349,109 @@ class Container(Pyro4.core.Daemon):
         self.rootId = component._pyroId
 
 
+# Publication of the updates of the VAs and DataFlows
+# All the VAs and DataFlows of a container share the same 0MQ PUB sockets (one
+# per high water mark), instead of each having its own socket and 0MQ context
+# (with its own I/O thread and file descriptors). Each message starts with a
+# topic specific to the object, and the subscribers only subscribe to the
+# topic of the object they are interested in.
+
+# The high water marks (ie, maximum number of messages queued per subscriber
+# before dropping the new ones) of the publishers.
+VA_HWM = 1000  # 0MQ default
+DATAFLOW_HWM = 4  # allow a bit of delay, but nothing more
+DATAFLOW_NODISCARD_HWM = 10000  # for the DataFlows with max_discard = 0
+
+# A 0MQ context (and its sockets) cannot be used after a fork, so everything is
+# per process (the entries of the parent are kept, but never used by the child).
+_publishers = {}  # (int, str, int) -> Publisher: pid, sockname, hwm -> publisher
+_publishers_lock = threading.Lock()
+_publishers_ctx = {}  # int -> 0MQ context: pid -> context shared by all the publishers of the process
+
+
+def getPublisherEndpoint(sockname, hwm):
+    """
+    sockname (str): the name of the socket of the container (Pyro daemon)
+    hwm (int): high water mark of the publisher
+    return (str): the 0MQ endpoint of the publisher
+    """
+    return "ipc://%s@pub%d" % (sockname, hwm)
+
+
+def getPublisherTopic(uri):
+    """
+    uri (Pyro4.URI): uri of a VA or DataFlow
+    return (str): the topic of the messages of the object. It is never the
+      prefix of the topic of another object.
+    """
+    return str(uri.object) + "\0"
+
+
+def getPublisher(sockname, hwm):
+    """
+    Returns the publisher for a given container and high water mark. It is
+    created if needed. Each call must be paired with a call to release().
+    sockname (str): the name of the socket of the container (Pyro daemon)
+    hwm (int): one of the *_HWM values
+    return (Publisher)
+    """
+    pid = os.getpid()
+    with _publishers_lock:
+        try:
+            pub = _publishers[(pid, sockname, hwm)]
+        except KeyError:
+            try:
+                ctx = _publishers_ctx[pid]
+            except KeyError:
+                ctx = zmq.Context(1)
+                _publishers_ctx[pid] = ctx
+            pub = Publisher(ctx, sockname, hwm)
+            _publishers[(pid, sockname, hwm)] = pub
+        pub._users += 1
+        return pub
+
+
+class Publisher(object):
+    """
+    0MQ PUB socket shared by all the VAs and DataFlows of a container.
+    Use getPublisher() to get it.
+    """
+    def __init__(self, ctx, sockname, hwm):
+        self._key = (os.getpid(), sockname, hwm)
+        self._users = 0
+        # 0MQ sockets are not thread-safe, but the objects notify from any thread
+        self._lock = threading.Lock()
+        self._socket = ctx.socket(zmq.PUB)
+        self._socket.linger = 1  # don't keep messages more than 1s after close
+        self._socket.hwm = hwm
+
+        endpoint = getPublisherEndpoint(sockname, hwm)
+        logging.debug("Publishing the updates to %s", endpoint)
+        self._socket.bind(endpoint)
+
+    def send(self, topic, frames):
+        """
+        Sends a message to all the subscribers of the topic
+        topic (str): topic of the object, as returned by getPublisherTopic()
+        frames (list of str or buffers): the content of the message
+        """
+        with self._lock:
+            self._socket.send_multipart([topic] + frames, copy=False)
+
+    def release(self):
+        """
+        Indicates the caller doesn't use the publisher anymore. Once no one uses
+        it, the socket is closed.
+        """
+        with _publishers_lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+            del _publishers[self._key]
+        with self._lock:
+            self._socket.close()
+
+
 # helper functions
 def getContainer(name, validate=True):
     """
@@ -27,6 +27,8 @@ losslessly and with metadata attached (see _metadata for the conventional ones).
 from __future__ import division
 
 import Pyro4
+import bisect
+import cPickle as pickle
 import inspect
 import logging
 import numpy
@@ -37,7 +39,77 @@ import threading
 import time
 import zmq
 
-from . import _core
+from . import _core, _vattributes
+
+
+class _MetadataDict(dict):
+    """
+    Metadata dict of a DataArray, which is shared with the views of the array
+    (see DataArray.metadata) until it is modified.
+    It behaves (and is pickled) as a normal dict.
+    """
+    __slots__ = ("_snapshot",)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        # None or _MetadataSnapshot currently read by the views
+        self._snapshot = None
+
+    def _detach_views(self):
+        """
+        Must be called before any modification: the views get their own copy
+        of the current content
+        """
+        snap = self._snapshot
+        if snap is not None:
+            self._snapshot = None
+            snap.md = dict.copy(self)
+
+    def __setitem__(self, key, value):
+        self._detach_views()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._detach_views()
+        dict.__delitem__(self, key)
+
+    def clear(self):
+        self._detach_views()
+        dict.clear(self)
+
+    def pop(self, *args):
+        self._detach_views()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._detach_views()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self._detach_views()
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self._detach_views()
+        dict.update(self, *args, **kwargs)
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    def __reduce_ex__(self, protocol):
+        return self.__reduce__()
+
+
+class _MetadataSnapshot(object):
+    """
+    Metadata shared by the views of a DataArray. It points to the dict of the
+    original array, until that dict is modified, in which case it gets a copy
+    of the content before modification.
+    """
+    __slots__ = ("md",)
+
+    def __init__(self, md):
+        self.md = md  # dict, which must not be modified via this object
 
 
 class DataArray(numpy.ndarray):
@@ -58,21 +130,65 @@ class DataArray(numpy.ndarray):
         metadata (dict str-> value): a dict of (standard) names to their values
         """
         obj = numpy.asarray(input_array).view(cls)
+        # Own copy, so that modifications can be detected
         if metadata is None:
-            metadata = {}
-        obj.metadata = metadata
+            obj._md = _MetadataDict()
+        else:
+            obj._md = _MetadataDict(metadata)
+        obj._mdsnap = None
         return obj
 
     def __array_finalize__(self, obj):
         if obj is None:
             return
 
-        if hasattr(obj, 'metadata'):
-            # Create a shallow copy of the meta data, otherwise when the array
-            # gets copied, both will use the same meta data dictionary.
-            self.metadata = obj.metadata.copy()
+        # Every view, slice, or result of an operation gets the metadata of the
+        # original array. The content is shared with the original array, and
+        # the view only gets its own dict when its .metadata is accessed (or
+        # the original dict is modified). That avoids copying the metadata for
+        # all the intermediary arrays (eg, when iterating over the elements of
+        # an array).
+        # Note: as with a normal dict, modifying the metadata while another
+        # thread creates a view is not safe.
+        md = getattr(obj, "_md", None)
+        if md is None:
+            snap = getattr(obj, "_mdsnap", None)
+            if snap is not None:  # view of a view
+                self._md = None
+                self._mdsnap = snap
+            elif hasattr(obj, 'metadata'):
+                self._md = _MetadataDict(obj.metadata)
+                self._mdsnap = None
+            else:
+                self._md = _MetadataDict()
+                self._mdsnap = None
+        elif isinstance(md, _MetadataDict):
+            snap = md._snapshot
+            if snap is None:
+                snap = _MetadataSnapshot(md)
+                md._snapshot = snap
+            self._md = None
+            self._mdsnap = snap
         else:
-            self.metadata = {}
+            # Plain dict set by the user, modifications cannot be detected
+            self._md = _MetadataDict(md)
+            self._mdsnap = None
+
+    def _get_metadata(self):
+        md = self._md
+        if md is None:
+            # Get our own copy, so that modifying it doesn't affect the other arrays
+            md = _MetadataDict(self._mdsnap.md)
+            self._md = md
+            self._mdsnap = None
+        return md
+
+    def _set_metadata(self, md):
+        self._md = md
+        self._mdsnap = None
+
+    metadata = property(_get_metadata, _set_metadata, doc=
+                        "dict str-> value: the metadata (MD_*) of the array")
 
     # Used to send the DataArray over Pyro (over ZMQ, we use an optimised way)
     def __reduce__(self):
@@ -85,7 +201,8 @@ class DataArray(numpy.ndarray):
     def __setstate__(self, state):
         nd_state, md = state
         numpy.ndarray.__setstate__(self, nd_state)
-        self.metadata = md
+        self._md = _MetadataDict(md)
+        self._mdsnap = None
 
     # def __array_wrap__(self, out_arr, context=None):
     #     print 'In __array_wrap__:'
@@ -95,6 +212,151 @@ class DataArray(numpy.ndarray):
     #     out_arr.metadata = self.metadata
     #     return numpy.ndarray.__array_wrap__(self, out_arr, context)
 
+class LatencyHistogram(object):
+    """
+    Histogram of durations, with logarithmic bins. It's cheap to update, so
+    that it can be used on each data passed, and the statistics are only
+    computed when requested.
+    Note: it's not thread-safe, but concurrent updates can at worse lose a
+    value, which is fine for statistics.
+    """
+    # Upper bound (in s) of each bin: 4 bins per decade from 1µs to 100s. The
+    # durations longer than the last bound are all counted in an extra bin.
+    BOUNDS = tuple(10 ** (e / 4) for e in range(-24, 9))
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.bins = [0] * (len(self.BOUNDS) + 1)
+
+    def add(self, duration):
+        """
+        duration (float): duration to add (in s)
+        """
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self.bins[bisect.bisect_left(self.BOUNDS, duration)] += 1
+
+    def percentile(self, p):
+        """
+        p (0<=float<=100): the percentile
+        return (float or None): upper bound of the bin containing the
+          percentile (in s, at most the max), or None if no duration was added.
+        """
+        if not self.count:
+            return None
+        n = self.count * p / 100
+        acc = 0
+        for i, c in enumerate(self.bins):
+            acc += c
+            if acc >= n and c:
+                if i < len(self.BOUNDS):
+                    return min(self.BOUNDS[i], self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        """
+        return (dict str -> value): count, mean, median, 95th percentile and
+          max of the durations (in s)
+        """
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count,
+                "mean": self.total / self.count,
+                "median": self.percentile(50),
+                "p95": self.percentile(95),
+                "max": self.max,
+                }
+
+
+class PipelineStatistics(object):
+    """
+    Counters of the data going through one element of the acquisition pipeline
+    (eg, a DataFlow or a Stream), with the latency of each processing stage.
+    The counters are always updated, and only summarized on request, so
+    they cost almost nothing when they are not read.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.received = 0  # number of data received
+        self.dropped = 0  # number of data received, but not passed on
+        self.latencies = {}  # str -> LatencyHistogram
+        self._tfirst = None  # time of the first data received
+        self._tlast = None  # time of the latest data received
+
+    def add(self, stage, duration):
+        """
+        Records the duration of a processing stage
+        stage (str): name of the stage
+        duration (float): duration (in s)
+        """
+        try:
+            self.latencies[stage].add(duration)
+        except KeyError:
+            lh = LatencyHistogram()
+            lh.add(duration)
+            self.latencies[stage] = lh
+
+    def add_age(self, stage, data, t):
+        """
+        Records the age of the data, based on its acquisition date
+        stage (str): name of the stage
+        data (DataArray): the data. If it has no MD_ACQ_DATE, nothing is recorded
+        t (float): the current time
+        """
+        try:
+            date = data.metadata[_metadata.MD_ACQ_DATE]
+        except (AttributeError, KeyError):
+            return
+        self.add(stage, t - date)
+
+    def record(self, data, tstart, tend, stage="processing"):
+        """
+        Records one data received and processed
+        data (DataArray): the data received
+        tstart (float): time the data was received
+        tend (float): time the processing of the data ended
+        stage (str): name of the processing stage
+        """
+        self.received += 1
+        if self._tfirst is None:
+            self._tfirst = tstart
+        self._tlast = tstart
+        self.add_age("age", data, tstart)
+        self.add(stage, tend - tstart)
+
+    def to_dict(self):
+        """
+        return (dict str -> value): the number of data received and dropped, the
+          average rate (in Hz, or None if unknown), and for each stage the
+          summary of its latency (see LatencyHistogram.to_dict())
+        """
+        if self.received > 1 and self._tlast > self._tfirst:
+            rate = (self.received - 1) / (self._tlast - self._tfirst)
+        else:
+            rate = None
+        stats = {"received": self.received,
+                 "dropped": self.dropped,
+                 "rate": rate}
+        for n, lh in self.latencies.items():
+            stats[n] = lh.to_dict()
+        return stats
+
+
+# Minimum time between two notifications of the .statistics of a DataFlow (in s)
+STATS_NOTIFY_PERIOD = 1
+
+
 class DataFlowBase(object):
     """
     This is an abstract class that must be extended by each detector which
@@ -106,6 +368,16 @@ class DataFlowBase(object):
     def __init__(self):
         self._listeners = set()
         self._lock = threading.Lock() # need to be acquired to modify the set
+        # Statistics of the data notified in this process. They are only
+        # recorded when enabled, or when .statistics is subscribed.
+        self.stats = PipelineStatistics()
+        self._stats_enabled = False
+        self._stats_recording = False
+        self._stats_tnotify = 0  # last time .statistics was notified
+        # dict str -> value: see PipelineStatistics.to_dict()
+        self._statsva = _vattributes.VigilantAttribute({}, readonly=True,
+                                                       getter=self._getStatistics)
+        self.statistics = self._statsva
 
     # to be overridden
     # not defined at all so that the proxy version automatically does a remote call
@@ -138,6 +410,29 @@ class DataFlowBase(object):
             if count_before > 0 and count_after == 0:
                 self.stop_generate()
 
+    def enableStatistics(self, enabled=True):
+        """
+        Record the statistics of the data notified in this process, even if
+        .statistics is not subscribed.
+        enabled (bool): True to start recording, False to stop
+        """
+        self._stats_enabled = enabled
+
+    def _getStatistics(self):
+        return self.stats.to_dict()
+
+    def _is_recording_stats(self):
+        """
+        return (bool): True if the statistics should be recorded. When the
+          recording starts, the previous statistics are discarded.
+        """
+        recording = (self._stats_enabled or bool(self._statsva._listeners) or
+                     bool(self._statsva._remote_listeners))
+        if recording and not self._stats_recording:
+            self.stats.reset()
+        self._stats_recording = recording
+        return recording
+
 #    # to be overridden
 #    def synchronizedOn(self, event):
 #        raise NotImplementedError("This DataFlow doesn't support Event synchronization")
@@ -174,6 +469,7 @@ class DataFlowBase(object):
         # Never take the lock here, to avoid the case where stop_generate() waits
         # for one last notify
 
+        tstart = time.time()
         # to allow modify the set while calling
         snapshot_listeners = frozenset(self._listeners)
         for l in snapshot_listeners:
@@ -185,6 +481,14 @@ class DataFlowBase(object):
                 # we cannot abort just because one listener failed
                 logging.exception("Exception when notifying a data_flow")
 
+        if self._is_recording_stats():
+            tend = time.time()
+            self.stats.record(data, tstart, tend)
+            # Update the subscribers of .statistics, but not at every frame
+            if tend - self._stats_tnotify >= STATS_NOTIFY_PERIOD:
+                self._stats_tnotify = tend
+                self._statsva.notify(self.stats.to_dict())
+
 
 # DataFlow object to create on the server (in a component)
 class DataFlow(DataFlowBase):
@@ -200,8 +504,9 @@ class DataFlow(DataFlowBase):
         self._remote_listeners = set() # any unique string works
 
         self._global_name = None # to be filled when registered
-        self._ctx = None
-        self.pipe = None
+        self._topic = None
+        self._pipes = {}  # hwm -> Publisher
+        self.pipe = None  # Publisher currently used
         self._max_discard = max_discard
 
     def _getproxystate(self):
@@ -209,7 +514,8 @@ class DataFlow(DataFlowBase):
         Equivalent to __getstate__() of the proxy version
         """
         proxy_state = Pyro4.core.pyroObjectSerializer(self)[2]
-        return (proxy_state, _core.dump_roattributes(self), self.max_discard)
+        return (proxy_state, _core.dump_roattributes(self), self.max_discard,
+                self.statistics)
 
     @property
     def max_discard(self):
@@ -222,17 +528,16 @@ class DataFlow(DataFlowBase):
 
     def _update_pipe_hwm(self):
         """
-        updates the high water mark option of OMQ pipe according to max_discard
+        selects the publisher with the high water mark corresponding to max_discard
         """
-        if self.pipe is None:
+        if not self._pipes:
             return
         if self._max_discard == 0:
-            # High-water mark
-            self.pipe.hwm = 10000
+            self.pipe = self._pipes[_core.DATAFLOW_NODISCARD_HWM]
         else:
             # allow a bit of delay, but nothing more: if more than 4 already
             # queued, the newest one will be dropped.
-            self.pipe.hwm = 4
+            self.pipe = self._pipes[_core.DATAFLOW_HWM]
             # TODO: in ZMQ v4, ZMQ_CONFLATE allows to have a queue of 1 message
             # containing only the newest message. That sounds closer to what we
             # need (though, currently multi-part messages are not supported).
@@ -247,20 +552,17 @@ class DataFlow(DataFlowBase):
         """
         daemon.register(self)
 
-        # create a zmq pipe to publish the data
-        # Warning: notify() will most likely run in a separate thread, which is
-        # not recommended by 0MQ. At least, we should never access it from this
-        # thread anymore. To be safe, it might need a pub-sub forwarder proxy inproc
-        self._ctx = zmq.Context(1)
-        self.pipe = self._ctx.socket(zmq.PUB)
-        self.pipe.linger = 1 # don't keep messages more than 1s after close
-        self._update_pipe_hwm()
-
         uri = daemon.uriFor(self)
         # uri.sockname is the file name of the pyro daemon (with full path)
         self._global_name = uri.sockname + "@" + uri.object
-        logging.debug("server is registered to send to " + "ipc://" + self._global_name)
-        self.pipe.bind("ipc://" + self._global_name)
+        # The data is published via the 0MQ sockets shared by the whole
+        # container. Both are opened immediately, so that the subscribers are
+        # already connected when max_discard changes.
+        self._topic = _core.getPublisherTopic(uri)
+        for hwm in (_core.DATAFLOW_HWM, _core.DATAFLOW_NODISCARD_HWM):
+            self._pipes[hwm] = _core.getPublisher(uri.sockname, hwm)
+        self._update_pipe_hwm()
+        self.statistics._register(daemon)
 
     def _unregister(self):
         """
@@ -269,15 +571,25 @@ class DataFlow(DataFlowBase):
         daemon = getattr(self, "_pyroDaemon", None)
         if daemon:
             daemon.unregister(self)
-        if self._ctx:
-            self.pipe.close()
-            self.pipe = None
-            self._ctx.term()
-            self._ctx = None
+        self.pipe = None
+        for p in self._pipes.values():
+            p.release()
+        self._pipes = {}
+        self.statistics._unregister()
 
     def _count_listeners(self):
         return len(self._listeners) + len(self._remote_listeners)
 
+    def getStatistics(self):
+        """
+        Note: on a proxy, it's a remote call, so it returns the statistics of
+          the dataflow as seen by the component. They are only recorded while
+          .statistics is subscribed, or after enableStatistics() is called.
+        return (dict str -> value): statistics on the data notified, see
+          PipelineStatistics.to_dict()
+        """
+        return self.stats.to_dict()
+
     def get(self, asap=True):
         """
         Acquires one image and return it
@@ -340,24 +652,27 @@ class DataFlow(DataFlowBase):
 
     def notify(self, data):
         # publish the data remotely
-        if self.pipe and len(self._remote_listeners) > 0:
-            # TODO thread-safe for self.pipe ?
+        pipe = self.pipe  # to be safe if unregistered simultaneously
+        if pipe and len(self._remote_listeners) > 0:
+            tstart = time.time()
             dformat = {"dtype": str(data.dtype), "shape": data.shape}
-            self.pipe.send_pyobj(dformat, zmq.SNDMORE)
-            self.pipe.send_pyobj(data.metadata, zmq.SNDMORE)
             try:
                 if not data.flags["C_CONTIGUOUS"]:
                     # if not in C order, it will be received incorrectly
                     # TODO: if it's just rotated, send the info to reconstruct it
                     # and avoid the memory copy
                     raise TypeError("Need C ordered array")
-                self.pipe.send(numpy.getbuffer(data), copy=False)
+                buf = numpy.getbuffer(data)
             except TypeError:
                 # not all buffers can be sent zero-copy (e.g., has strides)
                 # try harder by copying (which removes the strides)
                 logging.debug("Failed to send data with zero-copy")
-                data = numpy.require(data, requirements=["C_CONTIGUOUS"])
-                self.pipe.send(numpy.getbuffer(data), copy=False)
+                buf = numpy.getbuffer(numpy.require(data, requirements=["C_CONTIGUOUS"]))
+            pipe.send(self._topic, [pickle.dumps(dformat, pickle.HIGHEST_PROTOCOL),
+                                    pickle.dumps(data.metadata, pickle.HIGHEST_PROTOCOL),
+                                    buf])
+            if self._stats_recording:
+                self.stats.add("publish", time.time() - tstart)
 
         # publish locally
         DataFlowBase.notify(self, data)
@@ -382,6 +697,7 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         """
         Pyro4.Proxy.__init__(self, uri)
         self._global_name = uri.sockname + "@" + uri.object
+        self._topic = _core.getPublisherTopic(uri)
         # Should be unique among all the subscribers of the real DataFlow
         self._proxy_name = "%x/%x" % (os.getpid(), id(self))
         DataFlowBase.__init__(self)
@@ -394,22 +710,29 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
     def __getstate__(self):
         # must permit to recreate a proxy to a data-flow in a different container
         proxy_state = Pyro4.Proxy.__getstate__(self)
-        return (proxy_state, _core.dump_roattributes(self), self.max_discard)
+        return (proxy_state, _core.dump_roattributes(self), self.max_discard,
+                self.statistics)
 
     def __setstate__(self, state):
-        proxy_state, roattributes, self.max_discard = state
+        proxy_state, roattributes, self.max_discard, statistics = state
         Pyro4.Proxy.__setstate__(self, proxy_state)
         _core.load_roattributes(self, roattributes)
 
         self._global_name = self._pyroUri.sockname + "@" + self._pyroUri.object
+        self._topic = _core.getPublisherTopic(self._pyroUri)
         self._proxy_name = "%x/%x" % (os.getpid(), id(self))
         DataFlowBase.__init__(self)
+        # The statistics of the dataflow as seen by the component. The ones of
+        # the data received in this process are recorded locally, in .stats,
+        # when enableStatistics() is called.
+        self.statistics = statistics
 
         self._ctx = None
         self._commands = None
         self._thread = None
 
-    # .get() is a direct remote call
+    # .get() and .getStatistics() are direct remote calls
+    # .enableStatistics() only concerns the data received in this process
 
     # next three methods are directly from DataFlowBase
     #.subscribe()
@@ -420,7 +743,12 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         self._ctx = zmq.Context(1) # apparently 0MQ reuse contexts
         self._commands = self._ctx.socket(zmq.PAIR)
         self._commands.bind("inproc://" + self._global_name)
-        self._thread = SubscribeProxyThread(self.notify, self._global_name, self.max_discard, self._ctx)
+        # The data comes from one of the publishers, depending on max_discard
+        endpoints = [_core.getPublisherEndpoint(self._pyroUri.sockname, hwm)
+                     for hwm in (_core.DATAFLOW_HWM, _core.DATAFLOW_NODISCARD_HWM)]
+        self._thread = SubscribeProxyThread(self.notify, self._global_name,
+                                            endpoints, self._topic,
+                                            self.max_discard, self._ctx, self.stats)
         self._thread.start()
 
     def start_generate(self):
@@ -466,18 +794,23 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
 
 
 class SubscribeProxyThread(threading.Thread):
-    def __init__(self, notifier, uri, max_discard, zmq_ctx):
+    def __init__(self, notifier, uri, endpoints, topic, max_discard, zmq_ctx, stats=None):
         """
         notifier (callable): method to call when a new array arrives
         uri (string): unique string to identify the connection
+        endpoints (list of str): 0MQ endpoints of the publishers to connect to
+        topic (str): topic of the messages of the dataflow
         max_discard (int)
         zmq_ctx (0MQ context): available 0MQ context to use
+        stats (PipelineStatistics or None): where to count the discarded arrays
         """
         threading.Thread.__init__(self, name="zmq for dataflow " + uri)
         self.daemon = True
         self.uri = uri
+        self.topic = topic
         self.max_discard = max_discard
         self._ctx = zmq_ctx
+        self._stats = stats
         # don't keep strong reference to notifier so that it can be garbage
         # collected normally and it will let us know then that we can stop
         self.w_notifier = WeakMethod(notifier)
@@ -488,7 +821,8 @@ class SubscribeProxyThread(threading.Thread):
 
         # create a zmq subscription to receive the data
         self._data = zmq_ctx.socket(zmq.SUB)
-        self._data.connect("ipc://" + uri)
+        for ep in endpoints:
+            self._data.connect(ep)
         # TODO find out if it does something and if it does, depend on max_discard
 #        self.data.hwm = 1 # drop message silently if there is already one in the queue
         self._data.hwm = 0  # FIXME currently set to 0 in order to avoid discarding when not wanted
@@ -518,11 +852,11 @@ class SubscribeProxyThread(threading.Thread):
                 if self._commands in socks:
                     message = self._commands.recv()
                     if message == "SUB":
-                        self._data.setsockopt(zmq.SUBSCRIBE, '')
+                        self._data.setsockopt(zmq.SUBSCRIBE, self.topic)
                         logging.debug("Subscribed to remote dataflow %s", self.uri)
                         self._commands.send("SUBD")
                     elif message == "UNSUB":
-                        self._data.setsockopt(zmq.UNSUBSCRIBE, '')
+                        self._data.setsockopt(zmq.UNSUBSCRIBE, self.topic)
                         if logging:
                             logging.debug("Unsubscribed from remote dataflow %s", self.uri)
                         # no confirmation (async)
@@ -535,9 +869,7 @@ class SubscribeProxyThread(threading.Thread):
                 if self._data in socks:
                     # TODO: be more resilient if wrong data is received (can
                     # block forever)
-                    array_format = self._data.recv_pyobj()
-                    array_md = self._data.recv_pyobj()
-                    array_buf = self._data.recv(copy=False)
+                    topic, fmt_msg, md_msg, array_buf = self._data.recv_multipart(copy=False)
                     # logging.debug("Received new DataArray over ZMQ for %s", self.uri)
                     # more fresh data already?
                     if (self._data.getsockopt(zmq.EVENTS) & zmq.POLLIN and
@@ -545,10 +877,12 @@ class SubscribeProxyThread(threading.Thread):
                         discarded += 1
                         # logging.debug("Discarding object received as a newer one is available")
                         continue
-                    # TODO: only log the accumulated number every second, to avoid log flooding
-#                     if discarded:
-#                         logging.debug("Dataflow %s dropped %d arrays", self.uri, discarded)
+                    # Counted instead of logged, to avoid log flooding
+                    if discarded and self._stats is not None:
+                        self._stats.dropped += discarded
                     discarded = 0
+                    array_format = pickle.loads(fmt_msg.bytes)
+                    array_md = pickle.loads(md_msg.bytes)
                     # TODO: any need to use zmq.utils.rebuffer.array_from_buffer()?
                     if len(array_buf):
                         array = numpy.frombuffer(array_buf, dtype=array_format["dtype"])
@@ -62,6 +62,7 @@ MD_DWELL_TIME = "Pixel dwell time" # s (float), time the electron beam spends pe
 MD_EBEAM_VOLTAGE = "Electron beam acceleration voltage" # V (float), voltage used to accelerate the electron beam
 MD_EBEAM_CURRENT = "Electron beam emission current"  # A (float), emission current of the electron beam (typically, the probe current is a bit smaller and the spot diameter is linearly proportional)
 MD_EBEAM_SPOT_DIAM = "Electron beam spot diameter" # m (float), approximate diameter of the electron beam spot (typically function of the current)
+MD_FRAME_ROWS = "Frame rows"  # (int, int, int): first row, last row (excluded), and number of rows of the complete frame, for data which only contains a block of rows of a frame being scanned
 # The following two express the same thing (in different ways), so they should
 # not be used simultaneously.
 MD_WL_POLYNOMIAL = "Wavelength polynomial" # m, m/px, m/px²... (list of float), polynomial to convert from a pixel number of a spectrum to the wavelength
@@ -23,6 +23,7 @@ from __future__ import division
 
 import Pyro4
 from Pyro4.core import oneway
+import cPickle as pickle
 import collections
 import inspect
 import logging
@@ -147,8 +148,8 @@ class VigilantAttribute(VigilantAttributeBase):
         self._remote_listeners = set() # any unique string works
 
         self._global_name = None # to be filled when registered
-        self._ctx = None
-        self.pipe = None
+        self._topic = None
+        self.pipe = None  # Publisher
         self.debug = False  # If True, this VA will print a call stack when its value is set
         self.max_discard = max_discard
 
@@ -245,20 +246,12 @@ class VigilantAttribute(VigilantAttributeBase):
         """
         daemon.register(self)
 
-        # create a zmq pipe to publish the data
-        # Warning: notify() will most likely run in a separate thread, which is
-        # not recommended by 0MQ. At least, we should never access it from this
-        # thread anymore. To be safe, it might need a pub-sub forwarder proxy inproc
-        self._ctx = zmq.Context(1)
-        self.pipe = self._ctx.socket(zmq.PUB)
-        self.pipe.linger = 1 # don't keep messages more than 1s after close
-        # self.pipe.hwm has to be 0 (default), otherwise it drops _new_ values
-
         uri = daemon.uriFor(self)
         # uri.sockname is the file name of the pyro daemon (with full path)
         self._global_name = uri.sockname + "@" + uri.object
-        logging.debug("VA server is registered to send to " + "ipc://" + self._global_name)
-        self.pipe.bind("ipc://" + self._global_name)
+        # The data is published via the 0MQ socket shared by the whole container
+        self._topic = _core.getPublisherTopic(uri)
+        self.pipe = _core.getPublisher(uri.sockname, _core.VA_HWM)
 
     def _unregister(self):
         """
@@ -268,12 +261,9 @@ class VigilantAttribute(VigilantAttributeBase):
         if daemon:
             daemon.unregister(self)
         try:
-            if self.pipe:
-                self.pipe.close()
+            if self.pipe:  # no .pipe if exception during init
+                self.pipe.release()
                 self.pipe = None
-            if self._ctx: # no ._ctx if exception during init
-                self._ctx.term()
-                self._ctx = None
         except Exception:
             pass  # we've done our best
 
@@ -287,7 +277,7 @@ class VigilantAttribute(VigilantAttributeBase):
         if isinstance(listener, basestring):
             self._remote_listeners.add(listener)
             if init:
-                self.pipe.send_pyobj(self.value)
+                self._publish(self.value)
         else:
             VigilantAttributeBase.subscribe(self, listener, init, **kwargs)
 
@@ -310,11 +300,19 @@ class VigilantAttribute(VigilantAttributeBase):
 
         # publish the data remotely
         if len(self._remote_listeners) > 0:
-            self.pipe.send_pyobj(v)
+            self._publish(v)
 
         # publish locally
         VigilantAttributeBase.notify(self, v)
 
+    def _publish(self, v):
+        """
+        Sends the value to the remote listeners
+        """
+        pipe = self.pipe  # to be safe if unregistered simultaneously
+        if pipe:
+            pipe.send(self._topic, [pickle.dumps(v, pickle.HIGHEST_PROTOCOL)])
+
     def __del__(self):
         self._unregister()
 
@@ -329,6 +327,7 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         """
         Pyro4.Proxy.__init__(self, uri)
         self._global_name = uri.sockname + "@" + uri.object
+        self._topic = _core.getPublisherTopic(uri)
         VigilantAttributeBase.__init__(self) # TODO setting value=None might not always be valid
         self.max_discard = 100
         self.readonly = False # will be updated in __setstate__
@@ -390,6 +389,7 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         _core.load_roattributes(self, roattributes)
 
         self._global_name = self._pyroUri.sockname + "@" + self._pyroUri.object
+        self._topic = _core.getPublisherTopic(self._pyroUri)
 
         self._ctx = None
         self._commands = None
@@ -400,7 +400,9 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         self._ctx = zmq.Context(1) # apparently 0MQ reuse contexts
         self._commands = self._ctx.socket(zmq.PAIR)
         self._commands.bind("inproc://" + self._global_name)
-        self._thread = SubscribeProxyThread(self.notify, self._global_name, self.max_discard, self._ctx)
+        endpoint = _core.getPublisherEndpoint(self._pyroUri.sockname, _core.VA_HWM)
+        self._thread = SubscribeProxyThread(self.notify, self._global_name, [endpoint],
+                                            self._topic, self.max_discard, self._ctx)
         self._thread.start()
 
     def subscribe(self, listener, init=False, **kwargs):
@@ -462,16 +464,19 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
 
 
 class SubscribeProxyThread(threading.Thread):
-    def __init__(self, notifier, uri, max_discard, zmq_ctx):
+    def __init__(self, notifier, uri, endpoints, topic, max_discard, zmq_ctx):
         """
         notifier (callable): method to call when a new value arrives
         uri (string): unique string to identify the connection
+        endpoints (list of str): 0MQ endpoints of the publishers to connect to
+        topic (str): topic of the messages of the VA
         max_discard (int)
         zmq_ctx (0MQ context): available 0MQ context to use
         """
         threading.Thread.__init__(self, name="zmq for VA " + uri)
         self.daemon = True
         self.uri = uri
+        self.topic = topic
         self.max_discard = max_discard
         self._ctx = zmq_ctx
         # don't keep strong reference to notifier so that it can be garbage
@@ -484,7 +489,8 @@ class SubscribeProxyThread(threading.Thread):
 
         # create a zmq subscription to receive the data
         self.data = zmq_ctx.socket(zmq.SUB)
-        self.data.connect("ipc://" + uri)
+        for ep in endpoints:
+            self.data.connect(ep)
 
     def run(self):
         # Process messages for commands and data
@@ -499,10 +505,10 @@ class SubscribeProxyThread(threading.Thread):
             if socks.get(self._commands) == zmq.POLLIN:
                 message = self._commands.recv()
                 if message == "SUB":
-                    self.data.setsockopt(zmq.SUBSCRIBE, '')
+                    self.data.setsockopt(zmq.SUBSCRIBE, self.topic)
                     self._commands.send("SUBD")
                 elif message == "UNSUB":
-                    self.data.setsockopt(zmq.UNSUBSCRIBE, '')
+                    self.data.setsockopt(zmq.UNSUBSCRIBE, self.topic)
                     # no confirmation (async)
                 elif message == "STOP":
                     self._commands.close()
@@ -511,7 +517,8 @@ class SubscribeProxyThread(threading.Thread):
 
             # receive data
             if socks.get(self.data) == zmq.POLLIN:
-                value = self.data.recv_pyobj()
+                topic, msg = self.data.recv_multipart()
+                value = pickle.loads(msg)
                 # more fresh data already?
                 if (
                         self.data.getsockopt(zmq.EVENTS) & zmq.POLLIN and
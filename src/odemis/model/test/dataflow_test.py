@@ -24,6 +24,7 @@ from __future__ import division
 from Pyro4.core import oneway
 from odemis import model
 import logging
+import numpy
 import pickle
 import threading
 import time
@@ -160,6 +161,16 @@ class SynchronizableDataFlow(model.DataFlow):
             self._sync_event.subscribe(self)
 
         
+class CopyingMDArray(numpy.ndarray):
+    """
+    Array which copies its metadata for every view (as DataArray used to do)
+    """
+    def __array_finalize__(self, obj):
+        if obj is None:
+            return
+        self.metadata = getattr(obj, "metadata", {}).copy()
+
+
 class TestDataFlow(unittest.TestCase):
     
 #    @unittest.skip("simple")
@@ -171,6 +182,105 @@ class TestDataFlow(unittest.TestCase):
         self.assertEqual(darray.metadata, up_darray.metadata, "metadata is different after pickling")
         self.assertEqual(up_darray.metadata["a"], 1)
 
+    def test_dataarray_metadata(self):
+        """
+        Check the metadata of views is independent from the original array
+        """
+        darray = model.DataArray(numpy.zeros((10, 20)), metadata={"a": 1})
+        view = darray[2:5]
+        self.assertEqual(view.metadata, {"a": 1})
+        view.metadata["a"] = 2
+        self.assertEqual(darray.metadata["a"], 1)
+        self.assertEqual(view.metadata["a"], 2)
+
+        # Modifying the original doesn't affect the views already created
+        view2 = darray[1]
+        res = darray + 1
+        darray.metadata["b"] = 3
+        self.assertEqual(view2.metadata, {"a": 1})
+        self.assertEqual(res.metadata, {"a": 1})
+        view2.metadata["c"] = 4
+        self.assertEqual(darray.metadata, {"a": 1, "b": 3})
+        self.assertEqual(res.metadata, {"a": 1})
+
+        # Replacing the metadata
+        darray.metadata = {"d": 5}
+        view3 = darray[:, 1]
+        self.assertEqual(view3.metadata, {"d": 5})
+        self.assertEqual(view.metadata, {"a": 2})
+
+    def test_dataarray_metadata_isolation(self):
+        """
+        Check a metadata dict already referenced from outside is not shared
+        with the views
+        """
+        # dict obtained before creating the view
+        darray = model.DataArray(numpy.zeros((10, 20)), metadata={"a": 1})
+        md = darray.metadata
+        view = darray[1:]
+        md["x"] = 5
+        self.assertEqual(view.metadata, {"a": 1})
+        self.assertEqual(darray.metadata, {"a": 1, "x": 5})
+
+        # dict passed to the constructor
+        md = {"a": 1}
+        darray = model.DataArray(numpy.zeros((10, 20)), md)
+        view = darray[1:]
+        md["x"] = 5
+        self.assertEqual(darray.metadata, {"a": 1})
+        self.assertEqual(view.metadata, {"a": 1})
+
+        # dict set explicitly
+        md = {"a": 1}
+        darray.metadata = md
+        view = darray[1:]
+        md["x"] = 5
+        self.assertEqual(view.metadata, {"a": 1})
+
+        # view of a view, with the metadata accessed in between
+        view2 = view[1:]
+        md_view = view.metadata
+        view3 = view[2:]
+        md_view["y"] = 6
+        self.assertEqual(view2.metadata, {"a": 1})
+        self.assertEqual(view3.metadata, {"a": 1})
+
+    def test_dataarray_slicing_speed(self):
+        """
+        Check the overhead of the metadata when slicing is lower than copying it
+        """
+        md = dict(("key%d" % i, (i, "value%d" % i)) for i in range(50))
+        darray = model.DataArray(numpy.zeros((50, 200, 10)), metadata=md)
+        # As after a DataFlow, the metadata of the array has been read
+        self.assertEqual(darray.metadata, md)
+        carray = numpy.zeros((50, 200, 10)).view(CopyingMDArray)
+        carray.metadata = md
+
+        # Best of several runs, to limit the effect of the other processes
+        dur_da = dur_copy = float("inf")
+        for r in range(5):
+            tstart = time.time()
+            for i in numpy.ndindex(*darray.shape[:2]):
+                darray[i]
+            dur_da = min(dur_da, time.time() - tstart)
+
+            tstart = time.time()
+            for i in numpy.ndindex(*carray.shape[:2]):
+                carray[i]
+            dur_copy = min(dur_copy, time.time() - tstart)
+
+        print("Slicing took %g s for a DataArray and %g s when copying the metadata" %
+              (dur_da, dur_copy))
+        self.assertLess(dur_da, dur_copy)
+
+        # The slices still get the metadata
+        s1, s2 = darray[0, 0], darray[1, 1]
+        self.assertEqual(s1.metadata, md)
+        self.assertIsNot(s1.metadata, s2.metadata)
+        s1.metadata["key0"] = 1
+        self.assertEqual(darray.metadata, md)
+        self.assertEqual(s2.metadata, md)
+
 #    @unittest.skip("simple")
     def test_df_subscribe_get(self):
         self.df = SimpleDataFlow()
@@ -243,6 +353,64 @@ class TestDataFlow(unittest.TestCase):
             dataflow.unsubscribe(self.receive_data2)
 
 
+    def _acquire_df(self, number):
+        """
+        Receives the given number of images from self.df
+        """
+        self.size = (2, 2)
+        self.left = number
+        self.df.subscribe(self.receive_data)
+
+        for i in range(number):
+            # end early if it's already finished
+            if self.left == 0:
+                break
+            time.sleep(0.2) # 0.2s per image should be more than enough in any case
+        self.assertEqual(self.left, 0)
+
+    def test_df_statistics(self):
+        self.df = SimpleDataFlow()
+        number = 3
+
+        # By default, nothing is recorded
+        self._acquire_df(number)
+        self.assertEqual(self.df.statistics.value["received"], 0)
+
+        self.df.enableStatistics(True)
+        self._acquire_df(number)
+        stats = self.df.statistics.value
+        self.assertEqual(stats, self.df.getStatistics())
+        self.assertEqual(stats["received"], number)
+        self.assertEqual(stats["processing"]["count"], number)
+        self.assertLessEqual(stats["processing"]["median"], stats["processing"]["max"])
+        self.assertAlmostEqual(stats["rate"], 10, delta=3)  # 1 image every 0.1s
+        self.assertNotIn("age", stats)  # No MD_ACQ_DATE
+
+        self.df.stats.reset()
+        self.assertEqual(self.df.statistics.value["received"], 0)
+        self.df.enableStatistics(False)
+
+    def test_df_statistics_subscribe(self):
+        """
+        Check the statistics are recorded, and notified, while subscribed
+        """
+        self.df = SimpleDataFlow()
+        notified = []
+        def on_statistics(stats):
+            notified.append(stats)
+
+        self.df.statistics.subscribe(on_statistics)
+        self._acquire_df(3)
+        self.assertGreaterEqual(len(notified), 1)
+        self.assertEqual(notified[0]["received"], 1)
+        self.assertEqual(self.df.statistics.value["received"], 3)
+
+        # Once unsubscribed, the statistics are not recorded anymore
+        self.df.statistics.unsubscribe(on_statistics)
+        self._acquire_df(3)
+        self.assertEqual(self.df.statistics.value["received"], 3)
+        self.assertEqual(len(notified), 1)  # 1 notification per second max
+
     def test_synchronized_df(self):
         self.dfe = SimpleDataFlow()
         self.dfs = SynchronizableDataFlow()
@@ -295,6 +463,49 @@ class TestDataFlow(unittest.TestCase):
         
         self.assertEqual(self.left, 0)
 
-        
+
+
+class TestPipelineStatistics(unittest.TestCase):
+
+    def test_latency_histogram(self):
+        lh = model.LatencyHistogram()
+        self.assertEqual(lh.to_dict(), {"count": 0})
+        self.assertIsNone(lh.percentile(50))
+
+        for d in (1e-3,) * 90 + (0.1,) * 10:
+            lh.add(d)
+        summ = lh.to_dict()
+        self.assertEqual(summ["count"], 100)
+        self.assertAlmostEqual(summ["mean"], (90e-3 + 1) / 100)
+        self.assertEqual(summ["max"], 0.1)
+        # The percentiles are precise to a bin (ie, 10**(1/4))
+        self.assertGreaterEqual(summ["median"], 1e-3)
+        self.assertLess(summ["median"], 2e-3)
+        self.assertGreaterEqual(summ["p95"], 0.05)
+        self.assertLessEqual(summ["p95"], 0.1)
+
+        # Very long durations
+        lh.add(1000)
+        self.assertEqual(lh.to_dict()["max"], 1000)
+        self.assertEqual(lh.percentile(100), 1000)
+
+    def test_record(self):
+        stats = model.PipelineStatistics()
+        now = 1000.0  # Small number, to keep the precision of the durations
+        for i in range(10):
+            da = model.DataArray([1, 2], {model.MD_ACQ_DATE: now + i * 0.1})
+            stats.record(da, now + i * 0.1 + 0.01, now + i * 0.1 + 0.03)
+        stats.add("projection", 0.005)
+        stats.dropped = 2
+
+        summ = stats.to_dict()
+        self.assertEqual(summ["received"], 10)
+        self.assertEqual(summ["dropped"], 2)
+        self.assertAlmostEqual(summ["rate"], 10)
+        self.assertAlmostEqual(summ["age"]["mean"], 0.01)
+        self.assertAlmostEqual(summ["processing"]["mean"], 0.02)
+        self.assertEqual(summ["projection"]["count"], 1)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -100,6 +100,38 @@ class ContainerTest(unittest.TestCase):
         # we are not terminating the children, but this should be caught by the container
         container.terminate()
 
+    @timeout(20)
+    def test_dataflow_forked(self):
+        """
+        Check a DataFlow of a container forked after the current process has
+        already published data (as the back-end does) is still received.
+        """
+        # Component in a thread of the current process => publishers created here
+        cont = model.createNewContainer("testthread", in_own_process=False)
+        comp = cont.instantiate(MyComponent, {"name": "MyComp"})
+        self.count = 0
+        comp.data.subscribe(self.receive_data)
+        time.sleep(0.3)
+        comp.data.unsubscribe(self.receive_data)
+        self.assertGreater(self.count, 0)
+
+        # Forked after the publishers have been created
+        cont2, comp2 = model.createInNewContainer("testforked", MyComponent, {"name": "MyComp2"})
+        self.count = 0
+        comp2.data.subscribe(self.receive_data)
+        time.sleep(0.5)
+        comp2.data.unsubscribe(self.receive_data)
+        self.assertGreater(self.count, 0)
+
+        comp2.terminate()
+        cont2.terminate()
+        comp.terminate()
+        cont.terminate()
+        time.sleep(0.1)  # give it some time to terminate
+
+    def receive_data(self, dataflow, data):
+        self.count += 1
+
     def test_timeout(self):
         if Pyro4.config.COMMTIMEOUT == 0 or Pyro4.config.COMMTIMEOUT > 20:
             self.skipTest("Timeout too long (%d s) to test." % Pyro4.config.COMMTIMEOUT)
@@ -718,6 +750,38 @@ class RemoteTest(unittest.TestCase):
         self.last_value = value
         self.assertIsInstance(value, (int, float))
 
+#    @unittest.skip("simple")
+    def test_va_multiplexed(self):
+        """
+        Check that the updates of several VAs, sent over the same publisher,
+        only reach the subscribers of the corresponding VA
+        """
+        prop, cont = self.comp.prop, self.comp.cont
+        prop_values, cont_values = [], []
+        def on_prop(v):
+            prop_values.append(v)
+        def on_cont(v):
+            cont_values.append(v)
+
+        prop.subscribe(on_prop)
+        cont.subscribe(on_cont)
+        # While data is also sent
+        self.count = 0
+        self.expected_shape = (2048, 2048)
+        self.comp.data.subscribe(self.receive_data)
+        try:
+            for i in range(1, 5):
+                prop.value = i
+                cont.value = i / 2
+            time.sleep(0.1)  # give time to receive notifications
+        finally:
+            self.comp.data.unsubscribe(self.receive_data)
+            prop.unsubscribe(on_prop)
+            cont.unsubscribe(on_cont)
+
+        self.assertEqual(prop_values, [1, 2, 3, 4])
+        self.assertEqual(cont_values, [0.5, 1, 1.5, 2])
+
 #    @unittest.skip("simple")
     def test_enumerated_va(self):
         # enumerated
@@ -199,6 +199,24 @@ def speedUpPyroConnect(comp):
         t.start()
 
 
+class PartialDataFlow(model.DataFlow):
+    """
+    DataFlow to send the blocks of rows of a frame, as soon as they are
+    acquired. It doesn't start an acquisition by itself: the detector should
+    only send data (with notify()) while its .data is acquiring and .active is
+    True.
+    """
+    def __init__(self):
+        model.DataFlow.__init__(self)
+        self.active = False  # True when there are subscribers
+
+    def start_generate(self):
+        self.active = True
+
+    def stop_generate(self):
+        self.active = False
+
+
 BACKEND_RUNNING = "RUNNING"
 BACKEND_STARTING = "STARTING"
 BACKEND_DEAD = "DEAD"
@@ -270,9 +270,38 @@ def isClipping(data, drange=None):
     return (drange[1] in data)
 
 
+# Number of entries of the LUT used for the gamma correction
+GAMMA_LUT_SIZE = 4096
+_gamma_luts = {}  # (gamma, tint) -> LUT, to avoid recomputing it at every frame
+
+
+def _getGammaLUT(gamma, tint):
+    """
+    Computes the look-up table to convert intensities to RGB with a gamma
+    correction
+    gamma (0<float): power applied to the intensities (normalised 0->1)
+    tint (3-tuple of 0<=int<=255): RGB colour of the maximum intensity
+    return (numpy.ndarray of shape GAMMA_LUT_SIZE x 3 of uint8): the LUT
+    """
+    try:
+        return _gamma_luts[(gamma, tint)]
+    except KeyError:
+        pass
+
+    x = numpy.linspace(0, 1, GAMMA_LUT_SIZE) ** gamma
+    lut = numpy.outer(x, tint) + 0.5
+    lut = lut.astype(numpy.uint8)
+    lut.flags.writeable = False
+
+    if len(_gamma_luts) > 16:  # Typically, there are just a couple of them
+        _gamma_luts.clear()
+    _gamma_luts[(gamma, tint)] = lut
+    return lut
+
+
 # TODO: try to do cumulative histogram value mapping (=histogram equalization)?
 # => might improve the greys, but might be "too" clever
-def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
+def DataArray2RGB(data, irange=None, tint=(255, 255, 255), out=None, gamma=1):
     """
     :param data: (numpy.ndarray of unsigned int) 2D image greyscale (unsigned
         float might work as well)
@@ -283,8 +312,13 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         min must be < max, and must be of the same type as data.dtype.
     :param tint: (3-tuple of 0 < int <256) RGB colour of the final image (each
         pixel is multiplied by the value. Default is white.
+    :param out: (None or numpy.ndarray of shape data.shape + (3,) of uint8)
+        C-contiguous array where to store the result. Passing the same array
+        for each new frame avoids allocating memory each time.
+    :param gamma: (0 < float) power applied to the (normalised) intensities.
+        1 gives a linear mapping, < 1 brightens the dark values, > 1 darkens them.
     :return: (numpy.ndarray of 3*shape of uint8) converted image in RGB with the
-        same dimension
+        same dimension (same as out, if it was provided)
     """
     # TODO: handle signed values
     assert(len(data.shape) == 2) # => 2D with greyscale
@@ -292,6 +326,7 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
     # Discard the DataArray aspect and just get the raw array, to be sure we
     # don't get a DataArray as result of the numpy operations
     data = data.view(numpy.ndarray)
+    tint = tuple(tint)
 
     # fit it to 8 bits and update brightness and contrast at the same time
     if irange is None:
@@ -309,6 +344,37 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         if irange[0] == irange[1]:
             logging.info("Requested RGB conversion with null-range %s", irange)
 
+    # Ensure B&W if there is only one value allowed
+    if irange[0] >= irange[1]:
+        if data.dtype.kind in "iu":
+            idt = numpy.iinfo(data.dtype)
+            if irange[0] > idt.min:
+                irange = (irange[0] - 1, irange[0])
+            else:
+                irange = (irange[0], irange[0] + 1)
+        else:
+            irange = (irange[0] - 1e-9, irange[0])
+
+    if gamma != 1:
+        lut = _getGammaLUT(gamma, tint)
+    else:
+        lut = None
+
+    if img_fast:
+        try:
+            return img_fast.DataArray2RGB(data, irange, tint, out=out, lut=lut)
+        except ValueError as exp:
+            logging.info("Fast conversion cannot run: %s", exp)
+        except Exception:
+            logging.exception("Failed to use the fast conversion")
+
+    if lut is not None:
+        # Slow, but simple: compute the index in the LUT of each pixel
+        b = (GAMMA_LUT_SIZE - 1) / (irange[1] - irange[0])
+        dshift = data.clip(*irange) - irange[0]
+        idx = (dshift * b + 0.5).astype(numpy.uint16)
+        return numpy.take(lut, idx, axis=0, out=out)
+
     if data.dtype == numpy.uint8 and irange[0] == 0 and irange[1] == 255:
         # short-cut when data is already the same type
         # logging.debug("Applying direct range mapping to RGB")
@@ -319,28 +385,9 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         if data.dtype.kind in "iu":
             # no need to clip if irange is the whole possible range
             idt = numpy.iinfo(data.dtype)
-            # Ensure B&W if there is only one value allowed
-            if irange[0] >= irange[1]:
-                if irange[0] > idt.min:
-                    irange = (irange[0] - 1, irange[0])
-                else:
-                    irange = (irange[0], irange[0] + 1)
-
-            if img_fast:
-                try:
-                    # only (currently) supports uint16
-                    return img_fast.DataArray2RGB(data, irange, tint)
-                except ValueError as exp:
-                    logging.info("Fast conversion cannot run: %s", exp)
-                except Exception:
-                    logging.exception("Failed to use the fast conversion")
-
             if irange[0] > idt.min or irange[1] < idt.max:
                 data = data.clip(*irange)
         else: # floats et al. => always clip
-            # Ensure B&W if there is just one value allowed
-            if irange[0] >= irange[1]:
-                irange = (irange[0] - 1e-9, irange[0])
             data = data.clip(*irange)
 
         dshift = data - irange[0]
@@ -359,7 +406,10 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
     # apparently this is as fast (or even a bit better):
 
     # 0 copy (1 malloc)
-    rgb = numpy.empty(data.shape + (3,), dtype=numpy.uint8, order='C')
+    if out is None:
+        rgb = numpy.empty(data.shape + (3,), dtype=numpy.uint8, order='C')
+    else:
+        rgb = out
 
     # Tint (colouration)
     if tint == (255, 255, 255):
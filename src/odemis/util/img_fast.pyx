@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
+# distutils: extra_compile_args = -fopenmp
+# distutils: extra_link_args = -fopenmp
 '''
 Created on 10 Mar 2014
 
 @author: Éric Piel
 
-Copyright © 2014 Éric Piel, Delmic
+Copyright © 2014-2016 Éric Piel, Delmic
 
 This file is part of Odemis.
 
@@ -15,101 +17,191 @@ Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRAN
 You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
 '''
 # Optimised versions of the functions of odemis.util.img
+# The conversion runs in parallel on each row of the image (using OpenMP, if
+# the compiler supports it), and without the GIL, so that the other threads can
+# run at the same time.
 
 from __future__ import division
 import cython
+from cython.parallel cimport prange
 
 # import both numpy and the Cython declarations for numpy
 import numpy
 cimport numpy
 
-# TODO: use fused types to support multiple types (but needs Cython >= 0.20)
-ctypedef numpy.uint16_t uint16_t
+# Note: uses the plain C types, as Cython (0.29) fails to compile const fused
+# memoryviews of the numpy types.
+ctypedef fused data_t:
+    unsigned char  # uint8
+    unsigned short  # uint16
+    unsigned int  # uint32
+    signed char  # int8
+    short  # int16
+    int  # int32
+    float  # float32
+    double  # float64
+
+# The dtypes which the optimised version supports
+SUPPORTED_DTYPES = frozenset(numpy.dtype(t) for t in (
+                             numpy.uint8, numpy.uint16, numpy.uint32,
+                             numpy.int8, numpy.int16, numpy.int32,
+                             numpy.float32, numpy.float64))
+
+# Below this number of pixels, it's faster to not start multiple threads
+MIN_PARALLEL_SIZE = 2 ** 16
+
 
 # nogil allows multi-threading but prevents use of any Python objects or call
 @cython.cdivision(True)
-cdef void cDataArray2RGB(uint16_t* data, int datalen, uint16_t irange0, uint16_t irange1,
-                         int* tint, numpy.uint8_t* ret) nogil:
-    cdef double b = 255. / <double>(irange1 - irange0)
-    cdef double br = (b * <double>tint[0]) / 255.
-    cdef double bg = (b * <double>tint[1]) / 255.
-    cdef double bb = (b * <double>tint[2]) / 255.
-
-    cdef numpy.uint8_t di
+cdef void cRow2RGB(const data_t* data, Py_ssize_t datalen, double irange0, double irange1,
+                   int* tint, const numpy.uint8_t* lut, Py_ssize_t lutlen,
+                   numpy.uint8_t* ret) nogil:
+    """
+    Converts one row of data to RGB
+    lut (NULL or pointer to lutlen*3 uint8): if not NULL, the intensity is mapped
+      linearly to an index of the LUT, and the RGB values are read from it.
+      Otherwise, the intensity is mapped linearly to 0->tint.
+    """
+    cdef double b, br, bg, bb
     cdef double df
-    cdef int retpos = 0
+    cdef numpy.uint8_t di
+    cdef const numpy.uint8_t* lp
+    cdef Py_ssize_t i, li
+    cdef Py_ssize_t retpos = 0
 
-    if tint[0] == tint[1] == tint[2] == 255:
+    # Note: the comparisons are written such as NaNs are mapped to black
+    if lut != NULL:
+        b = <double>(lutlen - 1) / (irange1 - irange0)
+        for i in range(datalen):
+            df = <double>data[i]
+            if not df > irange0:
+                li = 0
+            elif df >= irange1:
+                li = lutlen - 1
+            else:
+                li = <Py_ssize_t> ((df - irange0) * b + 0.5)
+            lp = lut + li * 3
+            ret[retpos] = lp[0]
+            ret[retpos + 1] = lp[1]
+            ret[retpos + 2] = lp[2]
+            retpos += 3
+    elif tint[0] == tint[1] == tint[2] == 255:
         # optimised version, without tinting (about 2x faster)
+        b = 255. / (irange1 - irange0)
         for i in range(datalen):
+            df = <double>data[i]
             # clip
-            if data[i] <= irange0:
+            if not df > irange0:
                 di = 0
-            elif data[i] >= irange1:
+            elif df >= irange1:
                 di = 255
             else:
-                di = <numpy.uint8_t> ((data[i] - irange0) * b + 0.5)
-            ret[retpos] = di
-            retpos += 1
+                di = <numpy.uint8_t> ((df - irange0) * b + 0.5)
             ret[retpos] = di
-            retpos += 1
-            ret[retpos] = di
-            retpos += 1
+            ret[retpos + 1] = di
+            ret[retpos + 2] = di
+            retpos += 3
     else:
+        b = 255. / (irange1 - irange0)
+        br = (b * <double>tint[0]) / 255.
+        bg = (b * <double>tint[1]) / 255.
+        bb = (b * <double>tint[2]) / 255.
         for i in range(datalen):
+            df = <double>data[i]
             # clip
-            if data[i] <= irange0:
-                ret[retpos] = 0
-                retpos += 1
+            if not df > irange0:
                 ret[retpos] = 0
-                retpos += 1
-                ret[retpos] = 0
-                retpos += 1
-            elif data[i] >= irange1:
+                ret[retpos + 1] = 0
+                ret[retpos + 2] = 0
+            elif df >= irange1:
                 ret[retpos] = tint[0]
-                retpos += 1
-                ret[retpos] = tint[1]
-                retpos += 1
-                ret[retpos] = tint[2]
-                retpos += 1
+                ret[retpos + 1] = tint[1]
+                ret[retpos + 2] = tint[2]
             else:
-                df = (data[i] - irange0)
+                df = df - irange0
                 ret[retpos] = <numpy.uint8_t> (df * br + 0.5)
-                retpos += 1
-                ret[retpos] = <numpy.uint8_t> (df * bg + 0.5)
-                retpos += 1
-                ret[retpos] = <numpy.uint8_t> (df * bb + 0.5)
-                retpos += 1
-
-# This function is probably not needed, but I have no idea how to instantiate
-# a numpy array which can be passed as a pointer
+                ret[retpos + 1] = <numpy.uint8_t> (df * bg + 0.5)
+                ret[retpos + 2] = <numpy.uint8_t> (df * bb + 0.5)
+            retpos += 3
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def wrapDataArray2RGB(numpy.ndarray[uint16_t, ndim=2] data not None,
-                  irange,
-                  tint,
-                  numpy.ndarray[numpy.uint8_t, ndim=3] ret not None):
+def wrapDataArray2RGB(const data_t[:, ::1] data,
+                      double irange0, double irange1,
+                      tint,
+                      const numpy.uint8_t[:, ::1] lut,
+                      numpy.uint8_t[:, :, ::1] ret):
     cdef int ctint[3]
     ctint[0] = tint[0]
     ctint[1] = tint[1]
     ctint[2] = tint[2]
-    cDataArray2RGB(&data[0,0], data.size, irange[0], irange[1], ctint, &ret[0,0,0])
-
 
-def DataArray2RGB(data, irange, tint=(255, 255, 255)):
+    cdef const numpy.uint8_t* clut = NULL
+    cdef Py_ssize_t lutlen = 0
+    if lut is not None:
+        clut = &lut[0, 0]
+        lutlen = lut.shape[0]
+
+    cdef Py_ssize_t h = data.shape[0]
+    cdef Py_ssize_t w = data.shape[1]
+    cdef int nthreads = 0  # = as many as possible
+    if h * w < MIN_PARALLEL_SIZE:
+        nthreads = 1
+    cdef Py_ssize_t i
+
+    if h == 0 or w == 0:
+        return
+
+    if nthreads == 1:
+        with nogil:
+            cRow2RGB(&data[0, 0], h * w, irange0, irange1, ctint, clut, lutlen, &ret[0, 0, 0])
+    else:
+        for i in prange(h, nogil=True, schedule="static"):
+            cRow2RGB(&data[i, 0], w, irange0, irange1, ctint, clut, lutlen, &ret[i, 0, 0])
+
+
+def DataArray2RGB(data, irange, tint=(255, 255, 255), out=None, lut=None):
+    """
+    Optimised version of odemis.util.img.DataArray2RGB()
+    data (numpy.ndarray): 2D C-contiguous array of one of the SUPPORTED_DTYPES
+    irange (2 numbers): min/max intensities mapped to black/tint. min < max.
+    tint (3 0<=int<=255): RGB colour of the final image
+    out (None or numpy.ndarray of shape data.shape + (3,) and dtype uint8):
+      C-contiguous array in which the result will be stored. If None, a new
+      array is allocated.
+    lut (None or numpy.ndarray of shape (N, 3) and dtype uint8): if provided,
+      irange is mapped linearly from 0 to N-1, and the RGB values are read from
+      the LUT (and the tint is ignored).
+    return (numpy.ndarray of shape data.shape + (3,) and dtype uint8): the RGB
+      image (same as out, if it was provided)
+    raise ValueError: if the arguments are not supported
+    """
     if not data.flags.c_contiguous:
         raise ValueError("Optimised version only works with C-contiguous arrays")
-    if data.dtype != numpy.uint16:
+    if data.ndim != 2:
+        raise ValueError("Optimised version only works on 2D arrays")
+    if data.dtype not in SUPPORTED_DTYPES:
         # Note: cython automatically detects such errors, but it seems that with
         # ctyhon 0.23, it can leak memory.
-        raise ValueError("Optimised version only works on uint16 (got %s)" % (data.dtype,))
+        raise ValueError("Optimised version doesn't work on %s" % (data.dtype,))
     # Note: we could also make an optimised version for F-contiguous arrays,
     # but it's not clear when it'd be useful. For more complex arrays, it's also
     # probably possible to generate a faster version than numpy, but I don't
     # know how.
-    if irange[0] >= irange[1]:
+    if not irange[0] < irange[1]:
         raise ValueError("irange needs to be a tuple of low/high values")
-    ret = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
-    wrapDataArray2RGB(data, irange, tint, ret)
-    return ret
-
+    if lut is not None:
+        if (lut.dtype != numpy.uint8 or lut.ndim != 2 or lut.shape[1] != 3 or
+            lut.shape[0] < 2 or not lut.flags.c_contiguous):
+            raise ValueError("lut must be a C-contiguous uint8 array of shape N x 3")
+
+    if out is None:
+        out = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
+    elif (out.shape != data.shape + (3,) or out.dtype != numpy.uint8 or
+          not out.flags.c_contiguous):
+        raise ValueError("out must be a C-contiguous uint8 array of shape %s" %
+                         (data.shape + (3,),))
+
+    wrapDataArray2RGB(data.view(numpy.ndarray), irange[0], irange[1], tint, lut, out)
+    return out
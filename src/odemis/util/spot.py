@@ -20,8 +20,6 @@ import logging
 import numpy
 from odemis import model
 from odemis.util import img
-import scipy.signal
-import warnings
 
 
 def _SubtractBackground(data, background=None):
@@ -116,49 +114,122 @@ def SpotIntensity(data, background=None):
     return intens
 
 
-# def FindSubCenterCoordinates(subimages):
-#     """
-#     For each subimage, detects the center of the contained spot.
-#     Finally produces a list with the center coordinates corresponding to each subimage.
-#     subimages (List of model.DataArray): List of 2D arrays containing pixel intensity
-#     returns (list of (float, float)): Coordinates of spot centers
-#     """
-#     return [FindCenterCoordinates(i) for i in subimages]
+# Cache of the grids used by FindCenterCoordinates(), for each image shape
+_radial_grids = {}
+MAX_GRIDS_CACHED = 16
+
+# Maximum number of pixels processed at once by FindStackCenterCoordinates()
+# (to limit the memory usage)
+MAX_STACK_PX = 2 ** 22
+
+
+def _GetRadialGrids(shape):
+    """
+    Computes the coordinates of the points where the gradients are computed
+    (ie, between the pixels), from the center of the image.
+    shape (int, int): shape of the image (Y, X)
+    returns (2D ndarrays of shape (Y-1, X-1)): X and Y coordinates (Y going up)
+    """
+    try:
+        return _radial_grids[shape]
+    except KeyError:
+        pass
+
+    image_x, image_y = shape
+    # See Parthasarathy's paper for details
+    xk_onerow = numpy.arange(-(image_y - 1) / 2 + 0.5, (image_y - 1) / 2, 1)
+    yk_onecol = numpy.arange((image_x - 1) / 2 - 0.5, -(image_x - 1) / 2, -1)
+    xk, yk = numpy.meshgrid(xk_onerow, yk_onecol)
+    # They are shared, so make sure nobody modifies them
+    xk.flags.writeable = False
+    yk.flags.writeable = False
+
+    if len(_radial_grids) >= MAX_GRIDS_CACHED:
+        _radial_grids.clear()
+    _radial_grids[shape] = (xk, yk)
+    return xk, yk
+
+
+def _Mean3x3(data):
+    """
+    Smooths with a 3x3 averaging filter the last two dimensions. It gives the
+    same result as scipy.signal.convolve2d(mode='same', fillvalue=0), but
+    for all the images at once.
+    data (ndarray of floats): the images, with shape (..., Y, X)
+    returns (ndarray of floats): the smoothed images, of same shape
+    """
+    padded = numpy.zeros(data.shape[:-2] + (data.shape[-2] + 2, data.shape[-1] + 2))
+    padded[..., 1:-1, 1:-1] = data
+    # The filter is separable => sum along each dimension separately
+    rows = padded[..., :-2, :] + padded[..., 1:-1, :] + padded[..., 2:, :]
+    out = rows[..., :-2] + rows[..., 1:-1] + rows[..., 2:]
+    out /= 9
+    return out
 
 
 def FindCenterCoordinates(image):
     """
     Detects the center of the contained spot.
     It assumes there is only one spot.
-    subimages (model.DataArray): 2D arrays containing pixel intensity
+    image (model.DataArray): 2D arrays containing pixel intensity
     returns (float, float): Position of the spot center in px (from the center
       of the image), possibly with sub-pixel resolution.
     """
-    # Input might be integer
-    # TODO Dummy, change the way that you handle the array e.g. convolution
-    image = image.astype(numpy.float64)
-    image_x, image_y = image.shape
+    xc, yc = FindStackCenterCoordinates(image[numpy.newaxis])[0]
+    return xc, yc
 
-    # See Parthasarathy's paper for details
-    xk_onerow = numpy.arange(-(image_y - 1) / 2 + 0.5, (image_y - 1) / 2, 1)
-    (xk_onerow_x,) = xk_onerow.shape
-    xk = numpy.tile(xk_onerow, image_x - 1)
-    xk = xk.reshape((image_x - 1, xk_onerow_x))
-    yk_onecol = numpy.arange((image_x - 1) / 2 - 0.5, -(image_x - 1) / 2, -1)
-    (yk_onecol_x,) = yk_onecol.shape
-    yk_onecol = yk_onecol.reshape((yk_onecol_x, 1))
-    yk = numpy.tile(yk_onecol, image_y - 1)
 
-    dIdu = image[0:image_x - 1, 1:image_y] - image[1:image_x, 0:image_y - 1]
-    dIdv = image[0:image_x - 1, 0:image_y - 1] - image[1:image_x, 1:image_y]
+def FindSubCenterCoordinates(subimages):
+    """
+    For each subimage, detects the center of the contained spot.
+    The subimages of same shape are processed together, so it's much faster
+    than calling FindCenterCoordinates() on each of them.
+    subimages (list of 2D arrays): each image contains one spot
+    returns (list of (float, float)): Position of each spot center in px (from
+      the center of its subimage)
+    """
+    # Group the subimages by shape
+    groups = {}  # shape -> list of indices
+    for i, im in enumerate(subimages):
+        groups.setdefault(im.shape, []).append(i)
+
+    centers = [None] * len(subimages)
+    for idxs in groups.values():
+        stack = numpy.array([subimages[i] for i in idxs], dtype=numpy.float64)
+        for i, c in zip(idxs, FindStackCenterCoordinates(stack)):
+            centers[i] = tuple(c)
+
+    return centers
+
+
+def FindStackCenterCoordinates(images):
+    """
+    Detects the center of the spot contained in each image, using the
+    radial-symmetry method (cf Parthasarathy, Nature Methods 9, 2012).
+    It assumes there is only one spot per image.
+    images (3D array of shape (N, Y, X)): N images of the same shape
+    returns (ndarray of shape (N, 2)): Position of each spot center in px
+      (from the center of the image), possibly with sub-pixel resolution.
+      If an image is flat, its position is (0, 0).
+    """
+    images = numpy.asarray(images)
+    n = images.shape[0]
+    # Process the images by chunks, to limit the memory usage
+    chunk = max(1, MAX_STACK_PX // max(1, images[0].size))
+    if n > chunk:
+        return numpy.concatenate([FindStackCenterCoordinates(images[i:i + chunk])
+                                  for i in range(0, n, chunk)])
+
+    # Input might be integer
+    images = images.astype(numpy.float64)
+    xk, yk = _GetRadialGrids(images.shape[1:])
+
+    dIdu = images[:, :-1, 1:] - images[:, 1:, :-1]
+    dIdv = images[:, :-1, :-1] - images[:, 1:, 1:]
 
     # Smoothing
-    h = numpy.tile(numpy.ones(3) / 9, 3).reshape(3, 3)  # simple 3x3 averaging filter
-    # TODO: explain why it's ok to catch these warnings
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", numpy.ComplexWarning)
-        dIdu = scipy.signal.convolve2d(dIdu, h, mode='same', fillvalue=0)
-        dIdv = scipy.signal.convolve2d(dIdv, h, mode='same', fillvalue=0)
+    dIdu = _Mean3x3(dIdu)
+    dIdv = _Mean3x3(dIdv)
 
     # Calculate intensity gradient in xy coordinate system
     dIdx = dIdu - dIdv
@@ -171,41 +242,46 @@ def FindCenterCoordinates(image):
     # Normalize such that a^2 + b^2 = 1
     I2 = numpy.hypot(a, b)
     s = (I2 != 0)
-    a[s] = a[s] / I2[s]
-    b[s] = b[s] / I2[s]
+    a[s] /= I2[s]
+    b[s] /= I2[s]
 
     # Solve for c
     c = -a * xk - b * yk
 
     # Weighting: weight by square of gradient magnitude and inverse distance to gradient intensity centroid.
     dI2 = dIdu * dIdu + dIdv * dIdv
-    sdI2 = numpy.sum(dI2[:])
-    if sdI2 == 0:
+    sdI2 = dI2.sum(axis=(1, 2))
+    flat = (sdI2 == 0)
+    if flat.any():
         # We could raise LookupError, but the caller would probably end-up doing
         # the same thing, and technically, center could be anywhere.
-        logging.debug("Cannot get the center on a flat image")
-        return (0, 0)  # Just pretend to be at the center
-    x0 = numpy.sum(dI2 * xk) / sdI2
-    y0 = numpy.sum(dI2 * yk) / sdI2
-    w = dI2 / (0.05 + numpy.sqrt((xk - x0) * (xk - x0) + (yk - y0) * (yk - y0)))
+        logging.debug("Cannot get the center on %d flat images", numpy.count_nonzero(flat))
+        sdI2[flat] = 1  # Just to avoid dividing by 0
+    x0 = (dI2 * xk).sum(axis=(1, 2)) / sdI2
+    y0 = (dI2 * yk).sum(axis=(1, 2)) / sdI2
+    w = dI2 / (0.05 + numpy.hypot(xk - x0[:, numpy.newaxis, numpy.newaxis],
+                                  yk - y0[:, numpy.newaxis, numpy.newaxis]))
 
     # Make the edges zero, because of the filter
-    w[0, :] = 0
-    w[w.shape[0] - 1, :] = 0
-    w[:, 0] = 0
-    w[:, w.shape[1] - 1] = 0
+    w[:, 0, :] = 0
+    w[:, -1, :] = 0
+    w[:, :, 0] = 0
+    w[:, :, -1] = 0
 
     # Find radial center
-    swa2 = numpy.sum(w * a * a)
-    swab = numpy.sum(w * a * b)
-    swb2 = numpy.sum(w * b * b)
-    swac = numpy.sum(w * a * c)
-    swbc = numpy.sum(w * b * c)
+    wa = w * a
+    wb = w * b
+    swa2 = (wa * a).sum(axis=(1, 2))
+    swab = (wa * b).sum(axis=(1, 2))
+    swb2 = (wb * b).sum(axis=(1, 2))
+    swac = (wa * c).sum(axis=(1, 2))
+    swbc = (wb * c).sum(axis=(1, 2))
     det = swa2 * swb2 - swab * swab
-    xc = (swab * swbc - swb2 * swac) / det
-    yc = (swab * swac - swa2 * swbc) / det
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        xc = (swab * swbc - swb2 * swac) / det
+        yc = (swab * swac - swa2 * swbc) / det
 
     # Output relative to upper left coordinate
-    xc = xc  # + 1 / 2
-    yc = -yc  # + 1 / 2
-    return (xc, yc)
+    centers = numpy.column_stack((xc, -yc))
+    centers[flat] = 0  # Just pretend to be at the center
+    return centers
@@ -434,6 +434,71 @@ class TestDataArray2RGB(unittest.TestCase):
         numpy.testing.assert_almost_equal(rgb, rgb_nc_back, decimal=0)
         numpy.testing.assert_equal(rgb, rgb_nc_back)
 
+    def test_fast_dtypes(self):
+        """Compare the fast conversion with the numpy one, on all the types"""
+        if img.img_fast is None:
+            self.skipTest("Optimised functions not available")
+
+        shape = (2048, 2048)
+        irange = (10, 90)
+        tint = (0, 73, 255)
+        for dtype in ("uint8", "uint16", "uint32", "int8", "int16", "int32",
+                      "float32", "float64"):
+            data = (numpy.random.random(shape) * 100).astype(dtype)
+            tstart = time.time()
+            rgb = img.DataArray2RGB(data, irange, tint)
+            fast_dur = time.time() - tstart
+
+            img_fast = img.img_fast
+            img.img_fast = None  # Force the numpy version
+            try:
+                tstart = time.time()
+                rgb_std = img.DataArray2RGB(data, irange, tint)
+                std_dur = time.time() - tstart
+            finally:
+                img.img_fast = img_fast
+
+            print("Time for %s fast conversion = %g s, standard = %g s" %
+                  (dtype, fast_dur, std_dur))
+            # The numpy version rounds slightly differently
+            diff = numpy.abs(rgb.astype(numpy.int16) - rgb_std)
+            self.assertLessEqual(diff.max(), 1, "Conversion of %s differs" % (dtype,))
+
+    def test_out(self):
+        """Test passing the output array"""
+        data = numpy.zeros((251, 200), dtype="uint16")
+        data[:, :] = range(200)
+        out = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
+        rgb = img.DataArray2RGB(data, (0, 199), out=out)
+        self.assertIs(rgb, out)
+        numpy.testing.assert_equal(rgb[0, -1], [255, 255, 255])
+        numpy.testing.assert_equal(rgb[0, 0], [0, 0, 0])
+
+        # Also on the numpy version
+        data_nc = data.swapaxes(0, 1)
+        out_nc = numpy.empty(data_nc.shape + (3,), dtype=numpy.uint8)
+        rgb_nc = img.DataArray2RGB(data_nc, (0, 199), out=out_nc)
+        self.assertIs(rgb_nc, out_nc)
+        numpy.testing.assert_equal(rgb_nc[-1, 0], [255, 255, 255])
+
+    def test_gamma(self):
+        """Test the gamma correction"""
+        data = numpy.array([[0, 25, 50, 100, 150]], dtype="uint16")
+        tint = (255, 0, 128)
+        rgb = img.DataArray2RGB(data, (0, 100), tint, gamma=0.5)
+        numpy.testing.assert_equal(rgb[0, :, 0], [0, 128, 180, 255, 255])
+        numpy.testing.assert_equal(rgb[0, :, 1], [0, 0, 0, 0, 0])
+        numpy.testing.assert_equal(rgb[0, -1], tint)
+
+        # Same result with the numpy version
+        data_nc = numpy.repeat(data, 2, axis=1)[:, ::2]  # non-contiguous
+        rgb_nc = img.DataArray2RGB(data_nc, (0, 100), tint, gamma=0.5)
+        numpy.testing.assert_equal(rgb, rgb_nc)
+
+        # gamma > 1 => darker
+        rgb_dark = img.DataArray2RGB(data, (0, 100), gamma=2)
+        self.assertTrue(numpy.all(rgb_dark[0, 1:3, 0] < rgb[0, 1:3, 0]))
+
     def test_tint(self):
         """test with tint (on the fast path)"""
         size = (1024, 1024)
@@ -459,7 +524,7 @@ class TestDataArray2RGB(unittest.TestCase):
         self.assertTrue(numpy.all(pixelg <= pixel1))
 
     def test_tint_int16(self):
-        """test with tint, with the slow path"""
+        """test with tint, on signed data"""
         size = (1024, 1024)
         depth = 4096
         grey_img = numpy.zeros(size, dtype="int16") + depth // 2
@@ -16,12 +16,14 @@ You should have received a copy of the GNU General Public License along with Ode
 '''
 from __future__ import division
 
+import logging
 import math
 import numpy
 from odemis import model
 from odemis.dataio import tiff, hdf5
 from odemis.util import spot
 import os
+import time
 import unittest
 
 
@@ -159,6 +161,54 @@ class TestFindCenterCoordinates(unittest.TestCase):
             spot_coordinates = spot.FindCenterCoordinates(data)
             numpy.testing.assert_almost_equal(spot_coordinates, ofs, 3)
 
+
+class TestFindStackCenterCoordinates(unittest.TestCase):
+    """
+    Test FindStackCenterCoordinates() and FindSubCenterCoordinates()
+    """
+    def setUp(self):
+        # A grid of 20x20 gaussian spots, with a random sub-pixel shift
+        numpy.random.seed(0)
+        n, sz = 400, 21
+        self.offsets = numpy.random.uniform(-2, 2, (n, 2))
+        yy, xx = numpy.mgrid[0:sz, 0:sz]
+        c = (sz - 1) / 2
+        imgs = numpy.empty((n, sz, sz), dtype=numpy.uint16)
+        for i, (ox, oy) in enumerate(self.offsets):
+            spt = 1000 * numpy.exp(-((xx - c - ox) ** 2 + (yy - c - oy) ** 2) / (2 * 2 ** 2))
+            imgs[i] = spt + numpy.random.normal(100, 3, (sz, sz))
+        self.images = imgs
+
+    def test_accuracy(self):
+        coords = spot.FindStackCenterCoordinates(self.images)
+        self.assertEqual(coords.shape, (len(self.images), 2))
+        numpy.testing.assert_allclose(coords, self.offsets, atol=0.1)
+
+    def test_same_as_single(self):
+        tstart = time.time()
+        single = [spot.FindCenterCoordinates(im) for im in self.images]
+        dur_single = time.time() - tstart
+
+        tstart = time.time()
+        stack = spot.FindStackCenterCoordinates(self.images)
+        dur_stack = time.time() - tstart
+        logging.info("Found %d spots in %g s one by one, and in %g s as a stack",
+                     len(self.images), dur_single, dur_stack)
+
+        numpy.testing.assert_almost_equal(stack, single, 6)
+        self.assertLess(dur_stack, dur_single)
+
+    def test_sub_mixed_shapes(self):
+        subimages = [self.images[0], self.images[1][1:, 2:], self.images[2],
+                     numpy.zeros((5, 5), dtype=numpy.uint16), self.images[3][:-3, :]]
+        coords = spot.FindSubCenterCoordinates(subimages)
+        self.assertEqual(len(coords), len(subimages))
+        for im, c in zip(subimages, coords):
+            numpy.testing.assert_almost_equal(c, spot.FindCenterCoordinates(im), 6)
+        self.assertEqual(coords[3], (0, 0))
+        self.assertEqual(spot.FindSubCenterCoordinates([]), [])
+
+
 if __name__ == "__main__":
     unittest.main()
 